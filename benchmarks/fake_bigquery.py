@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""In-process fake of the BigQuery v2 REST API, for benchmarking Telescope.
+
+The fake implements jobs.insert, jobs.get, jobs.cancel, jobs.getQueryResults
+and tabledata.list. Jobs move from PENDING to RUNNING to DONE after configurable
+delays, and their results are synthetic NDT rows with the columns named in
+the query's SELECT clause. Responses can be delayed, paginated and made to
+fail at configurable rates, and some jobs can be made to straggle.
+"""
+
+import BaseHTTPServer
+import json
+import random
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+
+import httplib2
+from apiclient.discovery import build_from_document
+
+# Timestamp of the first synthetic row of every job: 2014-01-01 00:00:00 UTC.
+_FIRST_ROW_TIMESTAMP = 1388534400
+
+# Bytes that each synthetic row is reported to have processed.
+_BYTES_PER_ROW = 100
+
+_JOB_PATH = re.compile(r'^/bigquery/v2/projects/([^/]+)/jobs(?:/([^/]+))?$')
+_JOB_CANCEL_PATH = re.compile(
+    r'^/bigquery/v2/projects/([^/]+)/jobs/([^/]+)/cancel$')
+_QUERY_RESULTS_PATH = re.compile(
+    r'^/bigquery/v2/projects/([^/]+)/queries/([^/]+)$')
+_TABLE_DATA_PATH = re.compile(
+    r'^/bigquery/v2/projects/([^/]+)/datasets/([^/]+)/tables/([^/]+)/data$')
+_COLUMN_ALIAS = re.compile(r'\bAS\s+(\w+)')
+
+
+def create_discovery_document(root_url):
+    """Creates a discovery document for the subset of BigQuery that is faked.
+
+    Args:
+        root_url: (str) Root URL of the fake server, ending with a slash.
+
+    Returns:
+        (dict) Discovery document that can be passed to build_from_document.
+    """
+    project_parameter = {'type': 'string', 'required': True, 'location': 'path'}
+    page_parameters = {
+        'maxResults': {'type': 'integer',
+                       'location': 'query'},
+        'pageToken': {'type': 'string',
+                      'location': 'query'},
+        'startIndex': {'type': 'string',
+                       'location': 'query'}
+    }
+    query_results_parameters = {'timeoutMs': {'type': 'integer',
+                                              'location': 'query'}}
+    query_results_parameters.update(page_parameters)
+    query_results_parameters.update({'projectId': project_parameter,
+                                     'jobId': project_parameter})
+    table_data_parameters = {'projectId': project_parameter,
+                             'datasetId': project_parameter,
+                             'tableId': project_parameter}
+    table_data_parameters.update(page_parameters)
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'bigquery:v2',
+        'name': 'bigquery',
+        'version': 'v2',
+        'protocol': 'rest',
+        'rootUrl': root_url,
+        'servicePath': 'bigquery/v2/',
+        'parameters': {},
+        'schemas': {
+            'Job': {'id': 'Job',
+                    'type': 'object'},
+            'JobCancelResponse': {'id': 'JobCancelResponse',
+                                  'type': 'object'},
+            'GetQueryResultsResponse': {'id': 'GetQueryResultsResponse',
+                                        'type': 'object'},
+            'TableDataList': {'id': 'TableDataList',
+                              'type': 'object'}
+        },
+        'resources': {
+            'jobs': {
+                'methods': {
+                    'insert': {
+                        'id': 'bigquery.jobs.insert',
+                        'path': 'projects/{projectId}/jobs',
+                        'httpMethod': 'POST',
+                        'parameters': {'projectId': project_parameter},
+                        'parameterOrder': ['projectId'],
+                        'request': {'$ref': 'Job'},
+                        'response': {'$ref': 'Job'}
+                    },
+                    'get': {
+                        'id': 'bigquery.jobs.get',
+                        'path': 'projects/{projectId}/jobs/{jobId}',
+                        'httpMethod': 'GET',
+                        'parameters': {'projectId': project_parameter,
+                                       'jobId': project_parameter},
+                        'parameterOrder': ['projectId', 'jobId'],
+                        'response': {'$ref': 'Job'}
+                    },
+                    'cancel': {
+                        'id': 'bigquery.jobs.cancel',
+                        'path': 'projects/{projectId}/jobs/{jobId}/cancel',
+                        'httpMethod': 'POST',
+                        'parameters': {'projectId': project_parameter,
+                                       'jobId': project_parameter},
+                        'parameterOrder': ['projectId', 'jobId'],
+                        'response': {'$ref': 'JobCancelResponse'}
+                    },
+                    'getQueryResults': {
+                        'id': 'bigquery.jobs.getQueryResults',
+                        'path': 'projects/{projectId}/queries/{jobId}',
+                        'httpMethod': 'GET',
+                        'parameters': query_results_parameters,
+                        'parameterOrder': ['projectId', 'jobId'],
+                        'response': {'$ref': 'GetQueryResultsResponse'}
+                    }
+                }
+            },
+            'tabledata': {
+                'methods': {
+                    'list': {
+                        'id': 'bigquery.tabledata.list',
+                        'path': ('projects/{projectId}/datasets/{datasetId}/'
+                                 'tables/{tableId}/data'),
+                        'httpMethod': 'GET',
+                        'parameters': table_data_parameters,
+                        'parameterOrder': ['projectId', 'datasetId', 'tableId'],
+                        'response': {'$ref': 'TableDataList'}
+                    }
+                }
+            }
+        }
+    }
+
+
+class _FakeJob(object):
+
+    def __init__(self, project_id, job_id, query, priority, created, row_count,
+                 will_fail, extra_seconds):
+        self.project_id = project_id
+        self.job_id = job_id
+        self.query = query
+        self.priority = priority
+        self.created = created
+        self.row_count = row_count
+        self.will_fail = will_fail
+        self.extra_seconds = extra_seconds
+        self.cancelled = False
+        self.fields = _COLUMN_ALIAS.findall(query) or ['timestamp', 'value']
+
+
+class FakeBigQueryServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server that behaves like a small part of BigQuery."""
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self,
+                 port=0,
+                 pending_seconds=0.0,
+                 running_seconds=0.0,
+                 request_latency=0.0,
+                 rows_per_job=1000,
+                 page_size=100000,
+                 error_rate=0.0,
+                 job_failure_rate=0.0,
+                 straggler_rate=0.0,
+                 straggler_seconds=0.0,
+                 batch_pending_seconds=0.0,
+                 seed=0):
+        """Creates a fake BigQuery server listening on localhost.
+
+        Args:
+            port: (int) Port on which to listen, or 0 for any free port.
+            pending_seconds: (float) Time each job spends PENDING.
+            running_seconds: (float) Time each job spends RUNNING.
+            request_latency: (float) Delay before responding to each request.
+            rows_per_job: (int) Number of result rows of each job.
+            page_size: (int) Maximum number of rows in each page of results,
+                regardless of the maxResults that the client requests.
+            error_rate: (float) Fraction of requests that fail with a 503
+                error, which clients are expected to retry.
+            job_failure_rate: (float) Fraction of jobs whose results request
+                fails with a 400 error, as if the query were invalid.
+            straggler_rate: (float) Fraction of jobs that straggle.
+            straggler_seconds: (float) Additional time each straggling job
+                spends RUNNING.
+            batch_pending_seconds: (float) Additional time each BATCH priority
+                job spends PENDING.
+            seed: (int) Seed of the random choices of injected errors.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', port),
+                                           _FakeBigQueryRequestHandler)
+        self.pending_seconds = pending_seconds
+        self.running_seconds = running_seconds
+        self.request_latency = request_latency
+        self.rows_per_job = rows_per_job
+        self.page_size = page_size
+        self.error_rate = error_rate
+        self.job_failure_rate = job_failure_rate
+        self.straggler_rate = straggler_rate
+        self.straggler_seconds = straggler_seconds
+        self.batch_pending_seconds = batch_pending_seconds
+        self.request_counts = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._next_job_number = 0
+        self._thread = None
+
+    @property
+    def root_url(self):
+        return 'http://localhost:%d/' % self.server_address[1]
+
+    def start(self):
+        """Serves requests from a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def create_service(self):
+        """Creates a BigQuery service object whose requests go to this server.
+
+        Returns:
+            A BigQuery service, as returned by apiclient.discovery.build, with
+            its own HTTP connection.
+        """
+        return build_from_document(
+            create_discovery_document(self.root_url),
+            http=httplib2.Http())
+
+    def count_request(self, method_name):
+        with self._lock:
+            self.request_counts[method_name] = (
+                self.request_counts.get(method_name, 0) + 1)
+
+    def should_inject_error(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def insert_job(self, project_id, query, priority='INTERACTIVE'):
+        with self._lock:
+            self._next_job_number += 1
+            job_id = 'job_%d' % self._next_job_number
+            will_fail = self._random.random() < self.job_failure_rate
+            extra_seconds = (self.straggler_seconds
+                             if self._random.random() < self.straggler_rate else
+                             0.0)
+            job = _FakeJob(project_id, job_id, query, priority, time.time(),
+                           self.rows_per_job, will_fail, extra_seconds)
+            self._jobs[job_id] = job
+        return job
+
+    def get_job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel_job(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.cancelled = True
+            return job
+
+    def get_job_state(self, job):
+        if job.cancelled:
+            return 'DONE'
+        elapsed = time.time() - job.created
+        pending_seconds = self.pending_seconds
+        if job.priority == 'BATCH':
+            pending_seconds += self.batch_pending_seconds
+        if elapsed < pending_seconds:
+            return 'PENDING'
+        elif elapsed < (
+                pending_seconds + self.running_seconds + job.extra_seconds):
+            return 'RUNNING'
+        return 'DONE'
+
+
+class _FakeBigQueryRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        self._handle_request('POST')
+
+    def do_GET(self):
+        self._handle_request('GET')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle_request(self, http_method):
+        if self.server.request_latency:
+            time.sleep(self.server.request_latency)
+        parsed_url = urlparse.urlparse(self.path)
+        query_parameters = dict(urlparse.parse_qsl(parsed_url.query))
+
+        job_match = _JOB_PATH.match(parsed_url.path)
+        job_cancel_match = _JOB_CANCEL_PATH.match(parsed_url.path)
+        query_results_match = _QUERY_RESULTS_PATH.match(parsed_url.path)
+        table_data_match = _TABLE_DATA_PATH.match(parsed_url.path)
+        if job_match and http_method == 'POST' and not job_match.group(2):
+            method_name = 'jobs.insert'
+        elif job_match and http_method == 'GET' and job_match.group(2):
+            method_name = 'jobs.get'
+        elif job_cancel_match and http_method == 'POST':
+            method_name = 'jobs.cancel'
+        elif query_results_match and http_method == 'GET':
+            method_name = 'jobs.getQueryResults'
+        elif table_data_match and http_method == 'GET':
+            method_name = 'tabledata.list'
+        else:
+            self._send_error(404, 'Not found: %s' % parsed_url.path)
+            return
+
+        self.server.count_request(method_name)
+        if self.server.should_inject_error():
+            self._send_error(503, 'Injected backend error.')
+            return
+
+        if method_name == 'jobs.insert':
+            self._insert_job(job_match.group(1))
+        elif method_name == 'jobs.get':
+            self._get_job(job_match.group(2))
+        elif method_name == 'jobs.cancel':
+            self._cancel_job(job_cancel_match.group(2))
+        elif method_name == 'jobs.getQueryResults':
+            self._get_rows(
+                query_results_match.group(2),
+                query_parameters,
+                include_schema=True)
+        else:
+            self._get_rows(
+                table_data_match.group(3).replace('anon_', '', 1),
+                query_parameters,
+                include_schema=False)
+
+    def _insert_job(self, project_id):
+        content_length = int(self.headers.getheader('content-length', 0))
+        job_definition = json.loads(self.rfile.read(content_length))
+        query_configuration = job_definition['configuration']['query']
+        if job_definition['configuration'].get('dryRun'):
+            bytes_processed = str(self.server.rows_per_job * _BYTES_PER_ROW)
+            self._send_json({
+                'kind': 'bigquery#job',
+                'status': {'state': 'DONE'},
+                'statistics': {'totalBytesProcessed': bytes_processed,
+                               'query': {'totalBytesProcessed':
+                                         bytes_processed}}
+            })
+            return
+        job = self.server.insert_job(project_id, query_configuration['query'],
+                                     query_configuration.get('priority',
+                                                             'INTERACTIVE'))
+        self._send_json(self._describe_job(job, 'PENDING'))
+
+    def _get_job(self, job_id):
+        job = self.server.get_job(job_id)
+        if job is None:
+            self._send_error(404, 'Not found: Job %s' % job_id)
+            return
+        self._send_json(self._describe_job(job, self.server.get_job_state(job)))
+
+    def _cancel_job(self, job_id):
+        job = self.server.cancel_job(job_id)
+        if job is None:
+            self._send_error(404, 'Not found: Job %s' % job_id)
+            return
+        self._send_json({'kind': 'bigquery#jobCancelResponse',
+                         'job': self._describe_job(job, 'DONE')})
+
+    def _get_rows(self, job_id, query_parameters, include_schema):
+        job = self.server.get_job(job_id)
+        if job is None:
+            self._send_error(404, 'Not found: Job %s' % job_id)
+            return
+        if self.server.get_job_state(job) != 'DONE':
+            self._send_json({'jobComplete': False,
+                             'jobReference': self._job_reference(job)})
+            return
+        if job.cancelled:
+            self._send_error(400, 'Job %s was cancelled.' % job_id)
+            return
+        if job.will_fail:
+            self._send_error(400, 'Injected invalid query.')
+            return
+
+        start_index = int(query_parameters.get(
+            'pageToken', query_parameters.get('startIndex', 0)))
+        page_size = min(
+            int(query_parameters.get('maxResults', self.server.page_size)),
+            self.server.page_size)
+        end_index = min(start_index + page_size, job.row_count)
+        response = {
+            'totalRows': str(job.row_count),
+            'rows': [_create_row(job, row_index)
+                     for row_index in xrange(start_index, end_index)]
+        }
+        if end_index < job.row_count:
+            response['pageToken'] = str(end_index)
+        if include_schema:
+            response['jobComplete'] = True
+            response['jobReference'] = self._job_reference(job)
+            response['schema'] = {
+                'fields': [{'name': field,
+                            'type': 'FLOAT'} for field in job.fields]
+            }
+        self._send_json(response)
+
+    def _job_reference(self, job):
+        return {'projectId': job.project_id, 'jobId': job.job_id}
+
+    def _describe_job(self, job, state):
+        status = {'state': state}
+        if state == 'DONE' and job.cancelled:
+            status['errorResult'] = {'reason': 'stopped',
+                                     'message': 'Job execution was cancelled.'}
+        elif state == 'DONE' and job.will_fail:
+            status['errorResult'] = {'reason': 'invalidQuery',
+                                     'message': 'Injected invalid query.'}
+        job_resource = {
+            'kind': 'bigquery#job',
+            'jobReference': self._job_reference(job),
+            'configuration': {
+                'query': {
+                    'query': job.query,
+                    'destinationTable': {
+                        'projectId': job.project_id,
+                        'datasetId': '_fake_results',
+                        'tableId': 'anon_%s' % job.job_id
+                    }
+                }
+            },
+            'status': status
+        }
+        if state == 'DONE' and not job.cancelled and not job.will_fail:
+            job_resource['statistics'] = _create_statistics(job)
+        return job_resource
+
+    def _send_error(self, code, message):
+        self._send_json({'error': {'code': code,
+                                   'message': message,
+                                   'errors': [{'message': message}]}}, code)
+
+    def _send_json(self, response, code=200):
+        body = json.dumps(response)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _create_statistics(job):
+    """Creates the statistics of a finished job, scaled by its row count."""
+    bytes_processed = job.row_count * _BYTES_PER_ROW
+    created_millis = int(job.created * 1000)
+    return {
+        'creationTime': str(created_millis),
+        'startTime': str(created_millis),
+        'endTime': str(int(time.time() * 1000)),
+        'totalBytesProcessed': str(bytes_processed),
+        'query': {
+            'totalBytesProcessed': str(bytes_processed),
+            'totalBytesBilled': str(bytes_processed),
+            'cacheHit': False,
+            'totalSlotMs': str(job.row_count),
+            'queryPlan': [{
+                'name': 'S00: Input',
+                'waitMsAvg': '0',
+                'readMsAvg': '1',
+                'computeMsAvg': '1',
+                'writeMsAvg': '0'
+            }]
+        }
+    }
+
+
+def _create_row(job, row_index):
+    """Creates a deterministic synthetic NDT row in BigQuery's row format."""
+    values = []
+    for field_index, field in enumerate(job.fields):
+        if field == 'timestamp':
+            values.append({'v': str(_FIRST_ROW_TIMESTAMP + row_index)})
+        else:
+            values.append({'v': str(
+                (row_index * 7919 + field_index) % 10000 / 100.0)})
+    return {'f': values}
+
+
+class FakeGoogleAPIAuth(object):
+    """Stands in for external.GoogleAPIAuth, connecting to a fake server."""
+
+    def __init__(self, server, project_id='fake-project'):
+        self.project_id = project_id
+        self._server = server
+
+    def authenticate_with_google(self):
+        return self._server.create_service()
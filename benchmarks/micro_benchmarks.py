@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Times the hot paths of IP translation, query generation and selectors.
+
+The benchmarks run on a synthetic MaxMind ASN snapshot of realistic size and
+on large selector sweeps. Each benchmark reports the fastest of several
+repeats, which can be compared against a stored baseline and appended to a
+history file to track performance over time.
+
+Example:
+
+    python benchmarks/micro_benchmarks.py --save-baseline micro.json
+    python benchmarks/micro_benchmarks.py --baseline micro.json \\
+        --history micro-history.jsonl
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import random
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope')))
+import iptranslation
+import query
+import selector
+import utils
+
+# Number of blocks in the synthetic snapshot at scale 1.0, similar to a real
+# GeoIPASNum2 snapshot.
+SNAPSHOT_BLOCK_COUNT = 300000
+
+# Number of distinct AS names in the synthetic snapshot at scale 1.0.
+SNAPSHOT_ASN_COUNT = 40000
+
+# AS names of the providers that the benchmarks look up, with the fraction of
+# the snapshot's blocks that belong to each.
+PROVIDER_ASN_NAMES = {
+    'comcast': ('Comcast Cable Communications, Inc.', 0.03),
+    'twc': ('Time Warner Cable Internet LLC', 0.02),
+    'verizon': ('Verizon Online LLC', 0.02),
+    'centurylink': ('Qwest Communications Company, LLC', 0.01),
+    'level3': ('Level 3 Communications, Inc.', 0.01),
+    'cox': ('Cox Communications Inc.', 0.005),
+}
+
+METRICS = ('download_throughput', 'upload_throughput', 'minimum_rtt',
+           'average_rtt', 'packet_retransmit_rate')
+
+
+def create_snapshot(scale, seed=0):
+    """Creates the contents of a synthetic MaxMind ASN snapshot.
+
+    Args:
+        scale: (float) Size of the snapshot relative to a real one.
+        seed: (int) Seed of the random assignment of blocks to AS names.
+
+    Returns:
+        (str) Snapshot in the GeoIPASNum2 CSV format.
+    """
+    random_generator = random.Random(seed)
+    block_count = int(SNAPSHOT_BLOCK_COUNT * scale)
+    asn_count = max(1, int(SNAPSHOT_ASN_COUNT * scale))
+    provider_shares = []
+    provider_asn_number = 7000
+    for asn_name, block_share in sorted(PROVIDER_ASN_NAMES.itervalues()):
+        # Large providers announce their blocks from many ASNs.
+        for provider_asn_index in range(10):
+            provider_shares.append(('"AS%d %s"' % (provider_asn_number,
+                                                   asn_name), block_share / 10))
+            provider_asn_number += 1
+
+    rows = []
+    block_start = 16777216
+    for _ in xrange(block_count):
+        block_size = 1 << random_generator.randint(8, 16)
+        choice = random_generator.random()
+        for asn_name, block_share in provider_shares:
+            if choice < block_share:
+                break
+            choice -= block_share
+        else:
+            asn_number = 20000 + random_generator.randint(0, asn_count - 1)
+            asn_name = '"AS%d Synthetic Network %d"' % (asn_number, asn_number)
+        rows.append('%d,%d,%s\n' % (block_start, block_start + block_size - 1,
+                                    asn_name))
+        # Leave gaps between some blocks so that coalescing has work to do.
+        block_start += block_size * random_generator.randint(1, 2)
+    return ''.join(rows)
+
+
+def create_multi_selector(start_time_count, site_count):
+    multi_selector = selector.MultiSelector()
+    first_day = utils.make_datetime_utc_aware(datetime.datetime(2014, 1, 1))
+    multi_selector.start_times = [first_day + datetime.timedelta(days=day)
+                                  for day in range(start_time_count)]
+    multi_selector.duration = 24 * 60 * 60
+    multi_selector.metrics = list(METRICS)
+    multi_selector.ip_translation_spec = iptranslation.IPTranslationStrategySpec(
+        'maxmind', {'db_snapshots': ['2014-08-04']})
+    multi_selector.client_providers = sorted(PROVIDER_ASN_NAMES)
+    multi_selector.client_countries = [None]
+    multi_selector.sites = ['bnc%02d' % site for site in range(site_count)]
+    return multi_selector
+
+
+def create_translator(snapshot, blocks_by_asn_name=None):
+    translator = iptranslation.IPTranslationStrategyMaxMind(
+        [(None, StringIO.StringIO(snapshot))])
+    # Share an already parsed snapshot so that lookups are timed on their own.
+    translator._blocks_by_asn_name = blocks_by_asn_name
+    return translator
+
+
+class BenchmarkSuite(object):
+    """Builds the synthetic inputs and defines each timed benchmark."""
+
+    def __init__(self, scale):
+        self.snapshot = create_snapshot(scale)
+        self.blocks_by_asn_name = create_translator(
+            self.snapshot)._parse_maxmind_snapshot(StringIO.StringIO(
+                self.snapshot))
+        self.comcast_blocks = create_translator(
+            self.snapshot, self.blocks_by_asn_name).find_ip_blocks('comcast')
+        self.multi_selector = create_multi_selector(
+            start_time_count=int(365 * scale) or 1,
+            site_count=int(20 * scale) or 1)
+        self.selector_file_dir = tempfile.mkdtemp()
+        self.selector_filepath = os.path.join(self.selector_file_dir,
+                                              'sweep.json')
+        with open(self.selector_filepath, 'w') as selector_file:
+            selector_file.write(selector.MultiSelectorJsonEncoder().encode(
+                self.multi_selector))
+        self.windows = [(start_time, start_time + datetime.timedelta(days=1))
+                        for start_time in self.multi_selector.start_times]
+
+    def close(self):
+        shutil.rmtree(self.selector_file_dir)
+
+    def benchmarks(self):
+        """Lists each benchmark as a (name, function) pair."""
+        return [
+            ('parse_maxmind_snapshot', self.parse_maxmind_snapshot),
+            ('find_ip_blocks_one_provider', self.find_ip_blocks_one_provider),
+            ('find_ip_blocks_all_providers', self.find_ip_blocks_all_providers),
+            ('find_ip_blocks_cached', self.find_ip_blocks_cached),
+            ('coalesce_ip_blocks', self.coalesce_ip_blocks),
+            ('create_client_ip_blocks_conditional',
+             self.create_client_ip_blocks_conditional),
+            ('create_client_ip_blocks_join', self.create_client_ip_blocks_join),
+            ('render_template_per_window', self.render_template_per_window),
+            ('multi_selector_split', self.multi_selector_split),
+            ('parse_selector_file', self.parse_selector_file),
+        ]
+
+    def parse_maxmind_snapshot(self):
+        create_translator(self.snapshot)._parse_maxmind_snapshot(
+            StringIO.StringIO(self.snapshot))
+
+    def find_ip_blocks_one_provider(self):
+        create_translator(self.snapshot,
+                          self.blocks_by_asn_name).find_ip_blocks('comcast')
+
+    def find_ip_blocks_all_providers(self):
+        create_translator(self.snapshot,
+                          self.blocks_by_asn_name).find_ip_blocks_for_names(
+                              sorted(PROVIDER_ASN_NAMES))
+
+    def find_ip_blocks_cached(self):
+        translator = create_translator(self.snapshot, self.blocks_by_asn_name)
+        translator.find_ip_blocks('comcast')
+        for _ in xrange(10000):
+            translator.find_ip_blocks('comcast')
+
+    def coalesce_ip_blocks(self):
+        query.coalesce_ip_blocks(self.comcast_blocks)
+
+    def create_client_ip_blocks_conditional(self):
+        query.create_client_ip_blocks_conditional(self.comcast_blocks)
+
+    def create_client_ip_blocks_join(self):
+        query.create_client_ip_blocks_join(self.comcast_blocks)
+
+    def render_template_per_window(self):
+        template = query.BigQueryQueryTemplate(
+            'download_throughput',
+            server_ips=['10.0.0.1', '10.0.0.2', '10.0.0.3'],
+            client_ip_blocks=self.comcast_blocks)
+        for start_time, end_time in self.windows:
+            template.render(start_time, end_time)
+
+    def multi_selector_split(self):
+        self.multi_selector.split()
+
+    def parse_selector_file(self):
+        selector.SelectorFileParser().parse(self.selector_filepath)
+
+
+def time_benchmark(benchmark_function, repeats):
+    """Finds the fastest of several runs of a benchmark, in seconds."""
+    timings = []
+    for _ in range(repeats):
+        gc.collect()
+        started = time.time()
+        benchmark_function()
+        timings.append(time.time() - started)
+    return min(timings)
+
+
+def find_regressions(results, baseline, threshold):
+    """Lists the benchmarks that are slower than their baseline.
+
+    Args:
+        results: (dict) Map of benchmark names to seconds.
+        baseline: (dict) Map of benchmark names to baseline seconds.
+        threshold: (float) Fraction by which a benchmark may exceed its
+            baseline before it is considered a regression.
+
+    Returns:
+        (list) A list of (name, baseline_seconds, seconds) tuples.
+    """
+    regressions = []
+    for name in sorted(results):
+        if name in baseline and results[name] > baseline[name] * (1 + threshold
+                                                                 ):
+            regressions.append((name, baseline[name], results[name]))
+    return regressions
+
+
+def _get_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    suite = BenchmarkSuite(args.scale)
+    results = {}
+    try:
+        for name, benchmark_function in suite.benchmarks():
+            if args.benchmarks and name not in args.benchmarks:
+                continue
+            results[name] = time_benchmark(benchmark_function, args.repeats)
+            print('%-40s %10.4fs' % (name, results[name]))
+    finally:
+        suite.close()
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    if args.history:
+        with open(args.history, 'a') as history_file:
+            history_file.write(json.dumps({
+                'time': datetime.datetime.utcnow().strftime(
+                    '%Y-%m-%dT%H:%M:%SZ'),
+                'revision': _get_revision(),
+                'scale': args.scale,
+                'results': results
+            },
+                                          sort_keys=True) + '\n')
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file),
+                                           args.threshold)
+        for name, baseline_seconds, seconds in regressions:
+            print('REGRESSION %s: %.4fs -> %.4fs' % (name, baseline_seconds,
+                                                     seconds))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('benchmarks',
+                        nargs='*',
+                        help='Benchmarks to run, or none to run all of them.')
+    parser.add_argument('--scale',
+                        type=float,
+                        default=1.0,
+                        help=('Size of the synthetic snapshot and selector '
+                              'sweep relative to realistic inputs.'))
+    parser.add_argument('--repeats',
+                        type=int,
+                        default=3,
+                        help='Number of times to run each benchmark.')
+    parser.add_argument('--save-baseline',
+                        default=None,
+                        help='JSON file to which to write the results.')
+    parser.add_argument('--baseline',
+                        default=None,
+                        help=('JSON file of baseline results. Exits with '
+                              'status 1 if any benchmark regressed.'))
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=0.2,
+                        help=('Fraction by which a benchmark may be slower '
+                              'than its baseline.'))
+    parser.add_argument('--history',
+                        default=None,
+                        help=('JSON lines file to which to append the results, '
+                              'with the time and git revision.'))
+    sys.exit(main(parser.parse_args()))
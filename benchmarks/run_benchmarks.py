@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measures Telescope's end-to-end throughput against a fake BigQuery server.
+
+Each scenario generates queries for a set of synthetic selectors, runs them
+through Telescope's selector queue against an in-process fake BigQuery
+server, and writes the results to a temporary directory. Scenarios run in
+separate processes so that each reports its own peak memory use.
+
+Example:
+
+    python benchmarks/run_benchmarks.py --output report.json
+    python benchmarks/run_benchmarks.py --baseline report.json
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import Queue
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope')))
+import external
+import instrumentation
+import metrics
+import mlab
+import projectpool
+import query
+import selector
+import telescope
+import utils
+
+import fake_bigquery
+
+METRICS = ('download_throughput', 'upload_throughput', 'minimum_rtt',
+           'average_rtt', 'packet_retransmit_rate')
+
+# Settings of the fake server shared by every scenario unless overridden.
+DEFAULT_SERVER_SETTINGS = {
+    'pending_seconds': 0.05,
+    'running_seconds': 0.1,
+    'request_latency': 0.002,
+    'rows_per_job': 1000,
+    'page_size': 100000,
+    'error_rate': 0.0,
+    'job_failure_rate': 0.0
+}
+
+# Each scenario gives the number of selectors to run and the fake server
+# settings that differ from the defaults.
+SCENARIOS = {
+    'selectors_10': {'selector_count': 10},
+    'selectors_1k': {'selector_count': 1000,
+                     'rows_per_job': 100},
+    'selectors_10k': {'selector_count': 10000,
+                      'rows_per_job': 10},
+    'rows_2m': {'selector_count': 1,
+                'rows_per_job': 2000000},
+    'injected_errors': {'selector_count': 200,
+                        'rows_per_job': 100,
+                        'page_size': 50,
+                        'error_rate': 0.05,
+                        'job_failure_rate': 0.02},
+}
+
+# Throughput measures compared against a baseline report.
+THROUGHPUT_MEASURES = ('queries_per_second', 'rows_per_second')
+
+
+class _ScaledTime(object):
+    """Proxy for the time module whose sleeps are shortened by a factor.
+
+    Telescope sleeps for tens of seconds between polls of real BigQuery jobs.
+    Against the fake server, jobs finish in fractions of a second, so the
+    sleeps are scaled down to keep the benchmark measuring Telescope rather
+    than its back-off intervals.
+    """
+
+    def __init__(self, time_scale):
+        self._time_scale = time_scale
+
+    def sleep(self, seconds):
+        time.sleep(seconds * self._time_scale)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def create_selectors(selector_count, site_ids):
+    """Creates distinct selectors that differ by site, metric and day."""
+    first_day = utils.make_datetime_utc_aware(datetime.datetime(2014, 1, 1))
+    selectors = []
+    for selector_index in range(selector_count):
+        site_index, remainder = divmod(selector_index,
+                                       len(METRICS) * len(site_ids))
+        metric_index, site_offset = divmod(remainder, len(site_ids))
+        selectors.append(selector.Selector(start_time=first_day +
+                                           datetime.timedelta(days=site_index),
+                                           duration=24 * 60 * 60,
+                                           metric=METRICS[metric_index],
+                                           client_country='us',
+                                           site=site_ids[site_offset]))
+    return selectors
+
+
+def run_scenario(scenario_name, time_scale):
+    """Runs a scenario in the current process.
+
+    Args:
+        scenario_name: (str) Name of the scenario in SCENARIOS.
+        time_scale: (float) Factor by which to scale Telescope's sleeps.
+
+    Returns:
+        (dict) Report of the scenario's throughput, memory use and per-stage
+        timings.
+    """
+    scenario = SCENARIOS[scenario_name]
+    server_settings = dict(DEFAULT_SERVER_SETTINGS)
+    server_settings.update((name, value) for name, value in scenario.iteritems()
+                           if name in DEFAULT_SERVER_SETTINGS)
+    scaled_time = _ScaledTime(time_scale)
+    external.time = scaled_time
+    telescope.time = scaled_time
+
+    work_dir = tempfile.mkdtemp()
+    server = fake_bigquery.FakeBigQueryServer(**server_settings)
+    server.start()
+    try:
+        site_ids = ['bnc%02d' % site_index for site_index in range(20)]
+        site_map_filepath = os.path.join(work_dir, 'sites.json')
+        with open(site_map_filepath, 'w') as site_map_file:
+            json.dump({site_id: ['10.0.%d.%d' % (site_index, node)
+                                 for node in range(1, 4)]
+                       for site_index, site_id in enumerate(site_ids)},
+                      site_map_file)
+        mlab_site_resolver = mlab.MLabSiteResolver(
+            site_map_filepath=site_map_filepath)
+        query_template_cache = query.BigQueryQueryTemplateCache()
+
+        started = time.time()
+        selector_queue = Queue.Queue()
+        for data_selector in create_selectors(scenario['selector_count'],
+                                              site_ids):
+            thread_metadata = telescope.build_thread_metadata(data_selector)
+            data_filepath = utils.build_filename(
+                work_dir, thread_metadata['date'], thread_metadata['duration'],
+                thread_metadata['site'], thread_metadata['client_provider'],
+                thread_metadata['client_country'], thread_metadata['metric'],
+                '-raw.csv')
+            with instrumentation.span('generate_query'):
+                bq_query_string = telescope.generate_query(data_selector, None,
+                                                           mlab_site_resolver,
+                                                           query_template_cache)
+            selector_queue.put((bq_query_string, thread_metadata, data_filepath,
+                                False))
+        telescope.execute_selector_queue(
+            selector_queue,
+            projectpool.ProjectPool([fake_bigquery.FakeGoogleAPIAuth(server)]))
+        wall_seconds = time.time() - started
+    finally:
+        server.stop()
+        shutil.rmtree(work_dir)
+
+    registry = metrics.get_registry()
+    summary = instrumentation.get_recorder().summarize(slowest_count=0)
+    return {
+        'scenario': scenario_name,
+        'selector_count': scenario['selector_count'],
+        'server_settings': server_settings,
+        'wall_seconds': wall_seconds,
+        'queries_per_second': scenario['selector_count'] / wall_seconds,
+        'rows_per_second':
+        (registry.get_value(metrics.RESULT_ROWS) / wall_seconds),
+        'rows_collected': registry.get_value(metrics.RESULT_ROWS),
+        'bytes_written': registry.get_value(metrics.OUTPUT_BYTES_WRITTEN),
+        'jobs_succeeded': registry.get_value(metrics.JOBS_SUCCEEDED),
+        'jobs_failed': registry.get_value(metrics.JOBS_FAILED),
+        'query_retries': registry.get_value(metrics.QUERY_RETRIES),
+        'server_requests': server.request_counts,
+        # On Linux, ru_maxrss is measured in kilobytes.
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'stages': {stage: {'count': stage_summary['count'],
+                           'total_seconds': stage_summary['total_seconds'],
+                           'p50_seconds': stage_summary['p50_seconds'],
+                           'p99_seconds': stage_summary['p99_seconds']}
+                   for stage, stage_summary in summary['stages'].iteritems()}
+    }
+
+
+def run_scenario_in_subprocess(scenario_name, time_scale):
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), '--scenarios', scenario_name,
+        '--timescale', str(time_scale), '--inprocess'
+    ])
+    return json.loads(output)[0]
+
+
+def find_regressions(reports, baseline_reports, tolerance):
+    """Compares throughput against a baseline.
+
+    Args:
+        reports: (list) Reports from run_scenario.
+        baseline_reports: (list) Earlier reports to compare against.
+        tolerance: (float) Fraction by which throughput may fall below the
+            baseline before it is considered a regression.
+
+    Returns:
+        (list) Descriptions of each measure that regressed.
+    """
+    baselines_by_scenario = {report['scenario']: report
+                             for report in baseline_reports}
+    regressions = []
+    for report in reports:
+        baseline = baselines_by_scenario.get(report['scenario'])
+        if not baseline:
+            continue
+        for measure in THROUGHPUT_MEASURES:
+            if not baseline[measure]:
+                continue
+            if report[measure] < baseline[measure] * (1 - tolerance):
+                regressions.append('%s: %s fell from %.1f to %.1f' %
+                                   (report['scenario'], measure,
+                                    baseline[measure], report[measure]))
+    return regressions
+
+
+def print_report(report):
+    print('%-16s %8.2fs %10.1f queries/s %12.1f rows/s %8d KB peak RSS' %
+          (report['scenario'], report['wall_seconds'],
+           report['queries_per_second'], report['rows_per_second'],
+           report['peak_rss_kb']))
+    for stage in sorted(report['stages']):
+        stage_report = report['stages'][stage]
+        print('    %-34s %7d x  total %9.3fs  p50 %8.4fs  p99 %8.4fs' %
+              (stage, stage_report['count'], stage_report['total_seconds'],
+               stage_report['p50_seconds'], stage_report['p99_seconds']))
+
+
+def main(args):
+    logging.basicConfig(level=logging.CRITICAL)
+    if args.inprocess:
+        reports = [run_scenario(scenario_name, args.timescale)
+                   for scenario_name in args.scenarios]
+        print(json.dumps(reports))
+        return 0
+
+    reports = []
+    for scenario_name in args.scenarios:
+        report = run_scenario_in_subprocess(scenario_name, args.timescale)
+        print_report(report)
+        reports.append(report)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(reports, output_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(reports, json.load(baseline_file),
+                                           args.tolerance)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--scenarios',
+                        nargs='+',
+                        default=sorted(SCENARIOS),
+                        choices=sorted(SCENARIOS),
+                        help='Scenarios to run.')
+    parser.add_argument('--timescale',
+                        type=float,
+                        default=0.001,
+                        help=('Factor by which to scale the sleeps between '
+                              'Telescope\'s polls and retries.'))
+    parser.add_argument('--output',
+                        default=None,
+                        help='JSON file to which to write the reports.')
+    parser.add_argument('--baseline',
+                        default=None,
+                        help=('JSON file of earlier reports. Exits with status '
+                              '1 if throughput regressed.'))
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.25,
+                        help=('Fraction by which throughput may fall below '
+                              'the baseline.'))
+    parser.add_argument('--inprocess',
+                        action='store_true',
+                        help=('Run the scenarios in this process and print '
+                              'their reports as JSON.'))
+    sys.exit(main(parser.parse_args()))
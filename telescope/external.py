@@ -15,11 +15,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import datetime
 import httplib
 import httplib2
 import logging
 import os
+import Queue
+import threading
 import time
 
 from ssl import SSLError
@@ -30,6 +33,12 @@ from oauth2client.client import flow_from_clientsecrets
 from oauth2client.file import Storage
 from oauth2client.tools import run_flow
 
+import hedging
+import instrumentation
+import jobstats
+import metrics
+import projectpool
+
 
 class BigQueryError(Exception):
     pass
@@ -62,6 +71,13 @@ class BigQueryCommunicationError(BigQueryError):
                                                          (message, self.cause))
 
 
+class BigQueryQuotaExceeded(BigQueryCommunicationError):
+    """BigQuery rejected a request because a project's quota was exceeded.
+
+    The request may succeed if retried later, or through another project.
+    """
+
+
 class TableDoesNotExist(BigQueryError):
 
     def __init__(self):
@@ -73,6 +89,18 @@ class APIConfigError(BigQueryError):
     def __init__(self):
         super(APIConfigError, self).__init__()
 
+# Number of threads that cancel jobs in parallel when the process shuts down.
+CANCEL_THREADS = 16
+
+# Seconds between polls of a pending or running job of each priority. Batch
+# jobs may wait hours for idle capacity, so they are polled less often.
+POLL_SECONDS = {
+    projectpool.INTERACTIVE: {'PENDING': 60,
+                              'RUNNING': 10},
+    projectpool.BATCH: {'PENDING': 300,
+                        'RUNNING': 30}
+}
+
 
 class GoogleAPIAuthConfig:
     """Google API requires an object with preferences for logging and
@@ -89,11 +117,24 @@ class GoogleAPIAuthConfig:
 
 class GoogleAPIAuth:
 
-    def __init__(self, credentials_filepath, is_headless=False):
+    def __init__(self,
+                 credentials_filepath,
+                 is_headless=False,
+                 project_id=None):
+        """Authenticates to the Google APIs for a developer project.
+
+        Args:
+            credentials_filepath: (str) Path of the Google API credentials.
+            is_headless: (bool) Whether to authenticate without a local
+                webserver.
+            project_id: (str) ID of the project through which to run jobs, or
+                None to use the first project that the credentials can access.
+        """
         self.logger = logging.getLogger('telescope')
         self.credentials_filepath = credentials_filepath
         self._set_headless_mode(is_headless)
-        self.project_id = self._find_project_id_opportunistically()
+        self.project_id = (project_id or
+                           self._find_project_id_opportunistically())
 
     def _set_headless_mode(self, is_headless):
         GoogleAPIAuthConfig.noauth_local_webserver = is_headless
@@ -166,6 +207,8 @@ class BigQueryJobResultCollector(object):
             results_chunk, page_token = self._parse_query_results_response(
                 results_response)
             collected_rows.extend(results_chunk)
+            metrics.increment(metrics.RESULT_PAGES)
+            metrics.increment(metrics.RESULT_ROWS, len(results_chunk))
             if page_token:
                 self.logger.debug(
                     ('Query contains additional results (found %d rows so'
@@ -313,7 +356,9 @@ class BigQueryCall(object):
             self._authenticated_service.jobs(), self._project_id)
         return result_collector.collect_results(job_id)
 
-    def run_asynchronous_query(self, query_string):
+    def run_asynchronous_query(self,
+                               query_string,
+                               priority=projectpool.INTERACTIVE):
         job_reference_id = None
 
         try:
@@ -321,65 +366,713 @@ class BigQueryCall(object):
             job_definition = {
                 'configuration': {'query': {'query': query_string}}
             }
+            # BigQuery runs queries interactively unless told otherwise.
+            if priority != projectpool.INTERACTIVE:
+                job_definition['configuration']['query']['priority'] = priority
 
-            job_collection_insert = job_collection.insert(
-                projectId=self._project_id,
-                body=job_definition).execute()
+            with instrumentation.span('run_asynchronous_query'):
+                job_collection_insert = job_collection.insert(
+                    projectId=self._project_id,
+                    body=job_definition).execute()
             job_reference_id = job_collection_insert['jobReference']['jobId']
-        except (HttpError, httplib.ResponseNotReady) as e:
+        except HttpError as e:
+            if _is_quota_error(e):
+                raise BigQueryQuotaExceeded('Exceeded quota of project %s' %
+                                            self._project_id, e)
+            raise BigQueryCommunicationError(
+                'Failed to communicate with BigQuery', e)
+        except httplib.ResponseNotReady as e:
             raise BigQueryCommunicationError(
                 'Failed to communicate with BigQuery', e)
+        _in_flight_jobs.add(job_reference_id, self._project_id)
 
         return job_reference_id
 
+    def estimate_query_bytes(self, query_string):
+        """Estimates the bytes that a query would process with a dry run.
+
+        Args:
+            query_string: (str) The query to estimate.
+
+        Returns:
+            (int) Bytes that the query would process.
+
+        Raises:
+            BigQueryCommunicationError: The dry run failed.
+        """
+        job_definition = {
+            'configuration': {'query': {'query': query_string},
+                              'dryRun': True}
+        }
+        try:
+            with instrumentation.span('estimate_query_bytes'):
+                dry_run_job = self._authenticated_service.jobs().insert(
+                    projectId=self._project_id,
+                    body=job_definition).execute()
+        except (HttpError, httplib.ResponseNotReady) as e:
+            raise BigQueryCommunicationError(
+                'Failed to communicate with BigQuery', e)
+        return jobstats.parse_job_statistics(None, dry_run_job).bytes_processed
+
+    def cancel_job(self, job_id):
+        """Requests that BigQuery stop running a job.
+
+        Args:
+            job_id: (str) ID of the job to cancel.
+
+        Returns:
+            (bool) True if BigQuery accepted the request, False if the request
+            failed.
+        """
+        try:
+            self._authenticated_service.jobs().cancel(
+                projectId=self._project_id,
+                jobId=job_id).execute()
+        except Exception as caught_error:
+            self.logger.warn('Failed to cancel job %s: %s', job_id,
+                             caught_error)
+            return False
+        _in_flight_jobs.remove(job_id)
+        metrics.increment(metrics.JOBS_CANCELLED)
+        return True
+
+    def _get_job(self, query_object, job_id, notification_identifier):
+        """Retrieves a job, whose state is a value such as 'RUNNING'.
+
+        Args:
+            query_object: (BigQueryCall) Object whose service polls the job.
+            job_id: (str) ID of the job.
+            notification_identifier: (str) Identifier of the job's selector.
+
+        Returns:
+            (dict) The job, as returned by jobs.get, or None if it could not be
+            retrieved.
+        """
+        metrics.increment(metrics.JOB_POLLS)
+        try:
+            job_collection = query_object._authenticated_service.jobs()
+            job_collection_state = job_collection.get(
+                projectId=self._project_id,
+                jobId=job_id).execute()
+        except (SSLError, Exception, AttributeError, HttpError,
+                httplib2.ServerNotFoundError) as caught_error:
+            self.logger.warn('Encountered error (%s) monitoring for %s, could '
+                             'be temporary, not bailing out.', caught_error,
+                             notification_identifier)
+            return None
+        return job_collection_state
+
     def monitor_query_queue(self,
                             job_id,
                             job_metadata,
                             query_object=None,
-                            callback_function=None):
+                            callback_function=None,
+                            state_callback=None,
+                            straggler_policy=None,
+                            query_string=None,
+                            failure_callback=None,
+                            job_slot=None,
+                            promotion_seconds=None,
+                            statistics_callback=None,
+                            project_pool=None):
+        """Waits for a job to finish, then passes it to a callback.
+
+        With a straggler policy and the job's query, a duplicate job is
+        submitted once the job has waited much longer than comparable jobs
+        took, if the pool has room for it. The first of the two jobs to finish
+        is passed to the callback and the other is cancelled. A job that fails
+        is set aside while the other is still running, so that a failure is
+        passed to the callback only once every job has failed. If the policy's
+        deadline passes first, both are cancelled and the failure callback is
+        called instead.
+
+        A batch job that is still pending after the promotion time is replaced
+        by an interactive job once the interactive lane of its project has
+        room.
 
+        Args:
+            job_id: (str) ID of the job to monitor.
+            job_metadata: (dict) Metadata that labels the job's selector.
+            query_object: (BigQueryCall) Object whose service polls the job, or
+                None to use this object.
+            callback_function: (function) Called with the ID of the finished job
+                and this object.
+            state_callback: (function) Called with a job's ID and state each
+                time the state of one of the jobs changes.
+            straggler_policy: (hedging.StragglerPolicy) Policy that decides when
+                to hedge or abandon the job, or None to wait for it however long
+                it takes.
+            query_string: (str) The job's query, which is required to hedge it.
+            failure_callback: (function) Called with the job's ID and a reason
+                if the job is abandoned at its deadline.
+            job_slot: (projectpool.JobSlot) The job's slot in the lane of its
+                project, or None for an interactive job outside of any pool.
+            promotion_seconds: (float) Seconds after which a pending batch job
+                is promoted, or None to never promote it.
+            statistics_callback: (function) Called with the ID and the
+                jobstats.JobStatistics of the finished job before the job is
+                passed to the callback.
+            project_pool: (projectpool.ProjectPool) Pool from which a duplicate
+                job reserves its own slot, or None to submit it through this
+                object's project without one.
+        """
         query_object = query_object or self
 
         started_checking = datetime.datetime.utcnow()
+        # Time at which the job was first seen to leave the PENDING state.
+        started_running = None
+        # Time at which each of the selector's jobs was submitted, the original
+        # job first.
+        submitted_times = collections.OrderedDict([(job_id, started_checking)])
+        # Object through which each duplicate job was submitted and the slot
+        # that it holds, which is released once the duplicate is finished.
+        hedged_jobs = {}
+        # A selector whose job has failed is not hedged again, as its
+        # duplicates are likely to fail too.
+        has_failed_job = False
+        last_job_states = {}
+        comparable_key = hedging.comparison_key(job_metadata)
 
         notification_identifier = ', '.join(filter(None, job_metadata.values()))
         self.logger.info('Queued request for %s, received job id: %s',
                          notification_identifier, job_id)
 
-        while True:
-            try:
-                job_collection = query_object._authenticated_service.jobs()
-                job_collection_state = job_collection.get(
-                    projectId=self._project_id,
-                    jobId=job_id).execute()
-            except (SSLError, Exception, AttributeError, HttpError,
-                    httplib2.ServerNotFoundError) as caught_error:
-                self.logger.warn(
-                    'Encountered error (%s) monitoring for %s, could '
-                    'be temporary, not bailing out.', caught_error,
-                    notification_identifier)
-                job_collection_state = None
-
-            if job_collection_state is not None:
+        # The job remains in flight until its results have been handled.
+        metrics.add_to_gauge(metrics.JOBS_IN_FLIGHT, 1)
+        try:
+            while True:
+                job_resources = {}
+                job_states = {}
+                for active_job_id in submitted_times:
+                    active_job_resource = self._get_selector_job(
+                        active_job_id, query_object, hedged_jobs,
+                        notification_identifier)
+                    if active_job_resource is not None:
+                        job_resources[active_job_id] = active_job_resource
+                        job_states[active_job_id] = active_job_resource[
+                            'status']['state']
+
+                for failed_job_id in _find_failed_jobs(job_resources,
+                                                       submitted_times):
+                    self._drop_failed_job(failed_job_id, submitted_times,
+                                          hedged_jobs, job_states,
+                                          notification_identifier)
+                    has_failed_job = True
+
                 time_waiting = int((datetime.datetime.utcnow() -
                                     started_checking).total_seconds())
-
-                if job_collection_state['status']['state'] == 'RUNNING':
+                if not job_states:
+                    # None of the jobs could be retrieved, which may be
+                    # temporary, so they are polled again after the lane's
+                    # usual delay unless the deadline has passed.
+                    if (straggler_policy and
+                            straggler_policy.is_past_deadline(time_waiting)):
+                        self._abandon_jobs(submitted_times, hedged_jobs,
+                                           notification_identifier,
+                                           time_waiting, failure_callback)
+                        break
+                    poll_seconds = _poll_delay(
+                        POLL_SECONDS[_job_priority(job_slot)]['RUNNING'],
+                        straggler_policy, comparable_key, time_waiting,
+                        len(submitted_times) > 1)
+                    time.sleep(poll_seconds)
+                    continue
+
+                for active_job_id, active_job_state in job_states.iteritems():
+                    if active_job_state == 'DONE':
+                        _in_flight_jobs.remove(active_job_id)
+                    if (started_running is None and
+                            active_job_state != 'PENDING'):
+                        started_running = datetime.datetime.utcnow()
+                    if (state_callback is not None and active_job_state !=
+                            last_job_states.get(active_job_id)):
+                        last_job_states[active_job_id] = active_job_state
+                        state_callback(active_job_id, active_job_state)
+                job_state = _most_advanced_state(job_states.values())
+
+                if job_state in ('RUNNING', 'PENDING') and straggler_policy:
+                    if straggler_policy.is_past_deadline(time_waiting):
+                        self._abandon_jobs(submitted_times, hedged_jobs,
+                                           notification_identifier,
+                                           time_waiting, failure_callback)
+                        break
+                    if (query_string is not None and not has_failed_job and
+                            len(submitted_times) == 1 and
+                            straggler_policy.should_hedge(comparable_key,
+                                                          time_waiting)):
+                        self._hedge_job(query_string, submitted_times,
+                                        hedged_jobs, project_pool,
+                                        notification_identifier, time_waiting,
+                                        _job_priority(job_slot))
+
+                promotion_pending = (
+                    job_state == 'PENDING' and query_string is not None and
+                    promotion_seconds is not None and
+                    _job_priority(job_slot) == projectpool.BATCH)
+                if promotion_pending and time_waiting >= promotion_seconds:
+                    self._promote_job(query_string, submitted_times,
+                                      hedged_jobs, job_slot,
+                                      notification_identifier, time_waiting)
+
+                if job_state == 'RUNNING':
                     self.logger.info(
                         'Waiting for %s to complete, spent %d seconds so '
                         'far.', notification_identifier, time_waiting)
-                    time.sleep(10)
-                elif job_collection_state['status']['state'] == 'PENDING':
+                    poll_seconds = _poll_delay(
+                        POLL_SECONDS[_job_priority(job_slot)]['RUNNING'],
+                        straggler_policy, comparable_key, time_waiting,
+                        len(submitted_times) > 1)
+                    time.sleep(poll_seconds)
+                elif job_state == 'PENDING':
                     self.logger.info(
                         'Waiting for %s to submit, spent %d seconds so '
                         'far.', notification_identifier, time_waiting)
-                    time.sleep(60)
-                elif ((job_collection_state['status']['state'] == 'DONE') and
-                      callback_function is not None):
+                    poll_seconds = _poll_delay(
+                        POLL_SECONDS[_job_priority(job_slot)]['PENDING'],
+                        straggler_policy, comparable_key, time_waiting,
+                        len(submitted_times) > 1)
+                    if promotion_pending:
+                        poll_seconds = min(poll_seconds, max(
+                            1, promotion_seconds - time_waiting))
+                    time.sleep(poll_seconds)
+                elif job_state == 'DONE' and callback_function is not None:
                     self.logger.info('Found completion status for %s.',
                                      notification_identifier)
-                    callback_function(job_id, query_object=self)
+                    finished_job_id = [
+                        active_job_id for active_job_id in submitted_times
+                        if job_states.get(active_job_id) == 'DONE'
+                    ][0]
+                    finished_call = self._finish_hedged_jobs(
+                        finished_job_id, submitted_times, hedged_jobs,
+                        straggler_policy, comparable_key)
+                    self._record_job_timings(notification_identifier,
+                                             started_checking, started_running)
+                    self._record_job_statistics(finished_job_id,
+                                                job_resources[finished_job_id],
+                                                statistics_callback)
+                    callback_function(finished_job_id,
+                                      query_object=finished_call)
                     break
                 else:
                     raise Exception('UnknownBigQueryResponse')
+        finally:
+            metrics.add_to_gauge(metrics.JOBS_IN_FLIGHT, -1)
         return None
+
+    def _hedge_job(self, query_string, submitted_times, hedged_jobs,
+                   project_pool, notification_identifier, time_waiting,
+                   priority):
+        """Submits a duplicate of a straggling job.
+
+        The duplicate counts against the pool's limits like any other job, so
+        it is not submitted while every project's lane is full.
+
+        Args:
+            query_string: (str) The job's query.
+            submitted_times: (OrderedDict) Map of the IDs of the selector's jobs
+                to the times at which they were submitted, to which the
+                duplicate job is added.
+            hedged_jobs: (dict) Map of the IDs of the selector's duplicate jobs
+                to the BigQueryCall and projectpool.JobSlot of each, to which
+                the duplicate job is added.
+            project_pool: (projectpool.ProjectPool) Pool from which to reserve
+                the duplicate's slot, or None to submit it without one.
+            notification_identifier: (str) Identifier of the job's selector.
+            time_waiting: (int) Seconds the job has waited so far.
+            priority: (str) Priority of the job, one of projectpool.PRIORITIES.
+        """
+        hedge_call = self
+        hedge_slot = None
+        if project_pool is not None:
+            hedge_slot = project_pool.try_acquire(priority)
+            if hedge_slot is None:
+                self.logger.debug('No room to hedge %s, will try again.',
+                                  notification_identifier)
+                return
+        try:
+            if hedge_slot is not None:
+                hedge_call = BigQueryCall(
+                    get_authenticated_service(hedge_slot.google_auth_config),
+                    hedge_slot.project_id)
+            hedged_job_id = hedge_call.run_asynchronous_query(query_string,
+                                                              priority)
+        except BigQueryCommunicationError as caught_error:
+            if hedge_slot is not None:
+                hedge_slot.release()
+                if isinstance(caught_error, BigQueryQuotaExceeded):
+                    project_pool.mark_throttled(hedge_slot.project_id)
+            self.logger.warn('Failed to hedge %s, will try again: %s',
+                             notification_identifier, caught_error)
+            return
+        submitted_times[hedged_job_id] = datetime.datetime.utcnow()
+        hedged_jobs[hedged_job_id] = (hedge_call, hedge_slot)
+        metrics.increment(metrics.HEDGED_JOBS)
+        self.logger.info(
+            'Job for %s is straggling after %d seconds, submitted duplicate '
+            'job %s.', notification_identifier, time_waiting, hedged_job_id)
+
+    def _promote_job(self, query_string, submitted_times, hedged_jobs, job_slot,
+                     notification_identifier, time_waiting):
+        """Replaces a pending batch job with an interactive job.
+
+        Args:
+            query_string: (str) The job's query.
+            submitted_times: (OrderedDict) Map of the IDs of the selector's jobs
+                to the times at which they were submitted, whose jobs are
+                replaced by the interactive job.
+            hedged_jobs: (dict) Map of the IDs of the selector's duplicate jobs
+                to the BigQueryCall and projectpool.JobSlot of each.
+            job_slot: (projectpool.JobSlot) The job's slot, which is moved to
+                the interactive lane.
+            notification_identifier: (str) Identifier of the job's selector.
+            time_waiting: (int) Seconds the job has waited so far.
+        """
+        if not job_slot.promote():
+            return
+        try:
+            promoted_job_id = self.run_asynchronous_query(
+                query_string, projectpool.INTERACTIVE)
+        except BigQueryCommunicationError as caught_error:
+            job_slot.demote()
+            self.logger.warn('Failed to promote %s, will try again: %s',
+                             notification_identifier, caught_error)
+            return
+        for active_job_id in submitted_times:
+            self._cancel_selector_job(active_job_id, hedged_jobs)
+        submitted_times.clear()
+        submitted_times[promoted_job_id] = datetime.datetime.utcnow()
+        metrics.increment(metrics.JOBS_PROMOTED)
+        self.logger.info(
+            'Batch job for %s is still pending after %d seconds, replaced it '
+            'with interactive job %s.', notification_identifier, time_waiting,
+            promoted_job_id)
+
+    def _finish_hedged_jobs(self, finished_job_id, submitted_times, hedged_jobs,
+                            straggler_policy, comparable_key):
+        """Cancels the jobs that lost to a finished job and records its latency.
+
+        The slots of the selector's duplicate jobs, including the finished job
+        if it is a duplicate, are released.
+
+        Args:
+            finished_job_id: (str) ID of the first of the jobs to finish.
+            submitted_times: (OrderedDict) Map of the IDs of the selector's jobs
+                to the times at which they were submitted.
+            hedged_jobs: (dict) Map of the IDs of the selector's duplicate jobs
+                to the BigQueryCall and projectpool.JobSlot of each.
+            straggler_policy: (hedging.StragglerPolicy) Policy in which to
+                record the job's latency, or None.
+            comparable_key: (tuple) Key of the job's comparable jobs.
+
+        Returns:
+            (BigQueryCall) Object through which to retrieve the finished job's
+            results.
+        """
+        for active_job_id in submitted_times:
+            if active_job_id != finished_job_id:
+                self._cancel_selector_job(active_job_id, hedged_jobs)
+        finished_call = self._forget_selector_job(finished_job_id, hedged_jobs)
+        if finished_job_id != submitted_times.keys()[0]:
+            metrics.increment(metrics.HEDGES_WON)
+        if straggler_policy:
+            straggler_policy.record_latency(comparable_key, (
+                datetime.datetime.utcnow() - submitted_times[finished_job_id]
+            ).total_seconds())
+        return finished_call
+
+    def _abandon_jobs(self, submitted_times, hedged_jobs,
+                      notification_identifier, time_waiting, failure_callback):
+        """Cancels the jobs of a selector that has exceeded its deadline.
+
+        Args:
+            submitted_times: (OrderedDict) Map of the IDs of the selector's jobs
+                to the times at which they were submitted.
+            hedged_jobs: (dict) Map of the IDs of the selector's duplicate jobs
+                to the BigQueryCall and projectpool.JobSlot of each.
+            notification_identifier: (str) Identifier of the job's selector.
+            time_waiting: (int) Seconds the selector's jobs have waited.
+            failure_callback: (function) Called with the original job's ID and
+                a reason, or None.
+        """
+        reason = 'Exceeded deadline after %d seconds.' % time_waiting
+        self.logger.error('Abandoning %s: %s', notification_identifier, reason)
+        metrics.increment(metrics.DEADLINES_EXCEEDED)
+        for active_job_id in submitted_times:
+            self._cancel_selector_job(active_job_id, hedged_jobs)
+        if failure_callback is not None:
+            failure_callback(submitted_times.keys()[0], reason)
+
+    def _drop_failed_job(self, failed_job_id, submitted_times, hedged_jobs,
+                         job_states, notification_identifier):
+        """Stops waiting for a failed job while another of its selector's runs.
+
+        Args:
+            failed_job_id: (str) ID of the failed job.
+            submitted_times: (OrderedDict) Map of the IDs of the selector's jobs
+                to the times at which they were submitted, from which the job
+                is removed.
+            hedged_jobs: (dict) Map of the IDs of the selector's duplicate jobs
+                to the BigQueryCall and projectpool.JobSlot of each, from which
+                the job is removed.
+            job_states: (dict) Map of the IDs of the selector's jobs to their
+                latest states, from which the job is removed.
+            notification_identifier: (str) Identifier of the job's selector.
+        """
+        self.logger.warn('Job %s for %s failed, waiting for its other job.',
+                         failed_job_id, notification_identifier)
+        _in_flight_jobs.remove(failed_job_id)
+        self._forget_selector_job(failed_job_id, hedged_jobs)
+        del submitted_times[failed_job_id]
+        del job_states[failed_job_id]
+
+    def _get_selector_job(self, job_id, query_object, hedged_jobs,
+                          notification_identifier):
+        """Retrieves one of a selector's jobs through the project that runs it.
+
+        Args:
+            job_id: (str) ID of the job.
+            query_object: (BigQueryCall) Object whose service polls the
+                selector's original job.
+            hedged_jobs: (dict) Map of the IDs of the selector's duplicate jobs
+                to the BigQueryCall and projectpool.JobSlot of each.
+            notification_identifier: (str) Identifier of the job's selector.
+
+        Returns:
+            (dict) The job, as returned by jobs.get, or None if it could not be
+            retrieved.
+        """
+        if job_id not in hedged_jobs:
+            return self._get_job(query_object, job_id, notification_identifier)
+        hedge_call = hedged_jobs[job_id][0]
+        return hedge_call._get_job(hedge_call, job_id, notification_identifier)
+
+    def _cancel_selector_job(self, job_id, hedged_jobs):
+        """Cancels one of a selector's jobs and releases its slot.
+
+        Args:
+            job_id: (str) ID of the job.
+            hedged_jobs: (dict) Map of the IDs of the selector's duplicate jobs
+                to the BigQueryCall and projectpool.JobSlot of each.
+        """
+        self._forget_selector_job(job_id, hedged_jobs).cancel_job(job_id)
+
+    def _forget_selector_job(self, job_id, hedged_jobs):
+        """Releases the slot of a selector's job if it is a duplicate.
+
+        Args:
+            job_id: (str) ID of the job.
+            hedged_jobs: (dict) Map of the IDs of the selector's duplicate jobs
+                to the BigQueryCall and projectpool.JobSlot of each, from which
+                the job is removed.
+
+        Returns:
+            (BigQueryCall) Object through which the job was submitted.
+        """
+        job_call, hedge_slot = hedged_jobs.pop(job_id, (self, None))
+        if hedge_slot is not None:
+            hedge_slot.release()
+        return job_call
+
+    def _record_job_timings(self, notification_identifier, started_checking,
+                            started_running):
+        """Records the time a job spent queued and running.
+
+        Args:
+            notification_identifier: (str) Identifier of the job's selector.
+            started_checking: (datetime) Time at which monitoring started.
+            started_running: (datetime) Time at which the job was first seen to
+                have left the PENDING state.
+        """
+        finished = datetime.datetime.utcnow()
+        instrumentation.record('monitor_query_queue',
+                               (finished - started_checking).total_seconds(),
+                               notification_identifier)
+        instrumentation.record(
+            'job_pending', (started_running - started_checking).total_seconds(),
+            notification_identifier)
+        instrumentation.record('job_running',
+                               (finished - started_running).total_seconds(),
+                               notification_identifier)
+
+    def _record_job_statistics(self, job_id, job_resource, statistics_callback):
+        """Counts the bytes and slot time of a finished job.
+
+        Args:
+            job_id: (str) ID of the job.
+            job_resource: (dict) The finished job, as returned by jobs.get.
+            statistics_callback: (function) Called with the job's ID and
+                jobstats.JobStatistics, or None.
+        """
+        job_statistics = jobstats.parse_job_statistics(job_id, job_resource)
+        metrics.increment(metrics.BYTES_PROCESSED,
+                          job_statistics.bytes_processed)
+        metrics.increment(metrics.BYTES_BILLED, job_statistics.bytes_billed)
+        metrics.increment(metrics.SLOT_MILLIS, job_statistics.slot_millis)
+        if job_statistics.cache_hit:
+            metrics.increment(metrics.CACHE_HITS)
+        if statistics_callback is not None:
+            statistics_callback(job_id, job_statistics)
+
+
+def _job_priority(job_slot):
+    return job_slot.priority if job_slot else projectpool.INTERACTIVE
+
+
+def _is_quota_error(http_error):
+    """Checks whether an error is BigQuery's response to an exceeded quota.
+
+    BigQuery responds with 403 errors whose reason is rateLimitExceeded or
+    quotaExceeded when a project submits too many jobs, and sometimes with 429
+    errors.
+    """
+    if http_error.resp.status == 429:
+        return True
+    return http_error.resp.status == 403 and any(
+        reason in (http_error.content or '')
+        for reason in ('rateLimitExceeded', 'quotaExceeded'))
+
+
+def _find_failed_jobs(job_resources, submitted_times):
+    """Finds the failed jobs of a selector that has other jobs.
+
+    Args:
+        job_resources: (dict) Map of the IDs of the selector's jobs that were
+            retrieved to the jobs, as returned by jobs.get.
+        submitted_times: (OrderedDict) Map of the IDs of all of the selector's
+            jobs to the times at which they were submitted.
+
+    Returns:
+        (list) IDs of the jobs that finished with an error, or an empty list if
+        every one of the selector's jobs did.
+    """
+    failed_job_ids = [job_id for job_id, job_resource in job_resources.items()
+                      if 'errorResult' in job_resource['status']]
+    if len(failed_job_ids) == len(submitted_times):
+        return []
+    return failed_job_ids
+
+
+def _most_advanced_state(job_states):
+    """Finds the state of the job that is nearest to finishing.
+
+    Args:
+        job_states: (list) States of the jobs of one selector.
+
+    Returns:
+        (str) 'DONE', 'RUNNING' or 'PENDING', or a state that is not one of
+        these if any job is in such a state.
+    """
+    for job_state in job_states:
+        if job_state not in ('DONE', 'RUNNING', 'PENDING'):
+            return job_state
+    for job_state in ('DONE', 'RUNNING', 'PENDING'):
+        if job_state in job_states:
+            return job_state
+
+
+def _poll_delay(default_seconds, straggler_policy, comparable_key, time_waiting,
+                hedged):
+    """Calculates the seconds to wait before polling a job again.
+
+    The usual delay is shortened so that a job is hedged or abandoned soon
+    after its threshold or deadline.
+    """
+    if straggler_policy is None:
+        return default_seconds
+    seconds_until_action = straggler_policy.seconds_until_action(
+        comparable_key, time_waiting, hedged)
+    if seconds_until_action is None:
+        return default_seconds
+    return min(default_seconds, max(1, seconds_until_action))
+
+
+class InFlightJobs(object):
+    """Thread-safe record of the submitted jobs that have not finished.
+
+    Jobs are added when they are submitted and removed once they are seen to
+    finish or are cancelled, so that the jobs still running in BigQuery can be
+    cancelled when the process shuts down.
+    """
+
+    def __init__(self):
+        self._project_ids = {}
+        self._lock = threading.Lock()
+
+    def add(self, job_id, project_id):
+        with self._lock:
+            self._project_ids[job_id] = project_id
+
+    def remove(self, job_id):
+        with self._lock:
+            self._project_ids.pop(job_id, None)
+
+    def list_jobs(self):
+        """Lists the jobs in flight.
+
+        Returns:
+            (list) (job ID, project ID) tuples.
+        """
+        with self._lock:
+            return self._project_ids.items()
+
+    def cancel_all(self, project_pool, timeout_seconds):
+        """Cancels every job in flight, several at a time.
+
+        Args:
+            project_pool: (projectpool.ProjectPool) Pool of the projects that
+                own the jobs.
+            timeout_seconds: (float) Seconds after which to stop waiting for
+                cancellations to finish.
+
+        Returns:
+            (int) Number of jobs whose cancellation BigQuery accepted before
+            the timeout.
+        """
+        logger = logging.getLogger('telescope')
+        job_queue = Queue.Queue()
+        for job in self.list_jobs():
+            job_queue.put(job)
+        cancelled_job_ids = []
+
+        def cancel_queued_jobs():
+            # Each thread has its own services, as a service's HTTP connection
+            # may not be shared between threads.
+            query_objects = {}
+            while True:
+                try:
+                    job_id, project_id = job_queue.get(False)
+                except Queue.Empty:
+                    return
+                if project_id not in query_objects:
+                    try:
+                        query_objects[project_id] = BigQueryCall(
+                            get_authenticated_service(
+                                project_pool.get_auth_config(project_id)),
+                            project_id)
+                    except BigQueryCommunicationError as caught_error:
+                        logger.warn('Failed to authenticate to cancel job %s: '
+                                    '%s', job_id, caught_error)
+                        continue
+                if query_objects[project_id].cancel_job(job_id):
+                    cancelled_job_ids.append(job_id)
+
+        cancel_threads = []
+        for _ in range(min(CANCEL_THREADS, job_queue.qsize())):
+            cancel_thread = threading.Thread(target=cancel_queued_jobs,
+                                             name='cancel_jobs')
+            # Threads still waiting on BigQuery at the timeout must not keep
+            # the process alive.
+            cancel_thread.daemon = True
+            cancel_thread.start()
+            cancel_threads.append(cancel_thread)
+        deadline = time.time() + timeout_seconds
+        for cancel_thread in cancel_threads:
+            cancel_thread.join(max(0, deadline - time.time()))
+        return len(cancelled_job_ids)
+
+# Jobs in flight from every thread of the process.
+_in_flight_jobs = InFlightJobs()
+
+
+def get_in_flight_jobs():
+    return _in_flight_jobs
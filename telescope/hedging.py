@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Decides when a BigQuery job is a straggler that should be hedged.
+
+The latency of every finished job is recorded under a key shared by
+comparable jobs. Once enough comparable jobs have finished, a job that has
+been waiting longer than a multiple of a percentile of their latencies is a
+straggler, for which a duplicate job may be submitted. The first of the two
+jobs to finish is used. Independently of hedging, a job may be given a
+deadline after which it is abandoned.
+"""
+
+import threading
+
+import utils
+
+DEFAULT_HEDGE_MULTIPLIER = 2.0
+DEFAULT_MIN_SAMPLES = 10
+DEFAULT_MIN_HEDGE_SECONDS = 60.0
+
+
+def comparison_key(thread_metadata):
+    """Creates a key shared by the jobs of comparable selectors.
+
+    Selectors of the same metric over the same duration produce queries of
+    the same shape, so their jobs are expected to take similar times.
+
+    Args:
+        thread_metadata: (dict) Metadata that labels the selector's query.
+
+    Returns:
+        (tuple) Key of the selector's group of comparable jobs.
+    """
+    return (thread_metadata.get('metric'), thread_metadata.get('duration'))
+
+
+class StragglerPolicy(object):
+    """Thread-safe record of job latencies that identifies stragglers."""
+
+    def __init__(self,
+                 hedge_percentile=None,
+                 hedge_multiplier=DEFAULT_HEDGE_MULTIPLIER,
+                 min_samples=DEFAULT_MIN_SAMPLES,
+                 min_hedge_seconds=DEFAULT_MIN_HEDGE_SECONDS,
+                 deadline_seconds=None):
+        """Creates a policy without any recorded latencies.
+
+        Args:
+            hedge_percentile: (float) Percentile of comparable jobs' latencies
+                on which the hedging threshold is based, or None to never
+                hedge.
+            hedge_multiplier: (float) Multiple of the percentile after which a
+                job is hedged.
+            min_samples: (int) Number of comparable jobs that must have
+                finished before any job is hedged.
+            min_hedge_seconds: (float) Seconds a job must have waited before it
+                is hedged, however fast comparable jobs were.
+            deadline_seconds: (float) Seconds after a selector's first job was
+                submitted at which its jobs are abandoned, or None for no
+                deadline.
+        """
+        self._hedge_percentile = hedge_percentile
+        self._hedge_multiplier = hedge_multiplier
+        self._min_samples = min_samples
+        self._min_hedge_seconds = min_hedge_seconds
+        self._deadline_seconds = deadline_seconds
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def with_deadline(self, deadline_seconds):
+        """Creates a policy with another deadline that shares these latencies.
+
+        Args:
+            deadline_seconds: (float) Seconds after a selector's first job was
+                submitted at which its jobs are abandoned, or None for no
+                deadline.
+
+        Returns:
+            (StragglerPolicy) A policy that hedges as this one does and records
+            latencies in the same record.
+        """
+        policy = StragglerPolicy(self._hedge_percentile, self._hedge_multiplier,
+                                 self._min_samples, self._min_hedge_seconds,
+                                 deadline_seconds)
+        policy._latencies = self._latencies
+        policy._lock = self._lock
+        return policy
+
+    def record_latency(self, key, latency_seconds):
+        """Records the time a finished job took from submission to completion.
+
+        Args:
+            key: (tuple) Key of the job's comparable jobs, from
+                comparison_key.
+            latency_seconds: (float) Seconds the job took.
+        """
+        with self._lock:
+            self._latencies.setdefault(key, []).append(latency_seconds)
+
+    def hedge_threshold(self, key):
+        """Calculates the time after which a job is considered a straggler.
+
+        Args:
+            key: (tuple) Key of the job's comparable jobs.
+
+        Returns:
+            (float) Seconds after its submission at which a job should be
+            hedged, or None if it should not be hedged.
+        """
+        if self._hedge_percentile is None:
+            return None
+        with self._lock:
+            latencies = list(self._latencies.get(key, ()))
+        if len(latencies) < self._min_samples:
+            return None
+        percentile_latency = utils.calculate_percentile(latencies,
+                                                        self._hedge_percentile)
+        return max(self._min_hedge_seconds,
+                   self._hedge_multiplier * percentile_latency)
+
+    def should_hedge(self, key, elapsed_seconds):
+        """Indicates whether a job that has waited for some time is a straggler.
+
+        Args:
+            key: (tuple) Key of the job's comparable jobs.
+            elapsed_seconds: (float) Seconds since the job was submitted.
+
+        Returns:
+            (bool) True if a duplicate of the job should be submitted.
+        """
+        threshold = self.hedge_threshold(key)
+        return threshold is not None and elapsed_seconds >= threshold
+
+    def is_past_deadline(self, elapsed_seconds):
+        """Indicates whether a selector's jobs should be abandoned.
+
+        Args:
+            elapsed_seconds: (float) Seconds since the selector's first job was
+                submitted.
+
+        Returns:
+            (bool) True if the selector has exceeded its deadline.
+        """
+        return (self._deadline_seconds is not None and
+                elapsed_seconds >= self._deadline_seconds)
+
+    def seconds_until_action(self, key, elapsed_seconds, hedged):
+        """Calculates the time until a job should be hedged or abandoned.
+
+        Args:
+            key: (tuple) Key of the job's comparable jobs.
+            elapsed_seconds: (float) Seconds since the selector's first job was
+                submitted.
+            hedged: (bool) Whether the job has already been hedged.
+
+        Returns:
+            (float) Seconds until the job should next be hedged or abandoned,
+            or None if neither will happen.
+        """
+        action_times = []
+        threshold = None if hedged else self.hedge_threshold(key)
+        if threshold is not None:
+            action_times.append(threshold)
+        if self._deadline_seconds is not None:
+            action_times.append(self._deadline_seconds)
+        if not action_times:
+            return None
+        return max(0, min(action_times) - elapsed_seconds)
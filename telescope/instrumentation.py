@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Records how long each stage of a run takes and summarizes the timings."""
+
+import contextlib
+import json
+import logging
+import threading
+import time
+
+import utils
+
+# Upper bounds, in seconds, of the buckets of each stage's timing histogram.
+HISTOGRAM_BUCKET_BOUNDS = (0.001, 0.01, 0.1, 1, 10, 60, 300, 1800)
+
+# Number of slowest selectors to list in a timing summary.
+DEFAULT_SLOWEST_COUNT = 10
+
+
+class TimingRecorder(object):
+    """Thread-safe recorder of the time spent in each stage of a run.
+
+    Each timing belongs to a stage, such as generate_query, and optionally to
+    a label that identifies the selector being processed, so that the summary
+    can report both the distribution of each stage's timings and the
+    selectors that took longest overall.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._durations_by_stage = {}
+        self._durations_by_label = {}
+        self._start_time = time.time()
+
+    def record(self, stage, duration, label=None):
+        """Records the duration of one execution of a stage.
+
+        Args:
+            stage: (str) Name of the stage.
+            duration: (float) Number of seconds the stage took.
+            label: (str) Identifier of the selector processed by the stage, or
+                None if the stage was not specific to a selector.
+        """
+        with self._lock:
+            self._durations_by_stage.setdefault(stage, []).append(duration)
+            if label:
+                durations = self._durations_by_label.setdefault(label, {})
+                durations[stage] = durations.get(stage, 0.0) + duration
+
+    @contextlib.contextmanager
+    def span(self, stage, label=None):
+        """Records the time spent in a block of code as a stage.
+
+        Args:
+            stage: (str) Name of the stage.
+            label: (str) Identifier of the selector processed by the stage.
+        """
+        span_start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.time() - span_start, label)
+
+    def stage_totals(self):
+        """Lists the number of executions and total time of each stage.
+
+        Returns:
+            (dict) A map of each stage name to a (count, total_seconds) tuple.
+        """
+        with self._lock:
+            return {stage: (len(durations), sum(durations))
+                    for stage, durations in self._durations_by_stage.iteritems()
+                   }
+
+    def summarize(self, slowest_count=DEFAULT_SLOWEST_COUNT):
+        """Summarizes the recorded timings.
+
+        Args:
+            slowest_count: (int) Number of slowest selectors to include.
+
+        Returns:
+            (dict) Summary with the total wall time of the run, statistics and
+            a histogram for each stage, and the selectors with the greatest
+            total time across all stages.
+        """
+        with self._lock:
+            stages = {}
+            for stage, durations in self._durations_by_stage.iteritems():
+                stages[stage] = _summarize_durations(durations)
+            selector_totals = []
+            for label, durations in self._durations_by_label.iteritems():
+                selector_totals.append({
+                    'selector': label,
+                    'total_seconds': sum(durations.itervalues()),
+                    'stages': dict(durations)
+                })
+        selector_totals.sort(key=lambda total: total['total_seconds'],
+                             reverse=True)
+        return {
+            'wall_seconds': time.time() - self._start_time,
+            'stages': stages,
+            'slowest_selectors': selector_totals[:slowest_count]
+        }
+
+    def write_summary(self,
+                      summary_filepath,
+                      slowest_count=DEFAULT_SLOWEST_COUNT):
+        """Writes the summary of the recorded timings to a JSON file.
+
+        Args:
+            summary_filepath: (str) Path of the file to write.
+            slowest_count: (int) Number of slowest selectors to include.
+
+        Returns:
+            (bool) True if the summary was written successfully.
+        """
+        try:
+            with open(summary_filepath, 'w') as summary_file:
+                json.dump(
+                    self.summarize(slowest_count),
+                    summary_file,
+                    indent=2,
+                    sort_keys=True)
+            return True
+        except IOError as caught_error:
+            logging.getLogger('telescope').error(
+                'Failed to write timing summary %s: %s', summary_filepath,
+                caught_error)
+        return False
+
+
+def _summarize_durations(durations):
+    sorted_durations = sorted(durations)
+    histogram = []
+    bucket_start = 0
+    for bucket_bound in HISTOGRAM_BUCKET_BOUNDS + (None,):
+        bucket_end = bucket_start
+        while bucket_end < len(sorted_durations) and (
+                bucket_bound is None or
+                sorted_durations[bucket_end] <= bucket_bound):
+            bucket_end += 1
+        histogram.append({
+            'le': bucket_bound if bucket_bound is not None else 'inf',
+            'count': bucket_end - bucket_start
+        })
+        bucket_start = bucket_end
+    return {
+        'count': len(sorted_durations),
+        'total_seconds': sum(sorted_durations),
+        'min_seconds': sorted_durations[0],
+        'max_seconds': sorted_durations[-1],
+        'mean_seconds': sum(sorted_durations) / len(sorted_durations),
+        'p50_seconds': utils.calculate_percentile(sorted_durations, 50),
+        'p90_seconds': utils.calculate_percentile(sorted_durations, 90),
+        'p99_seconds': utils.calculate_percentile(sorted_durations, 99),
+        'histogram': histogram
+    }
+
+# Recorder shared by every module in the process, in the same way that modules
+# share the 'telescope' logger.
+_recorder = TimingRecorder()
+
+
+def get_recorder():
+    return _recorder
+
+
+def span(stage, label=None):
+    """Records the time spent in a block of code with the shared recorder."""
+    return _recorder.span(stage, label)
+
+
+def record(stage, duration, label=None):
+    """Records the duration of a stage with the shared recorder."""
+    _recorder.record(stage, duration, label)
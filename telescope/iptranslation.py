@@ -17,9 +17,14 @@
 
 import csv
 import datetime
+import hashlib
+import json
 import logging
 import os
 import re
+import struct
+
+import utils
 
 
 class MissingMaxMindError(Exception):
@@ -34,23 +39,207 @@ class IPTranslationStrategySpec(object):
     """Specification of how to create an IPTranslationStrategy object.
 
     Specifies the parameters required for IPTranslationFactory to create an
-    IPTranslationStrategy object.
+    IPTranslationStrategy object. Specs are immutable values: two specs with the
+    same strategy name and parameters are equal and hash identically, so they
+    may be used to share translators between selector files.
 
     Attributes:
         strategy_name: (str) The name of this IP translation strategy.
         params: (dict) A dictionary of parameters specific to this type of IP
-            translation strategy.
+            translation strategy. Each access returns a new copy, so changes to
+            it do not affect the spec.
     """
+    __slots__ = ('_strategy_name', '_frozen_params')
 
     def __init__(self, strategy_name, params):
-        self.strategy_name = strategy_name
-        self.params = params
+        self._strategy_name = strategy_name
+        self._frozen_params = _freeze(params)
+
+    @property
+    def strategy_name(self):
+        return self._strategy_name
+
+    @property
+    def params(self):
+        return _thaw(self._frozen_params)
+
+    def replace_params(self, **updated_params):
+        """Creates a copy of this spec with some parameters replaced.
+
+        Args:
+            updated_params: Parameters to add to or replace in the new spec.
+
+        Returns:
+            IPTranslationStrategySpec: A new spec with the same strategy name
+            and the updated parameters.
+        """
+        params = self.params
+        params.update(updated_params)
+        return IPTranslationStrategySpec(self._strategy_name, params)
+
+    def __eq__(self, other):
+        if not isinstance(other, IPTranslationStrategySpec):
+            return NotImplemented
+        return ((self._strategy_name, self._frozen_params) ==
+                (other._strategy_name, other._frozen_params))
+
+    def __ne__(self, other):
+        is_equal = self.__eq__(other)
+        if is_equal is NotImplemented:
+            return is_equal
+        return not is_equal
+
+    def __hash__(self):
+        return hash((self._strategy_name, self._frozen_params))
+
+    def __repr__(self):
+        return '<IPTranslationStrategySpec (strategy: %s, params: %s)>' % (
+            self._strategy_name, self.params)
+
+
+class IPBlockDiskCache(object):
+    """Persistent cache of IP blocks that match an ASN search.
+
+    Stores the blocks found for each (snapshot, search term) pair in its own
+    file so that later runs can resolve providers without parsing the snapshot.
+    Blocks are stored as big-endian pairs of unsigned 32-bit integers.
+
+    The digest of each snapshot is also recorded with the snapshot's path, size
+    and modification time, so that later runs do not hash an unchanged
+    snapshot again.
+    """
+
+    _BLOCK_FORMAT = '!II'
+    _SNAPSHOT_INDEX_FILENAME = 'snapshot-digests.json'
+
+    def __init__(self, cache_dir):
+        """Creates a cache that stores its files in cache_dir.
+
+        Args:
+            cache_dir: (str) Directory in which to store cached blocks. It will
+                be created if it does not exist.
+        """
+        self.logger = logging.getLogger('telescope')
+        self._cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, snapshot_digest, search_term):
+        """Retrieves cached blocks for a search of a snapshot.
+
+        Args:
+            snapshot_digest: (str) Hex digest of the snapshot's contents.
+            search_term: (str) Search term used to match AS names.
+
+        Returns:
+            list: A list of (block_start, block_end) tuples, or None if there
+            are no valid cached results for this search.
+        """
+        cache_path = self._build_path(snapshot_digest, search_term)
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                packed_blocks = cache_file.read()
+        except IOError:
+            return None
+
+        block_size = struct.calcsize(self._BLOCK_FORMAT)
+        if len(packed_blocks) % block_size != 0:
+            self.logger.warning('Ignoring corrupt IP block cache file: %s',
+                                cache_path)
+            return None
+        return [struct.unpack_from(self._BLOCK_FORMAT, packed_blocks, offset)
+                for offset in xrange(0, len(packed_blocks), block_size)]
+
+    def put(self, snapshot_digest, search_term, blocks):
+        """Stores the blocks found for a search of a snapshot.
+
+        Failures to write are logged, but do not raise an exception.
+
+        Args:
+            snapshot_digest: (str) Hex digest of the snapshot's contents.
+            search_term: (str) Search term used to match AS names.
+            blocks: (list) A list of (block_start, block_end) tuples.
+        """
+        cache_path = self._build_path(snapshot_digest, search_term)
+        packed_blocks = ''.join(struct.pack(self._BLOCK_FORMAT, start, end)
+                                for start, end in blocks)
+        try:
+            utils.write_file_atomically(cache_path, packed_blocks)
+        except (IOError, OSError) as caught_error:
+            self.logger.warning('Failed to write IP block cache file %s: %s',
+                                cache_path, caught_error)
+
+    def get_snapshot_digest(self, snapshot_path, calculate_digest):
+        """Finds the digest of a snapshot, hashing it only if it has changed.
+
+        Args:
+            snapshot_path: (str) Path of the snapshot file.
+            calculate_digest: (function) Calculates the hex digest of the
+                snapshot's contents.
+
+        Returns:
+            str: Hex digest of the snapshot's contents.
+        """
+        try:
+            snapshot_stat = os.stat(snapshot_path)
+        except OSError:
+            return calculate_digest()
+        snapshot_key = os.path.abspath(snapshot_path)
+        snapshot_version = {
+            'size': snapshot_stat.st_size,
+            'mtime': snapshot_stat.st_mtime
+        }
+        snapshot_index = self._load_snapshot_index()
+        indexed_version = snapshot_index.get(snapshot_key)
+        if _is_same_snapshot_version(indexed_version, snapshot_version):
+            return indexed_version['digest']
+
+        snapshot_version['digest'] = calculate_digest()
+        snapshot_index[snapshot_key] = snapshot_version
+        index_path = os.path.join(self._cache_dir,
+                                  self._SNAPSHOT_INDEX_FILENAME)
+        index_contents = json.dumps(snapshot_index, indent=2, sort_keys=True)
+        try:
+            utils.write_file_atomically(index_path, index_contents)
+        except (IOError, OSError) as caught_error:
+            self.logger.warning('Failed to write snapshot digest file %s: %s',
+                                index_path, caught_error)
+        return snapshot_version['digest']
+
+    def _load_snapshot_index(self):
+        index_path = os.path.join(self._cache_dir,
+                                  self._SNAPSHOT_INDEX_FILENAME)
+        try:
+            with open(index_path, 'r') as index_file:
+                snapshot_index = json.load(index_file)
+        except IOError:
+            return {}
+        except ValueError:
+            snapshot_index = None
+        if not isinstance(snapshot_index, dict):
+            self.logger.warning('Ignoring malformed snapshot digest file: %s',
+                                index_path)
+            return {}
+        return snapshot_index
+
+    def _build_path(self, snapshot_digest, search_term):
+        term_digest = hashlib.sha1(search_term.encode('utf-8')).hexdigest()
+        filename = '%s-%s.blocks' % (snapshot_digest, term_digest)
+        return os.path.join(self._cache_dir, filename)
 
 
 class IPTranslationStrategyFactory(object):
 
-    def __init__(self, file_opener=open):
+    def __init__(self, file_opener=open, block_cache=None):
+        """Creates a factory for IP translators.
+
+        Args:
+            file_opener: (function) Function used to open snapshot files.
+            block_cache: (IPBlockDiskCache) Persistent cache of IP blocks
+                shared by created translators, or None to disable it.
+        """
         self._file_opener = file_opener
+        self._block_cache = block_cache
         self._cache = {}
 
     def create(self, ip_translation_spec):
@@ -60,7 +249,7 @@ class IPTranslationStrategyFactory(object):
             ip_translator = self._create_maxmind_strategy(
                 ip_translation_spec.params)
         else:
-            ValueError('UnrecognizedIPTranslationStrategy')
+            raise ValueError('UnrecognizedIPTranslationStrategy')
         self._cache[ip_translation_spec] = ip_translator
         return ip_translator
 
@@ -83,7 +272,9 @@ class IPTranslationStrategyFactory(object):
             except IOError as io_error:
                 raise MissingMaxMindError(snapshot_path, io_error)
 
-        return IPTranslationStrategyMaxMind(snapshots)
+        return IPTranslationStrategyMaxMind(snapshots,
+                                            self._block_cache,
+                                            snapshot_path=snapshot_path)
 
 
 class IPTranslationStrategy(object):
@@ -91,66 +282,175 @@ class IPTranslationStrategy(object):
     def find_ip_blocks(self, asn_search_name):
         raise NotImplementedError()
 
+    def find_ip_blocks_for_names(self, asn_search_names):
+        """Finds the IP blocks for several ASN search names.
+
+        Strategies that can search for several names more efficiently than
+        one at a time should override this method.
+
+        Args:
+            asn_search_names (list): Names to search for.
+
+        Returns:
+            dict: A map of each search name to its list of matching blocks.
+        """
+        return {asn_search_name: self.find_ip_blocks(asn_search_name)
+                for asn_search_name in asn_search_names}
+
 
 class IPTranslationStrategyMaxMind(IPTranslationStrategy):
 
-    def __init__(self, snapshots):
+    def __init__(self, snapshots, block_cache=None, snapshot_path=None):
         """Creates a new MaxMind IP translator.
 
+        The snapshot is parsed lazily, the first time that a search cannot be
+        answered from the block cache.
+
         Args:
            snapshots (list): A list of 2-tuples where the first element is a
                datetime and the second element is a file handle to the snapshot
                at that date.
+           block_cache (IPBlockDiskCache): Persistent cache of search results,
+               or None to disable it.
+           snapshot_path (str): Path of the snapshot file, which lets the block
+               cache recognize an unchanged snapshot without hashing it, or
+               None to always hash it.
         """
         self.logger = logging.getLogger('telescope')
         if len(snapshots) > 1:
             raise NotImplementedError(
                 'Multiple MaxMind snapshot processing not yet implemented.')
-        snapshot_file = snapshots[0][1]
-        self._network_map = self._parse_maxmind_snapshot(snapshot_file)
+        self._snapshot_file = snapshots[0][1]
+        self._snapshot_path = snapshot_path
+        self._snapshot_digest = None
+        self._blocks_by_asn_name = None
+        self._block_cache = block_cache
         self._cache = {}
 
     def find_ip_blocks(self, asn_search_name):
         """Search memory-cached copy of map of network maps.
 
-        Currently, searches each (block_start_address, block_end_address,
-        asn_name) list based on a case-insensitive match of the AS name.
+        Currently, searches the AS names in the snapshot based on a
+        case-insensitive match of the AS name.
 
         Args:
             asn_search_name (str): string to search AS names in order to
                 identify network blocks.
 
         Returns:
-            list: Matching tuples of (block_start_address, block_end_address,
-            asn_name), empty if no network found.
+            list: Matching tuples of (block_start_address, block_end_address),
+            sorted by block start, empty if no network found.
 
         Notes:
             * Maintains and consults an internal cache of results since lookup
               process is relatively slow and results should not change.
+            * If a block cache is configured, results are also persisted there
+              and shared between runs.
         """
-        if asn_search_name in self._cache:
-            return self._cache[asn_search_name]
+        return self.find_ip_blocks_for_names([asn_search_name])[asn_search_name]
 
-        notification_cache = set()
-        blocks_to_return = []
+    def find_ip_blocks_for_names(self, asn_search_names):
+        """Finds the IP blocks for several ASN search names in a single pass.
 
-        asn_search_terms = self._translate_short_name(asn_search_name)
-        asn_name_re = re.compile(asn_search_terms, re.IGNORECASE)
+        Names that are not already cached are resolved together, so that the
+        snapshot is scanned once, and each distinct AS name in it is tested
+        once, regardless of how many names are requested.
+
+        Args:
+            asn_search_names (list): Names to search for.
 
-        for block_dict in self._network_map:
-            if asn_name_re.search(block_dict['asn_name']) is not None:
-                if not (block_dict['asn_name'] in notification_cache):
+        Returns:
+            dict: A map of each search name to its list of matching blocks.
+        """
+        uncached_search_terms = {}
+        for asn_search_name in asn_search_names:
+            if asn_search_name in self._cache:
+                continue
+            asn_search_terms = self._translate_short_name(asn_search_name)
+            if self._block_cache:
+                cached_blocks = self._block_cache.get(
+                    self._get_snapshot_digest(), asn_search_terms)
+                if cached_blocks is not None:
+                    self.logger.debug('Found cached IP blocks for %s.',
+                                      asn_search_name)
+                    self._cache[asn_search_name] = cached_blocks
+                    continue
+            uncached_search_terms[asn_search_name] = asn_search_terms
+
+        if uncached_search_terms:
+            found_blocks = self._search_network_map(uncached_search_terms)
+            for asn_search_name, blocks in found_blocks.iteritems():
+                if self._block_cache:
+                    self._block_cache.put(
+                        self._get_snapshot_digest(),
+                        uncached_search_terms[asn_search_name], blocks)
+                self._cache[asn_search_name] = blocks
+
+        return {asn_search_name: self._cache[asn_search_name]
+                for asn_search_name in asn_search_names}
+
+    def _search_network_map(self, search_terms_by_name):
+        """Searches the parsed snapshot for blocks with matching AS names.
+
+        All search terms are combined into a single regex, which is tested
+        once against each distinct AS name. Only AS names that match the
+        combined regex are tested against the individual search terms.
+
+        Args:
+            search_terms_by_name (dict): A map of ISP names to the regexes that
+                match their AS names.
+
+        Returns:
+            dict: A map of each ISP name to its list of matching
+            (block_start_address, block_end_address) tuples.
+        """
+        if self._blocks_by_asn_name is None:
+            self._blocks_by_asn_name = self._parse_maxmind_snapshot(
+                self._snapshot_file)
+
+        search_res = {name: re.compile(search_terms, re.IGNORECASE)
+                      for name, search_terms in search_terms_by_name.items()}
+        combined_re = re.compile(
+            self._regex_xor_names(search_terms_by_name.values(),
+                                  escape=False),
+            re.IGNORECASE)
+        blocks_by_name = {name: [] for name in search_terms_by_name}
+
+        for asn_name, blocks in self._blocks_by_asn_name.iteritems():
+            if combined_re.search(asn_name) is None:
+                continue
+            for name, search_re in search_res.iteritems():
+                if search_re.search(asn_name) is not None:
                     self.logger.debug((
                         'Found IP block associated with name {asn_name} searching for term '
-                        '{asn_search_name}.').format(
-                            asn_name=block_dict['asn_name'],
-                            asn_search_name=asn_search_name))
-                    notification_cache.add(block_dict['asn_name'])
-                block_start = int(block_dict['block_start'])
-                block_end = int(block_dict['block_end'])
-                blocks_to_return.append((block_start, block_end))
-        self._cache[asn_search_name] = blocks_to_return
-        return blocks_to_return
+                        '{asn_search_name}.').format(asn_name=asn_name,
+                                                     asn_search_name=name))
+                    blocks_by_name[name].extend(blocks)
+
+        for blocks in blocks_by_name.itervalues():
+            blocks.sort()
+        return blocks_by_name
+
+    def _get_snapshot_digest(self):
+        """Finds the SHA-1 digest of the snapshot file's contents.
+
+        Returns:
+            str: Hex digest of the snapshot file.
+        """
+        if self._snapshot_digest is None:
+            if self._block_cache and self._snapshot_path:
+                self._snapshot_digest = self._block_cache.get_snapshot_digest(
+                    self._snapshot_path, self._hash_snapshot)
+            else:
+                self._snapshot_digest = self._hash_snapshot()
+        return self._snapshot_digest
+
+    def _hash_snapshot(self):
+        snapshot_hash = hashlib.sha1()
+        for chunk in iter(lambda: self._snapshot_file.read(1 << 20), b''):
+            snapshot_hash.update(chunk)
+        self._snapshot_file.seek(0)
+        return snapshot_hash.hexdigest()
 
     @staticmethod
     def get_maxmind_snapshot_path(snapshot_datetime, maxmind_dir):
@@ -169,26 +469,31 @@ class IPTranslationStrategyMaxMind(IPTranslationStrategy):
             os.path.dirname(__file__), maxmind_dir, snapshot_filename)
 
     def _parse_maxmind_snapshot(self, snapshot_file):
-        """Parses a MaxMind snapshot file into a list of blocks with associated
-        ASN names.
+        """Parses a MaxMind snapshot file into an index of blocks by ASN name.
 
         Args:
-            snapshot_filename (str): Filename of MaxMind snapshot to parse.
+            snapshot_file (file): MaxMind snapshot file to parse.
 
         Returns:
-            list: A list of dicts, each containing a 'block_start', 'block_end',
-            and 'asn_name' entry, according to entries in the MaxMind
-            snapshot.
-        """
-        block_rows = []
-        csvReader = csv.DictReader(
-            snapshot_file,
-            fieldnames=['block_start', 'block_end', 'asn_name'])
-        for block_row in csvReader:
-            block_rows.append(block_row)
-        self.logger.debug('Parsed %d blocks from MaxMind snapshot',
-                          len(block_rows))
-        return block_rows
+            dict: A map of each distinct ASN name in the snapshot to a list of
+            (block_start, block_end) tuples for the blocks associated with
+            that name.
+        """
+        blocks_by_asn_name = {}
+        block_count = 0
+        for block_row in csv.reader(snapshot_file):
+            if len(block_row) < 3:
+                self.logger.debug('Skipping malformed MaxMind row: %s',
+                                  block_row)
+                continue
+            block_start, block_end, asn_name = block_row[:3]
+            blocks_by_asn_name.setdefault(asn_name, []).append(
+                (int(block_start), int(block_end)))
+            block_count += 1
+        self.logger.debug(
+            'Parsed %d blocks with %d distinct ASN names from MaxMind '
+            'snapshot', block_count, len(blocks_by_asn_name))
+        return blocks_by_asn_name
 
     def _translate_short_name(self, short_name):
         """Translates an ISP shortname into a regex that matches all company names
@@ -201,7 +506,7 @@ class IPTranslationStrategyMaxMind(IPTranslationStrategy):
         Returns:
             str: A regex string that matches company names that are part of the
             specified ISP. For example, level3 translates to:
-                '(Level 3 Communications)|(GBLX)'
+                '(?:Level 3 Communications)|(?:GBLX)'
         """
         short_name_map = {
             'twc': ['Time Warner'],
@@ -218,17 +523,61 @@ class IPTranslationStrategyMaxMind(IPTranslationStrategy):
 
         return re.escape(short_name)
 
-    def _regex_xor_names(self, names):
+    def _regex_xor_names(self, names, escape=True):
         """Converts a list of names into a regex that matches any of the names.
 
         Args:
             names (list): A list of ISP names.
+            escape (bool): Whether to escape regex special characters in the
+                names. Pass False to combine names that are already regexes.
 
         Returns:
             str: A regex that matches any name in the list. For example, the
-            list ['foo', 'bar', 'baz'] would result in '(foo)|(bar)|(baz)'.
+            list ['foo', 'bar', 'baz'] would result in
+            '(?:foo)|(?:bar)|(?:baz)'.
         """
-        escaped_names = []
-        for name in names:
-            escaped_names.append(re.escape(name))
-        return '(' + ')|('.join(escaped_names) + ')'
+        if escape:
+            names = [re.escape(name) for name in names]
+        return '(?:' + ')|(?:'.join(names) + ')'
+
+
+class _FrozenDict(tuple):
+    """Marks a tuple of sorted (key, value) pairs as a frozen dict."""
+    __slots__ = ()
+
+
+def _is_same_snapshot_version(indexed_version, snapshot_version):
+    """Checks that an index entry records a digest of a snapshot's version."""
+    if not isinstance(indexed_version, dict):
+        return False
+    if not isinstance(indexed_version.get('digest'), basestring):
+        return False
+    return (indexed_version.get('size') == snapshot_version['size'] and
+            indexed_version.get('mtime') == snapshot_version['mtime'])
+
+
+def _freeze(value):
+    """Converts a parameter value into an equivalent, hashable value.
+
+    Args:
+        value: A value parsed from JSON, possibly containing dicts and lists.
+
+    Returns:
+        A hashable equivalent of value in which dicts become _FrozenDicts and
+        lists become tuples.
+    """
+    if isinstance(value, dict):
+        return _FrozenDict(sorted((key, _freeze(item))
+                                  for key, item in value.items()))
+    elif isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _thaw(value):
+    """Reverses _freeze, producing a mutable copy of a frozen value."""
+    if isinstance(value, _FrozenDict):
+        return {key: _thaw(item) for key, item in value}
+    elif isinstance(value, tuple):
+        return [_thaw(item) for item in value]
+    return value
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Records the statistics that BigQuery reports for each finished job.
+
+BigQuery reports the bytes each query processed and billed, whether it was
+answered from BigQuery's cache, the slot time it consumed and the time spent
+in each stage of its plan. The statistics of each selector's job are written
+alongside its output and summarized by metric, site and client provider, so
+that the costliest selectors and query forms can be found.
+"""
+
+import collections
+import json
+import logging
+import os
+import threading
+
+# Number of most expensive selectors to list in a statistics report.
+DEFAULT_EXPENSIVE_COUNT = 10
+
+# Metadata fields by which a statistics report groups jobs.
+REPORT_GROUPINGS = ('metric', 'site', 'client_provider')
+
+_STATISTICS_FIELDS = ('job_id', 'bytes_processed', 'bytes_billed', 'cache_hit',
+                      'slot_millis', 'pending_millis', 'running_millis',
+                      'stages')
+
+
+class JobStatistics(collections.namedtuple('JobStatistics',
+                                           _STATISTICS_FIELDS)):
+    """The statistics of a finished BigQuery job.
+
+    Attributes:
+        job_id: (str) ID of the job.
+        bytes_processed: (int) Bytes read by the query.
+        bytes_billed: (int) Bytes for which the query was billed.
+        cache_hit: (bool) Whether the results came from BigQuery's cache.
+        slot_millis: (int) Slot milliseconds consumed by the query.
+        pending_millis: (int) Milliseconds between the job's creation and the
+            start of its execution, or None if BigQuery did not report them.
+        running_millis: (int) Milliseconds the job spent executing, or None if
+            BigQuery did not report them.
+        stages: (tuple) A dict for each stage of the query plan, with its name
+            and the average milliseconds its workers spent waiting, reading,
+            computing and writing.
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        statistics_dict = dict(zip(_STATISTICS_FIELDS, self))
+        statistics_dict['stages'] = list(self.stages)
+        return statistics_dict
+
+
+def parse_job_statistics(job_id, job_resource):
+    """Extracts the statistics of a job from its jobs.get response.
+
+    Args:
+        job_id: (str) ID of the job.
+        job_resource: (dict) The job, as returned by jobs.get.
+
+    Returns:
+        (JobStatistics) The job's statistics, with zeros for the values that
+        BigQuery did not report.
+    """
+    statistics = job_resource.get('statistics', {})
+    query_statistics = statistics.get('query', {})
+    # BigQuery reports 64-bit integers as strings.
+    bytes_processed = int(query_statistics.get(
+        'totalBytesProcessed', statistics.get('totalBytesProcessed', 0)))
+    stages = tuple({
+        'name': stage.get('name'),
+        'wait_millis': int(stage.get('waitMsAvg', 0)),
+        'read_millis': int(stage.get('readMsAvg', 0)),
+        'compute_millis': int(stage.get('computeMsAvg', 0)),
+        'write_millis': int(stage.get('writeMsAvg', 0))
+    } for stage in query_statistics.get('queryPlan', []))
+    return JobStatistics(
+        job_id=job_id,
+        bytes_processed=bytes_processed,
+        bytes_billed=int(query_statistics.get('totalBytesBilled', 0)),
+        cache_hit=bool(query_statistics.get('cacheHit', False)),
+        slot_millis=int(query_statistics.get('totalSlotMs', 0)),
+        pending_millis=_millis_between(statistics, 'creationTime', 'startTime'),
+        running_millis=_millis_between(statistics, 'startTime', 'endTime'),
+        stages=stages)
+
+
+def _millis_between(statistics, start_field, end_field):
+    if start_field not in statistics or end_field not in statistics:
+        return None
+    return int(statistics[end_field]) - int(statistics[start_field])
+
+
+def build_statistics_filepath(data_filepath):
+    """Builds the path of the statistics file of a selector's job.
+
+    Args:
+        data_filepath: (str) Path to which the selector's results are written.
+
+    Returns:
+        (str) Path of the JSON file alongside the results.
+    """
+    return os.path.splitext(data_filepath)[0] + '-jobstats.json'
+
+
+def write_job_statistics(statistics_filepath, thread_metadata, job_statistics):
+    """Writes the statistics of a selector's job to a JSON file.
+
+    Args:
+        statistics_filepath: (str) Path of the file to write.
+        thread_metadata: (dict) Metadata that labels the job's selector.
+        job_statistics: (JobStatistics) Statistics of the job.
+
+    Returns:
+        (bool) True if the file was written successfully.
+    """
+    try:
+        with open(statistics_filepath, 'w') as statistics_file:
+            json.dump({'selector': thread_metadata,
+                       'statistics': job_statistics.to_dict()},
+                      statistics_file,
+                      indent=2,
+                      sort_keys=True)
+        return True
+    except IOError as caught_error:
+        logging.getLogger('telescope').error(
+            'Failed to write job statistics %s: %s', statistics_filepath,
+            caught_error)
+    return False
+
+
+class JobStatisticsRecorder(object):
+    """Thread-safe recorder of the statistics of each selector's job."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = []
+
+    def record(self, thread_metadata, job_statistics):
+        """Records the statistics of a selector's finished job.
+
+        Args:
+            thread_metadata: (dict) Metadata that labels the job's selector.
+            job_statistics: (JobStatistics) Statistics of the job.
+        """
+        with self._lock:
+            self._records.append((dict(thread_metadata), job_statistics))
+
+    def summarize(self, expensive_count=DEFAULT_EXPENSIVE_COUNT):
+        """Summarizes the recorded statistics.
+
+        Args:
+            expensive_count: (int) Number of most expensive selectors to
+                include.
+
+        Returns:
+            (dict) Summary with the totals of every job, the totals of the jobs
+            of each value of each of REPORT_GROUPINGS, and the selectors whose
+            jobs billed the most bytes.
+        """
+        with self._lock:
+            records = list(self._records)
+        groupings = {}
+        for grouping in REPORT_GROUPINGS:
+            jobs_by_value = {}
+            for thread_metadata, job_statistics in records:
+                jobs_by_value.setdefault(
+                    str(thread_metadata.get(grouping)),
+                    []).append(job_statistics)
+            groupings[grouping] = {
+                value: _total_statistics(value_statistics)
+                for value, value_statistics in jobs_by_value.iteritems()
+            }
+        # Bytes billed decide the cost of on-demand queries, and slot time
+        # breaks ties between the cached or minimum-billed queries.
+        records.sort(
+            key=lambda record: (record[1].bytes_billed, record[1].slot_millis),
+            reverse=True)
+        return {
+            'totals': _total_statistics(
+                [job_statistics for _, job_statistics in records]),
+            'groupings': groupings,
+            'most_expensive_selectors': [
+                {'selector': thread_metadata,
+                 'statistics': job_statistics.to_dict()}
+                for thread_metadata, job_statistics in records[:expensive_count]
+            ]
+        }
+
+    def write_report(self,
+                     report_filepath,
+                     expensive_count=DEFAULT_EXPENSIVE_COUNT):
+        """Writes the summary of the recorded statistics to a JSON file.
+
+        Args:
+            report_filepath: (str) Path of the file to write.
+            expensive_count: (int) Number of most expensive selectors to
+                include.
+
+        Returns:
+            (bool) True if the report was written successfully.
+        """
+        try:
+            with open(report_filepath, 'w') as report_file:
+                json.dump(
+                    self.summarize(expensive_count),
+                    report_file,
+                    indent=2,
+                    sort_keys=True)
+            return True
+        except IOError as caught_error:
+            logging.getLogger('telescope').error(
+                'Failed to write job statistics report %s: %s', report_filepath,
+                caught_error)
+        return False
+
+
+def _total_statistics(job_statistics_list):
+    return {
+        'jobs': len(job_statistics_list),
+        'cache_hits': sum(1 for job_statistics in job_statistics_list
+                          if job_statistics.cache_hit),
+        'bytes_processed': sum(job_statistics.bytes_processed
+                               for job_statistics in job_statistics_list),
+        'bytes_billed': sum(job_statistics.bytes_billed
+                            for job_statistics in job_statistics_list),
+        'slot_millis': sum(job_statistics.slot_millis
+                           for job_statistics in job_statistics_list)
+    }
+
+# Recorder shared by every module in the process, in the same way as the
+# shared timing recorder.
+_recorder = JobStatisticsRecorder()
+
+
+def get_recorder():
+    return _recorder
+
+
+def record(thread_metadata, job_statistics):
+    """Records the statistics of a job with the shared recorder."""
+    _recorder.record(thread_metadata, job_statistics)
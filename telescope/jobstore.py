@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Records the state of each selector's BigQuery job in a SQLite file.
+
+Each selector's job moves through the queued, submitted, running and either
+downloaded or failed states. The store keeps the current state of every job
+along with the time of each transition, so that a later run, or a status
+query, can tell what happened to each selector after the process exits.
+"""
+
+import collections
+import hashlib
+import json
+import time
+
+import sqlitedb
+
+QUEUED = 'queued'
+SUBMITTED = 'submitted'
+RUNNING = 'running'
+DOWNLOADED = 'downloaded'
+FAILED = 'failed'
+STATES = (QUEUED, SUBMITTED, RUNNING, DOWNLOADED, FAILED)
+
+# Column of the jobs table that records when a job last entered each state.
+_TIME_COLUMNS = {
+    QUEUED: 'queued_time',
+    SUBMITTED: 'submitted_time',
+    RUNNING: 'running_time',
+    DOWNLOADED: 'finished_time',
+    FAILED: 'finished_time'
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    selector_key TEXT PRIMARY KEY,
+    output_path TEXT NOT NULL,
+    sql_hash TEXT NOT NULL,
+    state TEXT NOT NULL,
+    job_id TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    detail TEXT,
+    queued_time REAL,
+    submitted_time REAL,
+    running_time REAL,
+    finished_time REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state);
+CREATE TABLE IF NOT EXISTS job_transitions (
+    selector_key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    job_id TEXT,
+    transition_time REAL NOT NULL,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS job_transitions_by_key
+    ON job_transitions (selector_key);
+"""
+
+_JOB_COLUMNS = ('selector_key', 'output_path', 'sql_hash', 'state', 'job_id',
+                'attempts', 'detail', 'queued_time', 'submitted_time',
+                'running_time', 'finished_time')
+
+
+class JobRecord(collections.namedtuple('JobRecord', _JOB_COLUMNS)):
+    """The current state of a selector's job.
+
+    Attributes:
+        selector_key: (str) Key of the selector, from create_selector_key.
+        output_path: (str) Path to which the job's results are written.
+        sql_hash: (str) Hash of the job's query, from create_sql_hash.
+        state: (str) One of STATES.
+        job_id: (str) ID of the latest BigQuery job, or None if no job has
+            been submitted.
+        attempts: (int) Number of BigQuery jobs submitted for the selector.
+        detail: (str) Description of the latest transition, such as an error.
+        queued_time: (float) Time at which the job was last queued.
+        submitted_time: (float) Time at which the latest job was submitted.
+        running_time: (float) Time at which the latest job began running.
+        finished_time: (float) Time at which the job was downloaded or failed.
+    """
+    __slots__ = ()
+
+
+def create_selector_key(thread_metadata):
+    """Creates a key that identifies a selector by its output metadata.
+
+    Args:
+        thread_metadata: (dict) Metadata that labels the selector's query and
+            output files.
+
+    Returns:
+        (str) Hex digest that identifies the selector.
+    """
+    return hashlib.sha1(json.dumps(thread_metadata, sort_keys=True)).hexdigest()
+
+
+def create_sql_hash(bq_query_string):
+    """Hashes a query, so that a changed query for a selector is detected."""
+    return hashlib.sha1(bq_query_string).hexdigest()
+
+
+class SQLiteJobStore(object):
+    """Store of job states, kept in a SQLite database file.
+
+    Every update changes a job's current state and appends to its history of
+    transitions in a single transaction, so that the two always agree.
+    """
+
+    def __init__(self, store_filepath):
+        """Opens the store, creating it if it does not exist.
+
+        Args:
+            store_filepath: (str) Path of the SQLite database file.
+        """
+        self._store_filepath = store_filepath
+        sqlitedb.create_schema(store_filepath, _SCHEMA)
+
+    def _transact(self, operation):
+        return sqlitedb.transact(self._store_filepath, operation)
+
+    def record_queued(self, selector_key, output_path, bq_query_string):
+        """Records that a selector's query was generated and queued.
+
+        Args:
+            selector_key: (str) Key of the selector.
+            output_path: (str) Path to which the job's results are written.
+            bq_query_string: (str) The selector's query.
+        """
+        now = time.time()
+
+        def queue_job(cursor):
+            cursor.execute(
+                'INSERT OR IGNORE INTO jobs (selector_key, output_path, '
+                'sql_hash, state) VALUES (?, ?, ?, ?)',
+                (selector_key, output_path, create_sql_hash(bq_query_string),
+                 QUEUED))
+            cursor.execute(
+                'UPDATE jobs SET output_path = ?, sql_hash = ?, state = ?, '
+                'detail = NULL, queued_time = ?, submitted_time = NULL, '
+                'running_time = NULL, finished_time = NULL '
+                'WHERE selector_key = ?',
+                (output_path, create_sql_hash(bq_query_string), QUEUED, now,
+                 selector_key))
+            _insert_transition(cursor, selector_key, QUEUED, None, now, None)
+
+        self._transact(queue_job)
+
+    def record_state(self, selector_key, state, job_id=None, detail=None):
+        """Records that a selector's job entered a new state.
+
+        Args:
+            selector_key: (str) Key of the selector.
+            state: (str) One of STATES.
+            job_id: (str) ID of the BigQuery job, or None to keep the job ID
+                already recorded.
+            detail: (str) Description of the transition, such as an error.
+
+        Returns:
+            (bool) True if the selector's job was in the store.
+        """
+        now = time.time()
+
+        def update_job(cursor):
+            cursor.execute(
+                'UPDATE jobs SET state = ?, job_id = COALESCE(?, job_id), '
+                'detail = ?, attempts = attempts + ?, ' + _TIME_COLUMNS[state] +
+                ' = ? WHERE selector_key = ?', (state, job_id, detail, 1
+                                                if state == SUBMITTED else 0,
+                                                now, selector_key))
+            if cursor.rowcount != 1:
+                return False
+            _insert_transition(cursor, selector_key, state, job_id, now, detail)
+            return True
+
+        return self._transact(update_job)
+
+    def requeue_unfinished(self, detail=None):
+        """Returns the jobs that were submitted but not finished to the queue.
+
+        Args:
+            detail: (str) Description of why the jobs were requeued.
+
+        Returns:
+            (int) Number of jobs requeued.
+        """
+        now = time.time()
+
+        def requeue_jobs(cursor):
+            selector_keys = [
+                row[0]
+                for row in cursor.execute(
+                    'SELECT selector_key FROM jobs WHERE state IN (?, ?)', (
+                        SUBMITTED, RUNNING)).fetchall()
+            ]
+            cursor.executemany(
+                'UPDATE jobs SET state = ?, detail = ?, queued_time = ? '
+                'WHERE selector_key = ?', [(QUEUED, detail, now, selector_key)
+                                           for selector_key in selector_keys])
+            for selector_key in selector_keys:
+                _insert_transition(cursor, selector_key, QUEUED, None, now,
+                                   detail)
+            return len(selector_keys)
+
+        return self._transact(requeue_jobs)
+
+    def get_job(self, selector_key):
+        """Retrieves the current state of a selector's job.
+
+        Args:
+            selector_key: (str) Key of the selector.
+
+        Returns:
+            (JobRecord) The job, or None if it is not in the store.
+        """
+
+        def find_job(cursor):
+            return cursor.execute(
+                'SELECT ' + ', '.join(_JOB_COLUMNS) + ' FROM jobs '
+                'WHERE selector_key = ?', (selector_key,)).fetchone()
+
+        row = self._transact(find_job)
+        return JobRecord(*row) if row else None
+
+    def list_jobs(self, state=None):
+        """Lists the jobs in the store.
+
+        Args:
+            state: (str) One of STATES to list only jobs in that state, or None
+                to list every job.
+
+        Returns:
+            (list) JobRecord objects, ordered by output path.
+        """
+        query_string = 'SELECT ' + ', '.join(_JOB_COLUMNS) + ' FROM jobs'
+        query_params = ()
+        if state:
+            query_string += ' WHERE state = ?'
+            query_params = (state,)
+        query_string += ' ORDER BY output_path'
+
+        def find_jobs(cursor):
+            return cursor.execute(query_string, query_params).fetchall()
+
+        return [JobRecord(*row) for row in self._transact(find_jobs)]
+
+    def list_transitions(self, selector_key):
+        """Lists the states that a selector's job has passed through.
+
+        Args:
+            selector_key: (str) Key of the selector.
+
+        Returns:
+            (list) (state, job ID, time, detail) tuples, oldest first.
+        """
+
+        def find_transitions(cursor):
+            return cursor.execute(
+                'SELECT state, job_id, transition_time, detail '
+                'FROM job_transitions WHERE selector_key = ? '
+                'ORDER BY rowid', (selector_key,)).fetchall()
+
+        return self._transact(find_transitions)
+
+    def count_states(self):
+        """Counts the jobs in each state.
+
+        Returns:
+            (dict) A map of each of STATES to its number of jobs.
+        """
+
+        def count_jobs(cursor):
+            return cursor.execute('SELECT state, COUNT(*) FROM jobs '
+                                  'GROUP BY state').fetchall()
+
+        state_counts = dict.fromkeys(STATES, 0)
+        state_counts.update(self._transact(count_jobs))
+        return state_counts
+
+
+def _insert_transition(cursor, selector_key, state, job_id, transition_time,
+                       detail):
+    cursor.execute('INSERT INTO job_transitions (selector_key, state, job_id, '
+                   'transition_time, detail) VALUES (?, ?, ?, ?, ?)',
+                   (selector_key, state, job_id, transition_time, detail))
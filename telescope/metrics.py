@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Exposes live counters and gauges of a run over HTTP.
+
+Metrics are served in the Prometheus text exposition format, so that a
+long-running job can be watched with curl or scraped by a monitoring system.
+"""
+
+import BaseHTTPServer
+import logging
+import threading
+
+import instrumentation
+
+# Counters and gauges reported by the selector queue, job monitor, result
+# collector and writers.
+SELECTOR_QUEUE_DEPTH = 'telescope_selector_queue_depth'
+QUERIES_SUBMITTED = 'telescope_queries_submitted_total'
+QUERY_RETRIES = 'telescope_query_retries_total'
+PROJECT_THROTTLES = 'telescope_project_throttles_total'
+JOBS_IN_FLIGHT = 'telescope_jobs_in_flight'
+JOB_POLLS = 'telescope_job_polls_total'
+JOBS_SUCCEEDED = 'telescope_jobs_succeeded_total'
+JOBS_FAILED = 'telescope_jobs_failed_total'
+JOBS_CANCELLED = 'telescope_jobs_cancelled_total'
+HEDGED_JOBS = 'telescope_hedged_jobs_total'
+HEDGES_WON = 'telescope_hedges_won_total'
+JOBS_PROMOTED = 'telescope_jobs_promoted_total'
+DEADLINES_EXCEEDED = 'telescope_deadlines_exceeded_total'
+BYTES_PROCESSED = 'telescope_bytes_processed_total'
+BYTES_BILLED = 'telescope_bytes_billed_total'
+SLOT_MILLIS = 'telescope_slot_milliseconds_total'
+CACHE_HITS = 'telescope_cache_hits_total'
+RESULT_PAGES = 'telescope_result_pages_total'
+RESULT_ROWS = 'telescope_result_rows_total'
+OUTPUT_FILES_WRITTEN = 'telescope_output_files_written_total'
+OUTPUT_BYTES_WRITTEN = 'telescope_output_bytes_written_total'
+
+
+class MetricsRegistry(object):
+    """Thread-safe registry of named counters and gauges."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+
+    def increment(self, name, amount=1):
+        """Adds to a counter, which only ever increases."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        """Sets a gauge to its current value."""
+        with self._lock:
+            self._gauges[name] = value
+
+    def add_to_gauge(self, name, amount):
+        """Adds to a gauge, which may increase or decrease."""
+        with self._lock:
+            self._gauges[name] = self._gauges.get(name, 0) + amount
+
+    def get_value(self, name):
+        """Retrieves the value of a counter or gauge, or 0 if it is unset."""
+        with self._lock:
+            return self._counters.get(name, self._gauges.get(name, 0))
+
+    def render(self, timing_recorder=None):
+        """Renders the metrics in the Prometheus text exposition format.
+
+        Args:
+            timing_recorder: (instrumentation.TimingRecorder) Recorder whose
+                stage timings to include, or None to include only counters and
+                gauges.
+
+        Returns:
+            (str) The rendered metrics.
+        """
+        lines = []
+        with self._lock:
+            for metric_type, values in (('counter', self._counters),
+                                        ('gauge', self._gauges)):
+                for name in sorted(values):
+                    lines.append('# TYPE %s %s' % (name, metric_type))
+                    lines.append('%s %s' % (name, values[name]))
+        if timing_recorder:
+            stage_totals = timing_recorder.stage_totals()
+            for name, total_index in (('telescope_stage_executions_total', 0),
+                                      ('telescope_stage_seconds_total', 1)):
+                lines.append('# TYPE %s counter' % name)
+                for stage in sorted(stage_totals):
+                    lines.append(
+                        '%s{stage="%s"} %s' %
+                        (name, stage, stage_totals[stage][total_index]))
+        return ''.join(line + '\n' for line in lines)
+
+
+class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render(self.server.timing_recorder)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger('telescope').debug('Metrics request: ' + format,
+                                             *args)
+
+
+def start_metrics_server(port,
+                         host='localhost',
+                         registry=None,
+                         timing_recorder=None):
+    """Serves metrics at /metrics from a background thread.
+
+    Args:
+        port: (int) Port on which to listen, or 0 for any free port.
+        host: (str) Address on which to listen.
+        registry: (MetricsRegistry) Registry to serve, or None for the shared
+            registry.
+        timing_recorder: (instrumentation.TimingRecorder) Recorder whose stage
+            timings to serve, or None for the shared recorder.
+
+    Returns:
+        (BaseHTTPServer.HTTPServer) The running server. Its server_address
+        attribute gives the port on which it listens, and shutdown() stops it.
+    """
+    server = BaseHTTPServer.HTTPServer((host, port), _MetricsRequestHandler)
+    server.registry = registry or _registry
+    server.timing_recorder = (timing_recorder or instrumentation.get_recorder())
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    logging.getLogger('telescope').info(
+        'Serving metrics at http://%s:%d/metrics', host,
+        server.server_address[1])
+    return server
+
+# Registry shared by every module in the process.
+_registry = MetricsRegistry()
+
+
+def get_registry():
+    return _registry
+
+
+def increment(name, amount=1):
+    _registry.increment(name, amount)
+
+
+def set_gauge(name, value):
+    _registry.set_gauge(name, value)
+
+
+def add_to_gauge(name, amount):
+    _registry.add_to_gauge(name, amount)
@@ -15,7 +15,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
+import datetime
+import json
+import logging
 import socket
+import time
+from multiprocessing.pool import ThreadPool
+
+import utils
+
+# Maximum number of hostnames to resolve concurrently.
+MAX_RESOLVER_THREADS = 32
+
+# Default number of seconds for which resolved addresses in the cache file
+# remain valid.
+DEFAULT_CACHE_TTL = 24 * 60 * 60
 
 
 class DNSResolutionError(Exception):
@@ -24,17 +39,177 @@ class DNSResolutionError(Exception):
         Exception.__init__(self, 'Failed to resolve hostname `%s\'' % hostname)
 
 
+class SiteHistoryError(Exception):
+    pass
+
+
+class SiteHistoryParseError(SiteHistoryError):
+
+    def __init__(self, message):
+        super(SiteHistoryParseError, self).__init__(
+            'Failed to parse site history file: %s' % message)
+
+
+class SiteHistoryNoCoverage(SiteHistoryError):
+
+    def __init__(self, site_id, start_time, end_time):
+        super(SiteHistoryNoCoverage, self).__init__(
+            'Site history has no server addresses for %s between %s and %s' %
+            (site_id, start_time, end_time))
+
+
+class MLabSiteHistory(object):
+    """Time-versioned index of the server addresses of M-Lab sites.
+
+    The history file is a JSON dictionary that maps each site ID to a list of
+    periods during which the site's NDT servers had a given set of addresses:
+
+        {
+          "nuq01": [
+            {"start": "2012-01-01T00:00:00Z",
+             "end": "2015-06-01T00:00:00Z",
+             "ips": ["1.1.1.1", "1.1.1.2", "1.1.1.3"]},
+            {"start": "2015-06-01T00:00:00Z",
+             "end": null,
+             "ips": ["2.2.2.1", "2.2.2.2", "2.2.2.3", "2.2.2.4"]}
+          ]
+        }
+
+    A null end indicates that the period is still current.
+    """
+
+    _TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+    def __init__(self, history_dict):
+        """Builds the index from a parsed history file.
+
+        Args:
+            history_dict (dict): Site history in the format described above.
+        """
+        # Map of site ID to a list of (start, end, ips) tuples sorted by start,
+        # where start and end are UNIX timestamps and end may be None.
+        self._periods_by_site = {}
+        # Map of site ID to the sorted list of its period start times.
+        self._starts_by_site = {}
+        for site_id, periods in history_dict.items():
+            parsed_periods = sorted(self._parse_period(period)
+                                    for period in periods)
+            self._periods_by_site[site_id.lower()] = parsed_periods
+            self._starts_by_site[site_id.lower()] = [
+                period[0] for period in parsed_periods
+            ]
+
+    @classmethod
+    def from_file(cls, history_filepath):
+        """Loads a site history from a JSON file.
+
+        Args:
+            history_filepath (str): Path to the site history file.
+
+        Returns:
+            MLabSiteHistory: The parsed history.
+        """
+        with open(history_filepath, 'r') as history_file:
+            try:
+                return cls(json.load(history_file))
+            except ValueError:
+                raise SiteHistoryParseError('MalformedJSON')
+
+    def has_site(self, site_id):
+        return site_id in self._periods_by_site
+
+    def get_site_ndt_ips(self, site_id, start_time, end_time):
+        """Finds the addresses that a site's servers had during a window.
+
+        Args:
+            site_id (str): M-Lab site identifier.
+            start_time (datetime): Start of the time window (inclusive).
+            end_time (datetime): End of the time window (exclusive).
+
+        Returns:
+            list: Sorted list of every address that the site's servers had at
+            any time during the window.
+
+        Raises:
+            SiteHistoryNoCoverage: The history has no periods for the site that
+                overlap the window.
+        """
+        window_start = utils.utc_datetime_to_unix_timestamp(start_time)
+        window_end = utils.utc_datetime_to_unix_timestamp(end_time)
+        periods = self._periods_by_site.get(site_id, [])
+        # Only periods that begin before the window ends can overlap it.
+        candidate_count = bisect.bisect_left(
+            self._starts_by_site.get(site_id, []), window_end)
+
+        ips = set()
+        for period_start, period_end, period_ips in periods[:candidate_count]:
+            if period_end is None or period_end > window_start:
+                ips.update(period_ips)
+        if not ips:
+            raise SiteHistoryNoCoverage(site_id, start_time, end_time)
+        return sorted(ips)
+
+    def _parse_period(self, period):
+        try:
+            start = self._parse_time(period['start'])
+            end = None
+            if period.get('end'):
+                end = self._parse_time(period['end'])
+            return start, end, tuple(period['ips'])
+        except KeyError as e:
+            raise SiteHistoryParseError('Missing expected field: %s' %
+                                        e.args[0])
+
+    def _parse_time(self, time_string):
+        try:
+            return utils.utc_datetime_to_unix_timestamp(
+                datetime.datetime.strptime(time_string, self._TIME_FORMAT))
+        except ValueError:
+            raise SiteHistoryParseError('UnsupportedTimeFormat')
+
+
 class MLabSiteResolver(object):
 
-    def __init__(self):
+    def __init__(self,
+                 cache_filepath=None,
+                 cache_ttl=DEFAULT_CACHE_TTL,
+                 site_map_filepath=None,
+                 site_history=None):
+        """Creates a resolver of M-Lab site IDs to server addresses.
+
+        Args:
+            cache_filepath (str): Path of a file in which to persist resolved
+                addresses between runs, or None to cache only in memory.
+            cache_ttl (int): Number of seconds for which addresses in the
+                cache file remain valid.
+            site_map_filepath (str): Path of a JSON file that maps site IDs to
+                lists of server addresses. Sites in the map are never resolved
+                with DNS, which allows resolution to work offline.
+            site_history (MLabSiteHistory): History of site addresses, used in
+                preference to the site map and DNS when a time window is given.
+        """
+        self.logger = logging.getLogger('telescope')
         self._cache = {}
+        self._resolution_times = {}
+        self._cache_filepath = cache_filepath
+        self._cache_ttl = cache_ttl
+        self._site_map = {}
+        self._site_history = site_history
+        if site_map_filepath:
+            self._site_map = self._load_site_map(site_map_filepath)
+        if cache_filepath:
+            self._load_cache()
 
-    def get_site_ndt_ips(self, site_id):
+    def get_site_ndt_ips(self, site_id, start_time=None, end_time=None):
         """Get a list of a Measurement Lab site and slice's addresses.
 
         Args:
             site_id (str): M-Lab site identifier, should be an airport code and
                 a two-digit number.
+            start_time (datetime): Start of the time window for which to find
+                addresses, or None for the current addresses.
+            end_time (datetime): End of the time window for which to find
+                addresses, or None for the current addresses.
 
         Returns:
             list: List of the IP addresses associated with the slices for a tool
@@ -44,7 +219,16 @@ class MLabSiteResolver(object):
             * Different tools generally have their own IP addresses per node.
               Where they do not, the difference should be handled transparently
               by this function.
+            * If a site history is available and has the site, addresses come
+              from the history rather than from the site map or DNS.
         """
+        if (self._site_history and start_time and end_time and
+                self._site_history.has_site(site_id)):
+            return self._site_history.get_site_ndt_ips(site_id, start_time,
+                                                       end_time)
+        if site_id in self._site_map:
+            return list(self._site_map[site_id])
+
         node_addresses_to_return = []
 
         for node_id in ['mlab1', 'mlab2', 'mlab3']:
@@ -54,11 +238,99 @@ class MLabSiteResolver(object):
 
         return node_addresses_to_return
 
+    def prefetch_sites(self, site_ids):
+        """Resolves the addresses of several sites concurrently.
+
+        Resolved addresses are cached for later calls to get_site_ndt_ips.
+        Resolution failures are logged, but do not raise an exception, so that
+        get_site_ndt_ips reports them when the site is actually needed.
+
+        Args:
+            site_ids (list): M-Lab site identifiers to resolve.
+        """
+        hostnames = set()
+        for site_id in site_ids:
+            if site_id in self._site_map or (
+                    self._site_history and
+                    self._site_history.has_site(site_id)):
+                continue
+            for node_id in ['mlab1', 'mlab2', 'mlab3']:
+                hostname = self._generate_hostname(site_id, node_id)
+                if hostname not in self._cache:
+                    hostnames.add(hostname)
+        if not hostnames:
+            return
+
+        self.logger.debug('Resolving %d M-Lab hostnames.', len(hostnames))
+        pool = ThreadPool(min(MAX_RESOLVER_THREADS, len(hostnames)))
+        try:
+            pool.map(self._prefetch_hostname, sorted(hostnames))
+        finally:
+            pool.close()
+            pool.join()
+
+    def save_cache(self):
+        """Writes the resolved addresses to the cache file, if there is one."""
+        if not self._cache_filepath:
+            return
+        cache_entries = {}
+        for hostname, ip_address in self._cache.items():
+            cache_entries[hostname] = {
+                'ip': ip_address,
+                'resolved': self._resolution_times[hostname]
+            }
+        cache_contents = json.dumps(cache_entries, indent=2, sort_keys=True)
+        try:
+            utils.write_file_atomically(self._cache_filepath, cache_contents)
+        except (IOError, OSError) as caught_error:
+            self.logger.warning('Failed to write DNS cache file %s: %s',
+                                self._cache_filepath, caught_error)
+
+    def _load_cache(self):
+        """Loads unexpired addresses from the cache file into memory."""
+        try:
+            with open(self._cache_filepath, 'r') as cache_file:
+                cache_entries = json.load(cache_file)
+        except IOError:
+            return
+        except ValueError:
+            self.logger.warning('Ignoring malformed DNS cache file: %s',
+                                self._cache_filepath)
+            return
+        if not isinstance(cache_entries, dict):
+            self.logger.warning('Ignoring malformed DNS cache file: %s',
+                                self._cache_filepath)
+            return
+
+        oldest_valid_time = time.time() - self._cache_ttl
+        for hostname, cache_entry in cache_entries.items():
+            if not _is_valid_cache_entry(cache_entry):
+                self.logger.warning(
+                    'Ignoring malformed entry for %s in DNS cache file: %s',
+                    hostname, self._cache_filepath)
+                continue
+            if cache_entry['resolved'] >= oldest_valid_time:
+                self._cache[hostname] = cache_entry['ip']
+                self._resolution_times[hostname] = cache_entry['resolved']
+        self.logger.debug('Loaded %d addresses from DNS cache file.',
+                          len(self._cache))
+
+    def _load_site_map(self, site_map_filepath):
+        with open(site_map_filepath, 'r') as site_map_file:
+            site_map = json.load(site_map_file)
+        return {site_id.lower(): ips for site_id, ips in site_map.items()}
+
     def _generate_hostname(self, site_id, node_id):
         hostname = 'ndt.iupui.{node_id}.{site_id}.measurement-lab.org'.format(
             node_id=node_id, site_id=site_id)
         return hostname
 
+    def _prefetch_hostname(self, hostname):
+        try:
+            self._resolve_hostname(hostname)
+        except DNSResolutionError as caught_error:
+            self.logger.warning('%s', caught_error)
+
     def _resolve_hostname(self, hostname):
         if hostname in self._cache:
             return self._cache[hostname]
@@ -68,4 +340,17 @@ class MLabSiteResolver(object):
         except socket.gaierror:
             raise DNSResolutionError(hostname)
         self._cache[hostname] = ip_address
+        self._resolution_times[hostname] = int(time.time())
         return ip_address
+
+
+def _is_valid_cache_entry(cache_entry):
+    """Checks that a DNS cache entry has an address and a resolution time."""
+    if not isinstance(cache_entry, dict):
+        return False
+    ip_address = cache_entry.get('ip')
+    resolved = cache_entry.get('resolved')
+    if isinstance(resolved, bool):
+        return False
+    return (isinstance(ip_address, basestring) and
+            isinstance(resolved, (int, long, float)))
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Reads and writes plans, the compiled form of a set of selector files.
+
+Compiling selectors into queries requires MaxMind snapshots, DNS lookups and
+query generation. A plan holds the result of that work: the query of each
+selector, the file to which its results are written and, optionally, an
+estimate of the bytes it will process. A plan can then be executed, in whole
+or in slices, without repeating the compilation.
+
+With a result store, a plan's queries retrieve runs of days into the store,
+and its assembly steps write each selector's output from the stored days once
+the queries they depend on have finished.
+
+A plan file is written as JSON lines: a header, then one line for each step.
+"""
+
+import collections
+import hashlib
+import json
+
+PLAN_FORMAT_VERSION = 1
+
+QUERY = 'query'
+ASSEMBLY = 'assembly'
+
+
+class Error(Exception):
+    pass
+
+
+class PlanParseError(Error):
+
+    def __init__(self, message):
+        super(PlanParseError, self).__init__('Failed to parse plan: %s' %
+                                             message)
+
+
+class QueryStep(collections.namedtuple('QueryStep', [
+        'step_id', 'thread_metadata', 'output_path', 'bq_query_string',
+        'estimated_bytes', 'fetch'
+])):
+    """A query to run in BigQuery and the file to which to write its results.
+
+    Attributes:
+        step_id: (str) Identifier of the step within its plan.
+        thread_metadata: (dict) Metadata that labels the query's selector.
+        output_path: (str) Path to which the query's results are written.
+        bq_query_string: (str) The query.
+        estimated_bytes: (int) Bytes that a dry run of the query reported it
+            would process, or None if it was not estimated.
+        fetch: (tuple) For a query that retrieves days into the result store,
+            its (result key, first day, day count), with the first day as an
+            ISO 8601 date string. None for any other query.
+    """
+    __slots__ = ()
+
+
+class AssemblyStep(collections.namedtuple('AssemblyStep', [
+        'step_id', 'thread_metadata', 'output_path', 'result_key',
+        'start_timestamp', 'end_timestamp', 'depends_on'
+])):
+    """A selector whose output is assembled from the result store.
+
+    Attributes:
+        step_id: (str) Identifier of the step within its plan.
+        thread_metadata: (dict) Metadata that labels the selector.
+        output_path: (str) Path to which the selector's results are written.
+        result_key: (str) Result store key of the selector's tests.
+        start_timestamp: (int) UNIX timestamp of the start of the selector's
+            time window (inclusive).
+        end_timestamp: (int) UNIX timestamp of the end of the selector's time
+            window (exclusive).
+        depends_on: (tuple) IDs of the query steps that retrieve days of the
+            window that were missing from the store.
+    """
+    __slots__ = ()
+
+
+class Plan(object):
+    """The compiled queries and assemblies of a set of selectors."""
+
+    def __init__(self, query_steps, assembly_steps=(), result_store_dir=None):
+        """Creates a plan of steps.
+
+        Args:
+            query_steps: (list) QueryStep objects, in the order to run them.
+            assembly_steps: (list) AssemblyStep objects.
+            result_store_dir: (str) Directory of the result store from which
+                assembly steps read, or None if the plan has no assemblies.
+        """
+        self.query_steps = list(query_steps)
+        self.assembly_steps = list(assembly_steps)
+        self.result_store_dir = result_store_dir
+
+    def estimated_bytes(self):
+        """Sums the estimated bytes of the plan's queries.
+
+        Returns:
+            (int) The sum, or None if any query was not estimated.
+        """
+        if any(query_step.estimated_bytes is None
+               for query_step in self.query_steps):
+            return None
+        return sum(query_step.estimated_bytes
+                   for query_step in self.query_steps)
+
+    def select(self, field_values=None, shard_index=0, shard_count=1):
+        """Selects a slice of the plan.
+
+        An assembly step is selected with every query step that it depends
+        on, and the steps of a result key always fall in the same shard, so
+        that a slice never depends on the queries of another slice.
+
+        Args:
+            field_values: (dict) A map of metadata fields, such as 'site', to
+                the values that selected steps must have, or None to select
+                steps with any metadata.
+            shard_index: (int) Index of the shard to select, from 0.
+            shard_count: (int) Number of shards into which to divide the plan.
+
+        Returns:
+            (Plan) The plan of the selected steps.
+        """
+
+        def is_selected(step, shard_key):
+            return (_matches(step.thread_metadata, field_values or {}) and
+                    _shard_of(shard_key, shard_count) == shard_index)
+
+        assembly_steps = [
+            assembly_step for assembly_step in self.assembly_steps
+            if is_selected(assembly_step, assembly_step.result_key)
+        ]
+        required_step_ids = set(step_id
+                                for assembly_step in assembly_steps
+                                for step_id in assembly_step.depends_on)
+        query_steps = [
+            query_step for query_step in self.query_steps
+            if (query_step.step_id in required_step_ids or is_selected(
+                query_step, query_step.fetch[0]
+                if query_step.fetch else query_step.step_id))
+        ]
+        return Plan(query_steps, assembly_steps, self.result_store_dir)
+
+    def write(self, plan_filepath):
+        """Writes the plan to a file.
+
+        Args:
+            plan_filepath: (str) Path of the file to write.
+        """
+        with open(plan_filepath, 'w') as plan_file:
+            _write_line(plan_file, {
+                'plan_format_version': PLAN_FORMAT_VERSION,
+                'result_store': self.result_store_dir
+            })
+            for query_step in self.query_steps:
+                step_line = dict(query_step._asdict(), kind=QUERY)
+                _write_line(plan_file, step_line)
+            for assembly_step in self.assembly_steps:
+                step_line = dict(assembly_step._asdict(), kind=ASSEMBLY)
+                _write_line(plan_file, step_line)
+
+
+def read_plan(plan_filepath):
+    """Reads a plan from a file written by Plan.write.
+
+    Args:
+        plan_filepath: (str) Path of the plan file.
+
+    Returns:
+        (Plan) The plan.
+
+    Raises:
+        PlanParseError: The file is not a plan of a supported version.
+        IOError: The file could not be read.
+    """
+    with open(plan_filepath, 'r') as plan_file:
+        try:
+            plan_lines = [json.loads(line) for line in plan_file
+                          if line.strip()]
+        except ValueError as caught_error:
+            raise PlanParseError('Invalid plan file %s: %s' %
+                                 (plan_filepath, caught_error))
+    if (not plan_lines or
+            plan_lines[0].get('plan_format_version') != PLAN_FORMAT_VERSION):
+        raise PlanParseError('Unsupported plan file %s.' % plan_filepath)
+
+    query_steps = []
+    assembly_steps = []
+    for step_line in plan_lines[1:]:
+        kind = step_line.pop('kind', None)
+        try:
+            if kind == QUERY:
+                fetch = step_line['fetch']
+                step_line['fetch'] = tuple(fetch) if fetch else None
+                query_steps.append(QueryStep(**step_line))
+            elif kind == ASSEMBLY:
+                step_line['depends_on'] = tuple(step_line['depends_on'])
+                assembly_steps.append(AssemblyStep(**step_line))
+            else:
+                raise PlanParseError('Unknown plan step kind: %s' % kind)
+        except (KeyError, TypeError) as caught_error:
+            raise PlanParseError('Invalid %s step in plan file %s: %s' %
+                                 (kind, plan_filepath, caught_error))
+    return Plan(query_steps, assembly_steps, plan_lines[0].get('result_store'))
+
+
+def create_step_id(kind, output_path):
+    """Creates the ID of a step from the file to which it writes.
+
+    Args:
+        kind: (str) Either QUERY or ASSEMBLY.
+        output_path: (str) Path to which the step writes its results.
+
+    Returns:
+        (str) Identifier of the step, unique within its plan.
+    """
+    return '%s-%s' % (kind, hashlib.sha1(output_path).hexdigest()[:16])
+
+
+def parse_field_values(filter_strings):
+    """Parses the metadata fields by which to select a slice of a plan.
+
+    Args:
+        filter_strings: (list) Strings of the form 'field=value', such as
+            'site=lga01'.
+
+    Returns:
+        (dict) A map of each field to the values it may have.
+
+    Raises:
+        PlanParseError: A string is not of the form 'field=value'.
+    """
+    field_values = {}
+    for filter_string in filter_strings or []:
+        field, separator, value = filter_string.partition('=')
+        if not separator or not field:
+            raise PlanParseError('Invalid plan filter: %s' % filter_string)
+        field_values.setdefault(field, set()).add(value)
+    return field_values
+
+
+def parse_shard(shard_string):
+    """Parses a shard of a plan from a string of the form 'index/count'.
+
+    Args:
+        shard_string: (str) Shard, such as '0/4' for the first of four shards.
+
+    Returns:
+        (tuple) The (index, count) of the shard.
+
+    Raises:
+        PlanParseError: The string is not a valid shard.
+    """
+    try:
+        shard_index, shard_count = [int(part)
+                                    for part in shard_string.split('/')]
+    except ValueError:
+        raise PlanParseError('Invalid plan shard: %s' % shard_string)
+    if not 0 <= shard_index < shard_count:
+        raise PlanParseError('Invalid plan shard: %s' % shard_string)
+    return shard_index, shard_count
+
+
+def _matches(thread_metadata, field_values):
+    return all(str(thread_metadata.get(field)) in values
+               for field, values in field_values.iteritems())
+
+
+def _shard_of(shard_key, shard_count):
+    if shard_count == 1:
+        return 0
+    return int(hashlib.sha1(shard_key).hexdigest(), 16) % shard_count
+
+
+def _write_line(plan_file, line_value):
+    plan_file.write(json.dumps(line_value,
+                               sort_keys=True,
+                               separators=(',', ':')))
+    plan_file.write('\n')
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Profiles a run and periodically dumps the stacks of its threads.
+
+Profiles are aggregated by thread role rather than by individual thread, so
+that the many short-lived threads that monitor BigQuery jobs are reported
+together. A thread's role is its name up to the first hyphen, for example
+monitor_query_queue for a thread named monitor_query_queue-job_1234.
+"""
+
+import cProfile
+import datetime
+import logging
+import os
+import pstats
+import sys
+import threading
+import traceback
+
+# Profilers that may be selected with Profiler's mode.
+CPROFILE_MODE = 'cprofile'
+SAMPLING_MODE = 'sampling'
+MODES = (CPROFILE_MODE, SAMPLING_MODE)
+
+# Seconds between samples of every thread's stack in sampling mode.
+DEFAULT_SAMPLING_INTERVAL = 0.01
+
+# Number of functions to list in the text report of each cProfile profile.
+REPORT_FUNCTION_COUNT = 50
+
+STACK_DUMP_FILENAME = 'thread-stacks.log'
+
+
+class ProfilingError(Exception):
+    pass
+
+
+def thread_role(thread_name):
+    """Finds the role of a thread, by which its profile is aggregated.
+
+    Args:
+        thread_name: (str) Name of the thread, such as
+            'monitor_query_queue-job_1234' or 'Thread-7'.
+
+    Returns:
+        (str) Name of the thread up to its first hyphen.
+    """
+    return thread_name.split('-', 1)[0]
+
+
+class Profiler(object):
+    """Profiles the main thread and worker threads of a run.
+
+    In cProfile mode, the main thread is profiled between start() and stop(),
+    and worker threads are profiled when their targets are wrapped with
+    wrap_thread_target(). In sampling mode, the stacks of every thread are
+    sampled at a fixed interval, which costs far less than cProfile for runs
+    with many threads. Either mode may be combined with periodic dumps of
+    every thread's stack, which show where threads are blocked.
+
+    Output is written to the profile directory when the profiler stops:
+
+        <role>.pstats and <role>.txt for each thread role in cProfile mode.
+        <role>.folded for each thread role in sampling mode, in the folded
+            stack format read by flame graph tools.
+        thread-stacks.log with each periodic stack dump.
+    """
+
+    def __init__(self,
+                 profile_dir,
+                 mode=None,
+                 sampling_interval=DEFAULT_SAMPLING_INTERVAL,
+                 stack_dump_interval=None):
+        """Configures the profiler.
+
+        Args:
+            profile_dir: (str) Directory to which to write output. It is
+                created if it does not exist.
+            mode: (str) One of MODES, or None to only dump thread stacks.
+            sampling_interval: (float) Seconds between samples in sampling
+                mode.
+            stack_dump_interval: (float) Seconds between dumps of every
+                thread's stack, or None to not dump stacks.
+
+        Raises:
+            ProfilingError: The mode is not recognized.
+        """
+        if mode is not None and mode not in MODES:
+            raise ProfilingError('Unrecognized profiling mode: %s' % mode)
+        self._profile_dir = profile_dir
+        self._mode = mode
+        self._sampling_interval = sampling_interval
+        self._stack_dump_interval = stack_dump_interval
+        self._logger = logging.getLogger('telescope')
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._background_threads = []
+        self._main_profile = None
+        self._stats_by_role = {}
+        self._thread_counts_by_role = {}
+        self._sample_counts_by_role = {}
+
+    def start(self):
+        """Starts profiling the calling thread and any background samplers."""
+        if not os.path.exists(self._profile_dir):
+            os.makedirs(self._profile_dir)
+        if self._mode == CPROFILE_MODE:
+            self._main_profile = cProfile.Profile()
+            self._main_profile.enable()
+        elif self._mode == SAMPLING_MODE:
+            self._start_background_thread(self._sampling_interval,
+                                          self._sample_stacks)
+        if self._stack_dump_interval:
+            self._start_background_thread(self._stack_dump_interval,
+                                          self._dump_stacks)
+
+    def stop(self):
+        """Stops profiling and writes the output to the profile directory.
+
+        Worker threads that are still running when the profiler stops are not
+        included in cProfile output.
+        """
+        if self._main_profile:
+            self._main_profile.disable()
+            self._add_profile(
+                thread_role(threading.current_thread().name),
+                self._main_profile)
+            self._main_profile = None
+        self._stop_event.set()
+        for background_thread in self._background_threads:
+            background_thread.join()
+        self._background_threads = []
+        self._write_profiles()
+        self._write_samples()
+        self._logger.info('Wrote profiling output to %s.', self._profile_dir)
+
+    def wrap_thread_target(self, target):
+        """Wraps a thread's target so that it is profiled in cProfile mode.
+
+        Args:
+            target: (function) Function that the thread will run.
+
+        Returns:
+            (function) A function that runs the target, profiling it if the
+            profiler is in cProfile mode.
+        """
+        if self._mode != CPROFILE_MODE:
+            return target
+
+        def profiled_target(*args, **kwargs):
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return target(*args, **kwargs)
+            finally:
+                profile.disable()
+                self._add_profile(
+                    thread_role(threading.current_thread().name), profile)
+
+        return profiled_target
+
+    def _add_profile(self, role, profile):
+        profile.create_stats()
+        with self._lock:
+            if role in self._stats_by_role:
+                self._stats_by_role[role].add(profile)
+            else:
+                self._stats_by_role[role] = pstats.Stats(profile)
+            self._thread_counts_by_role[role] = (
+                self._thread_counts_by_role.get(role, 0) + 1)
+
+    def _start_background_thread(self, interval, function):
+
+        def run_periodically():
+            while not self._stop_event.wait(interval):
+                function()
+
+        background_thread = threading.Thread(target=run_periodically,
+                                             name='profiling')
+        background_thread.daemon = True
+        background_thread.start()
+        self._background_threads.append(background_thread)
+
+    def _iterate_thread_frames(self):
+        """Lists the name and current frame of every other thread."""
+        thread_names = {thread.ident: thread.name
+                        for thread in threading.enumerate()}
+        current_ident = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident != current_ident:
+                yield thread_names.get(ident, 'unknown'), frame
+
+    def _sample_stacks(self):
+        for thread_name, frame in self._iterate_thread_frames():
+            stack = []
+            while frame:
+                code = frame.f_code
+                stack.append('%s (%s)' % (code.co_name,
+                                          os.path.basename(code.co_filename)))
+                frame = frame.f_back
+            folded_stack = ';'.join(reversed(stack))
+            sample_counts = self._sample_counts_by_role.setdefault(
+                thread_role(thread_name), {})
+            sample_counts[folded_stack] = sample_counts.get(folded_stack, 0) + 1
+
+    def _dump_stacks(self):
+        lines = ['=== %s ===\n' % datetime.datetime.utcnow().isoformat()]
+        for thread_name, frame in sorted(self._iterate_thread_frames()):
+            lines.append('--- %s ---\n' % thread_name)
+            lines.extend(traceback.format_stack(frame))
+        lines.append('\n')
+        with open(
+                os.path.join(self._profile_dir, STACK_DUMP_FILENAME),
+                'a') as stack_dump_file:
+            stack_dump_file.writelines(lines)
+
+    def _write_profiles(self):
+        with self._lock:
+            for role, stats in self._stats_by_role.iteritems():
+                profile_filepath = os.path.join(self._profile_dir, role)
+                stats.dump_stats(profile_filepath + '.pstats')
+                with open(profile_filepath + '.txt', 'w') as report_file:
+                    report_file.write('Aggregated from %d thread(s).\n' %
+                                      self._thread_counts_by_role[role])
+                    stats.stream = report_file
+                    stats.sort_stats('cumulative').print_stats(
+                        REPORT_FUNCTION_COUNT)
+
+    def _write_samples(self):
+        for role, sample_counts in self._sample_counts_by_role.iteritems():
+            with open(
+                    os.path.join(self._profile_dir, role + '.folded'),
+                    'w') as folded_file:
+                for folded_stack in sorted(sample_counts):
+                    folded_file.write('%s %d\n' % (folded_stack,
+                                                   sample_counts[folded_stack]))
+
+# Profiler of the current run, if profiling was started.
+_profiler = None
+
+
+def start_profiling(profile_dir,
+                    mode=None,
+                    sampling_interval=DEFAULT_SAMPLING_INTERVAL,
+                    stack_dump_interval=None):
+    """Starts profiling the run from the calling thread.
+
+    Args:
+        profile_dir: (str) Directory to which to write output.
+        mode: (str) One of MODES, or None to only dump thread stacks.
+        sampling_interval: (float) Seconds between samples in sampling mode.
+        stack_dump_interval: (float) Seconds between dumps of every thread's
+            stack, or None to not dump stacks.
+
+    Returns:
+        (Profiler) The running profiler.
+    """
+    global _profiler
+    _profiler = Profiler(profile_dir, mode, sampling_interval,
+                         stack_dump_interval)
+    _profiler.start()
+    return _profiler
+
+
+def stop_profiling():
+    """Stops the running profiler, if any, and writes its output."""
+    global _profiler
+    if _profiler:
+        _profiler.stop()
+        _profiler = None
+
+
+def wrap_thread_target(target):
+    """Wraps a thread's target so that the running profiler profiles it.
+
+    Args:
+        target: (function) Function that the thread will run.
+
+    Returns:
+        (function) The wrapped target, or the target itself if no profiler is
+        running.
+    """
+    if _profiler:
+        return _profiler.wrap_thread_target(target)
+    return target
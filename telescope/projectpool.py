@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Spreads BigQuery jobs across a pool of Google developer projects.
+
+BigQuery limits the concurrent queries and the rate of requests of each
+project. Jobs are submitted through the project with the fewest jobs in
+flight, up to a limit per project. A project whose quota is exceeded is set
+aside for a while, so that jobs fail over to the other projects.
+
+Interactive and batch jobs run in separate lanes, each with its own limit, as
+batch jobs do not count against a project's limit on concurrent interactive
+queries. A batch job that waits too long may be promoted to the interactive
+lane once that lane has room.
+"""
+
+import threading
+import time
+
+# BigQuery priorities of jobs, each of which has its own lane.
+INTERACTIVE = 'INTERACTIVE'
+BATCH = 'BATCH'
+PRIORITIES = (INTERACTIVE, BATCH)
+
+DEFAULT_THROTTLE_SECONDS = 60.0
+
+# Seconds between checks for a project with capacity, so that a thread waiting
+# for one remains interruptible.
+_ACQUIRE_POLL_SECONDS = 1.0
+
+
+class JobSlot(object):
+    """A job's place in the lane of the project through which it runs."""
+
+    def __init__(self, project_pool, google_auth_config, priority):
+        self._project_pool = project_pool
+        self.google_auth_config = google_auth_config
+        self.priority = priority
+
+    @property
+    def project_id(self):
+        return self.google_auth_config.project_id
+
+    def promote(self):
+        """Moves a batch job to the interactive lane, if it has room.
+
+        Returns:
+            (bool) True if the job was moved.
+        """
+        return self._project_pool._promote(self)
+
+    def demote(self):
+        """Returns a promoted job to the batch lane."""
+        self._project_pool._demote(self)
+
+    def release(self):
+        """Frees the slot once the job has finished or failed to submit."""
+        self._project_pool._release(self)
+
+
+class ProjectPool(object):
+    """Thread-safe pool of projects through which to submit jobs."""
+
+    def __init__(self,
+                 google_auth_configs,
+                 max_jobs_per_project=None,
+                 throttle_seconds=DEFAULT_THROTTLE_SECONDS,
+                 max_batch_jobs_per_project=None,
+                 default_priority=INTERACTIVE,
+                 promotion_seconds=None):
+        """Creates a pool without any jobs in flight.
+
+        Args:
+            google_auth_configs: (list) external.GoogleAPIAuth objects, one for
+                each project, in order of preference.
+            max_jobs_per_project: (int) Maximum number of interactive jobs in
+                flight in each project, or None for no limit.
+            throttle_seconds: (float) Seconds for which a project whose quota
+                was exceeded receives no new jobs.
+            max_batch_jobs_per_project: (int) Maximum number of batch jobs in
+                flight in each project, or None for no limit.
+            default_priority: (str) Priority of the jobs of selectors that do
+                not specify one, one of PRIORITIES.
+            promotion_seconds: (float) Seconds after which a pending batch job
+                is promoted to the interactive lane, or None to never promote
+                batch jobs.
+        """
+        self._google_auth_configs = list(google_auth_configs)
+        self._max_jobs = {
+            INTERACTIVE: max_jobs_per_project,
+            BATCH: max_batch_jobs_per_project
+        }
+        self._throttle_seconds = throttle_seconds
+        self.default_priority = default_priority
+        self.promotion_seconds = promotion_seconds
+        self._auth_configs_by_project = dict(
+            (google_auth_config.project_id, google_auth_config)
+            for google_auth_config in self._google_auth_configs)
+        self._jobs_in_flight = dict(
+            ((project_id, priority), 0)
+            for project_id in self._auth_configs_by_project
+            for priority in PRIORITIES)
+        self._throttled_until = {}
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return len(self._google_auth_configs)
+
+    @property
+    def project_ids(self):
+        return [google_auth_config.project_id
+                for google_auth_config in self._google_auth_configs]
+
+    def get_auth_config(self, project_id):
+        """Retrieves the auth data of the project that owns a job.
+
+        Args:
+            project_id: (str) ID of the project.
+
+        Returns:
+            (external.GoogleAPIAuth) The project's auth data.
+        """
+        return self._auth_configs_by_project[project_id]
+
+    def acquire(self, priority=INTERACTIVE):
+        """Reserves a slot for a job in the least loaded available project.
+
+        Waits until some project is neither throttled nor at its limit for the
+        job's lane.
+
+        Args:
+            priority: (str) One of PRIORITIES.
+
+        Returns:
+            (JobSlot) Slot of the job, which must be released once the job has
+            finished.
+        """
+        with self._condition:
+            while True:
+                job_slot = self.try_acquire(priority)
+                if job_slot:
+                    return job_slot
+                self._condition.wait(self._seconds_until_available())
+
+    def try_acquire(self, priority=INTERACTIVE):
+        """Reserves a slot for a job if any project has room for it now.
+
+        Args:
+            priority: (str) One of PRIORITIES.
+
+        Returns:
+            (JobSlot) Slot of the job, or None if every project is throttled or
+            at its limit for the job's lane.
+        """
+        with self._condition:
+            google_auth_config = self._find_available_project(priority)
+            if not google_auth_config:
+                return None
+            self._jobs_in_flight[(google_auth_config.project_id, priority)] += 1
+            return JobSlot(self, google_auth_config, priority)
+
+    def wait_for_capacity(self):
+        """Waits briefly for a job to be released or a throttle to end."""
+        with self._condition:
+            self._condition.wait(self._seconds_until_available())
+
+    def mark_throttled(self, project_id):
+        """Sets aside a project whose quota was exceeded.
+
+        Args:
+            project_id: (str) ID of the project.
+        """
+        with self._condition:
+            self._throttled_until[project_id] = (
+                time.time() + self._throttle_seconds)
+
+    def count_jobs_in_flight(self, priority=INTERACTIVE):
+        """Counts the jobs in flight in each project's lane.
+
+        Args:
+            priority: (str) One of PRIORITIES.
+
+        Returns:
+            (dict) A map of each project ID to its number of jobs in flight.
+        """
+        with self._condition:
+            return dict((project_id, self._jobs_in_flight[(project_id,
+                                                           priority)])
+                        for project_id in self._auth_configs_by_project)
+
+    def _release(self, job_slot):
+        with self._condition:
+            self._jobs_in_flight[(job_slot.project_id, job_slot.priority)] -= 1
+            self._condition.notify_all()
+
+    def _promote(self, job_slot):
+        with self._condition:
+            if (job_slot.priority != BATCH or
+                    not self._has_room(job_slot.project_id, INTERACTIVE)):
+                return False
+            self._jobs_in_flight[(job_slot.project_id, BATCH)] -= 1
+            self._jobs_in_flight[(job_slot.project_id, INTERACTIVE)] += 1
+            job_slot.priority = INTERACTIVE
+            self._condition.notify_all()
+            return True
+
+    def _demote(self, job_slot):
+        with self._condition:
+            if job_slot.priority != INTERACTIVE:
+                return
+            self._jobs_in_flight[(job_slot.project_id, INTERACTIVE)] -= 1
+            self._jobs_in_flight[(job_slot.project_id, BATCH)] += 1
+            job_slot.priority = BATCH
+            self._condition.notify_all()
+
+    def _has_room(self, project_id, priority):
+        max_jobs = self._max_jobs[priority]
+        return (max_jobs is None or
+                self._jobs_in_flight[(project_id, priority)] < max_jobs)
+
+    def _find_available_project(self, priority):
+        now = time.time()
+        available_configs = [
+            google_auth_config
+            for google_auth_config in self._google_auth_configs
+            if (self._throttled_until.get(google_auth_config.project_id, 0) <=
+                now and self._has_room(google_auth_config.project_id, priority))
+        ]
+        if not available_configs:
+            return None
+
+        def count_lane_jobs(google_auth_config):
+            return self._jobs_in_flight[(google_auth_config.project_id,
+                                         priority)]
+
+        # min keeps the first of equally loaded projects, so that ties go to
+        # the preferred project.
+        return min(available_configs, key=count_lane_jobs)
+
+    def _seconds_until_available(self):
+        # A project at its limit becomes available when notified by a release,
+        # but a throttled one must be checked for once its throttling ends.
+        now = time.time()
+        seconds_until_unthrottled = [
+            throttled_until - now
+            for throttled_until in self._throttled_until.values()
+            if throttled_until > now
+        ]
+        return max(0.01,
+                   min(seconds_until_unthrottled + [_ACQUIRE_POLL_SECONDS]))
@@ -15,10 +15,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
 import logging
 
 import utils
 
+# Number of addresses in each bucket of a client IP range join. Ranges are
+# split on /16 boundaries so that each client address matches ranges in
+# exactly one bucket.
+IP_RANGE_BUCKET_SIZE = 2**16
+
+# Default number of client IP blocks above which a backend that supports range
+# joins filters client addresses with a join instead of with a conditional.
+DEFAULT_RANGE_JOIN_THRESHOLD = 1000
+
 
 def _seconds_to_microseconds(seconds):
     return seconds * 1000000
@@ -29,11 +39,168 @@ def _is_server_to_client_metric(metric):
                       'packet_retransmit_rate')
 
 
-def _create_test_validity_conditional(metric):
+def _memoize(create_clause):
+    """Caches the clauses created by a function of hashable arguments.
+
+    Args:
+        create_clause: (function) Function that creates a SQL clause string
+            from its positional arguments.
+
+    Returns:
+        (function) Function that returns the same clauses, creating each one
+        only once.
+    """
+    clauses_by_args = {}
+
+    def create_clause_memoized(*args):
+        if args not in clauses_by_args:
+            clauses_by_args[args] = create_clause(*args)
+        return clauses_by_args[args]
+
+    return create_clause_memoized
+
+
+class LegacySqlBackend(object):
+    """Generates the dialect-specific parts of legacy SQL NDT queries."""
+
+    name = 'legacy'
+    query_prefix = ''
+    equality_operator = '=='
+    # Legacy SQL has no array literals, so client IP blocks are always matched
+    # with a conditional.
+    range_join_threshold = None
+
+    def __init__(self, table='plx.google:m_lab.ndt.all'):
+        """Creates a legacy SQL backend.
+
+        Args:
+            table: (str) Name of the table of NDT tests to query.
+        """
+        self.table = table
+
+    def table_reference(self):
+        return self.table
+
+    def parse_ip(self, ip_field):
+        """Creates an expression that converts an IP address to an integer."""
+        return 'PARSE_IP(%s)' % ip_field
+
+    def uses_range_join(self, block_count):
+        """Indicates whether to match a number of client IP blocks by joining.
+
+        Args:
+            block_count: (int) Number of coalesced client IP blocks.
+
+        Returns:
+            (bool) True if the blocks should be matched with
+            create_client_ip_blocks_join, False if they should be matched with
+            create_client_ip_blocks_conditional.
+        """
+        return (self.range_join_threshold is not None and
+                block_count > self.range_join_threshold)
+
+    def create_time_conditional(self, start_time_datetime, end_time_datetime):
+        """Creates a conditional that selects tests within a time window.
+
+        Args:
+            start_time_datetime: (datetime) Start of the window (inclusive).
+            end_time_datetime: (datetime) End of the window (exclusive).
+
+        Returns:
+            (str) SQL conditional for the time window.
+        """
+        start_timestamp = utils.utc_datetime_to_unix_timestamp(
+            start_time_datetime)
+        end_timestamp = utils.utc_datetime_to_unix_timestamp(end_time_datetime)
+        return ('(web100_log_entry.log_time >= {start_time})'
+                ' AND (web100_log_entry.log_time < {end_time})').format(
+                    start_time=start_timestamp,
+                    end_time=end_timestamp)
+
+
+class StandardSqlBackend(LegacySqlBackend):
+    """Generates the dialect-specific parts of standard SQL NDT queries.
+
+    Targets tables that are partitioned by day, adding a predicate on the
+    partition column so that BigQuery scans only the partitions that overlap
+    the query's time window.
+    """
+
+    name = 'standard'
+    query_prefix = '#standardSQL\n'
+    equality_operator = '='
+
+    def __init__(self,
+                 table='measurement-lab.release.ndt_all',
+                 partition_column='_PARTITIONTIME',
+                 partition_column_type='TIMESTAMP',
+                 range_join_threshold=DEFAULT_RANGE_JOIN_THRESHOLD):
+        """Creates a standard SQL backend.
+
+        Args:
+            table: (str) Name of the table or view of NDT tests to query.
+            partition_column: (str) Column by which the table is partitioned,
+                such as _PARTITIONTIME for ingestion-time partitioned tables or
+                a DATE column.
+            partition_column_type: (str) Type of the partition column, either
+                TIMESTAMP or DATE.
+            range_join_threshold: (int) Number of client IP blocks above which
+                to match client addresses by joining with a table of the
+                blocks, or None to always use a conditional.
+        """
+        super(StandardSqlBackend, self).__init__(table)
+        self.partition_column = partition_column
+        self.partition_column_type = partition_column_type
+        self.range_join_threshold = range_join_threshold
+
+    def table_reference(self):
+        return '`%s`' % self.table
+
+    def parse_ip(self, ip_field):
+        # IPV4_TO_INT64 raises an error for the 16-byte addresses of IPv6
+        # clients, so the SAFE. prefix makes them NULL, as PARSE_IP does.
+        return 'SAFE.NET.IPV4_TO_INT64(NET.SAFE_IP_FROM_STRING(%s))' % ip_field
+
+    def create_time_conditional(self, start_time_datetime, end_time_datetime):
+        log_time_conditional = super(StandardSqlBackend,
+                                     self).create_time_conditional(
+                                         start_time_datetime, end_time_datetime)
+
+        # Partitions hold whole days, so select every day that overlaps the
+        # window.
+        start_timestamp = utils.utc_datetime_to_unix_timestamp(
+            start_time_datetime)
+        end_timestamp = utils.utc_datetime_to_unix_timestamp(end_time_datetime)
+        start_date = datetime.datetime.utcfromtimestamp(start_timestamp).date()
+        end_date = (datetime.datetime.utcfromtimestamp(end_timestamp - 1).date()
+                    + datetime.timedelta(days=1))
+        partition_conditional = (
+            '{column} >= {column_type}(\'{start_date}\')'
+            ' AND {column} < {column_type}(\'{end_date}\')').format(
+                column=self.partition_column,
+                column_type=self.partition_column_type,
+                start_date=start_date.isoformat(),
+                end_date=end_date.isoformat())
+        return '%s\n\t\tAND %s' % (log_time_conditional, partition_conditional)
+
+
+LEGACY_SQL_BACKEND = LegacySqlBackend()
+STANDARD_SQL_BACKEND = StandardSqlBackend()
+
+# Query backends for each dialect that a selector may specify.
+DEFAULT_BACKENDS = {
+    LEGACY_SQL_BACKEND.name: LEGACY_SQL_BACKEND,
+    STANDARD_SQL_BACKEND.name: STANDARD_SQL_BACKEND,
+}
+
+
+@_memoize
+def _create_test_validity_conditional(metric, backend):
     """Creates BigQuery SQL clauses to specify validity rules for an NDT test.
 
     Args:
         metric: (string) The metric for which to add the conditional.
+        backend: (LegacySqlBackend) Backend for the query's SQL dialect.
 
     Returns:
         (string) A set of SQL clauses that specify conditions an NDT test must
@@ -71,7 +238,7 @@ def _create_test_validity_conditional(metric):
             state_time_wait=STATE_TIME_WAIT))
 
     # Must have been determined to be unaffected by platform error.
-    conditions.append(('blacklist_flags == 0'))
+    conditions.append('blacklist_flags %s 0' % backend.equality_operator)
 
     if _is_server_to_client_metric(metric):
         # Must leave slow start phase of TCP, indicated by reaching
@@ -107,6 +274,7 @@ def _create_test_validity_conditional(metric):
     return '\n\tAND '.join(conditions)
 
 
+@_memoize
 def _create_select_clauses(metric):
     clauses = ['web100_log_entry.log_time AS timestamp']
     metric_to_clause = {
@@ -131,111 +299,251 @@ def _create_select_clauses(metric):
     return ',\n\t'.join(clauses)
 
 
-class BigQueryQueryGenerator(object):
+@_memoize
+def _create_data_direction_conditional(metric):
+    conditional = ''
+    if _is_server_to_client_metric(metric):
+        data_direction = 1
+    else:
+        data_direction = 0
+        conditional += '\n\tAND connection_spec.data_direction IS NOT NULL'
+    return 'connection_spec.data_direction = %d' % data_direction + conditional
+
+
+def create_client_ip_blocks_conditional(client_ip_blocks,
+                                        backend=LEGACY_SQL_BACKEND):
+    """Creates a BigQuery SQL conditional that matches client IP blocks.
+
+    Args:
+        client_ip_blocks: (list) A list of (start, end) tuples of IP addresses
+            in integer form.
+        backend: (LegacySqlBackend) Backend for the query's SQL dialect.
+
+    Returns:
+        (str) A SQL conditional that is true for tests whose client address is
+        in any of the blocks.
+    """
+    logger = logging.getLogger('telescope')
+    # remove duplicates, warn if any are found
+    unique_client_ip_blocks = list(set(client_ip_blocks))
+    if len(client_ip_blocks) != len(unique_client_ip_blocks):
+        logger.warning('Client IP blocks contained duplicates.')
+
+    # sort the blocks for the sake of consistent query generation
+    unique_client_ip_blocks.sort()
+
+    client_ip = backend.parse_ip('web100_log_entry.connection_spec.remote_ip')
+    block_statements = []
+    for start_block, end_block in unique_client_ip_blocks:
+        block_statements.append(
+            '{client_ip} BETWEEN {start_block} AND {end_block}'.format(
+                client_ip=client_ip,
+                start_block=start_block,
+                end_block=end_block))
+    return '(%s)' % ' OR\n\t\t'.join(block_statements)
+
+
+def coalesce_ip_blocks(client_ip_blocks):
+    """Merges overlapping and adjacent IP blocks.
+
+    Args:
+        client_ip_blocks: (list) A list of (start, end) tuples of IP addresses
+            in integer form, where end is inclusive.
+
+    Returns:
+        (list) Sorted list of disjoint, non-adjacent (start, end) tuples that
+        cover the same addresses as client_ip_blocks.
+    """
+    coalesced_blocks = []
+    for start_block, end_block in sorted(client_ip_blocks):
+        if coalesced_blocks and start_block <= coalesced_blocks[-1][1] + 1:
+            if end_block > coalesced_blocks[-1][1]:
+                coalesced_blocks[-1] = (coalesced_blocks[-1][0], end_block)
+        else:
+            coalesced_blocks.append((start_block, end_block))
+    return coalesced_blocks
+
+
+def _split_ip_blocks_by_bucket(client_ip_blocks):
+    """Splits IP blocks so that no block spans two range join buckets.
+
+    Args:
+        client_ip_blocks: (list) A list of disjoint (start, end) tuples of IP
+            addresses in integer form.
+
+    Returns:
+        (list) A list of (bucket, start, end) tuples, where bucket is the
+        index of the IP_RANGE_BUCKET_SIZE-aligned range that contains both
+        start and end.
+    """
+    bucketed_blocks = []
+    for start_block, end_block in client_ip_blocks:
+        while start_block <= end_block:
+            bucket = start_block // IP_RANGE_BUCKET_SIZE
+            bucket_end = min(end_block, (bucket + 1) * IP_RANGE_BUCKET_SIZE - 1)
+            bucketed_blocks.append((bucket, start_block, bucket_end))
+            start_block = bucket_end + 1
+    return bucketed_blocks
+
+
+def create_client_ip_blocks_join(client_ip_blocks,
+                                 backend=STANDARD_SQL_BACKEND):
+    """Creates a BigQuery SQL join that matches client IP blocks.
+
+    The blocks are coalesced and inlined into the query as an array, which
+    the query joins on the /16 bucket of each client address. BigQuery can
+    then match each test with an equality join against the few blocks in its
+    bucket, rather than evaluating one BETWEEN predicate per block.
+
+    Args:
+        client_ip_blocks: (list) A list of (start, end) tuples of IP addresses
+            in integer form.
+        backend: (StandardSqlBackend) Backend for the query's SQL dialect,
+            which must support array literals.
+
+    Returns:
+        (str) A SQL join clause that keeps only tests whose client address is
+        in any of the blocks.
+    """
+    client_ip = backend.parse_ip('web100_log_entry.connection_spec.remote_ip')
+    block_rows = [
+        '(%d, %d, %d)' % bucketed_block
+        for bucketed_block in _split_ip_blocks_by_bucket(coalesce_ip_blocks(
+            client_ip_blocks))
+    ]
+    return ('\n\tJOIN UNNEST(ARRAY<STRUCT<bucket INT64, start_ip INT64, '
+            'end_ip INT64>>[\n\t\t{block_rows}]) AS client_ip_block'
+            '\n\tON DIV({client_ip}, {bucket_size}) = client_ip_block.bucket'
+            '\n\t\tAND {client_ip} BETWEEN client_ip_block.start_ip'
+            ' AND client_ip_block.end_ip').format(
+                block_rows=',\n\t\t'.join(block_rows),
+                client_ip=client_ip,
+                bucket_size=IP_RANGE_BUCKET_SIZE)
+
+
+def create_client_ip_blocks_filter(client_ip_blocks,
+                                   backend=LEGACY_SQL_BACKEND):
+    """Creates the clauses that match client IP blocks in a backend's dialect.
+
+    Args:
+        client_ip_blocks: (list) A list of (start, end) tuples of IP addresses
+            in integer form.
+        backend: (LegacySqlBackend) Backend for the query's SQL dialect.
+
+    Returns:
+        (str, str) A 2-tuple of a join clause and a conditional, exactly one of
+        which is an empty string, depending on whether the backend matches
+        this many blocks with a join.
+    """
+    if backend.uses_range_join(len(coalesce_ip_blocks(client_ip_blocks))):
+        return create_client_ip_blocks_join(client_ip_blocks, backend), ''
+    return '', create_client_ip_blocks_conditional(client_ip_blocks, backend)
+
+
+class BigQueryQueryTemplate(object):
+    """A query for a fixed set of NDT tests, without its time window.
+
+    Every clause except the time window is rendered when the template is
+    created, so that rendering the query for a given time window only requires
+    formatting the window itself.
+    """
 
     def __init__(self,
-                 start_time,
-                 end_time,
                  metric,
                  server_ips=None,
                  client_ip_blocks=None,
-                 client_country=None):
+                 client_country=None,
+                 client_ip_blocks_conditional=None,
+                 backend=LEGACY_SQL_BACKEND,
+                 client_ip_blocks_join=None):
+        """Creates a query template.
+
+        Args:
+            metric: (str) Metric for which to retrieve data.
+            server_ips: (list) IP addresses of the M-Lab servers.
+            client_ip_blocks: (list) A list of (start, end) tuples of client IP
+                blocks.
+            client_country: (str) Country code of the clients.
+            client_ip_blocks_conditional: (str) Previously created result of
+                create_client_ip_blocks_conditional(client_ip_blocks), used in
+                place of client_ip_blocks.
+            backend: (LegacySqlBackend) Backend for the query's SQL dialect.
+            client_ip_blocks_join: (str) Previously created result of
+                create_client_ip_blocks_join(client_ip_blocks), used in place
+                of client_ip_blocks.
+        """
         self.logger = logging.getLogger('telescope')
         self._metric = metric
+        self._backend = backend
         self._conditional_dict = {}
-        self._add_data_direction_conditional(metric)
-        self._add_log_time_conditional(start_time, end_time)
-
-        if client_ip_blocks:
-            self._add_client_ip_blocks_conditional(client_ip_blocks)
+        self._client_ip_blocks_join = ''
+
+        if client_ip_blocks_join:
+            self._client_ip_blocks_join = client_ip_blocks_join
+        elif client_ip_blocks_conditional:
+            self._conditional_dict['client_ip_blocks'] = (
+                client_ip_blocks_conditional)
+        elif client_ip_blocks:
+            client_ip_blocks_join, client_ip_blocks_conditional = (
+                create_client_ip_blocks_filter(client_ip_blocks, backend))
+            self._client_ip_blocks_join = client_ip_blocks_join
+            if client_ip_blocks_conditional:
+                self._conditional_dict['client_ip_blocks'] = (
+                    client_ip_blocks_conditional)
         if client_country:
             self._add_client_country_conditional(client_country)
         if server_ips:
             self._add_server_ips_conditional(server_ips)
-        self._query = self._create_query_string()
-
-    def query(self):
-        return self._query
-
-    def _create_query_string(self):
-        built_query_format = ('SELECT\n\t{select_clauses}\n'
-                              'FROM\n\t{table}\n'
-                              'WHERE\n\t{conditional_list}')
-        conditional_list_string = ''
-
-        if 'data_direction' in self._conditional_dict:
-            conditional_list_string += self._conditional_dict['data_direction']
-
-        conditional_list_string += '\n\t AND %s' % (
-            _create_test_validity_conditional(self._metric))
-
-        log_times_joined = ' OR\n\t'.join(self._conditional_dict['log_time'])
-        conditional_list_string += '\n\tAND (%s)' % log_times_joined
-
+        self._query_head, self._query_tail = self._create_query_parts()
+
+    def render(self, start_time, end_time):
+        """Renders the query for a time window.
+
+        Args:
+            start_time: (datetime) Start of the time window (inclusive).
+            end_time: (datetime) End of the time window (exclusive).
+
+        Returns:
+            (str) BigQuery SQL query string.
+        """
+        return ''.join((self._query_head, self._backend.create_time_conditional(
+            start_time, end_time), self._query_tail))
+
+    def _create_query_parts(self):
+        """Creates the parts of the query that precede and follow the window.
+
+        Returns:
+            (str, str) A 2-tuple of the query text that precedes the log time
+            conditional and the query text that follows it.
+        """
+        query_head = (
+            '{query_prefix}'
+            'SELECT\n\t{select_clauses}\n'
+            'FROM\n\t{table}{client_ip_blocks_join}\n'
+            'WHERE\n\t{data_direction}'
+            '\n\t AND {validity}'
+            '\n\tAND (').format(
+                query_prefix=self._backend.query_prefix,
+                select_clauses=_create_select_clauses(self._metric),
+                table=self._backend.table_reference(),
+                client_ip_blocks_join=self._client_ip_blocks_join,
+                data_direction=_create_data_direction_conditional(self._metric),
+                validity=_create_test_validity_conditional(self._metric,
+                                                           self._backend))
+
+        query_tail = ')'
         if 'server_ips' in self._conditional_dict:
             server_ips_joined = ' OR\n\t\t'.join(self._conditional_dict[
                 'server_ips'])
-            conditional_list_string += '\n\tAND (%s)' % server_ips_joined
-
+            query_tail += '\n\tAND (%s)' % server_ips_joined
         if 'client_ip_blocks' in self._conditional_dict:
-            client_ip_blocks_joined = ' OR\n\t\t'.join(self._conditional_dict[
-                'client_ip_blocks'])
-            conditional_list_string += '\n\tAND (%s)' % client_ip_blocks_joined
+            query_tail += '\n\tAND %s' % (
+                self._conditional_dict['client_ip_blocks'])
         if 'client_country' in self._conditional_dict:
-            conditional_list_string += '\n\tAND %s' % (
+            query_tail += '\n\tAND %s' % (
                 self._conditional_dict['client_country'])
 
-        built_query_string = built_query_format.format(
-            select_clauses=_create_select_clauses(self._metric),
-            table='plx.google:m_lab.ndt.all',
-            conditional_list=conditional_list_string)
-
-        return built_query_string
-
-    def _add_log_time_conditional(self, start_time_datetime, end_time_datetime):
-        if 'log_time' not in self._conditional_dict:
-            self._conditional_dict['log_time'] = set()
-
-        utc_absolutely_utc = utils.unix_timestamp_to_utc_datetime(0)
-        start_time = int((start_time_datetime - utc_absolutely_utc
-                         ).total_seconds())
-        end_time = int((end_time_datetime - utc_absolutely_utc).total_seconds())
-
-        new_statement = (
-            '(web100_log_entry.log_time >= {start_time})'
-            ' AND (web100_log_entry.log_time < {end_time})').format(
-                start_time=start_time, end_time=end_time)
-
-        self._conditional_dict['log_time'].add(new_statement)
-
-    def _add_data_direction_conditional(self, metric):
-        conditional = ''
-        if _is_server_to_client_metric(metric):
-            data_direction = 1
-        else:
-            data_direction = 0
-            conditional += '\n\tAND connection_spec.data_direction IS NOT NULL'
-        self._conditional_dict['data_direction'] = (
-            'connection_spec.data_direction = %d' % data_direction + conditional
-        )
-
-    def _add_client_ip_blocks_conditional(self, client_ip_blocks):
-        # remove duplicates, warn if any are found
-        unique_client_ip_blocks = list(set(client_ip_blocks))
-        if len(client_ip_blocks) != len(unique_client_ip_blocks):
-            self.logger.warning('Client IP blocks contained duplicates.')
-
-        # sort the blocks for the sake of consistent query generation
-        unique_client_ip_blocks = sorted(unique_client_ip_blocks,
-                                         key=lambda block: block[0])
-
-        self._conditional_dict['client_ip_blocks'] = []
-        for start_block, end_block in client_ip_blocks:
-            new_statement = (
-                'PARSE_IP(web100_log_entry.connection_spec.remote_ip) BETWEEN '
-                '{start_block} AND {end_block}').format(start_block=start_block,
-                                                        end_block=end_block)
-            self._conditional_dict['client_ip_blocks'].append(new_statement)
+        return query_head, query_tail
 
     def _add_server_ips_conditional(self, server_ips):
         # remove duplicates, warn if any are found
@@ -255,3 +563,90 @@ class BigQueryQueryGenerator(object):
         self._conditional_dict['client_country'] = (
             'connection_spec.client_geolocation.country_code = \'%s\'' %
             (client_country.upper()))
+
+
+class BigQueryQueryTemplateCache(object):
+    """Cache of query templates and of their client IP block filters.
+
+    Selectors that differ only in their time windows share a template, and
+    selectors with the same client IP blocks share the join or conditional for
+    those blocks, which can be very large.
+    """
+
+    def __init__(self):
+        self._templates = {}
+        self._client_ip_blocks_filters = {}
+
+    def get_template(self,
+                     metric,
+                     server_ips=None,
+                     client_ip_blocks=None,
+                     client_country=None,
+                     client_ip_blocks_key=None,
+                     backend=LEGACY_SQL_BACKEND):
+        """Retrieves the template for a set of NDT tests, creating it if needed.
+
+        Args:
+            metric: (str) Metric for which to retrieve data.
+            server_ips: (list) IP addresses of the M-Lab servers.
+            client_ip_blocks: (list) A list of (start, end) tuples of client IP
+                blocks.
+            client_country: (str) Country code of the clients.
+            client_ip_blocks_key: A hashable value that uniquely identifies
+                client_ip_blocks, such as the IP translation spec and client
+                provider that produced them. If None, the blocks themselves
+                are used as the key.
+            backend: (LegacySqlBackend) Backend for the query's SQL dialect.
+
+        Returns:
+            (BigQueryQueryTemplate) The template for the given tests.
+        """
+        if client_ip_blocks and client_ip_blocks_key is None:
+            client_ip_blocks_key = tuple(client_ip_blocks)
+        if not client_ip_blocks:
+            client_ip_blocks_key = None
+        template_key = (backend, metric, tuple(sorted(server_ips or [])),
+                        client_ip_blocks_key, client_country)
+        if template_key in self._templates:
+            return self._templates[template_key]
+
+        client_ip_blocks_join = None
+        client_ip_blocks_conditional = None
+        if client_ip_blocks_key is not None:
+            filter_key = (backend, client_ip_blocks_key)
+            if filter_key not in self._client_ip_blocks_filters:
+                self._client_ip_blocks_filters[filter_key] = (
+                    create_client_ip_blocks_filter(client_ip_blocks, backend))
+            client_ip_blocks_join, client_ip_blocks_conditional = (
+                self._client_ip_blocks_filters[filter_key])
+
+        template = BigQueryQueryTemplate(
+            metric,
+            server_ips=server_ips,
+            client_country=client_country,
+            client_ip_blocks_conditional=client_ip_blocks_conditional,
+            backend=backend,
+            client_ip_blocks_join=client_ip_blocks_join)
+        self._templates[template_key] = template
+        return template
+
+
+class BigQueryQueryGenerator(object):
+
+    def __init__(self,
+                 start_time,
+                 end_time,
+                 metric,
+                 server_ips=None,
+                 client_ip_blocks=None,
+                 client_country=None,
+                 backend=LEGACY_SQL_BACKEND):
+        template = BigQueryQueryTemplate(metric,
+                                         server_ips=server_ips,
+                                         client_ip_blocks=client_ip_blocks,
+                                         client_country=client_country,
+                                         backend=backend)
+        self._query = template.render(start_time, end_time)
+
+    def query(self):
+        return self._query
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Provides a local store of query results for individual UTC days."""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+import jobstats
+import utils
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Number of the most recent UTC days, including today, whose tests M-Lab may
+# not have finished ingesting into BigQuery. Results retrieved for these days
+# are provisional, so they are re-retrieved by later runs.
+INGESTION_HORIZON_DAYS = 2
+
+
+def create_result_key(site, client_provider, client_country, metric,
+                      ip_translation_spec, dialect):
+    """Creates a key that identifies the set of NDT tests a selector matches.
+
+    Selectors with the same key differ only in their time windows, so they can
+    share the results stored for the days that their windows have in common.
+
+    Args:
+        site: (str) M-Lab site ID, or None.
+        client_provider: (str) Client provider name, or None.
+        client_country: (str) Client country code, or None.
+        metric: (str) Name of the metric.
+        ip_translation_spec: (iptranslation.IPTranslationStrategySpec) Spec of
+            the IP translation that maps the client provider to IP blocks.
+        dialect: (str) SQL dialect, which determines the table queried.
+
+    Returns:
+        (str) Hex digest that identifies the tests.
+    """
+    ip_translation = None
+    if ip_translation_spec:
+        ip_translation = {
+            'strategy': ip_translation_spec.strategy_name,
+            'params': ip_translation_spec.params
+        }
+    key_fields = {
+        'site': site,
+        'client_provider': client_provider,
+        'client_country': client_country,
+        'metric': metric,
+        'ip_translation': ip_translation,
+        'dialect': dialect
+    }
+    # The fields are serialized canonically, so that the key is the same in
+    # every process, whatever the order of the translation's parameters.
+    return hashlib.sha1(json.dumps(key_fields, sort_keys=True)).hexdigest()
+
+
+def days_in_window(start_time, end_time):
+    """Lists the UTC days that overlap a time window.
+
+    Args:
+        start_time: (datetime) Start of the window (inclusive).
+        end_time: (datetime) End of the window (exclusive).
+
+    Returns:
+        (list) A list of datetime.date objects, in order.
+    """
+    start_timestamp = utils.utc_datetime_to_unix_timestamp(start_time)
+    end_timestamp = utils.utc_datetime_to_unix_timestamp(end_time)
+    days = []
+    day_timestamp = start_timestamp - start_timestamp % SECONDS_PER_DAY
+    while day_timestamp < end_timestamp:
+        days.append(datetime.datetime.utcfromtimestamp(day_timestamp).date())
+        day_timestamp += SECONDS_PER_DAY
+    return days
+
+
+def group_consecutive_days(days):
+    """Groups days into runs of consecutive days.
+
+    Args:
+        days: (iterable) datetime.date objects, in any order.
+
+    Returns:
+        (list) A list of (first_day, day_count) tuples, in order.
+    """
+    day_runs = []
+    for day in sorted(set(days)):
+        if day_runs and day == day_runs[-1][0] + datetime.timedelta(
+                days=day_runs[-1][1]):
+            day_runs[-1] = (day_runs[-1][0], day_runs[-1][1] + 1)
+        else:
+            day_runs.append((day, 1))
+    return day_runs
+
+
+def day_to_datetime(day):
+    """Converts a date to a timezone-aware datetime at midnight UTC."""
+    return utils.make_datetime_utc_aware(datetime.datetime(day.year, day.month,
+                                                           day.day))
+
+
+class DailyResultStore(object):
+    """Stores the results of queries for individual UTC days.
+
+    Each day's results for a result key are stored in their own headerless CSV
+    file, in the format written by result_csv.metrics_to_csv. A day is stored
+    only once every test from that day has been retrieved, so the existence of
+    its file indicates that it is complete, even if the file is empty.
+
+    Days within the ingestion horizon when they are retrieved are stored in
+    provisional files instead. They are assembled like stored days, but remain
+    missing until a run after the horizon retrieves them again.
+    """
+
+    def __init__(self, store_dir):
+        """Creates a store that keeps its files in store_dir.
+
+        Args:
+            store_dir: (str) Directory in which to store results. It will be
+                created if it does not exist.
+        """
+        self.logger = logging.getLogger('telescope')
+        self._store_dir = utils.create_directory_if_not_exists(store_dir)
+        self._fetch_dir = utils.create_directory_if_not_exists(os.path.join(
+            store_dir, 'fetches'))
+
+    def find_missing_days(self, result_key, start_time, end_time):
+        """Lists the days of a time window that are not stored.
+
+        Args:
+            result_key: (str) Key of the tests, from create_result_key.
+            start_time: (datetime) Start of the window (inclusive).
+            end_time: (datetime) End of the window (exclusive).
+
+        Returns:
+            (list) A list of datetime.date objects, in order.
+        """
+        return [day for day in days_in_window(start_time, end_time)
+                if not os.path.exists(self._build_day_path(result_key, day))]
+
+    def build_fetch_filepath(self, result_key, first_day, day_count):
+        """Builds the path of the file to which to retrieve a run of days.
+
+        Args:
+            result_key: (str) Key of the tests, from create_result_key.
+            first_day: (datetime.date) First day of the run.
+            day_count: (int) Number of days in the run.
+
+        Returns:
+            (str) Path of the file.
+        """
+        return os.path.join(self._fetch_dir, '%s-%s+%dd-raw.csv' %
+                            (result_key, first_day.isoformat(), day_count))
+
+    def ingest_fetch(self, result_key, first_day, day_count):
+        """Splits a retrieved run of days into the store's daily files.
+
+        Days within the ingestion horizon of now are stored provisionally, so
+        that they remain missing.
+
+        Args:
+            result_key: (str) Key of the tests, from create_result_key.
+            first_day: (datetime.date) First day of the run.
+            day_count: (int) Number of days in the run.
+
+        Returns:
+            (bool) True if the run was retrieved and stored, False if its
+            fetch file does not exist.
+        """
+        fetch_filepath = self.build_fetch_filepath(result_key, first_day,
+                                                   day_count)
+        try:
+            with open(fetch_filepath, 'r') as fetch_file:
+                rows = fetch_file.readlines()
+        except IOError:
+            return False
+
+        rows_by_day = {}
+        for day_index in range(day_count):
+            rows_by_day[first_day + datetime.timedelta(days=day_index)] = []
+        for row in rows:
+            if not row.strip():
+                continue
+            day = datetime.datetime.utcfromtimestamp(_row_timestamp(row)).date()
+            if day in rows_by_day:
+                rows_by_day[day].append(row)
+
+        day_dir = utils.create_directory_if_not_exists(os.path.join(
+            self._store_dir, result_key))
+        today = datetime.datetime.utcnow().date()
+        first_provisional_day = today - datetime.timedelta(
+            days=INGESTION_HORIZON_DAYS - 1)
+        for day, day_rows in rows_by_day.iteritems():
+            provisional_path = self._build_provisional_day_path(result_key, day)
+            if day >= first_provisional_day:
+                utils.write_file_atomically(provisional_path, ''.join(day_rows))
+                continue
+            utils.write_file_atomically(
+                self._build_day_path(result_key, day), ''.join(day_rows))
+            if os.path.exists(provisional_path):
+                os.remove(provisional_path)
+        self.logger.debug('Stored %d days of results in %s.', day_count,
+                          day_dir)
+        os.remove(fetch_filepath)
+        # The statistics of the fetch's job remain in the run's job statistics
+        # report, so they are removed with the fetch rather than piling up.
+        statistics_filepath = jobstats.build_statistics_filepath(fetch_filepath)
+        if os.path.exists(statistics_filepath):
+            os.remove(statistics_filepath)
+        return True
+
+    def assemble(self, result_key, start_time, end_time):
+        """Assembles the stored results for a time window.
+
+        Args:
+            result_key: (str) Key of the tests, from create_result_key.
+            start_time: (datetime) Start of the window (inclusive).
+            end_time: (datetime) End of the window (exclusive).
+
+        Returns:
+            (str) Headerless CSV of the results within the window, or None if
+            any day of the window is neither stored nor provisionally stored.
+        """
+        start_timestamp = utils.utc_datetime_to_unix_timestamp(start_time)
+        end_timestamp = utils.utc_datetime_to_unix_timestamp(end_time)
+        window_rows = []
+        for day in days_in_window(start_time, end_time):
+            day_rows = self._read_day(result_key, day)
+            if day_rows is None:
+                return None
+            for row in day_rows:
+                if row.strip() and start_timestamp <= _row_timestamp(
+                        row) < end_timestamp:
+                    window_rows.append(row)
+        return ''.join(window_rows)
+
+    def _read_day(self, result_key, day):
+        """Reads the rows of a stored day, or else of a provisional day."""
+        for day_path in (self._build_day_path(result_key, day),
+                         self._build_provisional_day_path(result_key, day)):
+            try:
+                with open(day_path, 'r') as day_file:
+                    return day_file.readlines()
+            except IOError:
+                continue
+        return None
+
+    def _build_day_path(self, result_key, day):
+        return os.path.join(self._store_dir, result_key,
+                            '%s.csv' % day.isoformat())
+
+    def _build_provisional_day_path(self, result_key, day):
+        return os.path.join(self._store_dir, result_key,
+                            '%s-provisional.csv' % day.isoformat())
+
+
+def _row_timestamp(row):
+    """Parses the timestamp in the first column of a result CSV row."""
+    return int(float(row.split(',', 1)[0]))
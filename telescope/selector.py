@@ -15,6 +15,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import datetime
 import json
 import logging
@@ -24,6 +25,13 @@ import itertools
 import iptranslation
 import utils
 
+# SQL dialects in which selectors may specify that their queries be written.
+SUPPORTED_DIALECTS = ('legacy', 'standard')
+DEFAULT_DIALECT = 'legacy'
+
+# BigQuery priorities at which selectors may specify that their queries run.
+SUPPORTED_PRIORITIES = ('interactive', 'batch')
+
 
 class Error(Exception):
     pass
@@ -36,9 +44,17 @@ class SelectorParseError(Error):
             'Failed to parse selector file: %s' % message)
 
 
-class Selector(object):
+class Selector(collections.namedtuple('Selector', [
+        'start_time', 'duration', 'metric', 'ip_translation_spec',
+        'client_provider', 'client_country', 'site', 'dialect', 'priority',
+        'deadline'
+])):
     """Represents the data required to select a dataset from the M-Lab data.
 
+    Selectors are immutable and hashable, so they may be deduplicated or used
+    as cache keys. String fields are interned so that the many Selectors
+    produced by a large MultiSelector share a single copy of each value.
+
      Attributes:
          start_time: (datetime) Time at which selection window begins.
          duration: (int) Duration of time window in seconds.
@@ -46,17 +62,34 @@ class Selector(object):
          ip_translation_spec: (iptranslation.IPTranslationStrategySpec)
              Specifies how to translate the IP address information.
          client_provider: (str) Name of provider for which to retrieve data.
-         site_name: (str) Name of M-Lab site for which to retrieve data.
+         client_country: (str) Country code for which to retrieve data.
+         site: (str) Name of M-Lab site for which to retrieve data.
+         dialect: (str) SQL dialect of the query for this selector, either
+             'legacy' or 'standard'.
+         priority: (str) BigQuery priority of the query for this selector,
+             either 'interactive' or 'batch', or None to use the priority of
+             the run.
+         deadline: (int) Seconds after which the query for this selector is
+             abandoned, or None to use the deadline of the run.
     """
-
-    def __init__(self):
-        self.start_time = None
-        self.duration = None
-        self.metric = None
-        self.ip_translation_spec = None
-        self.client_provider = None
-        self.client_country = None
-        self.site = None
+    __slots__ = ()
+
+    def __new__(cls,
+                start_time=None,
+                duration=None,
+                metric=None,
+                ip_translation_spec=None,
+                client_provider=None,
+                client_country=None,
+                site=None,
+                dialect=DEFAULT_DIALECT,
+                priority=None,
+                deadline=None):
+        return super(Selector, cls).__new__(
+            cls, start_time, duration, _intern_string(metric),
+            ip_translation_spec, _intern_string(client_provider),
+            _intern_string(client_country), _intern_string(site),
+            _intern_string(dialect), _intern_string(priority), deadline)
 
     def __repr__(self):
         return (
@@ -81,12 +114,20 @@ class MultiSelector(object):
          client_providers: (list) List of string names of providers in the child
              Selectors.
          sites: (list) List of M-Lab sites in the child Selectors..
+         dialect: (str) SQL dialect of the queries for the child Selectors.
+         priority: (str) BigQuery priority of the queries for the child
+             Selectors, or None to use the priority of the run.
+         deadline: (int) Seconds after which the queries for the child
+             Selectors are abandoned, or None to use the deadline of the run.
     """
 
     def __init__(self):
         self.start_times = None
         self.duration = None
         self.ip_translation_spec = None
+        self.dialect = DEFAULT_DIALECT
+        self.priority = None
+        self.deadline = None
 
         # We use itertools to enumerate a combination of individual selectors from
         # lists of multiple values. Itertools will not iterate when passed a None
@@ -105,15 +146,17 @@ class MultiSelector(object):
             self.sites, self.metrics)
         for (start_time, client_provider, client_country, site,
              metric) in selector_product:
-            selector = Selector()
-            selector.ip_translation_spec = self.ip_translation_spec
-            selector.duration = self.duration
-            selector.start_time = start_time
-            selector.client_provider = client_provider
-            selector.client_country = client_country
-            selector.site = site
-            selector.metric = metric
-            selectors.append(selector)
+            selectors.append(Selector(
+                start_time=start_time,
+                duration=self.duration,
+                metric=metric,
+                ip_translation_spec=self.ip_translation_spec,
+                client_provider=client_provider,
+                client_country=client_country,
+                site=site,
+                dialect=self.dialect,
+                priority=self.priority,
+                deadline=self.deadline))
         return selectors
 
 
@@ -190,6 +233,15 @@ class SelectorFileParser(object):
         if 'sites' in selector_json and selector_json['sites']:
             multi_selector.sites = _normalize_string_values(selector_json[
                 'sites'])
+        if 'dialect' in selector_json:
+            multi_selector.dialect = selector_json['dialect']
+        if 'priority' in selector_json:
+            multi_selector.priority = selector_json['priority']
+        if 'deadline' in selector_json:
+            multi_selector.deadline = int(self._parse_duration(selector_json[
+                'deadline']))
+            if multi_selector.deadline <= 0:
+                raise SelectorParseError('UnsupportedDeadline')
 
         return multi_selector.split()
 
@@ -272,10 +324,8 @@ class SelectorFileParser(object):
             the selector file.
         """
         try:
-            ip_translation_spec = iptranslation.IPTranslationStrategySpec
-            ip_translation_spec.strategy_name = ip_translation_dict['strategy']
-            ip_translation_spec.params = ip_translation_dict['params']
-            return ip_translation_spec
+            return iptranslation.IPTranslationStrategySpec(
+                ip_translation_dict['strategy'], ip_translation_dict['params'])
         except KeyError as e:
             raise SelectorParseError(
                 ('Missing expected field in ip_translation '
@@ -326,6 +376,18 @@ class SelectorFileValidator(object):
             if metric not in supported_metrics:
                 raise SelectorParseError('UnsupportedMetric')
 
+        if ('dialect' in selector_dict and
+                selector_dict['dialect'] not in SUPPORTED_DIALECTS):
+            raise SelectorParseError('UnsupportedDialect')
+
+        if ('priority' in selector_dict and
+                selector_dict['priority'] not in SUPPORTED_PRIORITIES):
+            raise SelectorParseError('UnsupportedPriority')
+
+        if ('deadline' in selector_dict and
+                not isinstance(selector_dict['deadline'], basestring)):
+            raise SelectorParseError('UnsupportedDeadline')
+
 
 class SelectorFileValidator1_1(SelectorFileValidator):
 
@@ -359,6 +421,12 @@ class MultiSelectorJsonEncoder(json.JSONEncoder):
             base_selector['client_countries'] = selector.client_countries
         if selector.client_providers != [None]:
             base_selector['client_providers'] = selector.client_providers
+        if selector.dialect != DEFAULT_DIALECT:
+            base_selector['dialect'] = selector.dialect
+        if selector.priority is not None:
+            base_selector['priority'] = selector.priority
+        if selector.deadline is not None:
+            base_selector['deadline'] = '%ds' % selector.deadline
 
         return base_selector
 
@@ -393,3 +461,24 @@ def _normalize_string_values(field_values):
         list: A list of normalized parameters for building selectors from.
     """
     return [field_value.lower() for field_value in field_values]
+
+
+def _intern_string(value):
+    """Returns a canonical copy of a string value.
+
+    The builtin intern() accepts only byte strings, so the unicode values that
+    the JSON parser produces are interned as byte strings when they are ASCII,
+    and kept as they are otherwise.
+
+    Args:
+        value: (str) String value to intern, or None.
+
+    Returns:
+        str: A shared instance equal to value, or None if value is None.
+    """
+    if value is None:
+        return None
+    try:
+        return intern(str(value))
+    except UnicodeEncodeError:
+        return value
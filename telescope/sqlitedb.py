@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs transactions on the SQLite files shared by threads and processes.
+
+The job store and the work queue are each kept in a SQLite file that many
+threads, and possibly several processes, update at once. Each transaction
+opens its own connection and holds the file's write lock from its start, so
+that concurrent read-modify-write operations never interleave.
+"""
+
+import sqlite3
+
+# Seconds to wait for another thread or process to release its lock.
+LOCK_TIMEOUT_SECONDS = 60
+
+
+def connect(database_filepath):
+    """Opens a connection to a SQLite file.
+
+    Each call opens its own connection, so that the file may be used from
+    several threads. Transactions are begun explicitly.
+
+    Args:
+        database_filepath: (str) Path of the SQLite database file.
+
+    Returns:
+        (sqlite3.Connection) The connection.
+    """
+    return sqlite3.connect(database_filepath,
+                           timeout=LOCK_TIMEOUT_SECONDS,
+                           isolation_level=None)
+
+
+def create_schema(database_filepath, schema):
+    """Creates the tables of a SQLite file, if they do not already exist.
+
+    Args:
+        database_filepath: (str) Path of the SQLite database file.
+        schema: (str) SQL statements that create the tables.
+    """
+    connection = connect(database_filepath)
+    try:
+        connection.executescript(schema)
+    finally:
+        connection.close()
+
+
+def transact(database_filepath, operation):
+    """Runs an operation on a SQLite file in an exclusive transaction.
+
+    Args:
+        database_filepath: (str) Path of the SQLite database file.
+        operation: (function) Function that takes a sqlite3 cursor.
+
+    Returns:
+        The return value of the operation.
+    """
+    connection = connect(database_filepath)
+    try:
+        cursor = connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        result = operation(cursor)
+        cursor.execute('COMMIT')
+        return result
+    finally:
+        # Closing the connection rolls back an uncommitted transaction.
+        connection.close()
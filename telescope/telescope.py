@@ -16,25 +16,64 @@
 # limitations under the License.
 
 import argparse
+import collections
 import copy
 import datetime
+import itertools
 import logging
+import multiprocessing
 import os
 import Queue
 import random
+import sys
 import threading
 import time
+from multiprocessing.pool import ThreadPool
 
 import external
+import hedging
+import instrumentation
 import iptranslation
+import jobstats
+import jobstore
+import metrics
 import mlab
+import plan
+import profiling
+import projectpool
 import query
 import result_csv
+import resultstore
 import selector
 import utils
+import workqueue
 
 MAX_THREADS = 100
 
+# Number of selectors sent to a query generation worker process at a time.
+GENERATION_CHUNK_SIZE = 32
+
+# Seconds to wait for more generated queries when the selector queue is empty.
+GENERATION_POLL_SECONDS = 1
+
+# Seconds between checks for newly generated queries while jobs are in flight.
+DISPATCH_POLL_SECONDS = 1
+
+# Seconds for which a query whose submission failed with a request error waits
+# before it is submitted again. Other queries are submitted meanwhile.
+REQUEST_ERROR_COOLDOWN_SECONDS = 60
+
+# Seconds between checks of a shared work queue by coordinators and by workers
+# that have no queries to run.
+WORK_QUEUE_POLL_SECONDS = 30
+
+# Seconds between checks of whether a joined thread has finished. Joining with
+# a timeout lets the main thread receive KeyboardInterrupt while it waits.
+THREAD_JOIN_POLL_SECONDS = 1
+
+# Seconds to wait for in-flight jobs to be cancelled when a run is interrupted.
+DEFAULT_CANCEL_TIMEOUT_SECONDS = 30
+
 
 class TelescopeError(Exception):
     pass
@@ -62,16 +101,20 @@ class ExternalQueryHandler(object):
     data when the job completes.
     """
 
-    def __init__(self, filepath, metadata):
+    def __init__(self, filepath, metadata, job_store=None):
         """Inits ExternalQueryHandler ouput and metadata information.
 
         Args:
             filepath: (str) Where the processed results will be stored.
             metadata: (dict) Metadata on the query for output labels and further
               processing of received values.
+            job_store: (jobstore.SQLiteJobStore) Store in which to record the
+              job's state, or None to not record it.
         """
         self._metadata = metadata
         self._filepath = filepath
+        self._job_store = job_store
+        self._selector_key = jobstore.create_selector_key(metadata)
 
         self._has_succeeded = False  # Whether the query has returned a result.
         self._has_failed = False  # Whether the query has received a fatal error.
@@ -86,6 +129,42 @@ class ExternalQueryHandler(object):
         """Indicates whether the test has encountered a fatal error."""
         return self._has_failed
 
+    def record_job_state(self, job_id, job_state):
+        """Records that the job began running in the job store, if any.
+
+        Args:
+          job_id: (str) ID of the job.
+          job_state: (str) The job's BigQuery state, such as 'RUNNING'.
+        """
+        if self._job_store and job_state == 'RUNNING':
+            self._job_store.record_state(self._selector_key, jobstore.RUNNING,
+                                         job_id)
+
+    def record_job_failure(self, job_id, reason):
+        """Records that the job was abandoned, so that it is not retried.
+
+        Args:
+          job_id: (str) ID of the job.
+          reason: (str) Description of why the job was abandoned.
+        """
+        self._has_failed = True
+        metrics.increment(metrics.JOBS_FAILED)
+        if self._job_store:
+            self._job_store.record_state(self._selector_key, jobstore.FAILED,
+                                         job_id, reason)
+
+    def record_job_statistics(self, job_id, job_statistics):
+        """Records the statistics of the finished job alongside its output.
+
+        Args:
+            job_id: (str) ID of the job.
+            job_statistics: (jobstats.JobStatistics) Statistics of the job.
+        """
+        jobstats.record(self._metadata, job_statistics)
+        jobstats.write_job_statistics(
+            jobstats.build_statistics_filepath(self._filepath), self._metadata,
+            job_statistics)
+
     def retrieve_data_upon_job_completion(self, job_id, query_object=None):
         """Waits for a BigQuery job to complete, then processes its output.
 
@@ -104,15 +183,24 @@ class ExternalQueryHandler(object):
         logger = logging.getLogger('telescope')
 
         if query_object:
+            selector_label = ', '.join(filter(None, self._metadata.values()))
             try:
-                bq_query_returned_data = query_object.retrieve_job_data(job_id)
+                with instrumentation.span('collect_results', selector_label):
+                    bq_query_returned_data = query_object.retrieve_job_data(
+                        job_id)
                 logger.debug(
                     'Received data, processing according to %s metric.',
                     self._metadata['metric'])
 
-                write_metric_calculations_to_file(self._filepath,
-                                                  bq_query_returned_data)
+                with instrumentation.span('write_metric_calculations_to_file',
+                                          selector_label):
+                    write_metric_calculations_to_file(self._filepath,
+                                                      bq_query_returned_data)
                 self._has_succeeded = True
+                metrics.increment(metrics.JOBS_SUCCEEDED)
+                if self._job_store:
+                    self._job_store.record_state(self._selector_key,
+                                                 jobstore.DOWNLOADED, job_id)
             except (ValueError, external.BigQueryJobFailure,
                     external.BigQueryCommunicationError) as caught_error:
                 logger.error((
@@ -124,6 +212,11 @@ class ExternalQueryHandler(object):
                     'Requested tables for ({site}, {client_provider}, {metric}, {date}'
                     ') do not exist, moving on.').format(**self._metadata))
                 self._has_failed = True
+                metrics.increment(metrics.JOBS_FAILED)
+                if self._job_store:
+                    self._job_store.record_state(
+                        self._selector_key, jobstore.FAILED, job_id,
+                        'Requested tables do not exist.')
         return self._has_succeeded
 
 
@@ -163,8 +256,11 @@ def write_metric_calculations_to_file(data_filepath,
     """
     logger = logging.getLogger('telescope')
     try:
-        with open(data_filepath, 'w') as data_file_raw:
-            data_file_raw.write(result_csv.metrics_to_csv(metric_calculations))
+        with instrumentation.span('render_csv'):
+            metrics_csv = result_csv.metrics_to_csv(metric_calculations)
+        utils.write_file_atomically(data_filepath, metrics_csv)
+        metrics.increment(metrics.OUTPUT_FILES_WRITTEN)
+        metrics.increment(metrics.OUTPUT_BYTES_WRITTEN, len(metrics_csv))
         return True
     except IOError as caught_error:
         if caught_error.errno == 24:
@@ -213,18 +309,26 @@ def selectors_from_files(selector_files):
       selector_files: (list) A list of filenames of selector files.
 
     Returns:
-      (list) A list of Selector objects that were successfully parsed.
+      (list) A list of unique Selector objects that were successfully parsed,
+      in the order in which they first appeared.
     """
     logger = logging.getLogger('telescope')
     parser = selector.SelectorFileParser()
     selectors = []
+    selectors_seen = set()
     for selector_file in selector_files:
         logger.debug('Attempting to parse selector file at: %s', selector_file)
         try:
-            selectors.extend(parser.parse(selector_file))
+            parsed_selectors = parser.parse(selector_file)
         except Exception as caught_error:
             logger.error('Failed to parse selector file: %s', caught_error)
             continue
+        for parsed_selector in parsed_selectors:
+            if parsed_selector in selectors_seen:
+                logger.debug('Skipping duplicate selector: %s', parsed_selector)
+                continue
+            selectors_seen.add(parsed_selector)
+            selectors.append(parsed_selector)
     return selectors
 
 
@@ -240,7 +344,37 @@ def create_ip_translator(ip_translator_spec):
     return factory.create(ip_translator_spec)
 
 
-def generate_query(selector, ip_translator, mlab_site_resolver):
+def resolve_client_providers(selectors, ip_translator_factory, maxmind_dir):
+    """Resolves the client providers of a list of selectors to IP blocks.
+
+    Groups the selectors' client providers by IP translation spec, so that each
+    IP translator resolves all of its providers in a single search. The results
+    are cached by the translators for later query generation.
+
+    Args:
+        selectors: (list) A list of Selector objects.
+        ip_translator_factory: (iptranslation.IPTranslationStrategyFactory)
+            Factory that creates the IP translators for the selectors.
+        maxmind_dir: (str) MaxMind GeoLite ASN snapshot directory.
+    """
+    providers_by_spec = {}
+    for data_selector in selectors:
+        if data_selector.client_provider:
+            providers_by_spec.setdefault(
+                data_selector.ip_translation_spec,
+                set()).add(data_selector.client_provider)
+
+    for ip_translation_spec, client_providers in providers_by_spec.iteritems():
+        ip_translator = ip_translator_factory.create(
+            ip_translation_spec.replace_params(maxmind_dir=maxmind_dir))
+        ip_translator.find_ip_blocks_for_names(sorted(client_providers))
+
+
+def generate_query(selector,
+                   ip_translator,
+                   mlab_site_resolver,
+                   query_template_cache=None,
+                   query_backends=None):
     """Generates BigQuery SQL corresponding to the given Selector object.
 
     Args:
@@ -250,12 +384,19 @@ def generate_query(selector, ip_translator, mlab_site_resolver):
             name to associated IP address blocks.
         mlab_site_resolver: (mlab.MLabSiteResolver) Resolver to translate M-Lab
             site IDs to a set of IP addresses.
+        query_template_cache: (query.BigQueryQueryTemplateCache) Cache of query
+            templates shared between selectors, or None to build the query
+            from scratch.
+        query_backends: (dict) A map of the SQL dialects that selectors may
+            specify to the query backends that generate them, or None to use
+            query.DEFAULT_BACKENDS.
 
     Returns:
         (str, int) A 2-tuple containing the query string and the number of tables
         referenced in the query.
     """
     logger = logging.getLogger('telescope')
+    query_backend = (query_backends or query.DEFAULT_BACKENDS)[selector.dialect]
 
     start_time_datetime = selector.start_time
     end_time_datetime = start_time_datetime + datetime.timedelta(
@@ -272,7 +413,7 @@ def generate_query(selector, ip_translator, mlab_site_resolver):
     if selector.site:
         try:
             retrieved_site_ips = mlab_site_resolver.get_site_ndt_ips(
-                selector.site)
+                selector.site, start_time_datetime, end_time_datetime)
             for retrieved_site_ip in retrieved_site_ips:
                 server_ips.append(retrieved_site_ip)
                 logger.debug('Found IP for %s of %s.', selector.site,
@@ -280,14 +421,276 @@ def generate_query(selector, ip_translator, mlab_site_resolver):
         except Exception as caught_error:
             raise MLabServerResolutionFailed(caught_error)
 
-    query_generator = query.BigQueryQueryGenerator(
-        start_time_datetime,
-        end_time_datetime,
+    if query_template_cache is None:
+        query_generator = query.BigQueryQueryGenerator(
+            start_time_datetime,
+            end_time_datetime,
+            selector.metric,
+            server_ips=server_ips,
+            client_ip_blocks=client_ip_blocks,
+            client_country=selector.client_country,
+            backend=query_backend)
+        return query_generator.query()
+
+    # The translator returns the same blocks for the same spec and provider, so
+    # they identify the blocks without hashing every block.
+    query_template = query_template_cache.get_template(
         selector.metric,
         server_ips=server_ips,
         client_ip_blocks=client_ip_blocks,
-        client_country=selector.client_country)
-    return query_generator.query()
+        client_country=selector.client_country,
+        client_ip_blocks_key=(selector.ip_translation_spec,
+                              selector.client_provider),
+        backend=query_backend)
+    return query_template.render(start_time_datetime, end_time_datetime)
+
+
+def build_thread_metadata(data_selector):
+    """Builds the metadata that labels a selector's query and output files.
+
+    Args:
+        data_selector: (selector.Selector) Selector of the query.
+
+    Returns:
+        (dict) Metadata of the selector's time window, site, client, and metric,
+        and of its priority and deadline if it specifies them.
+    """
+    thread_metadata = {
+        'date': data_selector.start_time.strftime('%Y-%m-%d-%H%M%S'),
+        'duration': duration_to_string(data_selector.duration),
+        'site': data_selector.site,
+        'client_provider': data_selector.client_provider,
+        'client_country': data_selector.client_country,
+        'metric': data_selector.metric
+    }
+    # Selectors without a priority keep the metadata, and so the job store
+    # keys, that they had before priorities could be specified.
+    if data_selector.priority:
+        thread_metadata['priority'] = data_selector.priority
+    # Metadata values are strings, so that they may be joined into labels.
+    if data_selector.deadline:
+        thread_metadata['deadline'] = str(data_selector.deadline)
+    return thread_metadata
+
+
+def selector_result_key(data_selector):
+    """Creates the result store key of the tests that a selector matches."""
+    return resultstore.create_result_key(
+        data_selector.site, data_selector.client_provider,
+        data_selector.client_country, data_selector.metric,
+        data_selector.ip_translation_spec, data_selector.dialect)
+
+
+def plan_result_store_fetches(selectors, result_store):
+    """Plans the queries that retrieve the days missing from a result store.
+
+    Selectors that differ only in their time windows share one set of queries
+    for the union of their missing days, with one query for each run of
+    consecutive missing days.
+
+    Args:
+        selectors: (list) A list of Selector objects.
+        result_store: (resultstore.DailyResultStore) Store of the results of
+            previous queries.
+
+    Returns:
+        (list) A list of (fetch_selector, result_key, first_day, day_count)
+        tuples, where fetch_selector is a Selector for the whole days to
+        retrieve.
+    """
+    missing_days_by_key = {}
+    selectors_by_key = {}
+    for data_selector in selectors:
+        result_key = selector_result_key(data_selector)
+        end_time = data_selector.start_time + datetime.timedelta(
+            seconds=data_selector.duration)
+        missing_days_by_key.setdefault(
+            result_key, set()).update(result_store.find_missing_days(
+                result_key, data_selector.start_time, end_time))
+        selectors_by_key.setdefault(result_key, data_selector)
+
+    fetches = []
+    for result_key in sorted(missing_days_by_key):
+        for first_day, day_count in resultstore.group_consecutive_days(
+                missing_days_by_key[result_key]):
+            fetch_selector = selectors_by_key[result_key]._replace(
+                start_time=resultstore.day_to_datetime(first_day),
+                duration=day_count * resultstore.SECONDS_PER_DAY)
+            fetches.append((fetch_selector, result_key, first_day, day_count))
+    return fetches
+
+
+def write_selectors_from_result_store(pending_selectors, result_store):
+    """Writes the output files of selectors from a result store.
+
+    Args:
+        pending_selectors: (list) A list of (selector, data filepath) tuples.
+        result_store: (resultstore.DailyResultStore) Store of retrieved results.
+    """
+    for data_selector, data_filepath in pending_selectors:
+        end_time = data_selector.start_time + datetime.timedelta(
+            seconds=data_selector.duration)
+        write_window_from_result_store(
+            result_store, selector_result_key(data_selector),
+            data_selector.start_time, end_time,
+            build_thread_metadata(data_selector), data_filepath)
+
+
+def write_window_from_result_store(result_store, result_key, start_time,
+                                   end_time, thread_metadata, data_filepath):
+    """Writes the output file of a time window from a result store.
+
+    Args:
+        result_store: (resultstore.DailyResultStore) Store of retrieved results.
+        result_key: (str) Result store key of the selector's tests.
+        start_time: (datetime) Start of the window (inclusive).
+        end_time: (datetime) End of the window (exclusive).
+        thread_metadata: (dict) Metadata that labels the selector.
+        data_filepath: (str) Path to which to write the results.
+    """
+    logger = logging.getLogger('telescope')
+    results_csv = result_store.assemble(result_key, start_time, end_time)
+    if results_csv is None:
+        logger.error((
+            'Results for ({site}, {client_provider}, {metric}, {date}) '
+            'were not retrieved, moving on.').format(**thread_metadata))
+        return
+    try:
+        utils.write_file_atomically(data_filepath, results_csv)
+    except IOError as caught_error:
+        logger.error('When writing raw output, caught %s.', caught_error)
+
+# Inputs to query generation, shared with generation worker processes. It is
+# set before the workers are forked, so that they share the parent's parsed
+# translators and resolved sites copy-on-write instead of rebuilding them.
+_generation_context = None
+
+
+def _generate_timed_query(data_selector):
+    (ip_translator_factory, mlab_site_resolver, query_template_cache,
+     query_backends, maxmind_dir) = _generation_context
+    generation_start = time.time()
+    ip_translator = ip_translator_factory.create(
+        data_selector.ip_translation_spec.replace_params(
+            maxmind_dir=maxmind_dir))
+    bq_query_string = generate_query(data_selector, ip_translator,
+                                     mlab_site_resolver, query_template_cache,
+                                     query_backends)
+    return bq_query_string, time.time() - generation_start
+
+
+def generate_queries(selectors,
+                     ip_translator_factory,
+                     mlab_site_resolver,
+                     query_template_cache,
+                     query_backends,
+                     maxmind_dir,
+                     process_count=1):
+    """Generates the query of each selector, in the order of the selectors.
+
+    With more than one process, queries are generated by a pool of forked
+    worker processes. The translators and site resolver should already hold
+    every client provider and site that the selectors need, so that workers
+    do not repeat the work of resolving them.
+
+    Args:
+        selectors: (list) Selectors for which to generate queries.
+        ip_translator_factory: (iptranslation.IPTranslationStrategyFactory)
+            Factory of the translators of the selectors' client providers.
+        mlab_site_resolver: (mlab.MLabSiteResolver) Resolver of the selectors'
+            sites.
+        query_template_cache: (query.BigQueryQueryTemplateCache) Cache of query
+            templates shared between selectors.
+        query_backends: (dict) A map of the SQL dialects that selectors may
+            specify to the query backends that generate them.
+        maxmind_dir: (str) Directory of MaxMind snapshots.
+        process_count: (int) Number of processes with which to generate
+            queries.
+
+    Yields:
+        (str, float) A 2-tuple of each selector's query string and the number
+        of seconds taken to generate it, as soon as the query is generated.
+    """
+    global _generation_context
+    _generation_context = (ip_translator_factory, mlab_site_resolver,
+                           query_template_cache, query_backends, maxmind_dir)
+    try:
+        if process_count <= 1:
+            for data_selector in selectors:
+                yield _generate_timed_query(data_selector)
+            return
+        pool = multiprocessing.Pool(process_count)
+        try:
+            for timed_query in pool.imap(_generate_timed_query,
+                                         selectors,
+                                         chunksize=GENERATION_CHUNK_SIZE):
+                yield timed_query
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        _generation_context = None
+
+
+def enqueue_queries(query_selectors,
+                    timed_queries,
+                    selector_queue,
+                    output_dir,
+                    save_query=False,
+                    dry_run=False,
+                    job_store=None):
+    """Adds each generated query to the selector queue as it is generated.
+
+    Args:
+        query_selectors: (list) A list of (selector, data filepath) tuples for
+            which queries are generated.
+        timed_queries: (iterable) The (query string, generation seconds) tuple
+            of each selector, in the same order, as from generate_queries.
+        selector_queue: (Queue.Queue) Queue to which to add the queries.
+        output_dir: (str) Directory in which to save queries.
+        save_query: (bool) Whether to save each query as a .sql file.
+        dry_run: (bool) Whether to skip adding the queries to the queue.
+        job_store: (jobstore.SQLiteJobStore) Store in which to record that the
+            queries are queued, or None to not record them.
+    """
+    logger = logging.getLogger('telescope')
+    for query_selector, timed_query in itertools.izip(query_selectors,
+                                                      timed_queries):
+        data_selector, data_filepath = query_selector
+        bq_query_string, generation_seconds = timed_query
+        thread_metadata = build_thread_metadata(data_selector)
+        logger.debug((
+            'Generated Query for subset of {site}, {client_provider}, '
+            '{date}, {duration}.').format(**thread_metadata))
+        instrumentation.record(
+            'generate_query', generation_seconds,
+            ', '.join(filter(None, thread_metadata.values())))
+
+        if save_query:
+            bigquery_filepath = utils.build_filename(
+                output_dir, thread_metadata['date'],
+                thread_metadata['duration'], thread_metadata['site'],
+                thread_metadata['client_provider'],
+                thread_metadata['client_country'], thread_metadata['metric'],
+                '-bigquery.sql')
+            write_bigquery_to_file(bigquery_filepath, bq_query_string)
+        if not dry_run:
+            # Offer Queue a tuple of the BQ statement, metadata, and a boolean
+            # that indicates that the loop has not attempted to run the query
+            # thus far (failed queries are pushed back to the end of the loop).
+            if job_store:
+                job_store.record_queued(
+                    jobstore.create_selector_key(thread_metadata),
+                    data_filepath, bq_query_string)
+            selector_queue.put((bq_query_string, thread_metadata, data_filepath,
+                                False))
+            metrics.set_gauge(metrics.SELECTOR_QUEUE_DEPTH,
+                              selector_queue.qsize())
+        else:
+            logger.warn(
+                'Dry run flag caught, built query and reached the point that '
+                'it would be posted, moving on.')
 
 
 def duration_to_string(duration_seconds):
@@ -350,7 +753,140 @@ def wait_to_respect_thread_limit(concurrent_thread_limit, queue_size):
         active_thread_count = threading.activeCount()
 
 
-def process_selector_queue(selector_queue, google_auth_config):
+def release_slot_after(target, job_slot):
+    """Wraps a job's monitoring function to free the job's slot after.
+
+    Args:
+        target: (function) Function that monitors the job.
+        job_slot: (projectpool.JobSlot) The job's slot in its project's lane.
+
+    Returns:
+        (function) The wrapped function.
+    """
+
+    def monitor_and_release(*args, **kwargs):
+        try:
+            return target(*args, **kwargs)
+        finally:
+            job_slot.release()
+
+    return monitor_and_release
+
+
+def complete_after(target, completion_callback, external_query_handler):
+    """Wraps a job's monitoring function to report the job's completion after.
+
+    Args:
+        target: (function) Function that monitors the job.
+        completion_callback: (function) Called with the job's handler once the
+            function has returned or raised.
+        external_query_handler: (ExternalQueryHandler) Handler of the job.
+
+    Returns:
+        (function) The wrapped function.
+    """
+
+    def monitor_and_complete(*args, **kwargs):
+        try:
+            return target(*args, **kwargs)
+        finally:
+            completion_callback(external_query_handler)
+
+    return monitor_and_complete
+
+
+def query_priority(thread_metadata, project_pool):
+    """Finds the BigQuery priority at which to run a selector's query.
+
+    Args:
+        thread_metadata: (dict) Metadata that labels the selector's query.
+        project_pool: (projectpool.ProjectPool) Pool whose default priority
+            applies to selectors that do not specify one.
+
+    Returns:
+        (str) One of projectpool.PRIORITIES.
+    """
+    if thread_metadata.get('priority'):
+        return thread_metadata['priority'].upper()
+    return project_pool.default_priority
+
+
+def selector_straggler_policy(thread_metadata, straggler_policy):
+    """Finds the policy that decides when to hedge or abandon a selector's jobs.
+
+    Args:
+        thread_metadata: (dict) Metadata that labels the selector's query.
+        straggler_policy: (hedging.StragglerPolicy) Policy of the run, which
+            applies to selectors that do not specify a deadline, or None.
+
+    Returns:
+        (hedging.StragglerPolicy) The run's policy, with the selector's own
+        deadline if it specifies one.
+    """
+    if not thread_metadata.get('deadline'):
+        return straggler_policy
+    deadline_seconds = float(thread_metadata['deadline'])
+    if straggler_policy is None:
+        return hedging.StragglerPolicy(deadline_seconds=deadline_seconds)
+    return straggler_policy.with_deadline(deadline_seconds)
+
+
+def claim_next_submission(selector_queue,
+                          held_queue_sets,
+                          project_pool,
+                          cooling_queue_sets=None):
+    """Finds the next query whose lane has room and reserves a slot for it.
+
+    Queries whose lane is full are held back, so that they do not delay the
+    queries of the other lane. Held interactive queries are claimed before
+    held batch queries. Cooling queries join their lane once their cooldown
+    has passed.
+
+    Args:
+        selector_queue: (Queue.Queue) A queue of (query string, metadata,
+            data filepath, attempted) tuples to process.
+        held_queue_sets: (dict) A map of each of projectpool.PRIORITIES to a
+            deque of the queue sets held back in its lane.
+        project_pool: (projectpool.ProjectPool) Pool of the projects through
+            which to submit jobs.
+        cooling_queue_sets: (collections.deque) A deque of (not before, queue
+            set) tuples, in order of the Unix timestamps before which their
+            queries may not be submitted, or None if no queries are cooling.
+
+    Returns:
+        (tuple) The queue set and its projectpool.JobSlot, or (None, None) if
+        no queries remain.
+    """
+    if cooling_queue_sets is None:
+        cooling_queue_sets = collections.deque()
+    while True:
+        while cooling_queue_sets and cooling_queue_sets[0][0] <= time.time():
+            queue_set = cooling_queue_sets.popleft()[1]
+            held_queue_sets[query_priority(queue_set[1], project_pool)].append(
+                queue_set)
+        for priority in projectpool.PRIORITIES:
+            if held_queue_sets[priority]:
+                job_slot = project_pool.try_acquire(priority)
+                if job_slot:
+                    return held_queue_sets[priority].popleft(), job_slot
+        if not selector_queue.empty():
+            queue_set = selector_queue.get(False)
+            held_queue_sets[query_priority(queue_set[1], project_pool)].append(
+                queue_set)
+        elif any(held_queue_sets.values()):
+            project_pool.wait_for_capacity()
+        elif cooling_queue_sets:
+            time.sleep(max(0, min(cooling_queue_sets[0][0] - time.time(),
+                                  DISPATCH_POLL_SECONDS)))
+        else:
+            return None, None
+
+
+def process_selector_queue(selector_queue,
+                           project_pool,
+                           job_store=None,
+                           straggler_policy=None,
+                           completion_callback=None):
     """Processes the queue of Selector objects waiting for processing.
 
     Processes the queue of Selector objects by launching BigQuery jobs for each
@@ -358,10 +894,23 @@ def process_selector_queue(selector_queue, google_auth_config):
     limits so that queue processing obeys limits on maximum simultaneous
     threads.
 
+    Each job is submitted through the least loaded project of the pool, and
+    its results are retrieved through the same project. A project whose quota
+    is exceeded is set aside and the query is submitted to another project.
+    Interactive and batch queries are submitted in separate lanes, each with
+    its own limit on the jobs in flight in each project.
+
     Args:
         selector_queue: (Queue.Queue) A queue of Selector objects to process.
-        google_auth_config: (external.GoogleAPIAuth) Object containing GoogleAPI
-            auth data.
+        project_pool: (projectpool.ProjectPool) Pool of the projects through
+            which to submit jobs.
+        job_store: (jobstore.SQLiteJobStore) Store in which to record the state
+            of each job, or None to not record it.
+        straggler_policy: (hedging.StragglerPolicy) Policy that decides when
+            to hedge or abandon slow jobs, or None to wait for every job.
+        completion_callback: (function) Called from each job's thread with the
+            job's ExternalQueryHandler once the job's slot is released, or
+            None.
 
     Returns:
         (list) A list of 2-tuples where the first element is the spawned worker
@@ -370,24 +919,41 @@ def process_selector_queue(selector_queue, google_auth_config):
     """
     logger = logging.getLogger('telescope')
     thread_monitor = []
-
-    while not selector_queue.empty():
-        (bq_query_string, thread_metadata, data_filepath,
-         _) = selector_queue.get(False)
-
+    held_queue_sets = dict((priority, collections.deque())
+                           for priority in projectpool.PRIORITIES)
+    cooling_queue_sets = collections.deque()
+
+    while True:
+        queue_set, job_slot = claim_next_submission(
+            selector_queue, held_queue_sets, project_pool, cooling_queue_sets)
+        if queue_set is None:
+            break
+        (bq_query_string, thread_metadata, data_filepath, _) = queue_set
+        metrics.set_gauge(metrics.SELECTOR_QUEUE_DEPTH, selector_queue.qsize())
+
+        project_id = job_slot.project_id
         try:
             authenticated_service = external.get_authenticated_service(
-                google_auth_config)
+                job_slot.google_auth_config)
             bq_query_call = external.BigQueryCall(authenticated_service,
-                                                  google_auth_config.project_id)
-            bq_job_id = bq_query_call.run_asynchronous_query(bq_query_string)
-        except (external.BigQueryJobFailure,
-                external.BigQueryCommunicationError) as caught_error:
-            logger.warn('Caught request error %s on query, cooling down for a '
-                        'minute.', caught_error)
+                                                  project_id)
+            bq_job_id = bq_query_call.run_asynchronous_query(bq_query_string,
+                                                             job_slot.priority)
+        except external.BigQueryQuotaExceeded as caught_error:
+            job_slot.release()
+            project_pool.mark_throttled(project_id)
+            metrics.increment(metrics.PROJECT_THROTTLES)
+            logger.warn('Caught quota error %s on query, moving to another '
+                        'project.', caught_error)
             selector_queue.put((bq_query_string, thread_metadata, data_filepath,
                                 True))
-            time.sleep(60)
+            metrics.increment(metrics.QUERY_RETRIES)
+            continue
+        except (external.BigQueryJobFailure,
+                external.BigQueryCommunicationError) as caught_error:
+            job_slot.release()
+            logger.warn('Caught request error %s on query, cooling it down for '
+                        'a minute.', caught_error)
             bq_job_id = None
 
         if bq_job_id is None:
@@ -396,56 +962,859 @@ def process_selector_queue(selector_queue, google_auth_config):
                 'threads: {thread_count}).').format(
                     thread_count=threading.activeCount(),
                     **thread_metadata))
-            selector_queue.put((bq_query_string, thread_metadata, data_filepath,
-                                True))
+            # The query waits out its cooldown while other queries are
+            # submitted.
+            cooling_queue_sets.append(
+                (time.time() + REQUEST_ERROR_COOLDOWN_SECONDS,
+                 (bq_query_string, thread_metadata, data_filepath, True)))
+            metrics.increment(metrics.QUERY_RETRIES)
             continue
-
-        external_query_handler = ExternalQueryHandler(data_filepath,
-                                                      thread_metadata)
+        metrics.increment(metrics.QUERIES_SUBMITTED)
+        if job_store:
+            job_store.record_state(
+                jobstore.create_selector_key(thread_metadata),
+                jobstore.SUBMITTED, bq_job_id)
+
+        external_query_handler = ExternalQueryHandler(
+            data_filepath, thread_metadata, job_store)
         external_query_handler.queue_set = (bq_query_string, thread_metadata,
                                             data_filepath, True)
 
+        thread_target = release_slot_after(bq_query_call.monitor_query_queue,
+                                           job_slot)
+        if completion_callback is not None:
+            thread_target = complete_after(thread_target, completion_callback,
+                                           external_query_handler)
         new_thread = threading.Thread(
-            target=bq_query_call.monitor_query_queue,
+            target=profiling.wrap_thread_target(thread_target),
+            name='monitor_query_queue-%s' % bq_job_id,
             args=(bq_job_id, thread_metadata, None,
-                  external_query_handler.retrieve_data_upon_job_completion))
+                  external_query_handler.retrieve_data_upon_job_completion),
+            kwargs={
+                'state_callback': external_query_handler.record_job_state,
+                'straggler_policy': selector_straggler_policy(thread_metadata,
+                                                              straggler_policy),
+                'query_string': bq_query_string,
+                'failure_callback': external_query_handler.record_job_failure,
+                'job_slot': job_slot,
+                'promotion_seconds': project_pool.promotion_seconds,
+                'statistics_callback':
+                external_query_handler.record_job_statistics,
+                'project_pool': project_pool
+            })
         new_thread.daemon = True
         new_thread.start()
         thread_monitor.append((new_thread, external_query_handler))
 
-        concurrent_thread_limit = MAX_THREADS
+        concurrent_thread_limit = MAX_THREADS * len(project_pool)
         wait_to_respect_thread_limit(concurrent_thread_limit,
                                      selector_queue.qsize())
 
     return thread_monitor
 
 
+def join_thread(thread):
+    """Waits for a thread to finish, while remaining interruptible.
+
+    Args:
+        thread: (threading.Thread) Thread to wait for.
+    """
+    while thread.is_alive():
+        thread.join(THREAD_JOIN_POLL_SECONDS)
+
+
+def cancel_in_flight_jobs(project_pool, job_store, timeout_seconds):
+    """Cancels the jobs still running in BigQuery when a run is interrupted.
+
+    Selectors whose results were not downloaded are returned to the queued
+    state in the job store, so that the next run retries them immediately.
+
+    Args:
+        project_pool: (projectpool.ProjectPool) Pool of the projects that own
+            the jobs, or None if no jobs were submitted.
+        job_store: (jobstore.SQLiteJobStore) Store of job states, or None.
+        timeout_seconds: (float) Seconds after which to stop waiting for
+            cancellations to finish.
+    """
+    logger = logging.getLogger('telescope')
+    in_flight_jobs = external.get_in_flight_jobs()
+    job_count = len(in_flight_jobs.list_jobs())
+    if project_pool and job_count:
+        logger.info('Cancelling %d jobs in flight.', job_count)
+        cancelled_count = in_flight_jobs.cancel_all(project_pool,
+                                                    timeout_seconds)
+        logger.info('Cancelled %d of %d jobs in flight.', cancelled_count,
+                    job_count)
+    if job_store:
+        requeued_count = job_store.requeue_unfinished(
+            'Interrupted by shutdown.')
+        logger.info('Returned %d unfinished jobs to the queue.', requeued_count)
+
+
+def execute_selector_queue(selector_queue,
+                           project_pool,
+                           generation_done=None,
+                           job_store=None,
+                           straggler_policy=None):
+    """Runs every query in the selector queue until each succeeds or fails.
+
+    Queries are submitted continuously: each job's slot is freed as soon as
+    the job finishes, and a query that neither succeeded nor failed fatally
+    returns to the queue as soon as its job is given up, so that a slow job
+    never holds back the submission of other queries or retries. While
+    queries are still being generated, they are submitted as they arrive.
+
+    Args:
+        selector_queue: (Queue.Queue) A queue of (query string, metadata,
+            data filepath, attempted) tuples to process.
+        project_pool: (projectpool.ProjectPool) Pool of the projects through
+            which to submit jobs.
+        generation_done: (threading.Event) Event set once every query has been
+            added to the queue, or None if the queue is already complete.
+        job_store: (jobstore.SQLiteJobStore) Store in which to record the state
+            of each job, or None to not record it.
+        straggler_policy: (hedging.StragglerPolicy) Policy that decides when
+            to hedge or abandon slow jobs, or None to wait for every job.
+    """
+    completed_handlers = Queue.Queue()
+
+    def complete_query(external_query_handler):
+        requeue_unfinished_query(external_query_handler, selector_queue,
+                                 job_store)
+        completed_handlers.put(external_query_handler)
+
+    in_flight_count = 0
+    while True:
+        # Check for the end of generation before checking for an empty queue,
+        # so that queries added just before generation ends are not missed.
+        generation_finished = (generation_done is None or
+                               generation_done.is_set())
+        while not completed_handlers.empty():
+            completed_handlers.get(False)
+            in_flight_count -= 1
+
+        if not selector_queue.empty():
+            in_flight_count += len(process_selector_queue(
+                selector_queue,
+                project_pool,
+                job_store,
+                straggler_policy,
+                completion_callback=complete_query))
+        elif in_flight_count:
+            # Wake on the next completion, or after a short wait for the
+            # queries that generation adds meanwhile.
+            try:
+                completed_handlers.get(True, DISPATCH_POLL_SECONDS)
+                in_flight_count -= 1
+            except Queue.Empty:
+                pass
+        elif generation_finished:
+            break
+        else:
+            generation_done.wait(GENERATION_POLL_SECONDS)
+
+
+def requeue_unfinished_query(external_query_handler,
+                             selector_queue,
+                             job_store=None):
+    """Returns a query to the queue unless it succeeded or failed fatally.
+
+    Args:
+        external_query_handler: (ExternalQueryHandler) Handler of the query's
+            finished job.
+        selector_queue: (Queue.Queue) A queue of (query string, metadata,
+            data filepath, attempted) tuples to process.
+        job_store: (jobstore.SQLiteJobStore) Store in which to record that the
+            query is queued again, or None to not record it.
+    """
+    logger = logging.getLogger('telescope')
+    # Join together all defined attributes of thread_metadata for a user
+    # friendly notiication string.
+    thread_metadata = external_query_handler.queue_set[1]
+    identifier_string = ', '.join(filter(None, thread_metadata.values()))
+
+    if (not external_query_handler.has_succeeded and
+            not external_query_handler.has_failed):
+        if job_store:
+            job_store.record_state(
+                jobstore.create_selector_key(thread_metadata),
+                jobstore.QUEUED,
+                detail='Retrying after a transient error.')
+        selector_queue.put(external_query_handler.queue_set)
+        metrics.increment(metrics.QUERY_RETRIES)
+    elif external_query_handler.has_failed:
+        logger.debug('Fatal error on %s, moving along.', identifier_string)
+    else:
+        logger.debug('Successfully retrieved %s.', identifier_string)
+
+
+def is_output_cached(thread_metadata, data_filepath, job_store=None):
+    """Checks whether a selector's results were already written.
+
+    With a job store, a selector whose job the store records as downloaded or
+    failed is checked against its recorded state rather than the output
+    directory. A job that the store records as unfinished may have been
+    interrupted after its results were written, so its output directory is
+    checked instead.
+
+    Args:
+        thread_metadata: (dict) Metadata that labels the selector's output.
+        data_filepath: (str) Path to which the selector's results are written.
+        job_store: (jobstore.SQLiteJobStore) Store of job states, or None.
+
+    Returns:
+        (bool) True if the selector's results were already written.
+    """
+    if job_store:
+        job = job_store.get_job(jobstore.create_selector_key(thread_metadata))
+        if job and job.state in (jobstore.DOWNLOADED, jobstore.FAILED):
+            return (job.state == jobstore.DOWNLOADED and
+                    job.output_path == data_filepath)
+    return utils.check_for_valid_cache(data_filepath)
+
+
+def log_job_status(job_store):
+    """Logs the number of jobs in each state and the jobs that failed.
+
+    Args:
+        job_store: (jobstore.SQLiteJobStore) Store of job states.
+    """
+    logger = logging.getLogger('telescope')
+    state_counts = job_store.count_states()
+    logger.info(', '.join('%d %s' % (state_counts[state], state)
+                          for state in jobstore.STATES))
+    for job in job_store.list_jobs(jobstore.FAILED):
+        logger.info('Failed after %d attempts: %s (job %s): %s', job.attempts,
+                    job.output_path, job.job_id, job.detail)
+
+
+def create_google_auth_config(credentials_filepath,
+                              is_headless,
+                              project_id=None):
+    """Authenticates to the Google APIs.
+
+    Args:
+        credentials_filepath: (str) Path of the Google API credentials, which
+            are created through an authentication flow if they do not exist.
+        is_headless: (bool) Whether to authenticate without a local webserver.
+        project_id: (str) ID of the project through which to run jobs, or None
+            to use the first project that the credentials can access.
+
+    Returns:
+        (external.GoogleAPIAuth) Object containing GoogleAPI auth data, or None
+        if no developer project could be found.
+    """
+    logger = logging.getLogger('telescope')
+    if os.path.exists(credentials_filepath) is False:
+        logger.warn('No credentials for Google appear to exist, next step '
+                    'will be an authentication mechanism for its API.')
+
+    try:
+        return external.GoogleAPIAuth(credentials_filepath,
+                                      is_headless=is_headless,
+                                      project_id=project_id)
+    except external.APIConfigError:
+        logger.error('Could not find developer project, please create one in '
+                     'Developer Console to continue. (See README.md)')
+    return None
+
+
+def parse_project_spec(project_spec, default_credentials_filepath):
+    """Parses a project given on the command line.
+
+    Args:
+        project_spec: (str) A project ID, optionally followed by '=' and the
+            path of the credentials with which to access it.
+        default_credentials_filepath: (str) Path of the credentials of projects
+            given without their own.
+
+    Returns:
+        (tuple) The project ID and the path of its credentials.
+    """
+    project_id, _, credentials_filepath = project_spec.partition('=')
+    return project_id, credentials_filepath or default_credentials_filepath
+
+
+def create_project_pool(project_specs,
+                        credentials_filepath,
+                        is_headless,
+                        max_jobs_per_project,
+                        max_batch_jobs_per_project=None,
+                        default_priority=projectpool.INTERACTIVE,
+                        promotion_seconds=None):
+    """Authenticates to the Google APIs for each project of a pool.
+
+    Args:
+        project_specs: (list) Projects given on the command line, as accepted
+            by parse_project_spec, or an empty list to use the first project
+            that the default credentials can access.
+        credentials_filepath: (str) Path of the default Google API credentials.
+        is_headless: (bool) Whether to authenticate without a local webserver.
+        max_jobs_per_project: (int) Maximum number of interactive jobs in
+            flight in each project, or None for no limit.
+        max_batch_jobs_per_project: (int) Maximum number of batch jobs in
+            flight in each project, or None for no limit.
+        default_priority: (str) Priority of the jobs of selectors that do not
+            specify one, one of projectpool.PRIORITIES.
+        promotion_seconds: (float) Seconds after which a pending batch job is
+            promoted to the interactive lane, or None to never promote it.
+
+    Returns:
+        (projectpool.ProjectPool) Pool of the projects, or None if any project
+        could not be found.
+    """
+    project_credentials = [parse_project_spec(project_spec,
+                                              credentials_filepath)
+                           for project_spec in project_specs]
+    if not project_credentials:
+        project_credentials = [(None, credentials_filepath)]
+    google_auth_configs = []
+    for project_id, project_credentials_filepath in project_credentials:
+        google_auth_config = create_google_auth_config(
+            project_credentials_filepath, is_headless, project_id)
+        if not google_auth_config:
+            return None
+        google_auth_configs.append(google_auth_config)
+    return projectpool.ProjectPool(
+        google_auth_configs,
+        max_jobs_per_project,
+        max_batch_jobs_per_project=max_batch_jobs_per_project,
+        default_priority=default_priority,
+        promotion_seconds=promotion_seconds)
+
+
+def publish_selector_queue(selector_queue, work_queue, generation_done):
+    """Publishes queries to a work queue as they are generated.
+
+    The work queue is closed once every query has been published, so that
+    workers stop when they have finished the queries.
+
+    Args:
+        selector_queue: (Queue.Queue) A queue of (query string, metadata,
+            data filepath, attempted) tuples to publish.
+        work_queue: (workqueue.SQLiteWorkQueue) Queue shared with workers.
+        generation_done: (threading.Event) Event set once every query has been
+            added to the selector queue.
+    """
+    while True:
+        generation_finished = generation_done.is_set()
+        queue_sets = []
+        while not selector_queue.empty():
+            (bq_query_string, thread_metadata, data_filepath,
+             _) = selector_queue.get(False)
+            queue_sets.append((bq_query_string, thread_metadata, data_filepath))
+        if queue_sets:
+            work_queue.publish(queue_sets)
+        if generation_finished:
+            break
+        generation_done.wait(GENERATION_POLL_SECONDS)
+    work_queue.close()
+
+
+def wait_for_work_queue(work_queue):
+    """Waits for workers to finish every query in a work queue.
+
+    Args:
+        work_queue: (workqueue.SQLiteWorkQueue) Queue shared with workers.
+
+    Returns:
+        (dict) A map of each work item state to its number of items.
+    """
+    state_counts = workqueue.log_progress(work_queue)
+    while not work_queue.is_finished():
+        time.sleep(WORK_QUEUE_POLL_SECONDS)
+        state_counts = workqueue.log_progress(work_queue)
+    return state_counts
+
+
+def run_worker(work_queue,
+               project_pool,
+               worker_id,
+               batch_size=MAX_THREADS,
+               straggler_policy=None,
+               job_store=None):
+    """Claims and runs queries from a work queue until it is finished.
+
+    Queries are claimed continuously: whenever one of the worker's queries
+    finishes, its outcome is reported and another query is claimed in its
+    place, so that a slow query never holds back the rest of the worker's
+    queries. The leases on the claimed items are extended while their queries
+    run. Queries that neither succeed nor fail fatally are released, so that
+    any worker may retry them.
+
+    If the worker is interrupted, the items that have not finished are
+    released at once rather than when their leases expire.
+
+    Args:
+        work_queue: (workqueue.SQLiteWorkQueue) Queue shared with workers.
+        project_pool: (projectpool.ProjectPool) Pool of the projects through
+            which to submit jobs.
+        worker_id: (str) Identifier of this worker.
+        batch_size: (int) Maximum number of queries in flight at a time.
+        straggler_policy: (hedging.StragglerPolicy) Policy that decides when
+            to hedge or abandon slow jobs, or None to wait for every job.
+        job_store: (jobstore.SQLiteJobStore) Store in which to record the state
+            of each job, or None to not record it.
+    """
+    logger = logging.getLogger('telescope')
+    logger.info('Worker %s started.', worker_id)
+    completed_handlers = Queue.Queue()
+    item_ids_by_filepath = {}
+    heartbeat_stop = threading.Event()
+
+    def send_heartbeats():
+        while not heartbeat_stop.wait(work_queue.lease_seconds / 3.0):
+            work_queue.heartbeat(worker_id, item_ids_by_filepath.values())
+
+    def report_outcome(external_query_handler):
+        report_work_item_outcome(work_queue, worker_id, item_ids_by_filepath,
+                                 external_query_handler)
+
+    heartbeat_thread = threading.Thread(target=send_heartbeats,
+                                        name='heartbeat')
+    heartbeat_thread.daemon = True
+    heartbeat_thread.start()
+    try:
+        while True:
+            while not completed_handlers.empty():
+                report_outcome(completed_handlers.get(False))
+
+            work_items = []
+            claim_count = batch_size - len(item_ids_by_filepath)
+            if claim_count > 0:
+                work_items = work_queue.claim(worker_id, claim_count)
+            if work_items:
+                logger.info('Claimed %d queries.', len(work_items))
+                submit_work_items(work_items, item_ids_by_filepath,
+                                  project_pool, completed_handlers.put,
+                                  straggler_policy, job_store)
+            elif item_ids_by_filepath:
+                # Wake on the next completion, or after a while to claim the
+                # items that other workers released meanwhile.
+                try:
+                    report_outcome(completed_handlers.get(
+                        True, WORK_QUEUE_POLL_SECONDS))
+                except Queue.Empty:
+                    pass
+            elif work_queue.is_finished():
+                logger.info('Work queue is finished, stopping worker.')
+                return
+            else:
+                time.sleep(WORK_QUEUE_POLL_SECONDS)
+    except KeyboardInterrupt:
+        for item_id in item_ids_by_filepath.values():
+            work_queue.release(worker_id, item_id)
+        raise
+    finally:
+        heartbeat_stop.set()
+        heartbeat_thread.join()
+
+
+def submit_work_items(work_items, item_ids_by_filepath, project_pool,
+                      completion_callback, straggler_policy, job_store):
+    """Submits the queries of items claimed from a work queue.
+
+    Args:
+        work_items: (list) The workqueue.WorkItem objects claimed.
+        item_ids_by_filepath: (dict) Map of the data filepath of each item in
+            flight to its ID, to which the items are added.
+        project_pool: (projectpool.ProjectPool) Pool of the projects through
+            which to submit jobs.
+        completion_callback: (function) Called from each job's thread with the
+            job's ExternalQueryHandler once the job's slot is released.
+        straggler_policy: (hedging.StragglerPolicy) Policy that decides when
+            to hedge or abandon slow jobs, or None to wait for every job.
+        job_store: (jobstore.SQLiteJobStore) Store in which to record the state
+            of each job, or None to not record it.
+    """
+    selector_queue = Queue.Queue()
+    for work_item in work_items:
+        if job_store:
+            job_store.record_queued(
+                jobstore.create_selector_key(work_item.thread_metadata),
+                work_item.data_filepath, work_item.bq_query_string)
+        selector_queue.put((work_item.bq_query_string,
+                            work_item.thread_metadata, work_item.data_filepath,
+                            work_item.attempts > 1))
+        item_ids_by_filepath[work_item.data_filepath] = work_item.item_id
+    process_selector_queue(selector_queue,
+                           project_pool,
+                           job_store=job_store,
+                           straggler_policy=straggler_policy,
+                           completion_callback=completion_callback)
+
+
+def report_work_item_outcome(work_queue, worker_id, item_ids_by_filepath,
+                             external_query_handler):
+    """Reports the outcome of a finished query to the work queue.
+
+    Args:
+        work_queue: (workqueue.SQLiteWorkQueue) Queue shared with workers.
+        worker_id: (str) Identifier of the worker that claimed the item.
+        item_ids_by_filepath: (dict) Map of the data filepath of each item in
+            flight to its ID, from which the item is removed.
+        external_query_handler: (ExternalQueryHandler) Handler of the query's
+            finished job.
+    """
+    item_id = item_ids_by_filepath.pop(external_query_handler.queue_set[2],
+                                       None)
+    # Each item's outcome is reported once, even if its query was submitted
+    # more than once.
+    if item_id is None:
+        return
+    if external_query_handler.has_succeeded:
+        work_queue.complete(worker_id, item_id, True)
+    elif external_query_handler.has_failed:
+        work_queue.complete(worker_id, item_id, False)
+    else:
+        work_queue.release(worker_id, item_id)
+
+
+def compile_plan(pending_selectors,
+                 query_selectors,
+                 timed_queries,
+                 store_fetches=None,
+                 result_store_dir=None):
+    """Compiles the generated queries of selectors into a plan.
+
+    Args:
+        pending_selectors: (list) A list of (selector, data filepath) tuples of
+            the selectors whose output is not yet written.
+        query_selectors: (list) A list of (selector, data filepath) tuples for
+            which queries are generated, which are the pending selectors or,
+            with a result store, the store's fetches.
+        timed_queries: (iterable) The (query string, generation seconds) tuple
+            of each query selector, in the same order, as from
+            generate_queries.
+        store_fetches: (list) The (fetch_selector, result_key, first_day,
+            day_count) tuple of each query selector, as from
+            plan_result_store_fetches, or None without a result store.
+        result_store_dir: (str) Directory of the result store, or None.
+
+    Returns:
+        (plan.Plan) The plan.
+    """
+    query_steps = []
+    fetch_steps_by_key = {}
+    for query_index, (
+            query_selector, timed_query
+    ) in enumerate(itertools.izip(query_selectors, timed_queries)):
+        data_selector, data_filepath = query_selector
+        thread_metadata = build_thread_metadata(data_selector)
+        bq_query_string, generation_seconds = timed_query
+        instrumentation.record(
+            'generate_query', generation_seconds,
+            ', '.join(filter(None, thread_metadata.values())))
+        fetch = None
+        if store_fetches:
+            _, result_key, first_day, day_count = store_fetches[query_index]
+            fetch = (result_key, first_day.isoformat(), day_count)
+        query_step = plan.QueryStep(
+            step_id=plan.create_step_id(plan.QUERY, data_filepath),
+            thread_metadata=thread_metadata,
+            output_path=data_filepath,
+            bq_query_string=bq_query_string,
+            estimated_bytes=None,
+            fetch=fetch)
+        query_steps.append(query_step)
+        if fetch:
+            fetch_days = set(first_day + datetime.timedelta(days=day_index)
+                             for day_index in range(day_count))
+            fetch_steps_by_key.setdefault(result_key, []).append(
+                (fetch_days, query_step.step_id))
+
+    assembly_steps = []
+    if result_store_dir:
+        for data_selector, data_filepath in pending_selectors:
+            result_key = selector_result_key(data_selector)
+            end_time = data_selector.start_time + datetime.timedelta(
+                seconds=data_selector.duration)
+            window_days = set(resultstore.days_in_window(
+                data_selector.start_time, end_time))
+            assembly_steps.append(plan.AssemblyStep(
+                step_id=plan.create_step_id(plan.ASSEMBLY, data_filepath),
+                thread_metadata=build_thread_metadata(data_selector),
+                output_path=data_filepath,
+                result_key=result_key,
+                start_timestamp=utils.utc_datetime_to_unix_timestamp(
+                    data_selector.start_time),
+                end_timestamp=utils.utc_datetime_to_unix_timestamp(end_time),
+                depends_on=tuple(step_id
+                                 for fetch_days, step_id in
+                                 fetch_steps_by_key.get(result_key, [])
+                                 if fetch_days & window_days)))
+    return plan.Plan(query_steps, assembly_steps, result_store_dir)
+
+
+def estimate_plan_costs(compiled_plan, project_pool):
+    """Estimates the bytes that each query of a plan would process.
+
+    Each estimate is a BigQuery dry run, which is free and does not count
+    against the project's limit on concurrent queries.
+
+    Args:
+        compiled_plan: (plan.Plan) Plan whose queries to estimate.
+        project_pool: (projectpool.ProjectPool) Pool of the projects through
+            which to run the dry runs.
+
+    Returns:
+        (plan.Plan) The plan with the estimate of each query, or None for the
+        queries whose dry run failed.
+    """
+    logger = logging.getLogger('telescope')
+
+    def estimate_step(query_step):
+        job_slot = project_pool.acquire()
+        try:
+            bq_query_call = external.BigQueryCall(
+                external.get_authenticated_service(job_slot.google_auth_config),
+                job_slot.project_id)
+            return query_step._replace(estimated_bytes=(
+                bq_query_call.estimate_query_bytes(query_step.bq_query_string)))
+        except external.BigQueryCommunicationError as caught_error:
+            logger.warn('Failed to estimate the cost of %s: %s',
+                        query_step.output_path, caught_error)
+            return query_step
+        finally:
+            job_slot.release()
+
+    if not compiled_plan.query_steps:
+        return compiled_plan
+    pool = ThreadPool(min(MAX_THREADS, len(compiled_plan.query_steps)))
+    try:
+        query_steps = pool.map(estimate_step, compiled_plan.query_steps)
+    finally:
+        pool.close()
+        pool.join()
+    return plan.Plan(query_steps, compiled_plan.assembly_steps,
+                     compiled_plan.result_store_dir)
+
+
+def enqueue_plan_queries(compiled_plan,
+                         selector_queue,
+                         result_store=None,
+                         ignore_cache=False,
+                         job_store=None):
+    """Adds the queries of a plan whose results are not yet retrieved.
+
+    Args:
+        compiled_plan: (plan.Plan) Plan whose queries to add.
+        selector_queue: (Queue.Queue) Queue to which to add the queries.
+        result_store: (resultstore.DailyResultStore) Store into which the
+            plan's fetches retrieve days, or None if the plan has none.
+        ignore_cache: (bool) Whether to run queries whose results were already
+            retrieved.
+        job_store: (jobstore.SQLiteJobStore) Store in which to record that the
+            queries are queued, or None to not record them.
+    """
+    logger = logging.getLogger('telescope')
+    for query_step in compiled_plan.query_steps:
+        if not ignore_cache and _is_plan_query_done(query_step, result_store,
+                                                    job_store):
+            logger.info('Results of plan step %s found (%s), moving off.',
+                        query_step.step_id, query_step.output_path)
+            continue
+        if job_store:
+            job_store.record_queued(
+                jobstore.create_selector_key(query_step.thread_metadata),
+                query_step.output_path, query_step.bq_query_string)
+        selector_queue.put((query_step.bq_query_string,
+                            query_step.thread_metadata, query_step.output_path,
+                            False))
+    metrics.set_gauge(metrics.SELECTOR_QUEUE_DEPTH, selector_queue.qsize())
+
+
+def _is_plan_query_done(query_step, result_store, job_store):
+    if not query_step.fetch:
+        return is_output_cached(query_step.thread_metadata,
+                                query_step.output_path, job_store)
+    # A fetch is done once its days are stored, which removes its file.
+    result_key, first_day, day_count = query_step.fetch
+    first_datetime = resultstore.day_to_datetime(_parse_iso_date(first_day))
+    return not result_store.find_missing_days(
+        result_key,
+        first_datetime,
+        first_datetime + datetime.timedelta(days=day_count))
+
+
+def _parse_iso_date(date_string):
+    return datetime.datetime.strptime(date_string, '%Y-%m-%d').date()
+
+
+def finish_plan_assemblies(compiled_plan, result_store):
+    """Stores the plan's fetches and writes the outputs of its assemblies.
+
+    Args:
+        compiled_plan: (plan.Plan) Plan whose queries have run.
+        result_store: (resultstore.DailyResultStore) Store into which the
+            plan's fetches retrieved days.
+    """
+    for query_step in compiled_plan.query_steps:
+        if query_step.fetch:
+            result_key, first_day, day_count = query_step.fetch
+            result_store.ingest_fetch(result_key, _parse_iso_date(first_day),
+                                      day_count)
+    for assembly_step in compiled_plan.assembly_steps:
+        write_window_from_result_store(
+            result_store, assembly_step.result_key,
+            utils.unix_timestamp_to_utc_datetime(assembly_step.start_timestamp),
+            utils.unix_timestamp_to_utc_datetime(assembly_step.end_timestamp),
+            assembly_step.thread_metadata, assembly_step.output_path)
+
+
+def execute_plan(compiled_plan,
+                 project_pool,
+                 job_store=None,
+                 straggler_policy=None,
+                 ignore_cache=False,
+                 work_queue=None):
+    """Runs the queries of a plan, then writes the outputs of its assemblies.
+
+    Args:
+        compiled_plan: (plan.Plan) Plan to run.
+        project_pool: (projectpool.ProjectPool) Pool of the projects through
+            which to submit jobs, or None to publish the queries to the work
+            queue instead.
+        job_store: (jobstore.SQLiteJobStore) Store in which to record the state
+            of each job, or None to not record it.
+        straggler_policy: (hedging.StragglerPolicy) Policy that decides when
+            to hedge or abandon slow jobs, or None to wait for every job.
+        ignore_cache: (bool) Whether to run queries whose results were already
+            retrieved.
+        work_queue: (workqueue.SQLiteWorkQueue) Queue shared with workers that
+            run the queries, or None to run them in this process.
+    """
+    result_store = None
+    if compiled_plan.result_store_dir:
+        result_store = resultstore.DailyResultStore(
+            compiled_plan.result_store_dir)
+    selector_queue = Queue.Queue()
+    enqueue_plan_queries(compiled_plan, selector_queue, result_store,
+                         ignore_cache, job_store)
+    if work_queue:
+        generation_done = threading.Event()
+        generation_done.set()
+        publish_selector_queue(selector_queue, work_queue, generation_done)
+        wait_for_work_queue(work_queue)
+    else:
+        execute_selector_queue(selector_queue,
+                               project_pool,
+                               job_store=job_store,
+                               straggler_policy=straggler_policy)
+    if result_store:
+        finish_plan_assemblies(compiled_plan, result_store)
+
+
+def write_run_reports(args):
+    """Writes the timing and job statistics reports requested for the run."""
+    if args.timingreport:
+        instrumentation.get_recorder().write_summary(args.timingreport)
+    if args.jobstatsreport:
+        jobstats.get_recorder().write_report(args.jobstatsreport)
+
+
 def main(args):
     selector_queue = Queue.Queue()
     logger = setup_logger(args.verbosity)
+    if args.metricsport is not None:
+        metrics.start_metrics_server(args.metricsport)
+    job_store = None
+    if args.jobstore:
+        job_store = jobstore.SQLiteJobStore(args.jobstore)
+        if args.jobstatus:
+            log_job_status(job_store)
+            return False
+    # Latencies are shared by every job of the run, so that each job is
+    # compared with the comparable jobs that finished before it.
+    straggler_policy = hedging.StragglerPolicy(
+        hedge_percentile=args.hedgepercentile,
+        hedge_multiplier=args.hedgemultiplier,
+        min_samples=args.hedgeminsamples,
+        deadline_seconds=args.jobdeadline)
+
+    if args.worker:
+        project_pool = create_project_pool(
+            args.projects, args.credentials_filepath,
+            args.noauth_local_webserver, args.projectjobs,
+            args.projectbatchjobs, args.priority.upper(), args.batchpromotion)
+        if not project_pool:
+            return None
+        try:
+            run_worker(
+                workqueue.SQLiteWorkQueue(args.workqueue, args.leaseseconds),
+                project_pool,
+                workqueue.create_worker_id(),
+                straggler_policy=straggler_policy,
+                job_store=job_store)
+        except KeyboardInterrupt:
+            logger.error('Caught interruption, shutting down now.')
+            cancel_in_flight_jobs(project_pool, job_store, args.canceltimeout)
+        write_run_reports(args)
+        return False
+
+    if args.runplan:
+        compiled_plan = plan.read_plan(args.runplan).select(
+            plan.parse_field_values(args.planfilter),
+            *plan.parse_shard(args.planshard))
+        logger.info('Running %d queries and %d assemblies of plan %s.',
+                    len(compiled_plan.query_steps),
+                    len(compiled_plan.assembly_steps), args.runplan)
+        project_pool = None
+        work_queue = None
+        if args.workqueue:
+            work_queue = workqueue.SQLiteWorkQueue(args.workqueue,
+                                                   args.leaseseconds)
+        else:
+            project_pool = create_project_pool(
+                args.projects, args.credentials_filepath,
+                args.noauth_local_webserver, args.projectjobs,
+                args.projectbatchjobs, args.priority.upper(),
+                args.batchpromotion)
+            if not project_pool:
+                return None
+        try:
+            execute_plan(compiled_plan, project_pool, job_store,
+                         straggler_policy, args.ignorecache, work_queue)
+        except KeyboardInterrupt:
+            logger.error('Caught interruption, shutting down now.')
+            cancel_in_flight_jobs(project_pool, job_store, args.canceltimeout)
+        write_run_reports(args)
+        return False
 
     selectors = selectors_from_files(args.selector_in)
     # The selectors were likely provided in order. Shuffle them to get better
     # concurrent distribution on BigQuery tables.
     selectors = shuffle_selectors(selectors)
 
-    ip_translator_factory = iptranslation.IPTranslationStrategyFactory()
-    mlab_site_resolver = mlab.MLabSiteResolver()
+    block_cache = None
+    if args.ipblockcachedir:
+        block_cache = iptranslation.IPBlockDiskCache(args.ipblockcachedir)
+    ip_translator_factory = iptranslation.IPTranslationStrategyFactory(
+        block_cache=block_cache)
+    site_history = None
+    if args.sitehistory:
+        site_history = mlab.MLabSiteHistory.from_file(args.sitehistory)
+    mlab_site_resolver = mlab.MLabSiteResolver(cache_filepath=args.dnscachefile,
+                                               cache_ttl=args.dnscachettl,
+                                               site_map_filepath=args.sitemap,
+                                               site_history=site_history)
+    query_template_cache = query.BigQueryQueryTemplateCache()
+    query_backends = dict(query.DEFAULT_BACKENDS)
+    query_backends['standard'] = query.StandardSqlBackend(
+        table=args.standardsqltable,
+        partition_column=args.partitioncolumn,
+        partition_column_type=args.partitioncolumntype,
+        range_join_threshold=args.rangejointhreshold)
+    pending_selectors = []
     for data_selector in selectors:
-        thread_metadata = {
-            'date': data_selector.start_time.strftime('%Y-%m-%d-%H%M%S'),
-            'duration': duration_to_string(data_selector.duration),
-            'site': data_selector.site,
-            'client_provider': data_selector.client_provider,
-            'client_country': data_selector.client_country,
-            'metric': data_selector.metric
-        }
+        thread_metadata = build_thread_metadata(data_selector)
         data_filepath = utils.build_filename(
             args.output, thread_metadata['date'], thread_metadata['duration'],
             thread_metadata['site'], thread_metadata['client_provider'],
             thread_metadata['client_country'], thread_metadata['metric'],
             '-raw.csv')
-        if not args.ignorecache and utils.check_for_valid_cache(data_filepath):
+        if not args.ignorecache and is_output_cached(thread_metadata,
+                                                     data_filepath, job_store):
             logger.info(('Raw data file found (%s), assuming this is '
                          'cached copy of same data and moving off. Use '
                          '--ignorecache to suppress this behavior.'),
@@ -453,89 +1822,154 @@ def main(args):
             continue
 
         logger.debug('Did not find existing data file: %s', data_filepath)
-        logger.debug((
-            'Generating Query for subset of {site}, {client_provider}, '
-            '{date}, {duration}.').format(**thread_metadata))
-
-        data_selector.ip_translation_spec.params['maxmind_dir'] = (
-            args.maxminddir)
-
-        ip_translator = ip_translator_factory.create(
-            data_selector.ip_translation_spec)
-        bq_query_string = generate_query(data_selector, ip_translator,
-                                         mlab_site_resolver)
-
-        if args.savequery:
-            bigquery_filepath = utils.build_filename(
-                args.output, thread_metadata['date'],
-                thread_metadata['duration'], thread_metadata['site'],
-                thread_metadata['client_provider'],
-                thread_metadata['client_country'], thread_metadata['metric'],
-                '-bigquery.sql')
-            write_bigquery_to_file(bigquery_filepath, bq_query_string)
-        if not args.dryrun:
-            # Offer Queue a tuple of the BQ statement, metadata, and a boolean
-            # that indicates that the loop has not attempted to run the query
-            # thus far (failed queries are pushed back to the end of the loop).
-            selector_queue.put((bq_query_string, thread_metadata, data_filepath,
-                                False))
-        else:
-            logger.warn(
-                'Dry run flag caught, built query and reached the point that '
-                'it would be posted, moving on.')
-    try:
-        if not args.dryrun:
-            logger.info('Finished processing selector files, approximately %d '
-                        'queries to be performed.', selector_queue.qsize())
-            if os.path.exists(args.credentials_filepath) is False:
-                logger.warn(
-                    'No credentials for Google appear to exist, next step '
-                    'will be an authentication mechanism for its API.')
-
-            try:
-                google_auth_config = external.GoogleAPIAuth(
-                    args.credentials_filepath,
-                    is_headless=args.noauth_local_webserver)
-            except external.APIConfigError:
-                logger.error(
-                    'Could not find developer project, please create one in '
-                    'Developer Console to continue. (See README.md)')
+        # The selector's metadata is built again when it is needed, rather
+        # than kept for every pending selector.
+        pending_selectors.append((data_selector, data_filepath))
+
+    # With a result store, query only for the days that are not yet stored,
+    # then assemble each selector's output from the stored days.
+    result_store = None
+    store_fetches = []
+    query_selectors = pending_selectors
+    if args.resultstore:
+        result_store = resultstore.DailyResultStore(args.resultstore)
+        store_fetches = plan_result_store_fetches(
+            [data_selector for data_selector, _ in pending_selectors],
+            result_store)
+        query_selectors = []
+        for fetch_selector, result_key, first_day, day_count in store_fetches:
+            fetch_filepath = result_store.build_fetch_filepath(
+                result_key, first_day, day_count)
+            query_selectors.append((fetch_selector, fetch_filepath))
+        logger.info('Retrieving %d runs of days missing from the result store '
+                    'for %d selectors.', len(query_selectors),
+                    len(pending_selectors))
+
+    # Resolve every client provider up front, so that each snapshot is
+    # scanned once for all of its providers.
+    with instrumentation.span('resolve_client_providers'):
+        resolve_client_providers(
+            [data_selector for data_selector, _ in query_selectors],
+            ip_translator_factory, args.maxminddir)
+    with instrumentation.span('resolve_sites'):
+        mlab_site_resolver.prefetch_sites(set(
+            data_selector.site for data_selector, _ in query_selectors
+            if data_selector.site))
+
+    timed_queries = generate_queries(
+        [data_selector for data_selector, _ in query_selectors],
+        ip_translator_factory, mlab_site_resolver, query_template_cache,
+        query_backends, args.maxminddir, args.generationprocesses)
+
+    if args.writeplan:
+        compiled_plan = compile_plan(pending_selectors, query_selectors,
+                                     timed_queries, store_fetches or None,
+                                     args.resultstore)
+        mlab_site_resolver.save_cache()
+        if args.planestimates:
+            project_pool = create_project_pool(
+                args.projects, args.credentials_filepath,
+                args.noauth_local_webserver, args.projectjobs)
+            if not project_pool:
                 return None
+            compiled_plan = estimate_plan_costs(compiled_plan, project_pool)
+        compiled_plan.write(args.writeplan)
+        logger.info('Wrote %d queries and %d assemblies to plan %s, '
+                    'estimated to process %s bytes.',
+                    len(compiled_plan.query_steps),
+                    len(compiled_plan.assembly_steps), args.writeplan,
+                    compiled_plan.estimated_bytes())
+        write_run_reports(args)
+        return False
+
+    # Queries are added to the queue as they are generated, so that BigQuery
+    # runs the first queries while the rest are still being generated.
+    generation_done = threading.Event()
+    generation_errors = []
+
+    def generate_and_enqueue_queries():
+        try:
+            enqueue_queries(query_selectors, timed_queries, selector_queue,
+                            args.output, args.savequery, args.dryrun, job_store)
+            mlab_site_resolver.save_cache()
+        except Exception as caught_error:
+            logger.error('Query generation failed: %s', caught_error)
+            generation_errors.append(sys.exc_info())
+        finally:
+            generation_done.set()
 
-            while not selector_queue.empty():
-                thread_monitor = process_selector_queue(selector_queue,
-                                                        google_auth_config)
-
-                for (existing_thread, external_query_handler) in thread_monitor:
-                    existing_thread.join()
-                    # Join together all defined attributes of thread_metadata for a user
-                    # friendly notiication string.
-                    identifier_string = ', '.join(filter(
-                        None, thread_metadata.values()))
-
-                    if (not external_query_handler.has_succeeded and
-                            not external_query_handler.has_failed):
-                        selector_queue.put(external_query_handler.queue_set)
-                    elif external_query_handler.has_failed:
-                        logger.debug('Fatal error on %s, moving along.',
-                                     identifier_string)
-                    else:
-                        logger.debug('Successfully retrieved %s.',
-                                     identifier_string)
+    project_pool = None
+    try:
+        if args.dryrun:
+            generate_and_enqueue_queries()
+        else:
+            generation_thread = threading.Thread(
+                target=profiling.wrap_thread_target(
+                    generate_and_enqueue_queries),
+                name='generate_queries')
+            generation_thread.daemon = True
+            generation_thread.start()
+            if args.workqueue:
+                logger.info('Publishing approximately %d queries to %s.',
+                            len(query_selectors), args.workqueue)
+                work_queue = workqueue.SQLiteWorkQueue(args.workqueue,
+                                                       args.leaseseconds)
+                publish_selector_queue(selector_queue, work_queue,
+                                       generation_done)
+                wait_for_work_queue(work_queue)
+            else:
+                logger.info('Generating and running approximately %d queries.',
+                            len(query_selectors))
+                project_pool = create_project_pool(
+                    args.projects, args.credentials_filepath,
+                    args.noauth_local_webserver, args.projectjobs,
+                    args.projectbatchjobs, args.priority.upper(),
+                    args.batchpromotion)
+                if not project_pool:
+                    return None
+                execute_selector_queue(selector_queue, project_pool,
+                                       generation_done, job_store,
+                                       straggler_policy)
+            join_thread(generation_thread)
+
+            if result_store and not generation_errors:
+                for _, result_key, first_day, day_count in store_fetches:
+                    result_store.ingest_fetch(result_key, first_day, day_count)
+                write_selectors_from_result_store(pending_selectors,
+                                                  result_store)
 
     except KeyboardInterrupt:
         logger.error('Caught interruption, shutting down now.')
-
+        cancel_in_flight_jobs(project_pool, job_store, args.canceltimeout)
+        # Keep the runs of days that were retrieved before the interruption,
+        # so that the next run queries only the rest.
+        if result_store:
+            for _, result_key, first_day, day_count in store_fetches:
+                result_store.ingest_fetch(result_key, first_day, day_count)
+
+    write_run_reports(args)
+    if generation_errors:
+        error_type, error_value, error_traceback = generation_errors[0]
+        raise error_type, error_value, error_traceback
     return False
 
 
-if __name__ == '__main__':
+def parse_args(argv=None):
+    """Parses and checks the command line arguments.
+
+    Args:
+        argv: (list) Arguments to parse, or None to parse those of the process.
+
+    Returns:
+        (argparse.Namespace) The parsed arguments. Invalid arguments exit the
+        process with a usage message.
+    """
     parser = argparse.ArgumentParser(
         prog='M-Lab Telescope',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     parser.add_argument('selector_in',
-                        nargs='+',
+                        nargs='*',
                         default=None,
                         help='Selector JSON datafile(s) to parse.')
     parser.add_argument('-v',
@@ -554,6 +1988,74 @@ if __name__ == '__main__':
     parser.add_argument('--maxminddir',
                         default='resources/',
                         help='MaxMind GeoLite ASN snapshot directory.')
+    parser.add_argument('--ipblockcachedir',
+                        default=None,
+                        help=('Directory in which to cache the IP blocks found '
+                              'for each client provider, so that later runs '
+                              'need not parse MaxMind snapshots.'))
+    parser.add_argument('--timingreport',
+                        default=None,
+                        help=('JSON file to which to write a summary of the '
+                              'time spent in each stage of the run, including '
+                              'the slowest selectors.'))
+    parser.add_argument('--jobstatsreport',
+                        default=None,
+                        help=('JSON file to which to write the bytes billed '
+                              'and slot time of the run\'s BigQuery jobs, '
+                              'totalled by metric, site and client provider, '
+                              'including the most expensive selectors.'))
+    parser.add_argument('--metricsport',
+                        default=None,
+                        type=int,
+                        help=('Local port on which to serve live counters and '
+                              'gauges of the run at /metrics, in the '
+                              'Prometheus text format.'))
+    parser.add_argument('--resultstore',
+                        default=None,
+                        help=('Directory in which to store query results for '
+                              'each UTC day, so that selectors with '
+                              'overlapping time windows query each day only '
+                              'once.'))
+    parser.add_argument('--dnscachefile',
+                        default=None,
+                        help=('File in which to cache resolved M-Lab server '
+                              'addresses between runs.'))
+    parser.add_argument('--dnscachettl',
+                        default=mlab.DEFAULT_CACHE_TTL,
+                        type=int,
+                        help=('Number of seconds for which addresses in the '
+                              'DNS cache file remain valid.'))
+    parser.add_argument('--sitemap',
+                        default=None,
+                        help=('JSON file mapping M-Lab site IDs to lists of '
+                              'server addresses, used instead of DNS.'))
+    parser.add_argument('--sitehistory',
+                        default=None,
+                        help=('JSON file of the server addresses of M-Lab '
+                              'sites over time. Sites in the history are '
+                              'resolved for each selector\'s time window '
+                              'without DNS.'))
+    parser.add_argument('--standardsqltable',
+                        default=query.STANDARD_SQL_BACKEND.table,
+                        help=('Date-partitioned table or view of NDT tests '
+                              'to query for selectors that specify the '
+                              'standard SQL dialect.'))
+    parser.add_argument('--partitioncolumn',
+                        default='_PARTITIONTIME',
+                        help=('Partition column of the table given by '
+                              '--standardsqltable.'))
+    parser.add_argument('--partitioncolumntype',
+                        default='TIMESTAMP',
+                        choices=('TIMESTAMP', 'DATE'),
+                        help=('Type of the partition column of the table '
+                              'given by --standardsqltable.'))
+    parser.add_argument('--rangejointhreshold',
+                        default=query.DEFAULT_RANGE_JOIN_THRESHOLD,
+                        type=int,
+                        help=('Number of client IP blocks above which standard '
+                              'SQL queries match client addresses by joining '
+                              'with an inline table of the blocks instead of '
+                              'with one condition per block.'))
     parser.add_argument('--savequery',
                         default=False,
                         action='store_true',
@@ -580,6 +2082,182 @@ if __name__ == '__main__':
                         help=(
                             'Google API Credentials. If it does not exist, will'
                             ' trigger Google auth.'))
+    parser.add_argument('--project',
+                        dest='projects',
+                        action='append',
+                        default=[],
+                        help=('ID of a Google developer project through which '
+                              'to run jobs, optionally followed by = and the '
+                              'path of its credentials. Repeat to spread jobs '
+                              'across the quotas of several projects. By '
+                              'default, the first project of the credentials '
+                              'is used.'))
+    parser.add_argument('--projectjobs',
+                        default=MAX_THREADS,
+                        type=int,
+                        help=('Maximum number of interactive jobs in flight '
+                              'in each project.'))
+    parser.add_argument('--projectbatchjobs',
+                        default=None,
+                        type=int,
+                        help=('Maximum number of batch jobs in flight in each '
+                              'project. Batch jobs do not count against the '
+                              '--projectjobs limit. By default, batch jobs are '
+                              'limited only by the number of threads.'))
+    parser.add_argument('--priority',
+                        default='interactive',
+                        choices=selector.SUPPORTED_PRIORITIES,
+                        help=('BigQuery priority of the queries of selectors '
+                              'that do not specify one. Batch queries wait for '
+                              'idle capacity, so that bulk backfills do not '
+                              'delay interactive queries.'))
+    parser.add_argument('--batchpromotion',
+                        default=None,
+                        type=float,
+                        help=('Seconds after which a batch query that has not '
+                              'started is replaced by an interactive query, '
+                              'once the project has room for it. By default, '
+                              'batch queries wait however long BigQuery takes '
+                              'to start them.'))
+
+    parser.add_argument('--generationprocesses',
+                        default=1,
+                        type=int,
+                        help=('Number of worker processes with which to '
+                              'generate queries. Queries are submitted as '
+                              'they are generated.'))
+    parser.add_argument('--writeplan',
+                        default=None,
+                        help=('File to which to write the compiled plan of the '
+                              'selector files, with the query and output path '
+                              'of each selector, then exit without running '
+                              'the queries.'))
+    parser.add_argument('--planestimates',
+                        default=False,
+                        action='store_true',
+                        help=('With --writeplan, estimate the bytes that each '
+                              'query will process with a BigQuery dry run.'))
+    parser.add_argument('--runplan',
+                        default=None,
+                        help=('Plan file from --writeplan whose queries to '
+                              'run, instead of compiling selector files. '
+                              'MaxMind snapshots and DNS are not needed.'))
+    parser.add_argument('--planfilter',
+                        default=None,
+                        action='append',
+                        help=('With --runplan, run only the selectors whose '
+                              'metadata field has the given value, written as '
+                              'field=value, such as site=lga01. May be given '
+                              'more than once.'))
+    parser.add_argument('--planshard',
+                        default='0/1',
+                        help=('With --runplan, run only one shard of the '
+                              'plan, written as index/count, such as 0/4 for '
+                              'the first of four shards, so that several '
+                              'hosts can run one plan.'))
+    parser.add_argument('--workqueue',
+                        default=None,
+                        help=('SQLite file of a work queue shared between '
+                              'hosts. With selector files, publishes their '
+                              'queries to the queue and waits for workers to '
+                              'run them. With --worker, runs queries from the '
+                              'queue.'))
+    parser.add_argument('--worker',
+                        default=False,
+                        action='store_true',
+                        help=('Run queries from the --workqueue until it is '
+                              'finished. Workers and the coordinator should '
+                              'share the output directory.'))
+    parser.add_argument('--leaseseconds',
+                        default=workqueue.DEFAULT_LEASE_SECONDS,
+                        type=float,
+                        help=('Seconds after its last heartbeat at which a '
+                              'worker\'s queries may be claimed by others.'))
+    parser.add_argument('--jobstore',
+                        default=None,
+                        help=('SQLite file in which to record the state of '
+                              'each selector\'s job. Later runs skip '
+                              'selectors that the store records as '
+                              'downloaded.'))
+    parser.add_argument('--jobstatus',
+                        default=False,
+                        action='store_true',
+                        help=('Log the number of jobs in each state of the '
+                              '--jobstore, and the jobs that failed, then '
+                              'exit.'))
+    parser.add_argument('--canceltimeout',
+                        default=DEFAULT_CANCEL_TIMEOUT_SECONDS,
+                        type=float,
+                        help=('Seconds to wait for the jobs still running in '
+                              'BigQuery to be cancelled when the run is '
+                              'interrupted.'))
+    parser.add_argument('--hedgepercentile',
+                        default=None,
+                        type=float,
+                        help=('Percentile of the latencies of finished jobs of '
+                              'the same metric and duration on which to base '
+                              'the time after which a duplicate of a slow job '
+                              'is submitted. The first of the two jobs to '
+                              'finish is used. By default, jobs are not '
+                              'duplicated.'))
+    parser.add_argument('--hedgemultiplier',
+                        default=hedging.DEFAULT_HEDGE_MULTIPLIER,
+                        type=float,
+                        help=('Multiple of the --hedgepercentile latency after '
+                              'which a job is duplicated.'))
+    parser.add_argument('--hedgeminsamples',
+                        default=hedging.DEFAULT_MIN_SAMPLES,
+                        type=int,
+                        help=('Number of comparable jobs that must finish '
+                              'before any job is duplicated.'))
+    parser.add_argument('--jobdeadline',
+                        default=None,
+                        type=float,
+                        help=('Seconds after which a selector\'s jobs are '
+                              'cancelled and the selector is recorded as '
+                              'failed, for selector files that do not '
+                              'specify a deadline.'))
+    parser.add_argument('--profile',
+                        default=None,
+                        choices=profiling.MODES,
+                        help=('Profile the main thread and query monitoring '
+                              'threads with cProfile, or sample the stacks of '
+                              'every thread.'))
+    parser.add_argument('--profiledir',
+                        default='profiles/',
+                        help=('Directory to which to write profiles and thread '
+                              'stack dumps, aggregated by thread role.'))
+    parser.add_argument('--samplinginterval',
+                        default=profiling.DEFAULT_SAMPLING_INTERVAL,
+                        type=float,
+                        help=('Seconds between stack samples with --profile '
+                              'sampling.'))
+    parser.add_argument('--stackdumpinterval',
+                        default=None,
+                        type=float,
+                        help=('Seconds between dumps of every thread\'s stack '
+                              'to the profiling directory, to show where '
+                              'threads are blocked.'))
+
+    args = parser.parse_args(argv)
+    if args.worker and not args.workqueue:
+        parser.error('--worker requires --workqueue.')
+    if args.jobstatus and not args.jobstore:
+        parser.error('--jobstatus requires --jobstore.')
+    # A worker claims its queries and a plan holds its compiled queries, so
+    # neither needs selector files.
+    if (not args.worker and not args.jobstatus and not args.runplan and
+            not args.selector_in):
+        parser.error('At least one selector file is required.')
+    return args
+
 
-    args = parser.parse_args()
-    main(args)
+if __name__ == '__main__':
+    args = parse_args()
+    if args.profile or args.stackdumpinterval:
+        profiling.start_profiling(args.profiledir, args.profile,
+                                  args.samplinginterval, args.stackdumpinterval)
+    try:
+        main(args)
+    finally:
+        profiling.stop_profiling()
@@ -15,6 +15,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import calendar
 import datetime
 import os
 
@@ -39,6 +40,28 @@ def unix_timestamp_to_utc_datetime(unix_timestamp):
     return datetime.datetime.fromtimestamp(unix_timestamp, tz=UTC())
 
 
+def utc_datetime_to_unix_timestamp(datetime_value):
+    """Converts a naive UTC or timezone-aware datetime to a UNIX timestamp."""
+    return calendar.timegm(datetime_value.utctimetuple())
+
+
+def calculate_percentile(values, percentile):
+    """Calculates a percentile of values by the nearest-rank method.
+
+    Args:
+        values: (list) Numbers, which need not be sorted.
+        percentile: (float) Percentile to calculate, from 0 to 100.
+
+    Returns:
+        (float) The smallest value that is at least the given percentage of
+        the values.
+    """
+    sorted_values = sorted(values)
+    # Rounds the rank up without the error of a floating point division.
+    rank = int(-(-len(sorted_values) * percentile // 100))
+    return sorted_values[max(rank, 1) - 1]
+
+
 def build_filename(outpath, date, duration, site, client_provider,
                    client_country, metric, suffix):
     """Builds an output filename that reflects the data being written to file.
@@ -117,3 +140,20 @@ def create_directory_if_not_exists(directory_name):
     if not os.path.exists(directory_name):
         os.makedirs(directory_name)
     return directory_name
+
+
+def write_file_atomically(filepath, contents):
+    """Writes a file so that it is never seen partially written.
+
+    The contents are written to a temporary file that then replaces the file,
+    so that a write interrupted by the process exiting never leaves a partial
+    file that later runs would take for a complete one.
+
+    Args:
+        filepath: (str) Path of the file to write.
+        contents: (str) Contents of the file.
+    """
+    temp_filepath = '%s.%d.tmp' % (filepath, os.getpid())
+    with open(temp_filepath, 'w') as temp_file:
+        temp_file.write(contents)
+    os.rename(temp_filepath, filepath)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Shares queries between a coordinator and workers through a SQLite file.
+
+The coordinator publishes each query as a work item. Workers claim items
+under a lease, which they extend with heartbeats while the query runs, and
+report whether each item succeeded or failed. Items whose lease expires,
+for example because their worker crashed, become claimable again, until
+they have been claimed too many times.
+
+The queue file may live on a volume shared by several hosts, provided that
+the volume supports the file locking that SQLite relies on.
+"""
+
+import collections
+import json
+import logging
+import os
+import socket
+import time
+
+import sqlitedb
+
+# Seconds for which a claimed item is reserved for its worker unless the
+# worker extends the lease.
+DEFAULT_LEASE_SECONDS = 300
+
+# Number of times an item may be claimed before it is considered failed.
+DEFAULT_MAX_ATTEMPTS = 5
+
+PENDING = 'pending'
+LEASED = 'leased'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+STATES = (PENDING, LEASED, SUCCEEDED, FAILED)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS work_items (
+    item_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    bq_query_string TEXT NOT NULL,
+    thread_metadata TEXT NOT NULL,
+    data_filepath TEXT NOT NULL,
+    state TEXT NOT NULL,
+    worker_id TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS work_items_by_state ON work_items (state);
+CREATE TABLE IF NOT EXISTS queue_status (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class WorkItem(collections.namedtuple('WorkItem', [
+        'item_id', 'bq_query_string', 'thread_metadata', 'data_filepath',
+        'attempts'
+])):
+    """A query claimed from the work queue.
+
+    Attributes:
+        item_id: (int) Identifier of the item in the queue.
+        bq_query_string: (str) Query to run.
+        thread_metadata: (dict) Metadata that labels the query's output.
+        data_filepath: (str) Path to which to write the query's results.
+        attempts: (int) Number of times the item has been claimed, including
+            this claim.
+    """
+    __slots__ = ()
+
+
+def create_worker_id():
+    """Creates an identifier of the current worker process."""
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+class SQLiteWorkQueue(object):
+    """Work queue of queries, stored in a SQLite database file."""
+
+    def __init__(self,
+                 queue_filepath,
+                 lease_seconds=DEFAULT_LEASE_SECONDS,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """Opens the queue, creating it if it does not exist.
+
+        Args:
+            queue_filepath: (str) Path of the SQLite database file.
+            lease_seconds: (float) Seconds for which claimed items are leased.
+            max_attempts: (int) Number of times an item may be claimed before
+                it is considered failed.
+        """
+        self._queue_filepath = queue_filepath
+        self._lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+        sqlitedb.create_schema(queue_filepath, _SCHEMA)
+
+    @property
+    def lease_seconds(self):
+        return self._lease_seconds
+
+    def _transact(self, operation):
+        return sqlitedb.transact(self._queue_filepath, operation)
+
+    def publish(self, queue_sets):
+        """Adds queries to the queue.
+
+        Args:
+            queue_sets: (iterable) (query string, metadata, data filepath)
+                tuples to add.
+
+        Returns:
+            (int) Number of items added.
+        """
+        rows = [
+            (bq_query_string, json.dumps(thread_metadata), data_filepath,
+             PENDING)
+            for bq_query_string, thread_metadata, data_filepath in queue_sets
+        ]
+
+        def insert_items(cursor):
+            cursor.executemany(
+                'INSERT INTO work_items (bq_query_string, thread_metadata, '
+                'data_filepath, state) VALUES (?, ?, ?, ?)', rows)
+
+        self._transact(insert_items)
+        return len(rows)
+
+    def close(self):
+        """Records that every item has been published.
+
+        Workers stop once the queue is closed and every item has finished.
+        """
+
+        def mark_closed(cursor):
+            cursor.execute('INSERT OR REPLACE INTO queue_status (name, value) '
+                           'VALUES (\'closed\', \'1\')')
+
+        self._transact(mark_closed)
+
+    def is_closed(self):
+
+        def find_closed(cursor):
+            return cursor.execute('SELECT value FROM queue_status '
+                                  'WHERE name = \'closed\'').fetchone()
+
+        return bool(self._transact(find_closed))
+
+    def claim(self, worker_id, count=1):
+        """Leases pending items to a worker.
+
+        Items whose lease has expired are claimable again. Claimable items
+        that have reached the maximum number of attempts are marked as failed
+        instead.
+
+        Args:
+            worker_id: (str) Identifier of the claiming worker.
+            count: (int) Maximum number of items to claim.
+
+        Returns:
+            (list) The claimed WorkItem objects, which may be empty.
+        """
+        now = time.time()
+
+        def claim_items(cursor):
+            claimable_condition = ('(state = ? OR (state = ? AND '
+                                   'lease_expires < ?))')
+            claimable_params = (PENDING, LEASED, now)
+            cursor.execute(
+                'UPDATE work_items SET state = ?, worker_id = NULL WHERE ' +
+                claimable_condition + ' AND attempts >= ?',
+                (FAILED,) + claimable_params + (self._max_attempts,))
+            rows = cursor.execute(
+                'SELECT item_id, bq_query_string, thread_metadata, '
+                'data_filepath, attempts FROM work_items WHERE ' +
+                claimable_condition + ' ORDER BY item_id LIMIT ?',
+                claimable_params + (count,)).fetchall()
+            cursor.executemany(
+                'UPDATE work_items SET state = ?, worker_id = ?, '
+                'lease_expires = ?, attempts = attempts + 1 '
+                'WHERE item_id = ?',
+                [(LEASED, worker_id, now + self._lease_seconds, row[0])
+                 for row in rows])
+            return rows
+
+        return [WorkItem(item_id, bq_query_string, json.loads(thread_metadata),
+                         data_filepath, attempts + 1)
+                for (item_id, bq_query_string, thread_metadata, data_filepath,
+                     attempts) in self._transact(claim_items)]
+
+    def heartbeat(self, worker_id, item_ids):
+        """Extends the leases that a worker holds on items.
+
+        Args:
+            worker_id: (str) Identifier of the worker.
+            item_ids: (list) Identifiers of the items the worker is processing.
+
+        Returns:
+            (int) Number of items whose lease was extended. Items whose lease
+            expired and was claimed by another worker are not extended.
+        """
+        lease_expires = time.time() + self._lease_seconds
+
+        def extend_leases(cursor):
+            cursor.executemany(
+                'UPDATE work_items SET lease_expires = ? '
+                'WHERE item_id = ? AND worker_id = ? AND state = ?',
+                [(lease_expires, item_id, worker_id, LEASED)
+                 for item_id in item_ids])
+            return cursor.rowcount
+
+        return self._transact(extend_leases)
+
+    def _finish(self, worker_id, item_id, state):
+
+        def update_item(cursor):
+            cursor.execute(
+                'UPDATE work_items SET state = ?, lease_expires = NULL '
+                'WHERE item_id = ? AND worker_id = ? AND state = ?',
+                (state, item_id, worker_id, LEASED))
+            return cursor.rowcount == 1
+
+        return self._transact(update_item)
+
+    def complete(self, worker_id, item_id, succeeded):
+        """Records the outcome of an item.
+
+        Args:
+            worker_id: (str) Identifier of the worker that processed the item.
+            item_id: (int) Identifier of the item.
+            succeeded: (bool) Whether the item's results were written.
+
+        Returns:
+            (bool) True if the worker still held the item's lease.
+        """
+        return self._finish(worker_id, item_id, SUCCEEDED
+                            if succeeded else FAILED)
+
+    def release(self, worker_id, item_id):
+        """Returns an item that hit a transient error to the pending items.
+
+        Args:
+            worker_id: (str) Identifier of the worker that held the item.
+            item_id: (int) Identifier of the item.
+
+        Returns:
+            (bool) True if the worker still held the item's lease.
+        """
+        return self._finish(worker_id, item_id, PENDING)
+
+    def count_states(self):
+        """Counts the items in each state.
+
+        Returns:
+            (dict) A map of each of STATES to its number of items.
+        """
+
+        def count_items(cursor):
+            return cursor.execute('SELECT state, COUNT(*) FROM work_items '
+                                  'GROUP BY state').fetchall()
+
+        state_counts = dict.fromkeys(STATES, 0)
+        state_counts.update(self._transact(count_items))
+        return state_counts
+
+    def is_finished(self):
+        """Indicates whether the queue is closed and every item has finished."""
+        state_counts = self.count_states()
+        return (self.is_closed() and not state_counts[PENDING] and
+                not state_counts[LEASED])
+
+
+def log_progress(work_queue):
+    """Logs the number of items in each state of a work queue."""
+    state_counts = work_queue.count_states()
+    logging.getLogger('telescope').info(
+        'Work queue: %d pending, %d leased, %d succeeded, %d failed.',
+        state_counts[PENDING], state_counts[LEASED], state_counts[SUCCEEDED],
+        state_counts[FAILED])
+    return state_counts
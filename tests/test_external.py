@@ -105,6 +105,28 @@ class BigQueryCallTest(unittest.TestCase):
         with self.assertRaises(external.BigQueryCommunicationError):
             self.call.run_asynchronous_query('dummy_query_string')
 
+    def test_run_asynchronous_query_quota_exceeded(self):
+        """BigQueryCall should distinguish errors due to exceeded quotas."""
+        rate_limit_error = MockHttpError(403)
+        rate_limit_error.content = (
+            '{"error": {"errors": [{"reason": "rateLimitExceeded"}]}}')
+        self.mock_authenticated_service.jobs.side_effect = rate_limit_error
+
+        with self.assertRaises(external.BigQueryQuotaExceeded):
+            self.call.run_asynchronous_query('dummy_query_string')
+
+    def test_run_asynchronous_query_forbidden(self):
+        """BigQueryCall should not mistake other 403 errors for quota errors."""
+        self.mock_authenticated_service.jobs.side_effect = MockHttpError(403)
+
+        try:
+            self.call.run_asynchronous_query('dummy_query_string')
+        except external.BigQueryCommunicationError as caught_error:
+            self.assertNotIsInstance(caught_error,
+                                     external.BigQueryQuotaExceeded)
+        else:
+            self.fail('BigQueryCommunicationError was not raised.')
+
     def test_run_asynchronous_query_ResponseNotReady(self):
         """BigQueryCall should wrap ResponseNotReady to a BigQueryCommunicationError."""
         mock_job_collection = mock.Mock()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import time
+import unittest
+
+import mock
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope')))
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../benchmarks')))
+import external
+import fake_bigquery
+import hedging
+import projectpool
+
+QUERY = ('SELECT web100_log_entry.log_time AS timestamp, '
+         'web100_log_entry.snap.MinRTT AS minimum_rtt FROM t')
+
+
+class _ShortSleepTime(object):
+    """Proxy for the time module that shortens every sleep."""
+
+    def sleep(self, seconds):
+        time.sleep(0.01)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class FakeBigQueryServerTest(unittest.TestCase):
+    """Checks that Telescope's BigQuery client works against the fake."""
+
+    def create_server(self, **settings):
+        server = fake_bigquery.FakeBigQueryServer(**settings)
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+    def test_collects_every_page_of_synthetic_rows(self):
+        server = self.create_server(rows_per_job=25, page_size=10)
+        bq_call = external.BigQueryCall(server.create_service(), 'project')
+        job_id = bq_call.run_asynchronous_query(QUERY)
+
+        rows = bq_call.retrieve_job_data(job_id)
+
+        self.assertEqual(25, len(rows))
+        self.assertEqual(['minimum_rtt', 'timestamp'], sorted(rows[0].keys()))
+        self.assertEqual('1388534424', rows[-1]['timestamp'])
+        self.assertEqual(3, server.request_counts['jobs.getQueryResults'])
+
+    def test_dry_run_estimates_bytes_without_creating_job(self):
+        server = self.create_server(rows_per_job=25)
+        bq_call = external.BigQueryCall(server.create_service(), 'project')
+
+        self.assertEqual(2500, bq_call.estimate_query_bytes(QUERY))
+        self.assertIsNone(server.get_job('job_1'))
+
+    def test_job_states_advance(self):
+        server = self.create_server(pending_seconds=60)
+        service = server.create_service()
+        job_id = external.BigQueryCall(service,
+                                       'project').run_asynchronous_query(QUERY)
+        job = service.jobs().get(projectId='project', jobId=job_id).execute()
+        self.assertEqual('PENDING', job['status']['state'])
+
+        server.pending_seconds = 0
+        job = service.jobs().get(projectId='project', jobId=job_id).execute()
+        self.assertEqual('DONE', job['status']['state'])
+
+    def test_monitor_reports_each_job_state_change(self):
+        server = self.create_server(pending_seconds=0.05, running_seconds=0.05)
+        bq_call = external.BigQueryCall(server.create_service(), 'project')
+        job_id = bq_call.run_asynchronous_query(QUERY)
+        job_states = []
+        completed_job_ids = []
+
+        with mock.patch.object(external, 'time', _ShortSleepTime()):
+            bq_call.monitor_query_queue(
+                job_id, {'site': 'lga01'},
+                callback_function=(
+                    lambda job_id, query_object: completed_job_ids.append(job_id)
+                ),
+                state_callback=(
+                    lambda job_id, job_state: job_states.append(job_state)))
+
+        self.assertEqual(['PENDING', 'RUNNING', 'DONE'], job_states)
+        self.assertEqual([job_id], completed_job_ids)
+
+    def test_monitor_reports_statistics_of_finished_job(self):
+        server = self.create_server(rows_per_job=25)
+        bq_call = external.BigQueryCall(server.create_service(), 'project')
+        job_id = bq_call.run_asynchronous_query(QUERY)
+        reported_statistics = []
+
+        def record_statistics(_, job_statistics):
+            reported_statistics.append(job_statistics)
+
+        bq_call.monitor_query_queue(
+            job_id, {'site': 'lga01'},
+            callback_function=lambda job_id, query_object: None,
+            statistics_callback=record_statistics)
+
+        self.assertEqual(1, len(reported_statistics))
+        self.assertEqual(job_id, reported_statistics[0].job_id)
+        self.assertEqual(2500, reported_statistics[0].bytes_billed)
+        self.assertEqual(25, reported_statistics[0].slot_millis)
+        self.assertEqual(1, len(reported_statistics[0].stages))
+
+    def monitor_straggler(self,
+                          server,
+                          project_pool,
+                          job_slot,
+                          hedge_failure_rate=0.0):
+        bq_call = external.BigQueryCall(server.create_service(), 'project')
+        job_id = bq_call.run_asynchronous_query(QUERY)
+        server.straggler_rate = 0.0
+        server.job_failure_rate = hedge_failure_rate
+        job_metadata = {'metric': 'minimum_rtt', 'site': 'lga01'}
+        straggler_policy = hedging.StragglerPolicy(hedge_percentile=50,
+                                                   hedge_multiplier=1.0,
+                                                   min_samples=1,
+                                                   min_hedge_seconds=0)
+        straggler_policy.record_latency(
+            hedging.comparison_key(job_metadata), 0.0)
+        completed_job_ids = []
+
+        with mock.patch.object(external, 'time', _ShortSleepTime()):
+            bq_call.monitor_query_queue(
+                job_id,
+                job_metadata,
+                callback_function=(
+                    lambda job_id, query_object: completed_job_ids.append(job_id)
+                ),
+                straggler_policy=straggler_policy,
+                query_string=QUERY,
+                job_slot=job_slot,
+                project_pool=project_pool)
+        return job_id, completed_job_ids
+
+    def test_hedged_job_wins_and_straggler_is_cancelled(self):
+        server = self.create_server(running_seconds=0.05,
+                                    straggler_rate=1.0,
+                                    straggler_seconds=60)
+        job_id, completed_job_ids = self.monitor_straggler(server, None, None)
+
+        self.assertEqual(2, server.request_counts['jobs.insert'])
+        self.assertNotEqual(job_id, completed_job_ids[0])
+        self.assertEqual(1, len(completed_job_ids))
+        self.assertTrue(server.get_job(job_id).cancelled)
+        self.assertEqual(1, server.request_counts['jobs.cancel'])
+        bq_call = external.BigQueryCall(server.create_service(), 'project')
+        self.assertEqual(1000,
+                         len(bq_call.retrieve_job_data(completed_job_ids[0])))
+
+    def test_original_job_wins_when_hedged_job_fails(self):
+        server = self.create_server(running_seconds=0.05,
+                                    straggler_rate=1.0,
+                                    straggler_seconds=0.3)
+        project_pool = projectpool.ProjectPool(
+            [fake_bigquery.FakeGoogleAPIAuth(server, 'project')],
+            max_jobs_per_project=2)
+        job_slot = project_pool.acquire()
+
+        job_id, completed_job_ids = self.monitor_straggler(server, project_pool,
+                                                           job_slot, 1.0)
+
+        self.assertEqual(2, server.request_counts['jobs.insert'])
+        self.assertEqual([job_id], completed_job_ids)
+        self.assertEqual({'project': 1}, project_pool.count_jobs_in_flight())
+
+    def test_hedged_job_holds_pool_slot_until_finished(self):
+        server = self.create_server(running_seconds=0.05,
+                                    straggler_rate=1.0,
+                                    straggler_seconds=60)
+        project_pool = projectpool.ProjectPool(
+            [fake_bigquery.FakeGoogleAPIAuth(server, 'project')],
+            max_jobs_per_project=2)
+        job_slot = project_pool.acquire()
+
+        job_id, completed_job_ids = self.monitor_straggler(server, project_pool,
+                                                           job_slot)
+
+        self.assertEqual(2, server.request_counts['jobs.insert'])
+        self.assertNotEqual(job_id, completed_job_ids[0])
+        self.assertEqual({'project': 1}, project_pool.count_jobs_in_flight())
+
+    def test_straggler_is_not_hedged_without_pool_slot(self):
+        server = self.create_server(running_seconds=0.05,
+                                    straggler_rate=1.0,
+                                    straggler_seconds=0.2)
+        project_pool = projectpool.ProjectPool(
+            [fake_bigquery.FakeGoogleAPIAuth(server, 'project')],
+            max_jobs_per_project=1)
+        job_slot = project_pool.acquire()
+
+        job_id, completed_job_ids = self.monitor_straggler(server, project_pool,
+                                                           job_slot)
+
+        self.assertEqual(1, server.request_counts['jobs.insert'])
+        self.assertEqual([job_id], completed_job_ids)
+
+    def test_pending_batch_job_is_promoted_to_interactive(self):
+        server = self.create_server(batch_pending_seconds=60)
+        bq_call = external.BigQueryCall(server.create_service(), 'project')
+        job_slot = projectpool.ProjectPool([fake_bigquery.FakeGoogleAPIAuth(
+            server, 'project')]).acquire(projectpool.BATCH)
+        job_id = bq_call.run_asynchronous_query(QUERY, job_slot.priority)
+        completed_job_ids = []
+
+        bq_call.monitor_query_queue(
+            job_id, {'site': 'lga01'},
+            callback_function=(
+                lambda job_id, query_object: completed_job_ids.append(job_id)),
+            query_string=QUERY,
+            job_slot=job_slot,
+            promotion_seconds=0)
+
+        self.assertEqual('BATCH', server.get_job(job_id).priority)
+        self.assertTrue(server.get_job(job_id).cancelled)
+        self.assertEqual('INTERACTIVE',
+                         server.get_job(completed_job_ids[0]).priority)
+        self.assertEqual(projectpool.INTERACTIVE, job_slot.priority)
+
+    def test_jobs_past_deadline_are_cancelled(self):
+        server = self.create_server(pending_seconds=60)
+        bq_call = external.BigQueryCall(server.create_service(), 'project')
+        job_id = bq_call.run_asynchronous_query(QUERY)
+        failures = []
+
+        bq_call.monitor_query_queue(
+            job_id, {'site': 'lga01'},
+            callback_function=lambda job_id, query_object: None,
+            straggler_policy=hedging.StragglerPolicy(deadline_seconds=0),
+            query_string=QUERY,
+            failure_callback=(lambda job_id, reason: failures.append(job_id)))
+
+        self.assertEqual([job_id], failures)
+        self.assertTrue(server.get_job(job_id).cancelled)
+        self.assertEqual(1, server.request_counts['jobs.insert'])
+
+    def test_unreachable_jobs_are_abandoned_at_deadline(self):
+        server = self.create_server()
+        bq_call = external.BigQueryCall(server.create_service(), 'project')
+        job_id = bq_call.run_asynchronous_query(QUERY)
+        server.error_rate = 1.0
+        failures = []
+
+        with mock.patch.object(external, 'time', _ShortSleepTime()):
+            bq_call.monitor_query_queue(
+                job_id, {'site': 'lga01'},
+                callback_function=lambda job_id, query_object: None,
+                straggler_policy=hedging.StragglerPolicy(deadline_seconds=1),
+                failure_callback=(
+                    lambda job_id, reason: failures.append(job_id)))
+
+        self.assertEqual([job_id], failures)
+        self.assertGreater(server.request_counts['jobs.get'], 1)
+
+    def test_in_flight_jobs_are_cancelled(self):
+        server = self.create_server(pending_seconds=60)
+        bq_call = external.BigQueryCall(server.create_service(), 'project')
+        in_flight_jobs = external.InFlightJobs()
+        with mock.patch.object(external, '_in_flight_jobs', in_flight_jobs):
+            job_ids = [bq_call.run_asynchronous_query(QUERY) for _ in range(3)]
+            self.assertEqual(3, len(in_flight_jobs.list_jobs()))
+
+            cancelled_count = in_flight_jobs.cancel_all(
+                projectpool.ProjectPool([fake_bigquery.FakeGoogleAPIAuth(
+                    server, 'project')]), 10)
+
+        self.assertEqual(3, cancelled_count)
+        self.assertEqual([], in_flight_jobs.list_jobs())
+        self.assertTrue(all(server.get_job(job_id).cancelled
+                            for job_id in job_ids))
+
+    def test_finished_jobs_are_no_longer_in_flight(self):
+        server = self.create_server()
+        bq_call = external.BigQueryCall(server.create_service(), 'project')
+        in_flight_jobs = external.InFlightJobs()
+        with mock.patch.object(external, '_in_flight_jobs', in_flight_jobs):
+            job_id = bq_call.run_asynchronous_query(QUERY)
+            bq_call.monitor_query_queue(
+                job_id, {'site': 'lga01'},
+                callback_function=lambda job_id, query_object: None)
+
+        self.assertEqual([], in_flight_jobs.list_jobs())
+
+    def test_tabledata_list_pages_destination_table(self):
+        server = self.create_server(rows_per_job=5)
+        service = server.create_service()
+        job_id = external.BigQueryCall(service,
+                                       'project').run_asynchronous_query(QUERY)
+        destination_table = service.jobs().get(
+            projectId='project', jobId=job_id).execute()['configuration'][
+                'query']['destinationTable']
+
+        table_data = service.tabledata().list(maxResults=2,
+                                              **destination_table).execute()
+
+        self.assertEqual('5', table_data['totalRows'])
+        self.assertEqual(2, len(table_data['rows']))
+        self.assertEqual('2', table_data['pageToken'])
+
+    def test_injected_errors(self):
+        server = self.create_server(error_rate=1.0)
+        bq_call = external.BigQueryCall(server.create_service(), 'project')
+        self.assertRaises(external.BigQueryCommunicationError,
+                          bq_call.run_asynchronous_query, QUERY)
+
+    def test_injected_job_failure(self):
+        server = self.create_server(job_failure_rate=1.0)
+        bq_call = external.BigQueryCall(server.create_service(), 'project')
+        job_id = bq_call.run_asynchronous_query(QUERY)
+        self.assertRaises(external.BigQueryJobFailure,
+                          bq_call.retrieve_job_data, job_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope')))
+import hedging
+
+
+class StragglerPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.key = hedging.comparison_key({'metric': 'minimum_rtt',
+                                           'duration': '1d',
+                                           'site': 'lga01'})
+        self.policy = hedging.StragglerPolicy(hedge_percentile=90,
+                                              hedge_multiplier=2.0,
+                                              min_samples=3,
+                                              min_hedge_seconds=5.0,
+                                              deadline_seconds=600.0)
+
+    def record_latencies(self, latencies):
+        for latency in latencies:
+            self.policy.record_latency(self.key, latency)
+
+    def test_comparison_key_ignores_site(self):
+        self.assertEqual(self.key, hedging.comparison_key({'metric':
+                                                           'minimum_rtt',
+                                                           'duration': '1d',
+                                                           'site': 'mia01'}))
+        self.assertNotEqual(self.key,
+                            hedging.comparison_key({'metric': 'average_rtt',
+                                                    'duration': '1d'}))
+
+    def test_no_hedging_until_enough_comparable_jobs_finish(self):
+        self.record_latencies([10.0, 20.0])
+        self.policy.record_latency(('average_rtt', '1d'), 30.0)
+
+        self.assertIsNone(self.policy.hedge_threshold(self.key))
+        self.assertFalse(self.policy.should_hedge(self.key, 1000.0))
+
+    def test_threshold_is_multiple_of_percentile(self):
+        self.record_latencies([10.0, 20.0, 30.0, 40.0])
+
+        self.assertEqual(80.0, self.policy.hedge_threshold(self.key))
+        self.assertFalse(self.policy.should_hedge(self.key, 79.0))
+        self.assertTrue(self.policy.should_hedge(self.key, 80.0))
+
+    def test_threshold_is_at_least_minimum(self):
+        self.record_latencies([1.0, 1.0, 1.0])
+
+        self.assertEqual(5.0, self.policy.hedge_threshold(self.key))
+
+    def test_policy_without_percentile_never_hedges(self):
+        policy = hedging.StragglerPolicy(min_samples=0)
+        policy.record_latency(self.key, 1.0)
+
+        self.assertFalse(policy.should_hedge(self.key, 1000.0))
+        self.assertFalse(policy.is_past_deadline(1000.0))
+        self.assertIsNone(policy.seconds_until_action(self.key, 0, False))
+
+    def test_deadline(self):
+        self.assertFalse(self.policy.is_past_deadline(599.0))
+        self.assertTrue(self.policy.is_past_deadline(600.0))
+
+    def test_policy_with_deadline_shares_latencies(self):
+        policy = self.policy.with_deadline(60.0)
+        policy.record_latency(self.key, 10.0)
+        self.record_latencies([20.0, 30.0, 40.0])
+
+        self.assertTrue(policy.is_past_deadline(60.0))
+        self.assertFalse(self.policy.is_past_deadline(60.0))
+        self.assertEqual(80.0, policy.hedge_threshold(self.key))
+        self.assertEqual(80.0, self.policy.hedge_threshold(self.key))
+
+    def test_seconds_until_action(self):
+        self.record_latencies([10.0, 20.0, 30.0, 40.0])
+
+        self.assertEqual(70.0, self.policy.seconds_until_action(self.key, 10,
+                                                                False))
+        self.assertEqual(590.0, self.policy.seconds_until_action(self.key, 10,
+                                                                 True))
+        self.assertEqual(0, self.policy.seconds_until_action(self.key, 700,
+                                                             True))
+
+
+if __name__ == '__main__':
+    unittest.main()
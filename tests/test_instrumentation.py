@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope')))
+import instrumentation
+
+
+class TimingRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.recorder = instrumentation.TimingRecorder()
+
+    def test_stage_statistics(self):
+        for duration in (0.5, 2.0, 30.0, 4000.0):
+            self.recorder.record('generate_query', duration)
+        stage_summary = self.recorder.summarize()['stages']['generate_query']
+
+        self.assertEqual(4, stage_summary['count'])
+        self.assertEqual(4032.5, stage_summary['total_seconds'])
+        self.assertEqual(0.5, stage_summary['min_seconds'])
+        self.assertEqual(4000.0, stage_summary['max_seconds'])
+        self.assertEqual(2.0, stage_summary['p50_seconds'])
+        self.assertEqual(4000.0, stage_summary['p99_seconds'])
+
+    def test_histogram_counts_each_duration_once(self):
+        for duration in (0.0005, 0.5, 1, 2.0, 30.0, 4000.0):
+            self.recorder.record('collect_results', duration)
+        histogram = self.recorder.summarize()['stages']['collect_results'][
+            'histogram']
+
+        counts_by_bound = {bucket['le']: bucket['count']
+                           for bucket in histogram}
+        self.assertEqual(1, counts_by_bound[0.001])
+        self.assertEqual(2, counts_by_bound[1])
+        self.assertEqual(1, counts_by_bound[10])
+        self.assertEqual(1, counts_by_bound[60])
+        self.assertEqual(1, counts_by_bound['inf'])
+        self.assertEqual(6, sum(counts_by_bound.values()))
+
+    def test_slowest_selectors_sum_stages(self):
+        self.recorder.record('generate_query', 1.0, 'nuq01, comcast')
+        self.recorder.record('collect_results', 5.0, 'nuq01, comcast')
+        self.recorder.record('collect_results', 4.0, 'lga01, twc')
+        self.recorder.record('generate_query', 9.0)
+
+        slowest_selectors = self.recorder.summarize(
+            slowest_count=1)['slowest_selectors']
+        self.assertEqual(1, len(slowest_selectors))
+        self.assertEqual('nuq01, comcast', slowest_selectors[0]['selector'])
+        self.assertEqual(6.0, slowest_selectors[0]['total_seconds'])
+        self.assertEqual({'generate_query': 1.0,
+                          'collect_results': 5.0},
+                         slowest_selectors[0]['stages'])
+
+    def test_span_records_duration(self):
+        with self.recorder.span('resolve_sites'):
+            pass
+        self.assertEqual(
+            1, self.recorder.summarize()['stages']['resolve_sites']['count'])
+
+    def test_span_records_duration_when_block_raises(self):
+        with self.assertRaises(ValueError):
+            with self.recorder.span('generate_query', 'nuq01'):
+                raise ValueError()
+        self.assertEqual(
+            'nuq01',
+            self.recorder.summarize()['slowest_selectors'][0]['selector'])
+
+    def test_write_summary(self):
+        self.recorder.record('generate_query', 1.0)
+        temp_dir = tempfile.mkdtemp()
+        try:
+            summary_filepath = os.path.join(temp_dir, 'timing.json')
+            self.assertTrue(self.recorder.write_summary(summary_filepath))
+            with open(summary_filepath) as summary_file:
+                summary = json.load(summary_file)
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEqual(1, summary['stages']['generate_query']['count'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,7 +18,9 @@
 import datetime
 import io
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 import mock
@@ -28,12 +30,45 @@ sys.path.insert(1, os.path.abspath(os.path.join(
 import iptranslation
 
 
+class IPTranslationStrategySpecTest(unittest.TestCase):
+
+    def testSpecsWithSameValuesAreEqual(self):
+        spec_a = iptranslation.IPTranslationStrategySpec(
+            'maxmind', {'db_snapshots': ['2014-08-04']})
+        spec_b = iptranslation.IPTranslationStrategySpec(
+            'maxmind', {'db_snapshots': ['2014-08-04']})
+        self.assertEqual(spec_a, spec_b)
+        self.assertEqual(hash(spec_a), hash(spec_b))
+
+    def testSpecsWithDifferentSnapshotsAreNotEqual(self):
+        spec_a = iptranslation.IPTranslationStrategySpec(
+            'maxmind', {'db_snapshots': ['2014-08-04']})
+        spec_b = iptranslation.IPTranslationStrategySpec(
+            'maxmind', {'db_snapshots': ['2015-02-05']})
+        self.assertNotEqual(spec_a, spec_b)
+
+    def testModifyingParamsDoesNotAffectSpec(self):
+        spec = iptranslation.IPTranslationStrategySpec(
+            'maxmind', {'db_snapshots': ['2014-08-04']})
+        spec.params['maxmind_dir'] = '/fake/dir'
+        spec.params['db_snapshots'].append('2015-02-05')
+        self.assertDictEqual({'db_snapshots': ['2014-08-04']}, spec.params)
+
+    def testReplaceParamsCreatesNewSpec(self):
+        spec = iptranslation.IPTranslationStrategySpec(
+            'maxmind', {'db_snapshots': ['2014-08-04']})
+        replaced_spec = spec.replace_params(maxmind_dir='/fake/dir')
+        self.assertDictEqual({'db_snapshots': ['2014-08-04']}, spec.params)
+        self.assertDictEqual({'db_snapshots': ['2014-08-04'],
+                              'maxmind_dir': '/fake/dir'}, replaced_spec.params)
+
+
 class IPTranslationStrategyFactoryTest(unittest.TestCase):
 
-    def _createDummyMaxmindStrategySpec(self):
+    def _createDummyMaxmindStrategySpec(self, db_snapshot='2012-01-01'):
         strategy_params = {
             'maxmind_dir': '/fake/dir',
-            'db_snapshots': ['2012-01-01']
+            'db_snapshots': [db_snapshot]
         }
         return iptranslation.IPTranslationStrategySpec('maxmind',
                                                        strategy_params)
@@ -55,6 +90,31 @@ class IPTranslationStrategyFactoryTest(unittest.TestCase):
         with self.assertRaises(iptranslation.MissingMaxMindError):
             factory.create(strategy_spec)
 
+    def testEqualSpecsShareTranslator(self):
+        """Verify that equal specs from different files share a translator."""
+        mock_file_opener = mock.Mock(side_effect=lambda *args: io.BytesIO())
+        factory = iptranslation.IPTranslationStrategyFactory(mock_file_opener)
+        translator_a = factory.create(self._createDummyMaxmindStrategySpec())
+        translator_b = factory.create(self._createDummyMaxmindStrategySpec())
+        self.assertIs(translator_a, translator_b)
+        self.assertEqual(1, mock_file_opener.call_count)
+
+    def testDifferentSnapshotsCreateDifferentTranslators(self):
+        mock_file_opener = mock.Mock(side_effect=lambda *args: io.BytesIO())
+        factory = iptranslation.IPTranslationStrategyFactory(mock_file_opener)
+        translator_a = factory.create(self._createDummyMaxmindStrategySpec(
+            '2012-01-01'))
+        translator_b = factory.create(self._createDummyMaxmindStrategySpec(
+            '2013-01-01'))
+        self.assertIsNot(translator_a, translator_b)
+        self.assertEqual(2, mock_file_opener.call_count)
+
+    def testUnrecognizedStrategyRaisesValueError(self):
+        factory = iptranslation.IPTranslationStrategyFactory(mock.Mock())
+        strategy_spec = iptranslation.IPTranslationStrategySpec('bogus', {})
+        with self.assertRaises(ValueError):
+            factory.create(strategy_spec)
+
 
 class IPTranslationStrategyMaxMindTest(unittest.TestCase):
 
@@ -126,6 +186,169 @@ class IPTranslationStrategyMaxMindTest(unittest.TestCase):
         self.assertBlocksMatchForSearch(mock_file_contents, 'centurylink',
                                         expected_blocks)
 
+    def testBlocksOfSameNameAreSorted(self):
+        mock_file_contents = """5,10,"FooISP"
+12,15,"BarIsp"
+20,25,"FooISP"
+"""
+
+        expected_blocks = [(5, 10), (20, 25)]
+        self.assertBlocksMatchForSearch(mock_file_contents, 'foo',
+                                        expected_blocks)
+
+    def testFindBlocksForMultipleNames(self):
+        mock_file_contents = """1,15,"Level 3 Communications"
+16,20,"Rando Internet Company"
+21,25,"GBLX"
+26,30,"Time Warner"
+"""
+
+        translation_strategy = self.createIPTranslationStrategy(
+            mock_file_contents)
+        blocks_by_name = translation_strategy.find_ip_blocks_for_names(
+            ['level3', 'twc', 'rando', 'missing'])
+        self.assertDictEqual({'level3': [(1, 15), (21, 25)],
+                              'twc': [(26, 30)],
+                              'rando': [(16, 20)],
+                              'missing': []}, blocks_by_name)
+
+    def testNameMatchingMultipleSearchesIsFoundForEach(self):
+        mock_file_contents = """1,15,"Level 3 Communications"
+16,20,"Rando Internet Company"
+"""
+
+        translation_strategy = self.createIPTranslationStrategy(
+            mock_file_contents)
+        blocks_by_name = translation_strategy.find_ip_blocks_for_names(
+            ['level3', 'level 3', 'communications'])
+        self.assertDictEqual({'level3': [(1, 15)],
+                              'level 3': [(1, 15)],
+                              'communications': [(1, 15)]}, blocks_by_name)
+
+    def testFindBlocksForManyNames(self):
+        """Verify that searching for many names does not exceed regex limits."""
+        mock_file_contents = """1,15,"Level 3 Communications"
+16,20,"Rando Internet Company"
+"""
+
+        translation_strategy = self.createIPTranslationStrategy(
+            mock_file_contents)
+        search_names = ['level3', 'centurylink', 'cablevision'] * 40
+        search_names.extend('isp%d' % i for i in range(200))
+        blocks_by_name = translation_strategy.find_ip_blocks_for_names(
+            search_names)
+        self.assertListEqual([(1, 15)], blocks_by_name['level3'])
+        self.assertListEqual([], blocks_by_name['isp1'])
+
+
+class IPBlockDiskCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def testMissingEntryReturnsNone(self):
+        block_cache = iptranslation.IPBlockDiskCache(self.cache_dir)
+        self.assertIsNone(block_cache.get('abc123', 'comcast'))
+
+    def testStoredBlocksAreRetrieved(self):
+        block_cache = iptranslation.IPBlockDiskCache(self.cache_dir)
+        block_cache.put('abc123', 'comcast', [(5, 10), (20, 4294967295)])
+        self.assertListEqual([(5, 10), (20, 4294967295)],
+                             iptranslation.IPBlockDiskCache(self.cache_dir).get(
+                                 'abc123', 'comcast'))
+
+    def testEmptyResultIsCached(self):
+        block_cache = iptranslation.IPBlockDiskCache(self.cache_dir)
+        block_cache.put('abc123', 'comcast', [])
+        self.assertListEqual([], block_cache.get('abc123', 'comcast'))
+
+    def testEntriesAreKeyedBySnapshotAndSearchTerm(self):
+        block_cache = iptranslation.IPBlockDiskCache(self.cache_dir)
+        block_cache.put('abc123', 'comcast', [(5, 10)])
+        self.assertIsNone(block_cache.get('def456', 'comcast'))
+        self.assertIsNone(block_cache.get('abc123', 'verizon'))
+
+    def testCorruptEntryReturnsNone(self):
+        block_cache = iptranslation.IPBlockDiskCache(self.cache_dir)
+        block_cache.put('abc123', 'comcast', [(5, 10)])
+        cache_path = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        with open(cache_path, 'ab') as cache_file:
+            cache_file.write('x')
+        self.assertIsNone(block_cache.get('abc123', 'comcast'))
+
+    def testTranslatorUsesCacheWithoutParsingSnapshot(self):
+        mock_file_contents = """5,10,"FooISP"
+20,25,"BarIsp"
+"""
+        block_cache = iptranslation.IPBlockDiskCache(self.cache_dir)
+        snapshots = [(datetime.datetime(2014, 9, 1),
+                      io.BytesIO(mock_file_contents))]
+        translator = iptranslation.IPTranslationStrategyMaxMind(snapshots,
+                                                                block_cache)
+        self.assertListEqual([(20, 25)], translator.find_ip_blocks('bar'))
+
+        snapshots = [(datetime.datetime(2014, 9, 1),
+                      io.BytesIO(mock_file_contents))]
+        translator = iptranslation.IPTranslationStrategyMaxMind(snapshots,
+                                                                block_cache)
+        with mock.patch.object(translator,
+                               '_parse_maxmind_snapshot') as mock_parse:
+            self.assertListEqual([(20, 25)], translator.find_ip_blocks('bar'))
+            self.assertFalse(mock_parse.called)
+
+    def testUnchangedSnapshotIsNotHashedAgain(self):
+        snapshot_path = os.path.join(self.cache_dir, 'GeoIPASNum2.csv')
+        with open(snapshot_path, 'wb') as snapshot_file:
+            snapshot_file.write('5,10,"FooISP"\n')
+        calculate_digest = mock.Mock(return_value='abc123')
+
+        block_cache = iptranslation.IPBlockDiskCache(self.cache_dir)
+        self.assertEqual('abc123', block_cache.get_snapshot_digest(
+            snapshot_path, calculate_digest))
+        block_cache = iptranslation.IPBlockDiskCache(self.cache_dir)
+        self.assertEqual('abc123', block_cache.get_snapshot_digest(
+            snapshot_path, calculate_digest))
+        self.assertEqual(1, calculate_digest.call_count)
+
+    def testModifiedSnapshotIsHashedAgain(self):
+        snapshot_path = os.path.join(self.cache_dir, 'GeoIPASNum2.csv')
+        with open(snapshot_path, 'wb') as snapshot_file:
+            snapshot_file.write('5,10,"FooISP"\n')
+        os.utime(snapshot_path, (1000, 1000))
+        calculate_digest = mock.Mock(side_effect=['abc123', 'def456'])
+
+        block_cache = iptranslation.IPBlockDiskCache(self.cache_dir)
+        block_cache.get_snapshot_digest(snapshot_path, calculate_digest)
+        os.utime(snapshot_path, (2000, 2000))
+        self.assertEqual('def456', block_cache.get_snapshot_digest(
+            snapshot_path, calculate_digest))
+        self.assertEqual(2, calculate_digest.call_count)
+
+    def testTranslatorReusesIndexedSnapshotDigest(self):
+        snapshot_path = os.path.join(self.cache_dir, 'GeoIPASNum2.csv')
+        with open(snapshot_path, 'wb') as snapshot_file:
+            snapshot_file.write('5,10,"FooISP"\n20,25,"BarIsp"\n')
+        block_cache = iptranslation.IPBlockDiskCache(self.cache_dir)
+        with open(snapshot_path, 'rb') as snapshot_file:
+            snapshots = [(datetime.datetime(2014, 9, 1), snapshot_file)]
+            translator = iptranslation.IPTranslationStrategyMaxMind(
+                snapshots, block_cache,
+                snapshot_path=snapshot_path)
+            self.assertListEqual([(20, 25)], translator.find_ip_blocks('bar'))
+
+        with open(snapshot_path, 'rb') as snapshot_file:
+            snapshots = [(datetime.datetime(2014, 9, 1), snapshot_file)]
+            translator = iptranslation.IPTranslationStrategyMaxMind(
+                snapshots, block_cache,
+                snapshot_path=snapshot_path)
+            with mock.patch.object(translator, '_hash_snapshot') as mock_hash:
+                self.assertListEqual([(20, 25)],
+                                     translator.find_ip_blocks('bar'))
+                self.assertFalse(mock_hash.called)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope')))
+import jobstats
+
+
+def create_job_statistics(job_id, bytes_billed, slot_millis, cache_hit=False):
+    return jobstats.JobStatistics(job_id=job_id,
+                                  bytes_processed=bytes_billed,
+                                  bytes_billed=bytes_billed,
+                                  cache_hit=cache_hit,
+                                  slot_millis=slot_millis,
+                                  pending_millis=None,
+                                  running_millis=None,
+                                  stages=())
+
+
+class ParseJobStatisticsTest(unittest.TestCase):
+
+    def test_statistics_filepath_is_alongside_results(self):
+        self.assertEqual(
+            'out/2014-01-01-lga01-raw-jobstats.json',
+            jobstats.build_statistics_filepath('out/2014-01-01-lga01-raw.csv'))
+
+    def test_parses_query_statistics(self):
+        job_statistics = jobstats.parse_job_statistics('job_1', {
+            'status': {'state': 'DONE'},
+            'statistics': {
+                'creationTime': '1000',
+                'startTime': '4000',
+                'endTime': '9000',
+                'totalBytesProcessed': '2048',
+                'query': {
+                    'totalBytesProcessed': '2048',
+                    'totalBytesBilled': '10485760',
+                    'cacheHit': False,
+                    'totalSlotMs': '1234',
+                    'queryPlan': [{'name': 'S00: Input',
+                                   'waitMsAvg': '1',
+                                   'readMsAvg': '2',
+                                   'computeMsAvg': '3',
+                                   'writeMsAvg': '4'}]
+                }
+            }
+        })
+
+        self.assertEqual(2048, job_statistics.bytes_processed)
+        self.assertEqual(10485760, job_statistics.bytes_billed)
+        self.assertFalse(job_statistics.cache_hit)
+        self.assertEqual(1234, job_statistics.slot_millis)
+        self.assertEqual(3000, job_statistics.pending_millis)
+        self.assertEqual(5000, job_statistics.running_millis)
+        self.assertEqual(({'name': 'S00: Input',
+                           'wait_millis': 1,
+                           'read_millis': 2,
+                           'compute_millis': 3,
+                           'write_millis': 4},), job_statistics.stages)
+
+    def test_missing_statistics_are_zero(self):
+        job_statistics = jobstats.parse_job_statistics(
+            'job_1', {'status': {'state': 'DONE'}})
+
+        self.assertEqual(0, job_statistics.bytes_billed)
+        self.assertEqual(0, job_statistics.slot_millis)
+        self.assertIsNone(job_statistics.running_millis)
+        self.assertEqual((), job_statistics.stages)
+
+
+class JobStatisticsRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.recorder = jobstats.JobStatisticsRecorder()
+        self.recorder.record({'metric': 'minimum_rtt',
+                              'site': 'lga01',
+                              'client_provider': 'twc'},
+                             create_job_statistics('job_1', 300, 10))
+        self.recorder.record({'metric': 'minimum_rtt',
+                              'site': 'nuq01',
+                              'client_provider': 'twc'},
+                             create_job_statistics('job_2', 500, 20))
+        self.recorder.record({'metric': 'download_throughput',
+                              'site': 'lga01',
+                              'client_provider': None},
+                             create_job_statistics('job_3', 0, 5, True))
+
+    def test_totals_by_grouping(self):
+        summary = self.recorder.summarize()
+
+        self.assertEqual(800, summary['totals']['bytes_billed'])
+        self.assertEqual(1, summary['totals']['cache_hits'])
+        self.assertEqual(
+            800, summary['groupings']['metric']['minimum_rtt']['bytes_billed'])
+        self.assertEqual(2, summary['groupings']['site']['lga01']['jobs'])
+        self.assertEqual(15,
+                         summary['groupings']['site']['lga01']['slot_millis'])
+        self.assertEqual(
+            1, summary['groupings']['client_provider']['None']['jobs'])
+
+    def test_most_expensive_selectors(self):
+        most_expensive = self.recorder.summarize(
+            expensive_count=2)['most_expensive_selectors']
+
+        self.assertEqual(['job_2', 'job_1'],
+                         [selector_statistics['statistics']['job_id']
+                          for selector_statistics in most_expensive])
+        self.assertEqual('nuq01', most_expensive[0]['selector']['site'])
+
+    def test_write_report(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            report_filepath = os.path.join(temp_dir, 'jobstats.json')
+            self.assertTrue(self.recorder.write_report(report_filepath))
+            with open(report_filepath) as report_file:
+                report = json.load(report_file)
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEqual(3, report['totals']['jobs'])
+
+
+if __name__ == '__main__':
+    unittest.main()
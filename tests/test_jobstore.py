@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mock
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope')))
+import jobstore
+
+
+class SelectorKeyTest(unittest.TestCase):
+
+    def test_selector_key_ignores_metadata_order(self):
+        self.assertEqual(
+            jobstore.create_selector_key({'site': 'lga01',
+                                          'metric': 'minimum_rtt'}),
+            jobstore.create_selector_key({'metric': 'minimum_rtt',
+                                          'site': 'lga01'}))
+        self.assertNotEqual(
+            jobstore.create_selector_key({'site': 'lga01'}),
+            jobstore.create_selector_key({'site': 'lga02'}))
+
+
+class SQLiteJobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.store_filepath = os.path.join(self.store_dir, 'jobs.db')
+        self.time_patch = mock.patch.object(jobstore.time, 'time')
+        self.mock_time = self.time_patch.start()
+        self.mock_time.return_value = 100.0
+        self.job_store = jobstore.SQLiteJobStore(self.store_filepath)
+        self.job_store.record_queued('key_a', 'a-raw.csv', 'SELECT 1')
+
+    def tearDown(self):
+        self.time_patch.stop()
+        shutil.rmtree(self.store_dir)
+
+    def test_queued_job(self):
+        job = self.job_store.get_job('key_a')
+
+        self.assertEqual(jobstore.QUEUED, job.state)
+        self.assertEqual('a-raw.csv', job.output_path)
+        self.assertEqual(jobstore.create_sql_hash('SELECT 1'), job.sql_hash)
+        self.assertEqual(0, job.attempts)
+        self.assertEqual(100.0, job.queued_time)
+        self.assertIsNone(job.job_id)
+
+    def test_unknown_job(self):
+        self.assertIsNone(self.job_store.get_job('key_b'))
+        self.assertFalse(self.job_store.record_state('key_b',
+                                                     jobstore.SUBMITTED))
+
+    def test_job_lifecycle_records_transitions_and_timings(self):
+        self.mock_time.return_value = 110.0
+        self.job_store.record_state('key_a', jobstore.SUBMITTED, 'job_1')
+        self.mock_time.return_value = 120.0
+        self.job_store.record_state('key_a', jobstore.RUNNING, 'job_1')
+        self.mock_time.return_value = 130.0
+        self.job_store.record_state('key_a', jobstore.DOWNLOADED, 'job_1')
+
+        job = self.job_store.get_job('key_a')
+        self.assertEqual(jobstore.DOWNLOADED, job.state)
+        self.assertEqual('job_1', job.job_id)
+        self.assertEqual(1, job.attempts)
+        self.assertEqual((110.0, 120.0, 130.0), (
+            job.submitted_time, job.running_time, job.finished_time))
+        self.assertEqual([(jobstore.QUEUED, None, 100.0, None),
+                          (jobstore.SUBMITTED, 'job_1', 110.0, None),
+                          (jobstore.RUNNING, 'job_1', 120.0, None),
+                          (jobstore.DOWNLOADED, 'job_1', 130.0, None)],
+                         self.job_store.list_transitions('key_a'))
+
+    def test_retries_count_attempts_and_keep_job_id(self):
+        self.job_store.record_state('key_a', jobstore.SUBMITTED, 'job_1')
+        self.job_store.record_state('key_a', jobstore.QUEUED, detail='Retry')
+        job = self.job_store.get_job('key_a')
+        self.assertEqual(('job_1', 'Retry'), (job.job_id, job.detail))
+
+        self.job_store.record_state('key_a', jobstore.SUBMITTED, 'job_2')
+        self.job_store.record_state('key_a', jobstore.FAILED, None, 'No table')
+
+        job = self.job_store.get_job('key_a')
+        self.assertEqual(jobstore.FAILED, job.state)
+        self.assertEqual(('job_2', 2, 'No table'), (job.job_id, job.attempts,
+                                                    job.detail))
+
+    def test_requeued_selector_resets_state(self):
+        self.job_store.record_state('key_a', jobstore.DOWNLOADED, 'job_1')
+
+        self.job_store.record_queued('key_a', 'a-raw.csv', 'SELECT 2')
+
+        job = self.job_store.get_job('key_a')
+        self.assertEqual(jobstore.QUEUED, job.state)
+        self.assertEqual(jobstore.create_sql_hash('SELECT 2'), job.sql_hash)
+        self.assertIsNone(job.finished_time)
+
+    def test_unfinished_jobs_are_requeued(self):
+        self.job_store.record_queued('key_b', 'b-raw.csv', 'SELECT 1')
+        self.job_store.record_queued('key_c', 'c-raw.csv', 'SELECT 1')
+        self.job_store.record_state('key_a', jobstore.RUNNING, 'job_1')
+        self.job_store.record_state('key_b', jobstore.SUBMITTED, 'job_2')
+        self.job_store.record_state('key_c', jobstore.DOWNLOADED, 'job_3')
+        self.mock_time.return_value = 150.0
+
+        self.assertEqual(2, self.job_store.requeue_unfinished('Interrupted'))
+
+        job = self.job_store.get_job('key_a')
+        self.assertEqual((jobstore.QUEUED, 'job_1', 'Interrupted', 150.0),
+                         (job.state, job.job_id, job.detail, job.queued_time))
+        self.assertEqual((jobstore.QUEUED, None, 150.0, 'Interrupted'),
+                         self.job_store.list_transitions('key_b')[-1])
+        self.assertEqual(jobstore.DOWNLOADED,
+                         self.job_store.get_job('key_c').state)
+
+    def test_state_counts_and_listing_persist_across_instances(self):
+        self.job_store.record_queued('key_b', 'b-raw.csv', 'SELECT 1')
+        self.job_store.record_state('key_b', jobstore.FAILED)
+
+        reopened_store = jobstore.SQLiteJobStore(self.store_filepath)
+
+        self.assertEqual({'queued': 1,
+                          'submitted': 0,
+                          'running': 0,
+                          'downloaded': 0,
+                          'failed': 1}, reopened_store.count_states())
+        self.assertEqual(['b-raw.csv'], [
+            job.output_path for job in reopened_store.list_jobs(jobstore.FAILED)
+        ])
+        self.assertEqual(
+            ['a-raw.csv', 'b-raw.csv'],
+            [job.output_path for job in reopened_store.list_jobs()])
+
+
+if __name__ == '__main__':
+    unittest.main()
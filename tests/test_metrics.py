@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+import urllib2
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope')))
+import instrumentation
+import metrics
+
+
+class MetricsRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+
+    def test_counters_and_gauges(self):
+        self.registry.increment(metrics.RESULT_ROWS, 100)
+        self.registry.increment(metrics.RESULT_ROWS, 50)
+        self.registry.add_to_gauge(metrics.JOBS_IN_FLIGHT, 2)
+        self.registry.add_to_gauge(metrics.JOBS_IN_FLIGHT, -1)
+        self.registry.set_gauge(metrics.SELECTOR_QUEUE_DEPTH, 7)
+
+        self.assertEqual(150, self.registry.get_value(metrics.RESULT_ROWS))
+        self.assertEqual(1, self.registry.get_value(metrics.JOBS_IN_FLIGHT))
+        self.assertEqual(7,
+                         self.registry.get_value(metrics.SELECTOR_QUEUE_DEPTH))
+        self.assertEqual(0, self.registry.get_value(metrics.JOBS_FAILED))
+
+    def test_render_exposition_format(self):
+        self.registry.increment(metrics.RESULT_ROWS, 3)
+        self.registry.set_gauge(metrics.SELECTOR_QUEUE_DEPTH, 2)
+        timing_recorder = instrumentation.TimingRecorder()
+        timing_recorder.record('generate_query', 1.5)
+        timing_recorder.record('generate_query', 0.5)
+
+        self.assertEqual(('# TYPE telescope_result_rows_total counter\n'
+                          'telescope_result_rows_total 3\n'
+                          '# TYPE telescope_selector_queue_depth gauge\n'
+                          'telescope_selector_queue_depth 2\n'
+                          '# TYPE telescope_stage_executions_total counter\n'
+                          'telescope_stage_executions_total'
+                          '{stage="generate_query"} 2\n'
+                          '# TYPE telescope_stage_seconds_total counter\n'
+                          'telescope_stage_seconds_total'
+                          '{stage="generate_query"} 2.0\n'),
+                         self.registry.render(timing_recorder))
+
+
+class MetricsServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+        self.server = metrics.start_metrics_server(
+            0,
+            registry=self.registry,
+            timing_recorder=instrumentation.TimingRecorder())
+        self.base_url = 'http://localhost:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_serves_current_metrics(self):
+        self.registry.increment(metrics.QUERIES_SUBMITTED)
+        response = urllib2.urlopen(self.base_url + '/metrics')
+        self.assertIn('telescope_queries_submitted_total 1\n', response.read())
+
+        self.registry.increment(metrics.QUERIES_SUBMITTED)
+        response = urllib2.urlopen(self.base_url + '/metrics')
+        self.assertIn('telescope_queries_submitted_total 2\n', response.read())
+
+    def test_unknown_path_not_found(self):
+        with self.assertRaises(urllib2.HTTPError) as context:
+            urllib2.urlopen(self.base_url + '/other')
+        self.assertEqual(404, context.exception.code)
+
+
+if __name__ == '__main__':
+    unittest.main()
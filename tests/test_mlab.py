@@ -15,9 +15,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+import json
 import os
+import shutil
 import socket
 import sys
+import tempfile
+import time
 import unittest
 
 import mox
@@ -32,9 +37,11 @@ class MLabTest(unittest.TestCase):
     def setUp(self):
         self.mock = mox.Mox()
         self.mock.StubOutWithMock(socket, 'gethostbyname')
+        self.temp_dir = tempfile.mkdtemp()
 
     def tearDown(self):
         self.mock.UnsetStubs()
+        shutil.rmtree(self.temp_dir)
 
     def create_mock_dns_lookup_result(self, hostname, dns_result):
         socket.gethostbyname(hostname).AndReturn(dns_result)
@@ -68,6 +75,183 @@ class MLabTest(unittest.TestCase):
         self.assertRaises(mlab.DNSResolutionError, resolver.get_site_ndt_ips,
                           'nuq01')
 
+    def test_prefetch_sites_resolves_hostnames_once(self):
+        for node_id in ('mlab1', 'mlab2', 'mlab3'):
+            socket.gethostbyname(
+                'ndt.iupui.%s.nuq01.measurement-lab.org' %
+                node_id).InAnyOrder().AndReturn('1.1.1.%s' % node_id[-1])
+        self.mock.ReplayAll()
+        resolver = mlab.MLabSiteResolver()
+        resolver.prefetch_sites(['nuq01'])
+        self.assertListEqual(['1.1.1.1', '1.1.1.2', '1.1.1.3'],
+                             resolver.get_site_ndt_ips('nuq01'))
+
+        self.mock.VerifyAll()
+
+    def test_prefetch_sites_defers_dns_failure(self):
+        socket.gethostbyname(
+            'ndt.iupui.mlab1.nuq01.measurement-lab.org').InAnyOrder().AndReturn(
+                '1.1.1.1')
+        socket.gethostbyname(
+            'ndt.iupui.mlab2.nuq01.measurement-lab.org').InAnyOrder().AndRaise(
+                socket.gaierror)
+        socket.gethostbyname(
+            'ndt.iupui.mlab3.nuq01.measurement-lab.org').InAnyOrder().AndReturn(
+                '1.1.1.3')
+        self.create_mock_dns_lookup_failure(
+            'ndt.iupui.mlab2.nuq01.measurement-lab.org')
+        self.mock.ReplayAll()
+        resolver = mlab.MLabSiteResolver()
+        resolver.prefetch_sites(['nuq01'])
+        self.assertRaises(mlab.DNSResolutionError, resolver.get_site_ndt_ips,
+                          'nuq01')
+
+        self.mock.VerifyAll()
+
+    def test_site_map_is_used_instead_of_dns(self):
+        site_map_filepath = os.path.join(self.temp_dir, 'sites.json')
+        with open(site_map_filepath, 'w') as site_map_file:
+            json.dump({'NUQ01': ['1.1.1.1', '1.1.1.2']}, site_map_file)
+        self.mock.ReplayAll()
+        resolver = mlab.MLabSiteResolver(site_map_filepath=site_map_filepath)
+        resolver.prefetch_sites(['nuq01'])
+        self.assertListEqual(['1.1.1.1', '1.1.1.2'],
+                             resolver.get_site_ndt_ips('nuq01'))
+
+        self.mock.VerifyAll()
+
+    def test_cache_file_is_used_by_later_resolvers(self):
+        self.create_mock_dns_lookup_result(
+            'ndt.iupui.mlab1.nuq01.measurement-lab.org', '1.1.1.1')
+        self.create_mock_dns_lookup_result(
+            'ndt.iupui.mlab2.nuq01.measurement-lab.org', '1.1.1.2')
+        self.create_mock_dns_lookup_result(
+            'ndt.iupui.mlab3.nuq01.measurement-lab.org', '1.1.1.3')
+        self.mock.ReplayAll()
+        cache_filepath = os.path.join(self.temp_dir, 'dns.json')
+        resolver = mlab.MLabSiteResolver(cache_filepath=cache_filepath)
+        resolver.get_site_ndt_ips('nuq01')
+        resolver.save_cache()
+
+        resolver = mlab.MLabSiteResolver(cache_filepath=cache_filepath)
+        self.assertListEqual(['1.1.1.1', '1.1.1.2', '1.1.1.3'],
+                             resolver.get_site_ndt_ips('nuq01'))
+
+        self.mock.VerifyAll()
+
+    def test_expired_cache_entries_are_resolved_again(self):
+        cache_filepath = os.path.join(self.temp_dir, 'dns.json')
+        expired_time = int(time.time()) - 120
+        with open(cache_filepath, 'w') as cache_file:
+            json.dump({
+                'ndt.iupui.mlab1.nuq01.measurement-lab.org': {
+                    'ip': '9.9.9.9',
+                    'resolved': expired_time
+                }
+            }, cache_file)
+        self.create_mock_dns_lookup_result(
+            'ndt.iupui.mlab1.nuq01.measurement-lab.org', '1.1.1.1')
+        self.create_mock_dns_lookup_result(
+            'ndt.iupui.mlab2.nuq01.measurement-lab.org', '1.1.1.2')
+        self.create_mock_dns_lookup_result(
+            'ndt.iupui.mlab3.nuq01.measurement-lab.org', '1.1.1.3')
+        self.mock.ReplayAll()
+        resolver = mlab.MLabSiteResolver(cache_filepath=cache_filepath,
+                                         cache_ttl=60)
+        self.assertListEqual(['1.1.1.1', '1.1.1.2', '1.1.1.3'],
+                             resolver.get_site_ndt_ips('nuq01'))
+
+        self.mock.VerifyAll()
+
+    def test_malformed_cache_entries_are_resolved_again(self):
+        cache_filepath = os.path.join(self.temp_dir, 'dns.json')
+        with open(cache_filepath, 'w') as cache_file:
+            json.dump({
+                'ndt.iupui.mlab1.nuq01.measurement-lab.org': {
+                    'ip': '9.9.9.9'
+                },
+                'ndt.iupui.mlab2.nuq01.measurement-lab.org': {
+                    'ip': None,
+                    'resolved': int(time.time())
+                },
+                'ndt.iupui.mlab3.nuq01.measurement-lab.org': '9.9.9.9'
+            }, cache_file)
+        self.create_mock_dns_lookup_result(
+            'ndt.iupui.mlab1.nuq01.measurement-lab.org', '1.1.1.1')
+        self.create_mock_dns_lookup_result(
+            'ndt.iupui.mlab2.nuq01.measurement-lab.org', '1.1.1.2')
+        self.create_mock_dns_lookup_result(
+            'ndt.iupui.mlab3.nuq01.measurement-lab.org', '1.1.1.3')
+        self.mock.ReplayAll()
+        resolver = mlab.MLabSiteResolver(cache_filepath=cache_filepath)
+        self.assertListEqual(['1.1.1.1', '1.1.1.2', '1.1.1.3'],
+                             resolver.get_site_ndt_ips('nuq01'))
+
+        self.mock.VerifyAll()
+
+
+class MLabSiteHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.history = mlab.MLabSiteHistory({
+            'NUQ01': [
+                {'start': '2015-06-01T00:00:00Z',
+                 'end': None,
+                 'ips': ['2.2.2.1', '2.2.2.2']},
+                {'start': '2012-01-01T00:00:00Z',
+                 'end': '2015-06-01T00:00:00Z',
+                 'ips': ['1.1.1.1', '1.1.1.2']},
+            ]
+        })
+
+    def assertSiteIpsForWindow(self, expected_ips, start_time, end_time):
+        self.assertListEqual(expected_ips, self.history.get_site_ndt_ips(
+            'nuq01', start_time, end_time))
+
+    def test_window_within_old_period(self):
+        self.assertSiteIpsForWindow(['1.1.1.1', '1.1.1.2'],
+                                    datetime.datetime(2014, 1, 1),
+                                    datetime.datetime(2014, 2, 1))
+
+    def test_window_within_current_period(self):
+        self.assertSiteIpsForWindow(['2.2.2.1', '2.2.2.2'],
+                                    datetime.datetime(2016, 1, 1),
+                                    datetime.datetime(2016, 2, 1))
+
+    def test_window_ending_at_period_boundary(self):
+        self.assertSiteIpsForWindow(['1.1.1.1', '1.1.1.2'],
+                                    datetime.datetime(2015, 5, 1),
+                                    datetime.datetime(2015, 6, 1))
+
+    def test_window_spanning_periods(self):
+        self.assertSiteIpsForWindow(
+            ['1.1.1.1', '1.1.1.2', '2.2.2.1', '2.2.2.2'],
+            datetime.datetime(2015, 5, 15), datetime.datetime(2015, 6, 15))
+
+    def test_window_before_history_raises_error(self):
+        self.assertRaises(
+            mlab.SiteHistoryNoCoverage, self.history.get_site_ndt_ips, 'nuq01',
+            datetime.datetime(2010, 1, 1), datetime.datetime(2010, 2, 1))
+
+    def test_missing_field_raises_parse_error(self):
+        self.assertRaises(mlab.SiteHistoryParseError, mlab.MLabSiteHistory,
+                          {'nuq01': [{'start': '2012-01-01T00:00:00Z'}]})
+
+    def test_resolver_uses_history_without_dns(self):
+        mock = mox.Mox()
+        mock.StubOutWithMock(socket, 'gethostbyname')
+        mock.ReplayAll()
+        try:
+            resolver = mlab.MLabSiteResolver(site_history=self.history)
+            resolver.prefetch_sites(['nuq01'])
+            self.assertListEqual(['1.1.1.1', '1.1.1.2'],
+                                 resolver.get_site_ndt_ips(
+                                     'nuq01', datetime.datetime(2014, 1, 1),
+                                     datetime.datetime(2014, 2, 1)))
+            mock.VerifyAll()
+        finally:
+            mock.UnsetStubs()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope')))
+import plan
+
+
+def create_query_step(output_path, site, fetch=None, estimated_bytes=None):
+    return plan.QueryStep(step_id=plan.create_step_id(plan.QUERY, output_path),
+                          thread_metadata={'site': site,
+                                           'metric': 'minimum_rtt'},
+                          output_path=output_path,
+                          bq_query_string='SELECT %s' % site,
+                          estimated_bytes=estimated_bytes,
+                          fetch=fetch)
+
+
+class PlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.fetch_step = create_query_step('store/fetch-a.csv', 'lga01',
+                                            ('key_a', '2014-01-01', 2), 100)
+        direct_sites = ('lga01', 'nuq01', 'nuq01')
+        self.direct_steps = [
+            create_query_step('out/%d.csv' % index, site, None, 200)
+            for index, site in enumerate(direct_sites)
+        ]
+        self.assembly_step = plan.AssemblyStep(
+            step_id=plan.create_step_id(plan.ASSEMBLY, 'out/assembled.csv'),
+            thread_metadata={'site': 'lga01',
+                             'metric': 'minimum_rtt'},
+            output_path='out/assembled.csv',
+            result_key='key_a',
+            start_timestamp=1388534400,
+            end_timestamp=1388620800,
+            depends_on=(self.fetch_step.step_id,))
+        self.plan = plan.Plan([self.fetch_step] + self.direct_steps,
+                              [self.assembly_step], 'store')
+
+    def test_plan_survives_round_trip(self):
+        plan_filepath = os.path.join(self.temp_dir, 'plan.jsonl')
+        self.plan.write(plan_filepath)
+
+        read_plan = plan.read_plan(plan_filepath)
+
+        self.assertEqual(self.plan.query_steps, read_plan.query_steps)
+        self.assertEqual(self.plan.assembly_steps, read_plan.assembly_steps)
+        self.assertEqual('store', read_plan.result_store_dir)
+        self.assertEqual(700, read_plan.estimated_bytes())
+
+    def test_unsupported_plan_file_is_rejected(self):
+        plan_filepath = os.path.join(self.temp_dir, 'plan.jsonl')
+        with open(plan_filepath, 'w') as plan_file:
+            plan_file.write('{"plan_format_version": 99}\n')
+
+        self.assertRaises(plan.PlanParseError, plan.read_plan, plan_filepath)
+
+    def test_filter_selects_assembly_with_its_fetch(self):
+        selected_plan = self.plan.select({'site': set(['lga01'])})
+
+        self.assertEqual([self.fetch_step, self.direct_steps[0]],
+                         selected_plan.query_steps)
+        self.assertEqual([self.assembly_step], selected_plan.assembly_steps)
+
+    def test_shards_divide_plan_without_splitting_dependencies(self):
+        shards = [self.plan.select(None, index, 3) for index in range(3)]
+
+        self.assertItemsEqual(self.plan.query_steps,
+                              [query_step
+                               for shard in shards
+                               for query_step in shard.query_steps])
+        for shard in shards:
+            if shard.assembly_steps:
+                self.assertIn(self.fetch_step, shard.query_steps)
+
+    def test_estimated_bytes_is_unknown_without_every_estimate(self):
+        self.assertIsNone(plan.Plan([create_query_step('out/a.csv', 'lga01')
+                                    ]).estimated_bytes())
+
+    def test_parse_field_values(self):
+        self.assertEqual({'site': set(['lga01', 'nuq01']),
+                          'metric': set(['minimum_rtt'])},
+                         plan.parse_field_values(['site=lga01', 'site=nuq01',
+                                                  'metric=minimum_rtt']))
+        self.assertRaises(plan.PlanParseError, plan.parse_field_values,
+                          ['lga01'])
+
+    def test_parse_shard(self):
+        self.assertEqual((1, 4), plan.parse_shard('1/4'))
+        self.assertRaises(plan.PlanParseError, plan.parse_shard, '4/4')
+        self.assertRaises(plan.PlanParseError, plan.parse_shard, 'first')
+
+
+if __name__ == '__main__':
+    unittest.main()
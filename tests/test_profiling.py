@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope')))
+import profiling
+
+
+def monitor_job(wait_event):
+    wait_event.wait(5)
+
+
+def run_worker_threads(profiler, thread_count, target, args=()):
+    worker_threads = []
+    for thread_index in range(thread_count):
+        worker_thread = threading.Thread(
+            target=profiler.wrap_thread_target(target),
+            name='monitor_query_queue-job_%d' % thread_index,
+            args=args)
+        worker_thread.start()
+        worker_threads.append(worker_thread)
+    return worker_threads
+
+
+class ThreadRoleTest(unittest.TestCase):
+
+    def test_thread_role(self):
+        self.assertEqual('monitor_query_queue',
+                         profiling.thread_role('monitor_query_queue-job_1-2'))
+        self.assertEqual('Thread', profiling.thread_role('Thread-7'))
+        self.assertEqual('MainThread', profiling.thread_role('MainThread'))
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.profile_dir = os.path.join(tempfile.mkdtemp(), 'profiles')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.profile_dir))
+
+    def test_unrecognized_mode_raises_error(self):
+        with self.assertRaises(profiling.ProfilingError):
+            profiling.Profiler(self.profile_dir, mode='perf')
+
+    def test_cprofile_aggregates_worker_threads_by_role(self):
+        profiler = profiling.Profiler(self.profile_dir,
+                                      mode=profiling.CPROFILE_MODE)
+        profiler.start()
+        wait_event = threading.Event()
+        wait_event.set()
+        for worker_thread in run_worker_threads(profiler, 3, monitor_job,
+                                                (wait_event,)):
+            worker_thread.join()
+        profiler.stop()
+
+        self.assertItemsEqual(['MainThread.pstats', 'MainThread.txt',
+                               'monitor_query_queue.pstats',
+                               'monitor_query_queue.txt'],
+                              os.listdir(self.profile_dir))
+        stats = pstats.Stats(os.path.join(self.profile_dir,
+                                          'monitor_query_queue.pstats'))
+        monitor_job_stats = [
+            function_stats
+            for function, function_stats in stats.stats.iteritems()
+            if function[2] == 'monitor_job'
+        ]
+        # Each entry holds the primitive and total call counts.
+        self.assertEqual(3, monitor_job_stats[0][1])
+        with open(os.path.join(self.profile_dir,
+                               'monitor_query_queue.txt')) as report_file:
+            self.assertTrue(report_file.readline().startswith(
+                'Aggregated from 3 thread(s).'))
+
+    def test_wrap_thread_target_is_identity_outside_cprofile_mode(self):
+        profiler = profiling.Profiler(self.profile_dir,
+                                      mode=profiling.SAMPLING_MODE)
+        self.assertIs(monitor_job, profiler.wrap_thread_target(monitor_job))
+
+    def test_sampling_writes_folded_stacks_per_role(self):
+        profiler = profiling.Profiler(self.profile_dir,
+                                      mode=profiling.SAMPLING_MODE,
+                                      sampling_interval=0.001)
+        profiler.start()
+        wait_event = threading.Event()
+        worker_threads = run_worker_threads(profiler, 2, monitor_job,
+                                            (wait_event,))
+        time.sleep(0.05)
+        wait_event.set()
+        for worker_thread in worker_threads:
+            worker_thread.join()
+        profiler.stop()
+
+        with open(os.path.join(self.profile_dir,
+                               'monitor_query_queue.folded')) as folded_file:
+            folded_lines = folded_file.readlines()
+        self.assertTrue(folded_lines)
+        for folded_line in folded_lines:
+            folded_stack, sample_count = folded_line.rsplit(' ', 1)
+            self.assertGreater(int(sample_count), 0)
+        self.assertTrue(any('monitor_job (test_profiling.py)' in line
+                            for line in folded_lines))
+
+    def test_stack_dumps_list_every_thread(self):
+        profiler = profiling.Profiler(self.profile_dir,
+                                      stack_dump_interval=0.01)
+        profiler.start()
+        wait_event = threading.Event()
+        worker_threads = run_worker_threads(profiler, 1, monitor_job,
+                                            (wait_event,))
+        time.sleep(0.1)
+        wait_event.set()
+        worker_threads[0].join()
+        profiler.stop()
+
+        self.assertEqual([profiling.STACK_DUMP_FILENAME],
+                         os.listdir(self.profile_dir))
+        with open(os.path.join(self.profile_dir,
+                               profiling.STACK_DUMP_FILENAME)) as dump_file:
+            stack_dumps = dump_file.read()
+        self.assertIn('--- MainThread ---', stack_dumps)
+        self.assertIn('--- monitor_query_queue-job_0 ---', stack_dumps)
+        self.assertIn('in monitor_job', stack_dumps)
+
+
+class SharedProfilerTest(unittest.TestCase):
+
+    def test_wrap_thread_target_without_profiler_is_identity(self):
+        self.assertIs(monitor_job, profiling.wrap_thread_target(monitor_job))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import threading
+import unittest
+
+import mock
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope')))
+import projectpool
+
+
+class ProjectPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = projectpool.ProjectPool([mock.Mock(project_id='project_a'),
+                                             mock.Mock(project_id='project_b')],
+                                            max_jobs_per_project=2,
+                                            throttle_seconds=60.0,
+                                            max_batch_jobs_per_project=1)
+        time_patch = mock.patch.object(projectpool.time, 'time')
+        self.mock_time = time_patch.start()
+        self.addCleanup(time_patch.stop)
+        self.mock_time.return_value = 100.0
+
+    def acquire_slots(self, job_count, priority=projectpool.INTERACTIVE):
+        return [self.pool.acquire(priority) for _ in range(job_count)]
+
+    def acquire_project_ids(self, job_count, priority=projectpool.INTERACTIVE):
+        return [job_slot.project_id
+                for job_slot in self.acquire_slots(job_count, priority)]
+
+    def test_jobs_go_to_least_loaded_project(self):
+        job_slots = self.acquire_slots(4)
+        self.assertEqual(['project_a', 'project_b', 'project_a', 'project_b'],
+                         [job_slot.project_id for job_slot in job_slots])
+
+        job_slots[1].release()
+
+        self.assertEqual(['project_b'], self.acquire_project_ids(1))
+        self.assertEqual({'project_a': 2,
+                          'project_b': 2}, self.pool.count_jobs_in_flight())
+
+    def test_batch_jobs_have_their_own_lane(self):
+        self.acquire_slots(4)
+
+        self.assertEqual(['project_a', 'project_b'],
+                         self.acquire_project_ids(2, projectpool.BATCH))
+        self.assertIsNone(self.pool.try_acquire(projectpool.BATCH))
+        self.assertIsNone(self.pool.try_acquire(projectpool.INTERACTIVE))
+
+    def test_batch_job_is_promoted_when_interactive_lane_has_room(self):
+        interactive_slots = self.acquire_slots(3)
+        batch_slot = self.pool.acquire(projectpool.BATCH)
+        self.assertEqual('project_b', interactive_slots[1].project_id)
+        self.assertEqual('project_a', batch_slot.project_id)
+
+        self.assertFalse(batch_slot.promote())
+        interactive_slots[0].release()
+        self.assertTrue(batch_slot.promote())
+
+        self.assertEqual(projectpool.INTERACTIVE, batch_slot.priority)
+        self.assertEqual({'project_a': 2,
+                          'project_b': 1}, self.pool.count_jobs_in_flight())
+        self.assertEqual({'project_a': 0,
+                          'project_b': 0},
+                         self.pool.count_jobs_in_flight(projectpool.BATCH))
+
+    def test_throttled_project_receives_no_jobs_until_throttling_ends(self):
+        self.pool.mark_throttled('project_a')
+
+        self.assertEqual(['project_b', 'project_b'],
+                         self.acquire_project_ids(2))
+        self.mock_time.return_value = 160.0
+        self.assertEqual(['project_a'], self.acquire_project_ids(1))
+
+    def test_acquire_waits_for_a_job_to_be_released(self):
+        job_slots = self.acquire_slots(4)
+        acquired_project_ids = []
+
+        def acquire_project_id():
+            acquired_project_ids.extend(self.acquire_project_ids(1))
+
+        acquire_thread = threading.Thread(target=acquire_project_id)
+        acquire_thread.start()
+
+        job_slots[3].release()
+        acquire_thread.join(5)
+
+        self.assertEqual(['project_b'], acquired_project_ids)
+
+    def test_auth_config_is_found_by_project(self):
+        self.assertEqual('project_b',
+                         self.pool.get_auth_config('project_b').project_id)
+        self.assertEqual(['project_a', 'project_b'], self.pool.project_ids)
+        self.assertEqual(2, len(self.pool))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -484,6 +484,232 @@ WHERE
             start_time, end_time, client_country="US")
         self.assertQueriesEqual(query_expected, query_actual)
 
+    def test_standard_sql_upload_throughput_query_all_properties(self):
+        start_time = utils.make_datetime_utc_aware(datetime.datetime(2014, 1,
+                                                                     1))
+        end_time = utils.make_datetime_utc_aware(datetime.datetime(2014, 2, 1))
+        generator = query.BigQueryQueryGenerator(
+            start_time,
+            end_time,
+            'upload_throughput',
+            server_ips=['1.1.1.1'],
+            client_ip_blocks=[(5, 10)],
+            client_country='us',
+            backend=query.STANDARD_SQL_BACKEND)
+        query_expected = """
+#standardSQL
+SELECT
+  web100_log_entry.log_time AS timestamp,
+  8 * (web100_log_entry.snap.HCThruOctetsReceived /
+       web100_log_entry.snap.Duration) AS upload_mbps
+FROM
+  `measurement-lab.release.ndt_all`
+WHERE
+  connection_spec.data_direction = 0
+  AND connection_spec.data_direction IS NOT NULL
+  AND (web100_log_entry.snap.State = 1
+       OR (web100_log_entry.snap.State >= 5
+           AND web100_log_entry.snap.State <= 11))
+  AND blacklist_flags = 0
+  AND web100_log_entry.snap.HCThruOctetsReceived >= 8192
+  AND web100_log_entry.snap.Duration >= 9000000
+  AND web100_log_entry.snap.Duration < 3600000000
+  AND ((web100_log_entry.log_time >= 1388534400) AND (web100_log_entry.log_time < 1391212800)
+       AND _PARTITIONTIME >= TIMESTAMP('2014-01-01') AND _PARTITIONTIME < TIMESTAMP('2014-02-01'))
+  AND (web100_log_entry.connection_spec.local_ip = '1.1.1.1')
+  AND (SAFE.NET.IPV4_TO_INT64(NET.SAFE_IP_FROM_STRING(web100_log_entry.connection_spec.remote_ip)) BETWEEN 5 AND 10)
+  AND connection_spec.client_geolocation.country_code = 'US'
+"""
+
+        self.assertQueriesEqual(query_expected, generator.query())
+
+
+class StandardSqlBackendTest(unittest.TestCase):
+
+    def assertPartitionConditional(self, expected, backend, start_time,
+                                   end_time):
+        time_conditional = backend.create_time_conditional(
+            utils.make_datetime_utc_aware(start_time),
+            utils.make_datetime_utc_aware(end_time))
+        self.assertTrue(time_conditional.endswith(expected), time_conditional)
+
+    def test_partial_days_select_whole_partitions(self):
+        self.assertPartitionConditional(
+            "_PARTITIONTIME >= TIMESTAMP('2014-01-01') AND "
+            "_PARTITIONTIME < TIMESTAMP('2014-01-03')",
+            query.StandardSqlBackend(), datetime.datetime(2014, 1, 1, 12),
+            datetime.datetime(2014, 1, 2, 1))
+
+    def test_window_ending_at_midnight_excludes_next_day(self):
+        self.assertPartitionConditional(
+            "_PARTITIONTIME >= TIMESTAMP('2014-01-01') AND "
+            "_PARTITIONTIME < TIMESTAMP('2014-01-08')",
+            query.StandardSqlBackend(), datetime.datetime(2014, 1, 1),
+            datetime.datetime(2014, 1, 8))
+
+    def test_date_partition_column(self):
+        backend = query.StandardSqlBackend(table='project.dataset.ndt',
+                                           partition_column='partition_date',
+                                           partition_column_type='DATE')
+        self.assertEqual('`project.dataset.ndt`', backend.table_reference())
+        self.assertPartitionConditional(
+            "partition_date >= DATE('2014-01-01') AND "
+            "partition_date < DATE('2014-01-02')", backend,
+            datetime.datetime(2014, 1, 1), datetime.datetime(2014, 1, 2))
+
+
+class ClientIpBlocksJoinTest(unittest.TestCase):
+
+    def setUp(self):
+        self.start_time = utils.make_datetime_utc_aware(datetime.datetime(2014,
+                                                                          1, 1))
+        self.end_time = utils.make_datetime_utc_aware(datetime.datetime(2014, 2,
+                                                                        1))
+        self.backend = query.StandardSqlBackend(range_join_threshold=2)
+
+    def test_coalesce_merges_overlapping_and_adjacent_blocks(self):
+        self.assertEqual([(1, 20), (30, 40)], query.coalesce_ip_blocks(
+            [(11, 20), (30, 40), (1, 10), (5, 15), (35, 36)]))
+
+    def test_join_splits_blocks_on_bucket_boundaries(self):
+        join = query.create_client_ip_blocks_join([(5, 10), (65530, 65540)],
+                                                  self.backend)
+        self.assertIn('\t\t(0, 5, 10),\n'
+                      '\t\t(0, 65530, 65535),\n'
+                      '\t\t(1, 65536, 65540)]) AS client_ip_block', join)
+        self.assertIn('ON DIV(SAFE.NET.IPV4_TO_INT64(NET.SAFE_IP_FROM_STRING('
+                      'web100_log_entry.connection_spec.remote_ip)), 65536) = '
+                      'client_ip_block.bucket', join)
+
+    def test_join_used_above_threshold(self):
+        query_string = query.BigQueryQueryTemplate(
+            'minimum_rtt',
+            client_ip_blocks=[(5, 10), (20, 30), (40, 50)],
+            backend=self.backend).render(self.start_time, self.end_time)
+        self.assertIn(
+            'FROM\n\t`measurement-lab.release.ndt_all`\n\tJOIN UNNEST(',
+            query_string)
+        self.assertNotIn(' OR\n', query_string)
+
+    def test_conditional_used_at_threshold(self):
+        query_string = query.BigQueryQueryTemplate(
+            'minimum_rtt',
+            client_ip_blocks=[(5, 10), (11, 30), (40, 50)],
+            backend=self.backend).render(self.start_time, self.end_time)
+        self.assertNotIn('UNNEST', query_string)
+        self.assertIn('BETWEEN 40 AND 50)', query_string)
+
+    def test_legacy_backend_never_uses_join(self):
+        client_ip_blocks = [(i * 10, i * 10 + 5) for i in range(5000)]
+        query_string = query.BigQueryQueryTemplate(
+            'minimum_rtt', client_ip_blocks=client_ip_blocks).render(
+                self.start_time, self.end_time)
+        self.assertNotIn('UNNEST', query_string)
+
+    def test_cache_shares_join_between_metrics(self):
+        cache = query.BigQueryQueryTemplateCache()
+        client_ip_blocks = [(5, 10), (20, 30), (40, 50)]
+        for metric in ('minimum_rtt', 'download_throughput'):
+            query_string = cache.get_template(
+                metric,
+                client_ip_blocks=client_ip_blocks,
+                client_ip_blocks_key='comcast',
+                backend=self.backend).render(self.start_time, self.end_time)
+            self.assertIn('\t\t(0, 40, 50)]) AS client_ip_block', query_string)
+
+
+class BigQueryQueryTemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.start_time = utils.make_datetime_utc_aware(datetime.datetime(2014,
+                                                                          1, 1))
+        self.end_time = utils.make_datetime_utc_aware(datetime.datetime(2014, 2,
+                                                                        1))
+
+    def test_rendered_template_matches_generated_query(self):
+        server_ips = ['1.1.1.1', '2.2.2.2']
+        client_ip_blocks = [(5, 10), (35, 80)]
+        generator = query.BigQueryQueryGenerator(
+            self.start_time,
+            self.end_time,
+            'download_throughput',
+            server_ips=server_ips,
+            client_ip_blocks=client_ip_blocks,
+            client_country='us')
+        template = query.BigQueryQueryTemplate(
+            'download_throughput',
+            server_ips=server_ips,
+            client_ip_blocks=client_ip_blocks,
+            client_country='us')
+        self.assertEqual(generator.query(),
+                         template.render(self.start_time, self.end_time))
+
+    def test_template_renders_each_time_window(self):
+        template = query.BigQueryQueryTemplate('minimum_rtt')
+        later_start_time = utils.make_datetime_utc_aware(datetime.datetime(
+            2014, 3, 1))
+        later_end_time = utils.make_datetime_utc_aware(datetime.datetime(2014,
+                                                                         4, 1))
+        template.render(self.start_time, self.end_time)
+        self.assertIn('(web100_log_entry.log_time >= 1393632000) AND '
+                      '(web100_log_entry.log_time < 1396310400)',
+                      template.render(later_start_time, later_end_time))
+
+    def test_client_ip_blocks_are_deduplicated_and_sorted(self):
+        self.assertEqual(
+            '(PARSE_IP(web100_log_entry.connection_spec.remote_ip) BETWEEN 5 '
+            'AND 10 OR\n\t\t'
+            'PARSE_IP(web100_log_entry.connection_spec.remote_ip) BETWEEN 35 '
+            'AND 80)', query.create_client_ip_blocks_conditional(
+                [(35, 80), (5, 10), (35, 80)]))
+
+    def test_cache_reuses_template_for_same_tests(self):
+        cache = query.BigQueryQueryTemplateCache()
+        template_a = cache.get_template('average_rtt',
+                                        server_ips=['2.2.2.2', '1.1.1.1'],
+                                        client_ip_blocks=[(5, 10)])
+        template_b = cache.get_template('average_rtt',
+                                        server_ips=['1.1.1.1', '2.2.2.2'],
+                                        client_ip_blocks=[(5, 10)])
+        self.assertIs(template_a, template_b)
+
+    def test_cache_distinguishes_metrics_and_blocks(self):
+        cache = query.BigQueryQueryTemplateCache()
+        template = cache.get_template('average_rtt', client_ip_blocks=[(5, 10)])
+        self.assertIsNot(template,
+                         cache.get_template('minimum_rtt',
+                                            client_ip_blocks=[(5, 10)]))
+        self.assertIsNot(template,
+                         cache.get_template('average_rtt',
+                                            client_ip_blocks=[(5, 11)]))
+
+    def test_cache_distinguishes_backends(self):
+        cache = query.BigQueryQueryTemplateCache()
+        legacy_template = cache.get_template('average_rtt',
+                                             client_ip_blocks=[(5, 10)],
+                                             client_ip_blocks_key='comcast')
+        standard_template = cache.get_template(
+            'average_rtt',
+            client_ip_blocks=[(5, 10)],
+            client_ip_blocks_key='comcast',
+            backend=query.STANDARD_SQL_BACKEND)
+        self.assertIn('PARSE_IP(', legacy_template.render(self.start_time,
+                                                          self.end_time))
+        self.assertIn('NET.SAFE_IP_FROM_STRING(',
+                      standard_template.render(self.start_time, self.end_time))
+
+    def test_cache_uses_client_ip_blocks_key(self):
+        cache = query.BigQueryQueryTemplateCache()
+        template_a = cache.get_template('average_rtt',
+                                        client_ip_blocks=[(5, 10)],
+                                        client_ip_blocks_key='comcast')
+        template_b = cache.get_template('minimum_rtt',
+                                        client_ip_blocks=[(5, 10)],
+                                        client_ip_blocks_key='comcast')
+        self.assertIn('BETWEEN 5 AND 10',
+                      template_b.render(self.start_time, self.end_time))
+        self.assertIsNot(template_a, template_b)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope')))
+import iptranslation
+import jobstats
+import resultstore
+import utils
+
+
+def make_time(*args):
+    return utils.make_datetime_utc_aware(datetime.datetime(*args))
+
+
+class DayFunctionsTest(unittest.TestCase):
+
+    def test_days_in_window_includes_partial_days(self):
+        self.assertEqual([datetime.date(2014, 1, 1), datetime.date(2014, 1, 2)],
+                         resultstore.days_in_window(
+                             make_time(2014, 1, 1, 12),
+                             make_time(2014, 1, 2, 1)))
+
+    def test_days_in_window_excludes_day_starting_at_window_end(self):
+        self.assertEqual([datetime.date(2014, 1, 1), datetime.date(2014, 1, 2)],
+                         resultstore.days_in_window(
+                             make_time(2014, 1, 1), make_time(2014, 1, 3)))
+
+    def test_group_consecutive_days(self):
+        days = [datetime.date(2014, 1, 5), datetime.date(2014, 1, 1),
+                datetime.date(2014, 1, 2), datetime.date(2014, 1, 2)]
+        self.assertEqual([(datetime.date(2014, 1, 1), 2),
+                          (datetime.date(2014, 1, 5), 1)],
+                         resultstore.group_consecutive_days(days))
+
+
+class DailyResultStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.store = resultstore.DailyResultStore(self.store_dir)
+        self.result_key = resultstore.create_result_key(
+            'nuq01', 'comcast', None, 'minimum_rtt', None, 'legacy')
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def write_fetch(self, first_day, day_count, contents):
+        fetch_filepath = self.store.build_fetch_filepath(self.result_key,
+                                                         first_day, day_count)
+        with open(fetch_filepath, 'w') as fetch_file:
+            fetch_file.write(contents)
+
+    def test_result_keys_differ_by_tests(self):
+        self.assertNotEqual(self.result_key, resultstore.create_result_key(
+            'nuq01', 'comcast', None, 'average_rtt', None, 'legacy'))
+
+    def test_result_keys_depend_on_translation_params_not_their_order(self):
+        params = [('asn_name', 'comcast'), ('maxmind_dir', '/tmp/maxmind'),
+                  ('db_snapshots', ['2014-01-01'])]
+        result_keys = [
+            resultstore.create_result_key(
+                'nuq01', 'comcast', None, 'minimum_rtt',
+                iptranslation.IPTranslationStrategySpec(
+                    'maxmind', dict(ordered_params)), 'legacy')
+            for ordered_params in (params, params[::-1])
+        ]
+        self.assertEqual(result_keys[0], result_keys[1])
+        self.assertNotEqual(result_keys[0], resultstore.create_result_key(
+            'nuq01', 'comcast', None, 'minimum_rtt',
+            iptranslation.IPTranslationStrategySpec(
+                'maxmind', dict(params[1:])), 'legacy'))
+
+    def test_days_are_missing_until_ingested(self):
+        first_day = datetime.date(2014, 1, 1)
+        self.assertEqual([first_day, datetime.date(2014, 1, 2)],
+                         self.store.find_missing_days(self.result_key,
+                                                      make_time(2014, 1, 1),
+                                                      make_time(2014, 1, 3)))
+
+        # 1388534400 is 2014-01-01 00:00:00 UTC.
+        self.write_fetch(first_day, 2, '1388534400,5.0\r\n')
+        self.assertTrue(self.store.ingest_fetch(self.result_key, first_day, 2))
+        self.assertEqual([], self.store.find_missing_days(
+            self.result_key, make_time(2014, 1, 1), make_time(2014, 1, 3)))
+
+    def test_ingest_removes_fetch_and_its_job_statistics(self):
+        first_day = datetime.date(2014, 1, 1)
+        self.write_fetch(first_day, 1, '1388534400,5.0\r\n')
+        fetch_filepath = self.store.build_fetch_filepath(self.result_key,
+                                                         first_day, 1)
+        statistics_filepath = jobstats.build_statistics_filepath(fetch_filepath)
+        with open(statistics_filepath, 'w') as statistics_file:
+            statistics_file.write('{}')
+
+        self.assertTrue(self.store.ingest_fetch(self.result_key, first_day, 1))
+        self.assertFalse(os.path.exists(fetch_filepath))
+        self.assertFalse(os.path.exists(statistics_filepath))
+
+    def test_ingest_without_fetch_file_stores_nothing(self):
+        self.assertFalse(self.store.ingest_fetch(self.result_key, datetime.date(
+            2014, 1, 1), 1))
+        self.assertIsNone(self.store.assemble(self.result_key, make_time(
+            2014, 1, 1), make_time(2014, 1, 2)))
+
+    def test_assemble_filters_rows_to_window(self):
+        self.write_fetch(
+            datetime.date(2014, 1, 1), 3, ('1388534400,1.0\r\n'
+                                           '1388624400,2.0\r\n'
+                                           '1388718000,3.0\r\n'))
+        self.store.ingest_fetch(self.result_key, datetime.date(2014, 1, 1), 3)
+
+        # The window spans from 2014-01-02 00:00 to 2014-01-03 02:00.
+        self.assertEqual('1388624400,2.0\r\n', self.store.assemble(
+            self.result_key, make_time(2014, 1, 2), make_time(2014, 1, 3, 2)))
+        self.assertEqual('1388624400,2.0\r\n1388718000,3.0\r\n',
+                         self.store.assemble(self.result_key,
+                                             make_time(2014, 1, 2),
+                                             make_time(2014, 1, 4)))
+
+    def test_days_within_ingestion_horizon_remain_missing(self):
+        today = datetime.datetime.utcnow().date()
+        first_day = today - datetime.timedelta(days=2)
+        window_start = resultstore.day_to_datetime(first_day)
+        window_end = window_start + datetime.timedelta(days=3)
+        row = '%d,5.0\r\n' % utils.utc_datetime_to_unix_timestamp(window_start)
+        self.write_fetch(first_day, 3, row)
+        self.assertTrue(self.store.ingest_fetch(self.result_key, first_day, 3))
+
+        # Yesterday and today remain missing, but are still assembled.
+        self.assertEqual([today - datetime.timedelta(days=1), today],
+                         self.store.find_missing_days(self.result_key,
+                                                      window_start, window_end))
+        self.assertEqual(row, self.store.assemble(self.result_key, window_start,
+                                                  window_end))
+
+    def test_days_without_results_are_stored_as_empty(self):
+        self.write_fetch(datetime.date(2014, 1, 1), 2, '')
+        self.store.ingest_fetch(self.result_key, datetime.date(2014, 1, 1), 2)
+        self.assertEqual('', self.store.assemble(
+            self.result_key, make_time(2014, 1, 1), make_time(2014, 1, 3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
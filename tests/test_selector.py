@@ -15,7 +15,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
 import datetime
 import itertools
 import json
@@ -30,12 +29,55 @@ import selector
 import utils
 
 
+class SelectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ip_translation_spec = iptranslation.IPTranslationStrategySpec(
+            'maxmind', {'db_snapshots': ['2014-08-04']})
+
+    def create_selector(self, site):
+        return selector.Selector(start_time=datetime.datetime(2014, 2, 1),
+                                 duration=30 * 24 * 60 * 60,
+                                 metric='average_rtt',
+                                 ip_translation_spec=self.ip_translation_spec,
+                                 site=site)
+
+    def testSelectorIsImmutable(self):
+        with self.assertRaises(AttributeError):
+            self.create_selector('lga02').site = 'lga01'
+
+    def testEqualSelectorsDeduplicate(self):
+        selectors = set([self.create_selector('lga02'),
+                         self.create_selector('lga02'),
+                         self.create_selector('lga01')])
+        self.assertEqual(2, len(selectors))
+
+    def testStringFieldsAreInterned(self):
+        selector_a = self.create_selector(u''.join(['lga', '02']))
+        selector_b = self.create_selector(u''.join(['lga', '0', '2']))
+        self.assertIs(selector_a.site, selector_b.site)
+
+    def testNonAsciiStringFieldsAreKept(self):
+        self.assertEqual(u'l\xe9a01', self.create_selector(u'l\xe9a01').site)
+
+
 class SelectorFileParserTest(unittest.TestCase):
 
     def parse_file_contents(self, selector_file_contents):
         parser = selector.SelectorFileParser()
         return parser._parse_file_contents(selector_file_contents)
 
+    def create_expected_selector(self, **fields):
+        """Creates a Selector with the values shared by the test files."""
+        start_time = utils.make_datetime_utc_aware(datetime.datetime(2014, 2,
+                                                                     1))
+        return selector.Selector(
+            start_time=start_time,
+            duration=30 * 24 * 60 * 60,
+            ip_translation_spec=iptranslation.IPTranslationStrategySpec(
+                'maxmind', {'db_snapshots': ['2014-08-04']}),
+            **fields)
+
     def assertSelectorMatches(self, selector_expected, selector_actual):
         self.assertEqual(selector_expected.start_time,
                          selector_actual.start_time)
@@ -50,6 +92,9 @@ class SelectorFileParserTest(unittest.TestCase):
                          selector_actual.client_provider)
         self.assertEqual(selector_expected.client_country,
                          selector_actual.client_country)
+        self.assertEqual(selector_expected.dialect, selector_actual.dialect)
+        self.assertEqual(selector_expected.priority, selector_actual.priority)
+        self.assertEqual(selector_expected.deadline, selector_actual.deadline)
 
     def assertParsedSelectorsMatch(self, selectors_expected,
                                    selector_file_contents):
@@ -135,17 +180,11 @@ class SelectorFileParserTest(unittest.TestCase):
             "start_times": ["2014-02-01T00:00:00Z"]
         }"""
 
-        selector_expected = selector.Selector()
-        selector_expected.start_time = utils.make_datetime_utc_aware(
-            datetime.datetime(2014, 2, 1))
-        selector_expected.duration = 30 * 24 * 60 * 60
-        selector_expected.metric = 'average_rtt'
-        selector_expected.ip_translation_spec = (
-            iptranslation.IPTranslationStrategySpec(
-                'maxmind', {'db_snapshots': ['2014-08-04']}))
-        selector_expected.site = 'lga02'
-        selector_expected.client_provider = 'comcast'
-        selector_expected.client_country = 'us'
+        selector_expected = self.create_expected_selector(
+            metric='average_rtt',
+            site='lga02',
+            client_provider='comcast',
+            client_country='us')
         self.assertParsedSingleSelectorMatches(selector_expected,
                                                selector_file_contents)
 
@@ -166,24 +205,17 @@ class SelectorFileParserTest(unittest.TestCase):
         }"""
 
         selectors_expected = []
-        selector_base = selector.Selector()
-        selector_base.start_time = utils.make_datetime_utc_aware(
-            datetime.datetime(2014, 2, 1))
-        selector_base.duration = 30 * 24 * 60 * 60
-        selector_base.ip_translation_spec = (
-            iptranslation.IPTranslationStrategySpec(
-                'maxmind', {'db_snapshots': ['2014-08-04']}))
+        selector_base = self.create_expected_selector()
         sites = ['lga01', 'lga02']
         client_providers = ['comcast', 'verizon']
         metrics = ['minimum_rtt', 'download_throughput', 'average_rtt']
 
         for client_provider, site, metric in itertools.product(client_providers,
                                                                sites, metrics):
-            selector_copy = copy.copy(selector_base)
-            selector_copy.metric = metric
-            selector_copy.client_provider = client_provider
-            selector_copy.site = site
-            selectors_expected.append(selector_copy)
+            selectors_expected.append(selector_base._replace(
+                metric=metric,
+                client_provider=client_provider,
+                site=site))
 
         self.assertParsedSelectorsMatch(selectors_expected,
                                         selector_file_contents)
@@ -202,14 +234,7 @@ class SelectorFileParserTest(unittest.TestCase):
             "start_times": ["2014-02-01T00:00:00Z"]
         }"""
 
-        selector_expected = selector.Selector()
-        selector_expected.start_time = utils.make_datetime_utc_aware(
-            datetime.datetime(2014, 2, 1))
-        selector_expected.duration = 30 * 24 * 60 * 60
-        selector_expected.metric = 'average_rtt'
-        selector_expected.ip_translation_spec = (
-            iptranslation.IPTranslationStrategySpec(
-                'maxmind', {'db_snapshots': ['2014-08-04']}))
+        selector_expected = self.create_expected_selector(metric='average_rtt')
         self.assertParsedSingleSelectorMatches(selector_expected,
                                                selector_file_contents)
 
@@ -229,19 +254,11 @@ class SelectorFileParserTest(unittest.TestCase):
         }"""
 
         selectors_expected = []
-        selector_base = selector.Selector()
-        selector_base.start_time = utils.make_datetime_utc_aware(
-            datetime.datetime(2014, 2, 1))
-        selector_base.duration = 30 * 24 * 60 * 60
-        selector_base.metric = "average_rtt"
-        selector_base.ip_translation_spec = (
-            iptranslation.IPTranslationStrategySpec(
-                'maxmind', {'db_snapshots': ['2014-08-04']}))
+        selector_base = self.create_expected_selector(metric="average_rtt")
 
         for client_country in ('us', 'ca', 'uk', 'au'):
-            selector_copy = copy.copy(selector_base)
-            selector_copy.client_country = client_country
-            selectors_expected.append(selector_copy)
+            selectors_expected.append(selector_base._replace(
+                client_country=client_country))
 
         self.assertParsedSelectorsMatch(selectors_expected,
                                         selector_file_contents)
@@ -261,15 +278,8 @@ class SelectorFileParserTest(unittest.TestCase):
             "start_times": ["2014-02-01T00:00:00Z"]
         }"""
 
-        selector_expected = selector.Selector()
-        selector_expected.start_time = utils.make_datetime_utc_aware(
-            datetime.datetime(2014, 2, 1))
-        selector_expected.duration = 30 * 24 * 60 * 60
-        selector_expected.metric = 'average_rtt'
-        selector_expected.ip_translation_spec = (
-            iptranslation.IPTranslationStrategySpec(
-                'maxmind', {'db_snapshots': ['2014-08-04']}))
-        selector_expected.site = 'lga02'
+        selector_expected = self.create_expected_selector(metric='average_rtt',
+                                                          site='lga02')
         self.assertParsedSingleSelectorMatches(selector_expected,
                                                selector_file_contents)
 
@@ -289,15 +299,9 @@ class SelectorFileParserTest(unittest.TestCase):
             "start_times": ["2014-02-01T00:00:00Z"]
         }"""
 
-        selector_expected = selector.Selector()
-        selector_expected.start_time = utils.make_datetime_utc_aware(
-            datetime.datetime(2014, 2, 1))
-        selector_expected.duration = 30 * 24 * 60 * 60
-        selector_expected.metric = 'average_rtt'
-        selector_expected.ip_translation_spec = (
-            iptranslation.IPTranslationStrategySpec(
-                'maxmind', {'db_snapshots': ['2014-08-04']}))
-        selector_expected.client_provider = 'comcast'
+        selector_expected = self.create_expected_selector(
+            metric='average_rtt',
+            client_provider='comcast')
         self.assertParsedSingleSelectorMatches(selector_expected,
                                                selector_file_contents)
 
@@ -317,15 +321,8 @@ class SelectorFileParserTest(unittest.TestCase):
             "start_times": ["2014-02-01T00:00:00Z"]
         }"""
 
-        selector_expected = selector.Selector()
-        selector_expected.start_time = utils.make_datetime_utc_aware(
-            datetime.datetime(2014, 2, 1))
-        selector_expected.duration = 30 * 24 * 60 * 60
-        selector_expected.metric = 'average_rtt'
-        selector_expected.ip_translation_spec = (
-            iptranslation.IPTranslationStrategySpec(
-                'maxmind', {'db_snapshots': ['2014-08-04']}))
-        selector_expected.client_country = 'us'
+        selector_expected = self.create_expected_selector(metric='average_rtt',
+                                                          client_country='us')
         self.assertParsedSingleSelectorMatches(selector_expected,
                                                selector_file_contents)
 
@@ -345,15 +342,8 @@ class SelectorFileParserTest(unittest.TestCase):
             "start_times": ["2014-02-01T00:00:00Z"]
         }"""
 
-        selector_expected = selector.Selector()
-        selector_expected.start_time = utils.make_datetime_utc_aware(
-            datetime.datetime(2014, 2, 1))
-        selector_expected.duration = 30 * 24 * 60 * 60
-        selector_expected.metric = 'average_rtt'
-        selector_expected.ip_translation_spec = (
-            iptranslation.IPTranslationStrategySpec(
-                'maxmind', {'db_snapshots': ['2014-08-04']}))
-        selector_expected.client_country = None
+        selector_expected = self.create_expected_selector(metric='average_rtt',
+                                                          client_country=None)
         self.assertParsedSingleSelectorMatches(selector_expected,
                                                selector_file_contents)
 
@@ -390,17 +380,126 @@ class SelectorFileParserTest(unittest.TestCase):
             "start_times": ["2014-02-01T00:00:00Z"]
         }"""
 
-        selector_expected = selector.Selector()
-        selector_expected.start_time = utils.make_datetime_utc_aware(
-            datetime.datetime(2014, 2, 1))
-        selector_expected.duration = 30 * 24 * 60 * 60
-        selector_expected.metric = 'average_rtt'
-        selector_expected.ip_translation_spec = (
-            iptranslation.IPTranslationStrategySpec(
-                'maxmind', {'db_snapshots': ['2014-08-04']}))
+        selector_expected = self.create_expected_selector(metric='average_rtt')
+        self.assertParsedSingleSelectorMatches(selector_expected,
+                                               selector_file_contents)
+
+    def testValidInput_v1dot1_StandardDialect(self):
+        selector_file_contents = """{
+            "file_format_version": 1.1,
+            "duration": "30d",
+            "metrics": ["average_rtt"],
+            "ip_translation":{
+                "strategy":"maxmind",
+                "params":{
+                    "db_snapshots":["2014-08-04"]
+                }
+            },
+            "dialect": "standard",
+            "start_times": ["2014-02-01T00:00:00Z"]
+        }"""
+
+        selector_expected = self.create_expected_selector(metric='average_rtt',
+                                                          dialect='standard')
+        self.assertParsedSingleSelectorMatches(selector_expected,
+                                               selector_file_contents)
+
+    def testFailsParseForUnsupportedDialect(self):
+        selector_file_contents = """{
+            "file_format_version": 1.1,
+            "duration": "30d",
+            "metrics": ["average_rtt"],
+            "ip_translation":{
+                "strategy":"maxmind",
+                "params":{
+                    "db_snapshots":["2014-08-04"]
+                }
+            },
+            "dialect": "sql2011",
+            "start_times": ["2014-02-01T00:00:00Z"]
+        }"""
+
+        self.assertRaises(selector.SelectorParseError, self.parse_file_contents,
+                          selector_file_contents)
+
+    def testValidInput_v1dot1_BatchPriority(self):
+        selector_file_contents = """{
+            "file_format_version": 1.1,
+            "duration": "30d",
+            "metrics": ["average_rtt"],
+            "ip_translation":{
+                "strategy":"maxmind",
+                "params":{
+                    "db_snapshots":["2014-08-04"]
+                }
+            },
+            "priority": "batch",
+            "start_times": ["2014-02-01T00:00:00Z"]
+        }"""
+
+        selector_expected = self.create_expected_selector(metric='average_rtt',
+                                                          priority='batch')
         self.assertParsedSingleSelectorMatches(selector_expected,
                                                selector_file_contents)
 
+    def testValidInput_v1dot1_Deadline(self):
+        selector_file_contents = """{
+            "file_format_version": 1.1,
+            "duration": "30d",
+            "metrics": ["average_rtt"],
+            "ip_translation":{
+                "strategy":"maxmind",
+                "params":{
+                    "db_snapshots":["2014-08-04"]
+                }
+            },
+            "deadline": "1h30m",
+            "start_times": ["2014-02-01T00:00:00Z"]
+        }"""
+
+        selector_expected = self.create_expected_selector(metric='average_rtt',
+                                                          deadline=5400)
+        self.assertParsedSingleSelectorMatches(selector_expected,
+                                               selector_file_contents)
+
+    def testFailsParseForUnsupportedDeadline(self):
+        # Deadlines must be positive durations, not numbers of seconds.
+        for deadline_json in ('3600', '"0s"'):
+            selector_file_contents = """{
+                "file_format_version": 1.1,
+                "duration": "30d",
+                "metrics": ["average_rtt"],
+                "ip_translation":{
+                    "strategy":"maxmind",
+                    "params":{
+                        "db_snapshots":["2014-08-04"]
+                    }
+                },
+                "deadline": %s,
+                "start_times": ["2014-02-01T00:00:00Z"]
+            }""" % deadline_json
+
+            self.assertRaises(selector.SelectorParseError,
+                              self.parse_file_contents, selector_file_contents)
+
+    def testFailsParseForUnsupportedPriority(self):
+        selector_file_contents = """{
+            "file_format_version": 1.1,
+            "duration": "30d",
+            "metrics": ["average_rtt"],
+            "ip_translation":{
+                "strategy":"maxmind",
+                "params":{
+                    "db_snapshots":["2014-08-04"]
+                }
+            },
+            "priority": "urgent",
+            "start_times": ["2014-02-01T00:00:00Z"]
+        }"""
+
+        self.assertRaises(selector.SelectorParseError, self.parse_file_contents,
+                          selector_file_contents)
+
     def testFailsParseForInvalidJson(self):
         selector_file_contents = """{
    "file_format_version": 1.1,
@@ -475,6 +574,8 @@ class MultiSelectorJsonEncoderTest(unittest.TestCase):
         s.metrics = ['download_throughput', 'upload_throughput', 'minimum_rtt']
         s.ip_translation_spec = (iptranslation.IPTranslationStrategySpec(
             'maxmind', {'db_snapshots': ['2015-02-05']}))
+        s.dialect = 'standard'
+        s.deadline = 5400
 
         encoded_expected = """
 {
@@ -489,6 +590,8 @@ class MultiSelectorJsonEncoderTest(unittest.TestCase):
   },
   "sites": ["iad01", "lga06", "mia01", "nuq03"],
   "client_providers": ["comcast", "twc", "verizon"],
+  "dialect": "standard",
+  "deadline": "5400s",
   "start_times": ["2015-04-01T00:00:00Z",
                   "2015-04-08T00:00:00Z",
                   "2015-04-15T00:00:00Z"]
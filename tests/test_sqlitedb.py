@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope')))
+import sqlitedb
+
+
+class TransactTest(unittest.TestCase):
+
+    def setUp(self):
+        self.database_dir = tempfile.mkdtemp()
+        self.database_filepath = os.path.join(self.database_dir, 'test.db')
+        sqlitedb.create_schema(
+            self.database_filepath,
+            'CREATE TABLE IF NOT EXISTS items (name TEXT NOT NULL);')
+
+    def tearDown(self):
+        shutil.rmtree(self.database_dir)
+
+    def insert_item(self):
+
+        def insert(cursor):
+            cursor.execute("INSERT INTO items (name) VALUES ('a')")
+
+        sqlitedb.transact(self.database_filepath, insert)
+
+    def count_items(self):
+
+        def count(cursor):
+            return cursor.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+
+        return sqlitedb.transact(self.database_filepath, count)
+
+    def test_transaction_is_committed(self):
+        self.insert_item()
+
+        self.assertEqual(1, self.count_items())
+
+    def test_failed_transaction_is_rolled_back(self):
+
+        def insert_then_fail(cursor):
+            cursor.execute("INSERT INTO items (name) VALUES ('a')")
+            raise ValueError('Operation failed.')
+
+        self.assertRaises(ValueError, sqlitedb.transact, self.database_filepath,
+                          insert_then_fail)
+        self.assertEqual(0, self.count_items())
+
+    def test_creating_schema_again_keeps_rows(self):
+        self.insert_item()
+        sqlitedb.create_schema(
+            self.database_filepath,
+            'CREATE TABLE IF NOT EXISTS items (name TEXT NOT NULL);')
+
+        self.assertEqual(1, self.count_items())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,580 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import datetime
+import imp
+import os
+import Queue
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import mock
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope')))
+import hedging
+import iptranslation
+import jobstore
+import projectpool
+import query
+import resultstore
+import selector
+import utils
+import workqueue
+
+# When tests are discovered from the repository root, the telescope package
+# shadows the telescope module, so the module is loaded from its path.
+telescope = imp.load_source('telescope_module', os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope/telescope.py')))
+
+
+def create_selectors(selector_count):
+    first_day = utils.make_datetime_utc_aware(datetime.datetime(2014, 1, 1))
+    return [selector.Selector(
+        start_time=first_day + datetime.timedelta(days=day),
+        duration=24 * 60 * 60,
+        metric='minimum_rtt',
+        ip_translation_spec=iptranslation.IPTranslationStrategySpec(
+            'maxmind', {'db_snapshots': ['2014-08-04']}),
+        client_provider='comcast',
+        site='lga01') for day in range(selector_count)]
+
+
+class ParseArgsTest(unittest.TestCase):
+
+    def test_run_plan_needs_no_selector_files(self):
+        args = telescope.parse_args(['--runplan', 'plan.jsonl', '--planfilter',
+                                     'site=lga01', '--planshard', '1/4'])
+
+        self.assertEqual('plan.jsonl', args.runplan)
+        self.assertEqual(['site=lga01'], args.planfilter)
+        self.assertEqual('1/4', args.planshard)
+
+    @mock.patch.object(sys, 'stderr')
+    def test_selector_files_are_otherwise_required(self, _):
+        self.assertRaises(SystemExit, telescope.parse_args, [])
+        self.assertEqual(['a.json', 'b.json'],
+                         telescope.parse_args(['a.json', 'b.json']).selector_in)
+
+
+class GenerateQueriesTest(unittest.TestCase):
+
+    def setUp(self):
+        mock_translator = mock.Mock()
+        mock_translator.find_ip_blocks.return_value = [(5, 10), (20, 30)]
+        self.mock_translator_factory = mock.Mock()
+        self.mock_translator_factory.create.return_value = mock_translator
+        self.mock_site_resolver = mock.Mock()
+        self.mock_site_resolver.get_site_ndt_ips.return_value = ['1.0.0.1']
+        self.selectors = create_selectors(100)
+
+    def generate_query_strings(self, process_count):
+        return [bq_query_string
+                for bq_query_string, _ in telescope.generate_queries(
+                    self.selectors, self.mock_translator_factory,
+                    self.mock_site_resolver, query.BigQueryQueryTemplateCache(),
+                    None, 'resources/', process_count)]
+
+    def test_process_pool_generates_same_queries_in_order(self):
+        serial_queries = self.generate_query_strings(1)
+
+        self.assertEqual(100, len(serial_queries))
+        # The first and last selectors start on 2014-01-01 and 2014-04-10.
+        self.assertIn('>= 1388534400', serial_queries[0])
+        self.assertIn('>= 1397088000', serial_queries[-1])
+        self.assertEqual(serial_queries, self.generate_query_strings(3))
+
+    def test_generation_times_are_reported(self):
+        for _, generation_seconds in telescope.generate_queries(
+                self.selectors[:3], self.mock_translator_factory,
+                self.mock_site_resolver, None, None, 'resources/'):
+            self.assertGreaterEqual(generation_seconds, 0)
+
+
+class ExecuteSelectorQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.process_selector_queue_patch = mock.patch.object(
+            telescope, 'process_selector_queue')
+        self.mock_process_selector_queue = (
+            self.process_selector_queue_patch.start())
+        self.processed_queries = []
+
+        def process_selector_queue(selector_queue,
+                                   google_auth_config,
+                                   job_store=None,
+                                   straggler_policy=None,
+                                   completion_callback=None):
+            while not selector_queue.empty():
+                self.processed_queries.append(selector_queue.get(False)[0])
+            return []
+
+        self.mock_process_selector_queue.side_effect = process_selector_queue
+
+    def tearDown(self):
+        self.process_selector_queue_patch.stop()
+
+    def test_waits_for_queries_until_generation_is_done(self):
+        selector_queue = Queue.Queue()
+        generation_done = threading.Event()
+
+        def generate():
+            for query_index in range(3):
+                selector_queue.put(('query %d' % query_index, {}, None, False))
+            generation_done.set()
+
+        with mock.patch.object(telescope, 'GENERATION_POLL_SECONDS', 0.01):
+            generation_timer = threading.Timer(0.05, generate)
+            generation_timer.start()
+            telescope.execute_selector_queue(selector_queue, None,
+                                             generation_done)
+            generation_timer.join()
+
+        self.assertEqual(['query 0', 'query 1', 'query 2'],
+                         self.processed_queries)
+
+    def test_returns_once_queue_is_empty_without_generation(self):
+        selector_queue = Queue.Queue()
+        selector_queue.put(('query', {}, None, False))
+
+        telescope.execute_selector_queue(selector_queue, None)
+
+        self.assertEqual(['query'], self.processed_queries)
+
+    def test_retries_without_waiting_for_slow_jobs(self):
+        selector_queue = Queue.Queue()
+        selector_queue.put(('slow', {}, None, False))
+        selector_queue.put(('flaky', {}, None, False))
+        slow_job_released = threading.Event()
+        released_before_timeout = []
+
+        def run_job(external_query_handler, completion_callback):
+            if external_query_handler.queue_set[0] == 'slow':
+                released_before_timeout.append(slow_job_released.wait(5))
+            completion_callback(external_query_handler)
+
+        def process_selector_queue(selector_queue,
+                                   google_auth_config,
+                                   job_store=None,
+                                   straggler_policy=None,
+                                   completion_callback=None):
+            thread_monitor = []
+            while not selector_queue.empty():
+                queue_set = selector_queue.get(False)
+                self.processed_queries.append(queue_set[0])
+                # The first attempt of the flaky query neither succeeds nor
+                # fails, and its retry releases the slow job.
+                if queue_set[3]:
+                    slow_job_released.set()
+                external_query_handler = mock.Mock(
+                    queue_set=queue_set[:3] + (True,),
+                    has_succeeded=queue_set[0] == 'slow' or queue_set[3],
+                    has_failed=False)
+                job_thread = threading.Thread(
+                    target=run_job,
+                    args=(external_query_handler, completion_callback))
+                job_thread.start()
+                thread_monitor.append((job_thread, external_query_handler))
+            return thread_monitor
+
+        self.mock_process_selector_queue.side_effect = process_selector_queue
+
+        telescope.execute_selector_queue(selector_queue, None)
+
+        self.assertEqual(['slow', 'flaky', 'flaky'], self.processed_queries)
+        self.assertEqual([True], released_before_timeout)
+
+
+class IsOutputCachedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.job_store = jobstore.SQLiteJobStore(os.path.join(self.store_dir,
+                                                              'jobs.db'))
+        self.thread_metadata = {'site': 'lga01', 'metric': 'minimum_rtt'}
+        self.job_store.record_queued(
+            jobstore.create_selector_key(self.thread_metadata), 'a-raw.csv',
+            'SELECT 1')
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    @mock.patch.object(utils, 'check_for_valid_cache')
+    def test_job_store_decides_for_finished_selectors(
+            self, mock_check_for_valid_cache):
+        selector_key = jobstore.create_selector_key(self.thread_metadata)
+        self.job_store.record_state(selector_key, jobstore.DOWNLOADED)
+        self.assertTrue(telescope.is_output_cached(self.thread_metadata,
+                                                   'a-raw.csv', self.job_store))
+        self.assertFalse(telescope.is_output_cached(
+            self.thread_metadata, 'b-raw.csv', self.job_store))
+        self.job_store.record_state(selector_key, jobstore.FAILED)
+        self.assertFalse(telescope.is_output_cached(
+            self.thread_metadata, 'a-raw.csv', self.job_store))
+        self.assertFalse(mock_check_for_valid_cache.called)
+
+    @mock.patch.object(utils, 'check_for_valid_cache')
+    def test_output_directory_decides_for_unfinished_selectors(
+            self, mock_check_for_valid_cache):
+        mock_check_for_valid_cache.return_value = True
+        self.job_store.record_state(
+            jobstore.create_selector_key(self.thread_metadata),
+            jobstore.RUNNING)
+
+        self.assertTrue(telescope.is_output_cached(self.thread_metadata,
+                                                   'a-raw.csv', self.job_store))
+        mock_check_for_valid_cache.assert_called_once_with('a-raw.csv')
+
+    @mock.patch.object(utils, 'check_for_valid_cache')
+    def test_output_directory_decides_for_unknown_selectors(
+            self, mock_check_for_valid_cache):
+        mock_check_for_valid_cache.return_value = True
+
+        self.assertTrue(telescope.is_output_cached({'site': 'mia01'},
+                                                   'b-raw.csv', self.job_store))
+        mock_check_for_valid_cache.assert_called_once_with('b-raw.csv')
+
+
+class CompilePlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.store_dir = os.path.join(self.temp_dir, 'store')
+        self.result_store = resultstore.DailyResultStore(self.store_dir)
+        self.pending_selectors = [
+            (data_selector, os.path.join(self.temp_dir, '%d-raw.csv' % index))
+            for index, data_selector in enumerate(create_selectors(3))
+        ]
+        self.store_fetches = telescope.plan_result_store_fetches(
+            [data_selector for data_selector, _ in self.pending_selectors],
+            self.result_store)
+        query_selectors = [
+            (fetch_selector, self.result_store.build_fetch_filepath(
+                result_key, first_day, day_count))
+            for fetch_selector, result_key, first_day, day_count in
+            self.store_fetches
+        ]
+        timed_queries = [('SELECT 1', 0.0)] * len(query_selectors)
+        self.compiled_plan = telescope.compile_plan(
+            self.pending_selectors, query_selectors, timed_queries,
+            self.store_fetches, self.store_dir)
+
+    def test_assemblies_depend_on_fetch_of_their_days(self):
+        self.assertEqual(1, len(self.compiled_plan.query_steps))
+        fetch_step = self.compiled_plan.query_steps[0]
+        self.assertEqual(3, fetch_step.fetch[2])
+        self.assertEqual([(fetch_step.step_id,)] * 3, [
+            assembly_step.depends_on
+            for assembly_step in self.compiled_plan.assembly_steps
+        ])
+
+    def test_assemblies_are_written_from_retrieved_fetch(self):
+        # Rows on 2014-01-01, 2014-01-02 and 2014-01-03.
+        with open(self.compiled_plan.query_steps[0].output_path,
+                  'w') as fetch_file:
+            fetch_file.write('1388534400,1.0\n1388620800,2.0\n'
+                             '1388707200,3.0\n')
+
+        telescope.finish_plan_assemblies(self.compiled_plan, self.result_store)
+
+        with open(self.pending_selectors[1][1]) as output_file:
+            self.assertEqual('1388620800,2.0\n', output_file.read())
+
+
+class SelectorStragglerPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.straggler_policy = hedging.StragglerPolicy(deadline_seconds=600.0)
+
+    def test_selector_without_deadline_uses_run_policy(self):
+        self.assertIs(self.straggler_policy,
+                      telescope.selector_straggler_policy(
+                          {'site': 'lga01'}, self.straggler_policy))
+        self.assertIsNone(telescope.selector_straggler_policy({'site': 'lga01'},
+                                                              None))
+
+    def test_selector_deadline_replaces_run_deadline(self):
+        data_selector = selector.Selector(start_time=datetime.datetime(2014, 1,
+                                                                       1),
+                                          duration=86400,
+                                          metric='minimum_rtt',
+                                          site='lga01',
+                                          deadline=60)
+        thread_metadata = telescope.build_thread_metadata(data_selector)
+
+        for straggler_policy in (self.straggler_policy, None):
+            policy = telescope.selector_straggler_policy(thread_metadata,
+                                                         straggler_policy)
+            self.assertFalse(policy.is_past_deadline(59.0))
+            self.assertTrue(policy.is_past_deadline(60.0))
+
+
+class ClaimNextSubmissionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.project_pool = projectpool.ProjectPool(
+            [mock.Mock(project_id='project_a')],
+            max_jobs_per_project=1,
+            max_batch_jobs_per_project=1,
+            default_priority=projectpool.BATCH)
+        self.selector_queue = Queue.Queue()
+        self.held_queue_sets = dict((priority, collections.deque())
+                                    for priority in projectpool.PRIORITIES)
+
+    def claim_next_query(self):
+        queue_set, _ = telescope.claim_next_submission(
+            self.selector_queue, self.held_queue_sets, self.project_pool)
+        return queue_set[0] if queue_set else None
+
+    def test_full_lane_does_not_delay_other_lane(self):
+        for bq_query_string, priority in (('batch 1', None),
+                                          ('batch 2', 'batch'),
+                                          ('interactive', 'interactive')):
+            self.selector_queue.put((bq_query_string, {'priority': priority},
+                                     None, False))
+
+        self.assertEqual('batch 1', self.claim_next_query())
+        self.assertEqual('interactive', self.claim_next_query())
+        self.assertEqual(['batch 2'], [
+            queue_set[0]
+            for queue_set in self.held_queue_sets[projectpool.BATCH]
+        ])
+
+    def test_no_submission_once_queue_is_empty(self):
+        self.assertIsNone(self.claim_next_query())
+
+
+class ProcessSelectorQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        # Sleeping advances a fake clock, so that cooldowns pass at once.
+        self.clock = 0.0
+        self.time_patch = mock.patch.object(telescope.time,
+                                            'time',
+                                            side_effect=lambda: self.clock)
+        self.time_patch.start()
+        self.sleep_patch = mock.patch.object(telescope.time,
+                                             'sleep',
+                                             side_effect=self.advance_clock)
+        self.sleep_patch.start()
+
+    def tearDown(self):
+        self.sleep_patch.stop()
+        self.time_patch.stop()
+
+    def advance_clock(self, seconds):
+        self.clock += seconds
+
+    @mock.patch.object(telescope.external, 'get_authenticated_service')
+    @mock.patch.object(telescope.external, 'BigQueryCall')
+    def test_query_is_submitted_once_more_after_request_error(
+            self, mock_bigquery_call, mock_get_service):
+        mock_run_query = mock_bigquery_call.return_value.run_asynchronous_query
+        mock_run_query.side_effect = [
+            telescope.external.BigQueryCommunicationError('Failed', None),
+            'job_1'
+        ]
+        selector_queue = Queue.Queue()
+        selector_queue.put(('SELECT 1', {'site': 'lga01',
+                                         'metric': 'minimum_rtt'}, 'a-raw.csv',
+                            False))
+
+        thread_monitor = telescope.process_selector_queue(
+            selector_queue,
+            projectpool.ProjectPool([mock.Mock(project_id='project_a')]))
+        for job_thread, _ in thread_monitor:
+            job_thread.join()
+
+        self.assertEqual(2, mock_run_query.call_count)
+        self.assertEqual(1, len(thread_monitor))
+        self.assertTrue(selector_queue.empty())
+
+    @mock.patch.object(telescope.external, 'get_authenticated_service')
+    @mock.patch.object(telescope.external, 'BigQueryCall')
+    def test_request_error_does_not_delay_other_queries(
+            self, mock_bigquery_call, mock_get_service):
+        submissions = []
+
+        def run_query(bq_query_string, priority):
+            submissions.append((bq_query_string, self.clock))
+            if len(submissions) == 1:
+                raise telescope.external.BigQueryCommunicationError('Failed',
+                                                                    None)
+            return 'job_%d' % len(submissions)
+
+        mock_bigquery_call.return_value.run_asynchronous_query.side_effect = (
+            run_query)
+        selector_queue = Queue.Queue()
+        for bq_query_string in ('SELECT 1', 'SELECT 2'):
+            selector_queue.put((bq_query_string, {'site': 'lga01',
+                                                  'metric': 'minimum_rtt'},
+                                'a-raw.csv', False))
+
+        thread_monitor = telescope.process_selector_queue(
+            selector_queue,
+            projectpool.ProjectPool([mock.Mock(project_id='project_a')]))
+        for job_thread, _ in thread_monitor:
+            job_thread.join()
+
+        self.assertEqual([('SELECT 1', 0.0), ('SELECT 2', 0.0)],
+                         submissions[:2])
+        self.assertEqual('SELECT 1', submissions[2][0])
+        self.assertGreaterEqual(submissions[2][1],
+                                telescope.REQUEST_ERROR_COOLDOWN_SECONDS)
+
+
+class RunWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue_dir = tempfile.mkdtemp()
+        self.work_queue = workqueue.SQLiteWorkQueue(os.path.join(self.queue_dir,
+                                                                 'queue.db'))
+        self.process_selector_queue_patch = mock.patch.object(
+            telescope, 'process_selector_queue')
+        self.mock_process_selector_queue = (
+            self.process_selector_queue_patch.start())
+        self.mock_process_selector_queue.side_effect = (
+            self.process_selector_queue)
+        self.attempts_by_query = {}
+        self.job_stores = []
+
+    def tearDown(self):
+        self.process_selector_queue_patch.stop()
+        shutil.rmtree(self.queue_dir)
+
+    def process_selector_queue(self,
+                               selector_queue,
+                               google_auth_config,
+                               job_store=None,
+                               straggler_policy=None,
+                               completion_callback=None):
+        """Succeeds, fails or retries each query according to its text.
+
+        The jobs of queries whose text is 'hang' never finish.
+        """
+        self.job_stores.append(job_store)
+        thread_monitor = []
+        while not selector_queue.empty():
+            queue_set = selector_queue.get(False)
+            bq_query_string = queue_set[0]
+            attempts = self.attempts_by_query.get(bq_query_string, 0) + 1
+            self.attempts_by_query[bq_query_string] = attempts
+            mock_handler = mock.Mock()
+            mock_handler.queue_set = queue_set
+            mock_handler.has_succeeded = (
+                bq_query_string == 'succeed' or
+                (bq_query_string == 'retry' and attempts > 1))
+            mock_handler.has_failed = bq_query_string == 'fail'
+            thread_monitor.append((mock.Mock(), mock_handler))
+            if bq_query_string != 'hang':
+                completion_callback(mock_handler)
+        return thread_monitor
+
+    def test_worker_reports_outcomes_until_queue_is_finished(self):
+        self.work_queue.publish([('succeed', {}, 'succeed.csv'),
+                                 ('fail', {}, 'fail.csv'),
+                                 ('retry', {}, 'retry.csv')])
+        self.work_queue.close()
+
+        with mock.patch.object(telescope, 'WORK_QUEUE_POLL_SECONDS', 0):
+            telescope.run_worker(self.work_queue, None, 'worker_a')
+
+        self.assertEqual({'succeed': 1,
+                          'fail': 1,
+                          'retry': 2}, self.attempts_by_query)
+        self.assertEqual({'pending': 0,
+                          'leased': 0,
+                          'succeeded': 2,
+                          'failed': 1}, self.work_queue.count_states())
+
+    def test_worker_records_jobs_in_job_store(self):
+        job_store = jobstore.SQLiteJobStore(os.path.join(self.queue_dir,
+                                                         'jobs.db'))
+        self.work_queue.publish([('succeed', {'site': 'lga01'}, 'lga01.csv'),
+                                 ('succeed', {'site': 'mia01'}, 'mia01.csv')])
+        self.work_queue.close()
+
+        with mock.patch.object(telescope, 'WORK_QUEUE_POLL_SECONDS', 0):
+            telescope.run_worker(self.work_queue,
+                                 None,
+                                 'worker_a',
+                                 job_store=job_store)
+
+        self.assertEqual([job_store], self.job_stores)
+        self.assertEqual(['lga01.csv', 'mia01.csv'],
+                         sorted(job.output_path
+                                for job in job_store.list_jobs()))
+
+    def test_worker_claims_query_as_each_query_finishes(self):
+        self.work_queue.publish([('hang', {}, 'hang.csv'),
+                                 ('succeed', {}, 'a.csv'),
+                                 ('succeed', {}, 'b.csv')])
+        self.work_queue.close()
+        claim_counts = []
+        claim = self.work_queue.claim
+
+        def claim_once_more(worker_id, count):
+            claim_counts.append(count)
+            if len(claim_counts) > 3:
+                raise KeyboardInterrupt
+            return claim(worker_id, count)
+
+        with mock.patch.object(self.work_queue, 'claim') as mock_claim:
+            mock_claim.side_effect = claim_once_more
+            with mock.patch.object(telescope, 'WORK_QUEUE_POLL_SECONDS', 0):
+                self.assertRaises(KeyboardInterrupt, telescope.run_worker,
+                                  self.work_queue, None, 'worker_a', 2)
+
+        # The hanging query holds one of the two slots, and each finished
+        # query frees the other for the next item.
+        self.assertEqual([2, 1, 1, 1], claim_counts)
+        self.assertEqual({'pending': 1,
+                          'leased': 0,
+                          'succeeded': 2,
+                          'failed': 0}, self.work_queue.count_states())
+
+    def test_interrupted_worker_releases_unfinished_items(self):
+        self.work_queue.publish([('succeed', {}, 'succeed.csv'),
+                                 ('hang', {}, 'hang.csv')])
+
+        get = telescope.Queue.Queue.get
+
+        def interrupt_wait(queue, block=True, timeout=None):
+            if block:
+                raise KeyboardInterrupt
+            return get(queue, block, timeout)
+
+        with mock.patch.object(telescope.Queue.Queue,
+                               'get',
+                               autospec=True) as mock_get:
+            mock_get.side_effect = interrupt_wait
+            self.assertRaises(KeyboardInterrupt, telescope.run_worker,
+                              self.work_queue, None, 'worker_a')
+
+        self.assertEqual({'pending': 1,
+                          'leased': 0,
+                          'succeeded': 1,
+                          'failed': 0}, self.work_queue.count_states())
+
+
+if __name__ == '__main__':
+    unittest.main()
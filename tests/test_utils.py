@@ -16,7 +16,9 @@
 # limitations under the License.
 
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 sys.path.insert(1, os.path.abspath(os.path.join(
@@ -39,6 +41,26 @@ class UtilsTest(unittest.TestCase):
         self.assertEquals('spaces are okay.csv',
                           utils.strip_special_chars('spaces are okay.csv'))
 
+    def testCalculatePercentile(self):
+        values = [5, 1, 4, 2, 3]
+        self.assertEqual(1, utils.calculate_percentile(values, 0))
+        self.assertEqual(3, utils.calculate_percentile(values, 50))
+        self.assertEqual(5, utils.calculate_percentile(values, 95))
+        self.assertEqual(5, utils.calculate_percentile(values, 100))
+        self.assertEqual(2, utils.calculate_percentile(range(1, 101), 1.5))
+
+    def testWriteFileAtomically(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        output_filepath = os.path.join(output_dir, 'output.csv')
+
+        utils.write_file_atomically(output_filepath, 'old')
+        utils.write_file_atomically(output_filepath, 'new')
+
+        with open(output_filepath) as output_file:
+            self.assertEquals('new', output_file.read())
+        self.assertEquals(['output.csv'], os.listdir(output_dir))
+
     def testFilenameBuilder_CompleteParameterSet(self):
         fake_filepath = utils.build_filename('/tmp/path/', '2014-02-01', '30d',
                                              'iad01', 'comcast', 'us',
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mock
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../telescope')))
+import workqueue
+
+
+class SQLiteWorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue_dir = tempfile.mkdtemp()
+        self.queue_filepath = os.path.join(self.queue_dir, 'queue.db')
+        self.time_patch = mock.patch.object(workqueue.time, 'time')
+        self.mock_time = self.time_patch.start()
+        self.mock_time.return_value = 1000.0
+        self.work_queue = workqueue.SQLiteWorkQueue(self.queue_filepath,
+                                                    lease_seconds=60,
+                                                    max_attempts=2)
+        self.work_queue.publish([
+            ('SELECT 1', {'site': 'lga01'}, 'lga01.csv'),
+            ('SELECT 2', {'site': 'mia01'}, 'mia01.csv'),
+        ])
+
+    def tearDown(self):
+        self.time_patch.stop()
+        shutil.rmtree(self.queue_dir)
+
+    def test_claimed_items_are_leased_to_one_worker(self):
+        work_items = self.work_queue.claim('worker_a', count=1)
+
+        self.assertEqual(1, len(work_items))
+        self.assertEqual('SELECT 1', work_items[0].bq_query_string)
+        self.assertEqual({'site': 'lga01'}, work_items[0].thread_metadata)
+        self.assertEqual('lga01.csv', work_items[0].data_filepath)
+        self.assertEqual(1, work_items[0].attempts)
+        self.assertEqual(['SELECT 2'], [
+            work_item.bq_query_string
+            for work_item in self.work_queue.claim('worker_b',
+                                                   count=5)
+        ])
+        self.assertEqual([], self.work_queue.claim('worker_c', count=5))
+
+    def test_queue_is_shared_between_instances(self):
+        self.work_queue.claim('worker_a', count=1)
+        other_work_queue = workqueue.SQLiteWorkQueue(self.queue_filepath)
+
+        self.assertEqual({'pending': 1,
+                          'leased': 1,
+                          'succeeded': 0,
+                          'failed': 0}, other_work_queue.count_states())
+
+    def test_expired_lease_is_reclaimed(self):
+        work_item = self.work_queue.claim('worker_a', count=1)[0]
+        self.mock_time.return_value = 1061.0
+
+        reclaimed_items = self.work_queue.claim('worker_b', count=1)
+
+        self.assertEqual(work_item.item_id, reclaimed_items[0].item_id)
+        self.assertEqual(2, reclaimed_items[0].attempts)
+        # The first worker no longer holds the lease.
+        self.assertFalse(self.work_queue.complete('worker_a', work_item.item_id,
+                                                  True))
+        self.assertTrue(self.work_queue.complete('worker_b', work_item.item_id,
+                                                 True))
+
+    def test_heartbeat_extends_lease(self):
+        work_item = self.work_queue.claim('worker_a', count=1)[0]
+        self.mock_time.return_value = 1050.0
+        self.assertEqual(1, self.work_queue.heartbeat('worker_a',
+                                                      [work_item.item_id]))
+        self.mock_time.return_value = 1100.0
+
+        self.assertEqual(['SELECT 2'], [
+            reclaimed_item.bq_query_string
+            for reclaimed_item in self.work_queue.claim('worker_b',
+                                                        count=5)
+        ])
+
+    def test_items_fail_after_max_attempts(self):
+        self.work_queue.claim('worker_a', count=1)
+        self.mock_time.return_value = 1061.0
+        self.work_queue.claim('worker_b', count=1)
+        self.mock_time.return_value = 1122.0
+
+        self.assertEqual(['SELECT 2'], [
+            work_item.bq_query_string
+            for work_item in self.work_queue.claim('worker_c',
+                                                   count=5)
+        ])
+        self.assertEqual(1, self.work_queue.count_states()['failed'])
+
+    def test_released_items_are_claimable_again(self):
+        work_item = self.work_queue.claim('worker_a', count=1)[0]
+
+        self.assertTrue(self.work_queue.release('worker_a', work_item.item_id))
+        self.assertEqual([work_item.item_id, work_item.item_id + 1], [
+            claimed_item.item_id
+            for claimed_item in self.work_queue.claim('worker_b',
+                                                      count=5)
+        ])
+
+    def test_queue_finishes_once_closed_and_every_item_finished(self):
+        work_items = self.work_queue.claim('worker_a', count=5)
+        self.work_queue.complete('worker_a', work_items[0].item_id, True)
+        self.work_queue.complete('worker_a', work_items[1].item_id, False)
+        self.assertFalse(self.work_queue.is_finished())
+
+        self.work_queue.close()
+
+        self.assertTrue(self.work_queue.is_finished())
+        self.assertEqual({'pending': 0,
+                          'leased': 0,
+                          'succeeded': 1,
+                          'failed': 1}, self.work_queue.count_states())
+
+
+if __name__ == '__main__':
+    unittest.main()